@@ -0,0 +1,5 @@
+"""Shared helpers used by the step 01-03 scripts.
+
+The step scripts are run directly (``python script.py``), so each of them puts
+the repository root on ``sys.path`` before importing from this package.
+"""
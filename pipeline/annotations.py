@@ -0,0 +1,126 @@
+"""Loading the step 03 outputs and step 04 human annotations under one schema.
+
+The CSVs use different column names per source ("Title" vs "Title of article",
+"Sl.No" vs "Sl.no", ...). ``load_annotations`` renames them to the JSON keys
+the step 03 prompts use, so any comparison can work on canonical names.
+"""
+import re
+
+import pandas as pd
+
+# Canonical name -> column headers seen across the step 03/04 CSVs
+COLUMN_ALIASES = {
+    "sl_no": ["Sl.no", "Sl.No", "Sl. No"],
+    "authors": ["Authors"],
+    "year": ["Year of publication", "Publication Year"],
+    "title": ["Title", "Title of article"],
+    "journal": ["Name of Publication/Journal", "Name of publication", "Journal/Book"],
+    "primary_author_affiliation": ["Primary affiliation of primary author"],
+    "publication_types": ["Type of evidence source", "Type of Evidence Source"],
+    "virology_subdomain": ["Subdomain"],
+    "disease_name": ["Disease Name"],
+    "research_aim": ["Research Aim"],
+    "research_problem": ["Research Problem"],
+    "ai_objective": ["AI Objective"],
+    "ai_methodology": ["AI Methodology"],
+    "ai_method_details": ["AI Method Details"],
+    "ai_method_type": ["AI Method Type"],
+    "software_released": ["Was software released?", "Is software publicly released?",
+                          "Is the software publicly released?"],
+    "software_license": ["What was the license?", "Software License", "software license"],
+    "virology_task": ["Virology sub-task addressed", "Virology AI task addressed"],
+    "type_of_underlying_data": ["Type of Underlying Data"],
+    "dataset_name": ["Dataset Name"],
+    "was_performance_measured": ["Was performance measured?", "Was Performance Measured"],
+    "performance_measurement_details": [
+        "How was it measured and what was being measured?",
+        "How was Performance measured and What was measured?",
+        "How was Performance measured?",
+        "Performance Measurement Details",
+    ],
+    "performance_metrics": ["performance metrics", "Performance Metrics"],
+    "performance_results": ["Performance score", "Performance Results"],
+    "doi": ["doi", "DOI"],
+    "pmcid": ["PMCID"],
+    "pmid": ["PMID"],
+    "abstract": ["Abstract"],
+}
+
+# Fields the step 03 prompts ask the LLM for
+LLM_FIELDS = [
+    "research_aim", "research_problem", "ai_objective", "ai_methodology",
+    "ai_method_details", "ai_method_type", "type_of_underlying_data", "dataset_name",
+    "disease_name", "virology_subdomain", "was_performance_measured",
+    "performance_results", "performance_measurement_details",
+]
+
+
+def _header_key(name):
+    return re.sub(r"[^a-z0-9]+", " ", str(name).lower()).strip()
+
+
+_ALIAS_LOOKUP = {_header_key(alias): canonical
+                 for canonical, aliases in COLUMN_ALIASES.items() for alias in aliases}
+
+
+def column_map(columns):
+    """Canonical name -> actual header for the known columns among ``columns``."""
+    mapping = {}
+    for column in columns:
+        canonical = _ALIAS_LOOKUP.get(_header_key(column))
+        if canonical and canonical not in mapping:
+            mapping[canonical] = column
+    return mapping
+
+
+def read_csv_any(path):
+    """Read a CSV that may be UTF-8 or Latin-1 encoded (the step 04 files are mixed)."""
+    try:
+        return pd.read_csv(path, encoding="utf-8")
+    except UnicodeDecodeError:
+        return pd.read_csv(path, encoding="ISO-8859-1")
+
+
+def normalize_columns(df):
+    """Rename known headers to their canonical names and drop empty unnamed columns."""
+    renamed = {column: canonical for canonical, column in column_map(df.columns).items()}
+    df = df.rename(columns=renamed)
+    unnamed = [c for c in df.columns if str(c).startswith("Unnamed") and df[c].isna().all()]
+    return df.drop(columns=unnamed)
+
+
+def normalize_title(title):
+    """Lower-case alphanumeric form of a title, used to align records across files."""
+    if not isinstance(title, str):
+        return ""
+    return re.sub(r"[^a-z0-9]+", " ", title.lower()).strip()
+
+
+def load_annotations(path, metadata_path=None, fill_columns=("pmid", "pmcid", "doi")):
+    """Load a step 03/04 CSV with canonical column names.
+
+    Args:
+        path (str): Path to the annotated or extracted CSV.
+        metadata_path (str): Optional step 02 output (with PMID/PMCID/DOI columns)
+            used to fill in identifiers by matching titles.
+        fill_columns (tuple): Canonical columns taken from ``metadata_path``
+            (e.g. add ``"abstract"``).
+
+    Returns:
+        pd.DataFrame: The records with canonical columns and a ``title_key`` column.
+    """
+    df = normalize_columns(read_csv_any(path))
+    df["title_key"] = df.get("title", pd.Series("", index=df.index)).map(normalize_title)
+
+    if metadata_path:
+        meta = normalize_columns(read_csv_any(metadata_path))
+        meta["title_key"] = meta["title"].map(normalize_title)
+        id_columns = [c for c in fill_columns if c in meta.columns]
+        meta = meta.drop_duplicates("title_key").set_index("title_key")[id_columns]
+        for column in id_columns:
+            looked_up = df["title_key"].map(meta[column])
+            if column in df.columns:
+                df[column] = df[column].fillna(looked_up)
+            else:
+                df[column] = looked_up
+    return df
@@ -0,0 +1,272 @@
+"""Persistent registry of the downloaded XML/PDF files, indexed by identifier.
+
+Each file is indexed once with its size, modification time, SHA-256 and the
+identifiers it belongs to (PMCID/PMID/DOI read from the JATS front matter for
+XML files, the DOI encoded in the file name for preprint PDFs). Documents
+inside the pack files of a folder (``pipeline.packs``) are indexed as
+``<pack>#<name>`` next to the loose files. Rescans only
+look at files that are new or changed, and lookups are indexed SQLite queries
+instead of a directory glob per paper. The registry also remembers where the
+extracted text of each file is cached.
+
+    python -m pipeline.assets --db assets.sqlite scan path/to/merged_pdfs
+    python -m pipeline.assets --db assets.sqlite lookup --doi 10.1101/2020.04.16.20064709
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+from pipeline.logs import setup_logging
+from pipeline.packs import document_name, open_document, pack_documents
+
+log = logging.getLogger(__name__)
+
+DOCUMENT_SUFFIXES = {".xml": "xml", ".pdf": "pdf"}
+# Default registry file and text cache folder, created inside the document folder
+REGISTRY_NAME = ".asset_registry.sqlite"
+TEXT_CACHE_NAME = ".text_cache"
+
+_PMCID_NAME = re.compile(r"^(PMC\d+)$", re.IGNORECASE)
+# The bioRxiv/medRxiv PDFs are saved as "<anything><doi with '/' -> '_'>.pdf"
+_DOI_NAME = re.compile(r"(10\.\d{4,9}_.+)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    doi TEXT,
+    doi_key TEXT,
+    pmcid TEXT,
+    pmid TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    text_cache TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_doi_key ON assets (doi_key);
+CREATE INDEX IF NOT EXISTS assets_pmcid ON assets (pmcid);
+CREATE INDEX IF NOT EXISTS assets_pmid ON assets (pmid);
+CREATE INDEX IF NOT EXISTS assets_sha256 ON assets (sha256);
+"""
+
+
+def doi_key(doi):
+    """Normalised DOI used for matching: lower case with '/' replaced by '_' (as in the PDF names)."""
+    if not isinstance(doi, str) or not doi.strip():
+        return None
+    doi = re.sub(r"^(https?://(dx\.)?doi\.org/|doi:)", "", doi.strip(), flags=re.IGNORECASE)
+    return doi.lower().replace("/", "_")
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def xml_identifiers(path):
+    """PMCID, PMID and DOI from the ``<article-id>`` elements of a JATS file (stops after the front matter)."""
+    ids = {}
+    try:
+        with open_document(path) as f:
+            for event, elem in ET.iterparse(f, events=("end",)):
+                tag = elem.tag.rsplit("}", 1)[-1]
+                if tag == "article-id" and elem.text:
+                    id_type = elem.get("pub-id-type")
+                    value = elem.text.strip()
+                    if id_type in ("pmc", "pmcid") and "pmcid" not in ids:
+                        ids["pmcid"] = value if value.upper().startswith("PMC") else f"PMC{value}"
+                    elif id_type == "pmid" and "pmid" not in ids:
+                        ids["pmid"] = value
+                    elif id_type == "doi" and "doi" not in ids:
+                        ids["doi"] = value
+                elif tag in ("article-meta", "front"):
+                    break
+    except ET.ParseError:
+        pass
+    return ids
+
+
+def name_identifiers(path):
+    """Identifiers encoded in the file name (``PMC123.xml`` or ``..._10.1101_xyz.pdf``)."""
+    stem = Path(document_name(path)).stem
+    match = _PMCID_NAME.match(stem)
+    if match:
+        return {"pmcid": match.group(1).upper()}
+    match = _DOI_NAME.search(stem)
+    if match:
+        return {"doi": match.group(1).replace("_", "/", 1)}
+    return {}
+
+
+class AssetRegistry:
+    """SQLite-backed index of document files; safe to share between threads."""
+
+    def __init__(self, db_path, text_cache_dir=None):
+        self.db_path = str(db_path)
+        db_dir = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        self.text_cache_dir = text_cache_dir or os.path.join(db_dir, TEXT_CACHE_NAME)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def scan(self, folder):
+        """Index new or changed documents under ``folder`` and forget deleted ones.
+
+        Returns:
+            dict: Counts of ``added``, ``updated``, ``unchanged`` and ``removed`` files.
+        """
+        counts = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+        folder = os.path.abspath(folder)
+        with self._lock:
+            known = {row["path"]: (row["size"], row["mtime"]) for row in self._conn.execute(
+                "SELECT path, size, mtime FROM assets WHERE path LIKE ?", (folder + os.sep + "%",))}
+        seen = set()
+        rows = []
+        documents = []
+        for entry in os.scandir(folder):
+            if DOCUMENT_SUFFIXES.get(os.path.splitext(entry.name)[1].lower()) and entry.is_file():
+                stat = entry.stat()
+                documents.append((entry.path, stat.st_size, stat.st_mtime, None))
+        documents.extend(pack_documents(folder))
+        for path, size, mtime, sha256 in documents:
+            kind = DOCUMENT_SUFFIXES[os.path.splitext(path)[1].lower()]
+            seen.add(path)
+            previous = known.get(path)
+            if previous == (size, mtime):
+                counts["unchanged"] += 1
+                continue
+            counts["updated" if previous else "added"] += 1
+            ids = name_identifiers(path)
+            if kind == "xml":
+                ids.update(xml_identifiers(path))
+            # Packs store the checksum of each document
+            rows.append((path, kind, ids.get("doi"), doi_key(ids.get("doi")), ids.get("pmcid"),
+                         ids.get("pmid"), size, mtime, sha256 or file_sha256(path), time.time()))
+        removed = [(path,) for path in known if path not in seen]
+        counts["removed"] = len(removed)
+        with self._lock, self._conn:
+            # A changed file keeps no stale text cache; a file moved into a pack keeps the text of the same content
+            self._conn.executemany(
+                "INSERT INTO assets (path, kind, doi, doi_key, pmcid, pmid, size, mtime, sha256, text_cache, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                "(SELECT text_cache FROM assets WHERE sha256 = ?9 AND text_cache IS NOT NULL LIMIT 1), ?) "
+                "ON CONFLICT(path) DO UPDATE SET kind=excluded.kind, doi=excluded.doi, doi_key=excluded.doi_key, "
+                "pmcid=excluded.pmcid, pmid=excluded.pmid, size=excluded.size, mtime=excluded.mtime, "
+                "sha256=excluded.sha256, text_cache=excluded.text_cache, indexed_at=excluded.indexed_at",
+                rows)
+            self._conn.executemany("DELETE FROM assets WHERE path = ?", removed)
+        return counts
+
+    def lookup(self, doi=None, pmcid=None, pmid=None, kind=None):
+        """Return the registry record (dict) for the first identifier that matches, or None."""
+        clauses = []
+        if pmcid and isinstance(pmcid, str) and pmcid.strip():
+            clauses.append(("pmcid = ?", pmcid.strip().upper()))
+        if pmid is not None and str(pmid).strip() not in ("", "nan"):
+            clauses.append(("pmid = ?", str(pmid).strip().split(".")[0]))
+        key = doi_key(doi)
+        if key:
+            clauses.append(("doi_key = ?", key))
+        for clause, value in clauses:
+            query = f"SELECT * FROM assets WHERE {clause}"
+            params = [value]
+            if kind:
+                query += " AND kind = ?"
+                params.append(kind)
+            with self._lock:
+                row = self._conn.execute(query + " ORDER BY mtime DESC LIMIT 1", params).fetchone()
+            if row:
+                return dict(row)
+        return None
+
+    def set_text_cache(self, path, cache_path):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE assets SET text_cache = ? WHERE path = ?", (str(cache_path), str(path)))
+
+    def cached_text(self, record):
+        """Previously extracted text of ``record`` if its cache file still exists."""
+        cache_path = record.get("text_cache")
+        if cache_path and cache_path.endswith(".txt") and os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                return f.read()
+        return None
+
+    def store_text(self, record, text, cache_dir=None):
+        """Write extracted text to ``cache_dir`` (named by checksum) and remember its location."""
+        cache_dir = cache_dir or self.text_cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{record['sha256']}.txt")
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+        self.set_text_cache(record["path"], cache_path)
+        record["text_cache"] = cache_path
+        return cache_path
+
+    def summary(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, COUNT(*), SUM(size), SUM(text_cache IS NOT NULL), "
+                "SUM(doi IS NULL AND pmcid IS NULL AND pmid IS NULL) FROM assets GROUP BY kind").fetchall()
+        return [{"kind": r[0], "files": r[1], "bytes": r[2] or 0, "text_cached": r[3], "unidentified": r[4]}
+                for r in rows]
+
+
+def open_registry(folder, db_path=None):
+    """Registry for ``folder`` (stored inside it unless ``db_path`` is given), updated with new or changed files."""
+    registry = AssetRegistry(db_path or os.path.join(folder, REGISTRY_NAME))
+    start = time.perf_counter()
+    counts = registry.scan(folder)
+    log.info("Asset registry %s: %d added, %d updated, %d unchanged, %d removed (%.1fs)", registry.db_path,
+             counts["added"], counts["updated"], counts["unchanged"], counts["removed"], time.perf_counter() - start)
+    return registry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index downloaded XML/PDF files by DOI, PMCID and PMID.")
+    parser.add_argument("--db", required=True, help="registry SQLite file")
+    sub = parser.add_subparsers(dest="command", required=True)
+    scan = sub.add_parser("scan", help="index new or changed files in one or more folders")
+    scan.add_argument("folders", nargs="+")
+    lookup = sub.add_parser("lookup", help="find the file of a paper")
+    lookup.add_argument("--doi")
+    lookup.add_argument("--pmcid")
+    lookup.add_argument("--pmid")
+    sub.add_parser("summary", help="files, sizes and cached texts per kind")
+    args = parser.parse_args()
+    setup_logging()
+
+    registry = AssetRegistry(args.db)
+    if args.command == "scan":
+        for folder in args.folders:
+            start = time.perf_counter()
+            counts = registry.scan(folder)
+            print(f"{folder}: {counts} in {time.perf_counter() - start:.1f}s")
+    elif args.command == "lookup":
+        print(registry.lookup(doi=args.doi, pmcid=args.pmcid, pmid=args.pmid))
+    else:
+        for row in registry.summary():
+            print(row)
+    registry.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+"""End-to-end throughput benchmark on synthetic corpora.
+
+Generates corpora shaped like the real data (PubMed export CSVs, a step 01
+metadata CSV with abstracts, JATS XML files named ``PMC<id>.xml`` and preprint
+PDFs named ``<prefix>_<doi>.pdf``) at the requested scales, then runs the real
+step scripts on them, each in its own process:
+
+    aggregate  step 01 aggregation of the PubMed exports          (per export row)
+    filter     step 02 two-stage semantic filtering               (per abstract)
+    text_xml   JATS parsing into the XML cache (pipeline.jats)    (per XML file)
+    text_pdf   PDF text-layer extraction (pipeline.pdf_text)      (per PDF)
+    llm_xml    step 03 performance extraction, PubMed/XML flow    (per XML file)
+    llm_pdf    step 03 performance extraction, bioRxiv/PDF flow   (per PDF)
+
+The LLM stages talk to ``pipeline.llm_stub`` with a configurable per-token
+latency instead of ollama. Every run records its wall time, items per second
+and the peak RSS of the script process (worker pools and poppler are separate
+processes and not included), appended to a results CSV. Across scales, the
+log-log slope of time over items gives the scaling exponent of each stage
+(1.0 is linear). ``compare`` reports the throughput and memory of a run
+against a baseline results file, so regressions show up as numbers.
+
+    python -m pipeline.benchmark run --abstracts 1000 10000 100000 --documents 100 1000
+    python -m pipeline.benchmark run --stages aggregate filter --abstracts 1000 10000 1000000
+    python -m pipeline.benchmark run --stages llm_xml --documents 100 --token-delay 0.01 --label stub-10ms
+    python -m pipeline.benchmark curves bench/results.csv
+    python -m pipeline.benchmark compare bench/results.csv --baseline bench/baseline.csv
+"""
+import argparse
+import csv
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from pipeline.llm_stub import StubServer
+from pipeline.orchestrator import REPO_ROOT, SCRIPTS
+
+DEFAULT_WORK_DIR = Path("bench")
+DEFAULT_ABSTRACTS = [1000, 10000]
+DEFAULT_DOCUMENTS = [100, 1000]
+# Seconds per generated token of the LLM stub (roughly a 3B model on a laptop GPU is 0.01-0.03)
+DEFAULT_TOKEN_DELAY = 0.002
+# Items processed by each stage come from the abstract or the document scale
+ABSTRACT_STAGES = ["aggregate", "filter"]
+DOCUMENT_STAGES = ["text_xml", "text_pdf", "llm_xml", "llm_pdf"]
+STAGES = ABSTRACT_STAGES + DOCUMENT_STAGES
+RESULT_COLUMNS = ["label", "started", "stage", "items", "seconds", "items_per_second", "peak_rss_mb",
+                  "returncode", "log"]
+
+# PubMed "Export to CSV" columns (the abstract is added by extract_abstracts_from_pmid.py)
+PUBMED_COLUMNS = ["PMID", "Title", "Authors", "Citation", "First Author", "Journal/Book", "Publication Year",
+                  "Create Date", "PMCID", "NIHMS ID", "DOI"]
+# Columns of the bioRxiv/medRxiv step 02 output that step 03 reads
+RXIV_COLUMNS = ["Title", "authors", "category", "date", "Abstract", "doi"]
+
+# Vocabulary of the synthetic text: a share of the papers is about deep learning
+# for infectious diseases so that the step 02 filter keeps some of them.
+TOPICS = ["influenza", "SARS-CoV-2", "HIV", "dengue", "hepatitis B", "tuberculosis", "malaria", "Ebola",
+          "Alzheimer's disease", "breast cancer", "type 2 diabetes", "hypertension", "asthma", "stroke"]
+METHODS = ["convolutional neural network", "transformer model", "random forest", "logistic regression",
+           "recurrent neural network", "graph neural network", "gradient boosting", "cohort study",
+           "randomized controlled trial", "systematic review"]
+DATA = ["chest CT scans", "protein sequences", "electronic health records", "genomic sequences",
+        "histopathology images", "clinical notes", "surveillance data", "mass spectrometry profiles"]
+FILLER = ["Samples were collected from several sites and processed with a standardised protocol.",
+          "Baseline characteristics were comparable between the groups.",
+          "Missing values were handled by multiple imputation before the analysis.",
+          "The study was approved by the institutional review board.",
+          "Results were consistent across the sensitivity analyses."]
+JOURNALS = ["PLoS One", "Sci Rep", "Nat Commun", "BMC Bioinformatics", "Viruses", "Front Microbiol",
+            "J Med Virol", "Lancet Digit Health"]
+NAMES = ["Smith", "Chen", "Garcia", "Müller", "Kumar", "Okafor", "Rossi", "Tanaka", "Novak", "Silva"]
+
+
+def _sentences(rng, count):
+    topic, method, data = rng.choice(TOPICS), rng.choice(METHODS), rng.choice(DATA)
+    sentences = [f"We developed a {method} for {topic} using {data}.",
+                 f"The {method} was trained on {rng.randint(200, 90000)} {data} from {rng.randint(2, 40)} centres.",
+                 f"On the held-out test set it reached an AUC of 0.{rng.randint(70, 99)} "
+                 f"and an accuracy of {rng.randint(70, 99)}.{rng.randint(0, 9)}%."]
+    while len(sentences) < count:
+        sentences.append(rng.choice(FILLER))
+    return topic, method, sentences[:count]
+
+
+def _paper(rng, index):
+    """Identifiers, title, authors and abstract sentences of synthetic paper ``index``."""
+    topic, method, sentences = _sentences(rng, rng.randint(6, 12))
+    authors = [f"{rng.choice(NAMES)} {chr(65 + rng.randrange(26))}" for _ in range(rng.randint(2, 8))]
+    year = rng.randint(2015, 2024)
+    return {
+        "index": index, "pmid": 30000000 + index, "pmcid": f"PMC{9000000 + index}",
+        "doi": f"10.1101/{year}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}.{20000000 + index}",
+        "title": f"A {method} for {topic}: evidence from {rng.choice(DATA)}",
+        "authors": authors, "year": year, "journal": rng.choice(JOURNALS), "abstract": sentences,
+    }
+
+
+def _pubmed_row(paper, with_abstract):
+    authors = ", ".join(paper["authors"])
+    row = {
+        "PMID": paper["pmid"], "Title": paper["title"], "Authors": authors + ".",
+        "Citation": f"{paper['journal']}. {paper['year']};{paper['index'] % 50 + 1}(1):1-12. doi: {paper['doi']}.",
+        "First Author": paper["authors"][0], "Journal/Book": paper["journal"], "Publication Year": paper["year"],
+        "Create Date": f"{paper['year']}/01/01", "PMCID": paper["pmcid"], "NIHMS ID": "", "DOI": paper["doi"],
+    }
+    if with_abstract:
+        row["Abstract"] = " ".join(paper["abstract"])
+    return row
+
+
+def _write_csv(path, columns, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def generate_abstracts(folder, count, exports=4, duplicate_share=0.1, seed=0):
+    """PubMed export CSVs (with duplicates across files) and the step 01 metadata CSV of ``count`` papers."""
+    folder = Path(folder)
+    (folder / "exports").mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    writers, files = [], []
+    for i in range(exports):
+        f = open(folder / "exports" / f"pubmed_export_{i + 1}.csv", "w", newline="", encoding="utf-8")
+        writer = csv.DictWriter(f, fieldnames=PUBMED_COLUMNS)
+        writer.writeheader()
+        files.append(f)
+        writers.append(writer)
+    export_rows = 0
+    with open(folder / "metadata.csv", "w", newline="", encoding="utf-8") as f:
+        metadata = csv.DictWriter(f, fieldnames=PUBMED_COLUMNS + ["Abstract"])
+        metadata.writeheader()
+        for index in range(count):
+            paper = _paper(rng, index)
+            metadata.writerow(_pubmed_row(paper, with_abstract=True))
+            # Overlapping search queries return the same record in several exports
+            copies = 2 if rng.random() < duplicate_share else 1
+            for target in rng.sample(range(exports), min(copies, exports)):
+                writers[target].writerow(_pubmed_row(paper, with_abstract=False))
+                export_rows += 1
+    for f in files:
+        f.close()
+    return export_rows
+
+
+def jats_xml(paper, rng):
+    """A JATS article with front matter ids, abstract, body sections, a results table and references."""
+    _, method, _ = _sentences(rng, 1)
+
+    def paragraphs(count):
+        return "".join(f"<p>{escape(' '.join(_sentences(rng, rng.randint(4, 8))[2]))}</p>" for _ in range(count))
+
+    metrics = [("AUC", f"0.{rng.randint(70, 99)}"), ("Accuracy", f"0.{rng.randint(70, 99)}"),
+               ("Sensitivity", f"0.{rng.randint(60, 99)}"), ("Specificity", f"0.{rng.randint(60, 99)}")]
+    table = "".join(f"<tr><td>{name}</td><td>{value}</td></tr>" for name, value in metrics)
+    references = "".join(f"<ref id=\"R{i}\"><mixed-citation>{rng.choice(NAMES)} et al. {escape(rng.choice(METHODS))} "
+                         f"in {escape(rng.choice(TOPICS))}. {rng.choice(JOURNALS)}. {rng.randint(1995, 2023)}."
+                         f"</mixed-citation></ref>" for i in range(rng.randint(15, 40)))
+    sections = "".join(f"<sec sec-type=\"{kind}\"><title>{title}</title>{paragraphs(rng.randint(3, 8))}</sec>"
+                       for kind, title in [("intro", "Introduction"), ("methods", "Methods"),
+                                           ("results", "Results"), ("discussion", "Discussion")])
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article"><front>'
+        f'<journal-meta><journal-title-group><journal-title>{escape(paper["journal"])}</journal-title>'
+        f'</journal-title-group></journal-meta><article-meta>'
+        f'<article-id pub-id-type="pmid">{paper["pmid"]}</article-id>'
+        f'<article-id pub-id-type="pmc">{paper["pmcid"]}</article-id>'
+        f'<article-id pub-id-type="doi">{paper["doi"]}</article-id>'
+        f'<title-group><article-title>{escape(paper["title"])}</article-title></title-group>'
+        f'<abstract><p>{escape(" ".join(paper["abstract"]))}</p></abstract></article-meta></front>'
+        f'<body>{sections}<table-wrap id="T1"><label>Table 1</label><caption><p>Performance of the '
+        f'{escape(method)} on the test set.</p></caption><table><thead><tr><th>Metric</th><th>Value</th></tr>'
+        f'</thead><tbody>{table}</tbody></table></table-wrap></body>'
+        f'<back><ref-list><title>References</title>{references}</ref-list></back></article>\n'
+    )
+
+
+def pdf_bytes(lines, lines_per_page=50):
+    """A minimal PDF with a text layer (Helvetica, one line per text row); enough for pdftotext."""
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for page in pages:
+        rows = "".join("({}) Tj T*\n".format(line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)"))
+                       for line in page)
+        stream = f"BT /F1 10 Tf 14 TL 50 770 Td\n{rows}ET".encode("latin-1", errors="replace")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode("latin-1") + stream + b"\nendstream")
+        kids.append(len(objects) + 1)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{k} 0 R' for k in kids)}] /Count {len(kids)} >>"
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        body = body if isinstance(body, bytes) else body.encode("latin-1")
+        out += f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(out)
+
+
+def _wrap(text, width=95):
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    return lines + [line] if line else lines
+
+
+def preprint_lines(paper, rng):
+    """Text rows of a preprint PDF: header, abstract, sections and references."""
+    lines = [f"bioRxiv preprint doi: https://doi.org/{paper['doi']}", paper["title"], ", ".join(paper["authors"]),
+             "", "Abstract"] + _wrap(" ".join(paper["abstract"]))
+    for title in ("Introduction", "Methods", "Results", "Discussion"):
+        lines += ["", title]
+        for _ in range(rng.randint(3, 6)):
+            lines += _wrap(" ".join(_sentences(rng, rng.randint(4, 8))[2]))
+    lines += ["", "References"]
+    lines += [f"{i + 1}. {rng.choice(NAMES)} et al. {rng.choice(JOURNALS)}. {rng.randint(1995, 2023)}."
+              for i in range(rng.randint(15, 30))]
+    return lines
+
+
+def generate_documents(folder, count, pdf=True, seed=1):
+    """``count`` JATS files (and preprint PDFs) with the step 03 input CSV of each flow."""
+    folder = Path(folder)
+    xml_dir, pdf_dir = folder / "xml", folder / "pdf"
+    xml_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    pubmed_rows, rxiv_rows = [], []
+    for index in range(count):
+        paper = _paper(rng, index)
+        (xml_dir / f"{paper['pmcid']}.xml").write_text(jats_xml(paper, rng), encoding="utf-8")
+        pubmed_rows.append(_pubmed_row(paper, with_abstract=True))
+        if pdf:
+            pdf_dir.mkdir(exist_ok=True)
+            name = f"{paper['index']:06d}_{paper['doi'].replace('/', '_', 1)}.pdf"
+            (pdf_dir / name).write_bytes(pdf_bytes(preprint_lines(paper, rng)))
+            rxiv_rows.append({"Title": paper["title"], "authors": "; ".join(paper["authors"]),
+                              "category": "bioinformatics", "date": f"{paper['year']}-01-01",
+                              "Abstract": " ".join(paper["abstract"]), "doi": paper["doi"]})
+    _write_csv(folder / "pubmed_input.csv", PUBMED_COLUMNS + ["Abstract"], pubmed_rows)
+    if pdf:
+        _write_csv(folder / "rxiv_input.csv", RXIV_COLUMNS, rxiv_rows)
+
+
+def corpus(work_dir, kind, count, pdf=True):
+    """Folder of the synthetic corpus of ``kind`` ("abstracts" or "documents") and size, generated once."""
+    folder = Path(work_dir) / "corpus" / f"{kind}_{count}"
+    done = folder / ".complete"
+    if kind == "documents" and pdf and done.exists() and not (folder / "pdf").exists():
+        shutil.rmtree(folder)
+    if not done.exists():
+        start = time.perf_counter()
+        if kind == "abstracts":
+            items = generate_abstracts(folder, count)
+            done.write_text(str(items))
+        else:
+            generate_documents(folder, count, pdf)
+            done.write_text(str(count))
+        print(f"Generated {kind} corpus of {count} in {folder} ({time.perf_counter() - start:.1f}s)")
+    return folder
+
+
+def _wait_sampling_rss(process, interval=0.05):
+    """Wait for ``process`` and return its peak sampled RSS in MiB, or None without psutil."""
+    try:
+        import psutil
+    except ImportError:
+        process.wait()
+        return None
+    peak = 0
+    try:
+        sampled = psutil.Process(process.pid)
+        while process.poll() is None:
+            peak = max(peak, sampled.memory_info().rss)
+            time.sleep(interval)
+    except psutil.Error:
+        # The process exited between two samples
+        pass
+    process.wait()
+    return peak / 2**20
+
+
+def measure(stage, items, command, log_path, env=None, label=""):
+    """Run ``command`` to completion and return its result row (peak RSS of that process only).
+
+    ``os.wait4`` reports the exact peak on POSIX; elsewhere (Windows) the RSS is
+    sampled with psutil when it is installed, and left empty otherwise.
+    """
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    started = datetime.now().isoformat(timespec="seconds")
+    with open(log_path, "w", encoding="utf-8") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([str(part) for part in command], stdout=log, stderr=subprocess.STDOUT,
+                                   cwd=REPO_ROOT, env=env)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            seconds = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in KiB on Linux and in bytes on macOS
+            peak = usage.ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+        else:
+            peak = _wait_sampling_rss(process)
+            seconds = time.perf_counter() - start
+    return {"label": label, "started": started, "stage": stage, "items": items, "seconds": round(seconds, 3),
+            "items_per_second": round(items / seconds, 2) if seconds else "",
+            "peak_rss_mb": round(peak, 1) if peak is not None else "",
+            "returncode": process.returncode, "log": str(log_path)}
+
+
+def _mib(value, width=9):
+    """Peak RSS column; "n/a" where it was not measured."""
+    return f"{value:>{width}.1f}" if value not in ("", None) else f"{'n/a':>{width}}"
+
+
+def _fresh(path):
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+    return path
+
+
+def stage_command(stage, folder, run_dir, python=sys.executable):
+    """Command line of ``stage`` on the corpus in ``folder``; outputs go to the empty ``run_dir``."""
+    scripts = SCRIPTS["pubmed"]
+    if stage == "aggregate":
+        return [python, scripts["aggregate"], folder / "exports", "--output", run_dir / "aggregated.csv"]
+    if stage == "filter":
+        stage1 = run_dir / "stage1.csv"
+        # Ground-truth files that do not exist skip the evaluation
+        return [python, scripts["filter"], "--input", folder / "metadata.csv", "--output-general", stage1,
+                "--dl-input", stage1, "--output", run_dir / "stage2.csv", "--final-output", run_dir / "filtered.csv",
+                "--ground-truth-general", run_dir / "none.csv", "--ground-truth-dl", run_dir / "none.csv"]
+    if stage == "text_xml":
+        return [python, "-m", "pipeline.jats", "extract", folder / "xml", "--cache", run_dir / "xml_cache"]
+    if stage == "text_pdf":
+        return [python, "-m", "pipeline.pdf_text", folder / "pdf"]
+    if stage == "llm_xml":
+        return [python, scripts["performance"], "--input", folder / "pubmed_input.csv", "--xml-dir", folder / "xml",
+                "--xml-cache", run_dir / "xml_cache", "--output", run_dir / "performance.csv"]
+    if stage == "llm_pdf":
+        return [python, SCRIPTS["biorxiv"]["performance"], "--input", folder / "rxiv_input.csv",
+                "--pdf-dir", folder / "pdf", "--output", run_dir / "performance.csv"]
+    raise ValueError(f"Unknown stage {stage!r}")
+
+
+def _forget_registry(folder):
+    """Drop the asset registry and text cache a previous run left in the document folders (cold runs)."""
+    from pipeline.assets import REGISTRY_NAME, TEXT_CACHE_NAME
+    for sub in ("xml", "pdf"):
+        for name in (REGISTRY_NAME, REGISTRY_NAME + "-wal", REGISTRY_NAME + "-shm"):
+            if (folder / sub / name).exists():
+                (folder / sub / name).unlink()
+        if (folder / sub / TEXT_CACHE_NAME).exists():
+            shutil.rmtree(folder / sub / TEXT_CACHE_NAME)
+
+
+def run_benchmark(work_dir, stages, abstracts, documents, token_delay=DEFAULT_TOKEN_DELAY, repeat=1,
+                  label="", results_path=None):
+    """Run ``stages`` at every scale; returns the result rows (also appended to ``results_path``)."""
+    work_dir = Path(work_dir).resolve()
+    results_path = Path(results_path or work_dir / "results.csv")
+    pdf = any(stage in stages for stage in ("text_pdf", "llm_pdf"))
+    rows = []
+    stub = None
+    if any(stage.startswith("llm_") for stage in stages):
+        stub = StubServer(token_delay=token_delay).start()
+        print(f"LLM stub at {stub.url}, {token_delay * 1000:g} ms/token")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")])))
+    if stub:
+        env["OLLAMA_HOST"] = stub.url
+    try:
+        for stage in stages:
+            kind, scales = ("abstracts", abstracts) if stage in ABSTRACT_STAGES else ("documents", documents)
+            for count in scales:
+                folder = corpus(work_dir, kind, count, pdf)
+                items = int((folder / ".complete").read_text()) if stage == "aggregate" else count
+                for attempt in range(repeat):
+                    run_dir = _fresh(work_dir / "runs" / f"{stage}_{count}")
+                    if kind == "documents":
+                        _forget_registry(folder)
+                    row = measure(stage, items, stage_command(stage, folder, run_dir), run_dir / "run.log", env, label)
+                    rows.append(row)
+                    _append_results(results_path, [row])
+                    status = "" if row["returncode"] == 0 else f"  FAILED ({row['returncode']}), see {row['log']}"
+                    print(f"{stage:<10} {items:>9} items {row['seconds']:9.2f}s {row['items_per_second'] or 0:10.1f}/s "
+                          f"peak {_mib(row['peak_rss_mb'], 8)} MiB{status}")
+    finally:
+        if stub:
+            stub.stop()
+    print(f"Results appended to {results_path}")
+    print(format_curves(rows))
+    return rows
+
+
+def _append_results(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    header = not path.exists()
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_results(path, label=None):
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = [row for row in csv.DictReader(f) if row["returncode"] == "0"]
+    return [row for row in rows if label is None or row["label"] == label]
+
+
+def scaling_exponent(points):
+    """Least-squares slope of log(seconds) over log(items); 1.0 is linear, None below two scales."""
+    points = [(math.log(items), math.log(seconds)) for items, seconds in points if items > 0 and seconds > 0]
+    if len({x for x, _ in points}) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return (sum((x - mean_x) * (y - mean_y) for x, y in points)
+            / sum((x - mean_x) ** 2 for x, _ in points))
+
+
+def curves(rows):
+    """Per stage: the median time, throughput and peak RSS at each scale and the scaling exponent."""
+    by_stage = {}
+    for row in rows:
+        if str(row["returncode"]) != "0":
+            continue
+        by_stage.setdefault(row["stage"], {}).setdefault(int(row["items"]), []).append(row)
+    result = {}
+    for stage, scales in by_stage.items():
+        points = []
+        for items, runs in sorted(scales.items()):
+            seconds = sorted(float(r["seconds"]) for r in runs)[len(runs) // 2]
+            peaks = [float(r["peak_rss_mb"]) for r in runs if r["peak_rss_mb"] not in ("", None)]
+            points.append({"items": items, "seconds": seconds, "items_per_second": items / seconds if seconds else 0,
+                           "peak_rss_mb": max(peaks) if peaks else None, "runs": len(runs)})
+        result[stage] = {"points": points,
+                         "exponent": scaling_exponent([(p["items"], p["seconds"]) for p in points])}
+    return result
+
+
+def format_curves(rows):
+    lines = [f"{'stage':<10} {'items':>9} {'seconds':>9} {'items/s':>10} {'peak MiB':>9}  runs"]
+    for stage, curve in curves(rows).items():
+        for point in curve["points"]:
+            lines.append(f"{stage:<10} {point['items']:>9} {point['seconds']:>9.2f} "
+                         f"{point['items_per_second']:>10.1f} {_mib(point['peak_rss_mb'])}  {point['runs']}")
+        exponent = curve["exponent"]
+        lines.append(f"{stage:<10} scaling exponent {exponent:.2f}" if exponent is not None
+                     else f"{stage:<10} scaling exponent n/a (one scale)")
+    return "\n".join(lines)
+
+
+def compare(rows, baseline_rows, tolerance=0.2):
+    """Throughput and peak RSS against the baseline at the scales both have; flags changes beyond ``tolerance``.
+
+    Returns the report lines and the number of regressions.
+    """
+    current, baseline = curves(rows), curves(baseline_rows)
+    lines = [f"{'stage':<10} {'items':>9} {'items/s':>10} {'baseline':>10} {'ratio':>6} "
+             f"{'peak MiB':>9} {'baseline':>9} {'ratio':>6}"]
+    regressions = 0
+    for stage, curve in current.items():
+        reference = {p["items"]: p for p in baseline.get(stage, {}).get("points", [])}
+        for point in curve["points"]:
+            base = reference.get(point["items"])
+            if not base:
+                continue
+            speed = point["items_per_second"] / base["items_per_second"] if base["items_per_second"] else 0
+            # No memory comparison where either run could not measure RSS
+            memory = point["peak_rss_mb"] / base["peak_rss_mb"] if point["peak_rss_mb"] and base["peak_rss_mb"] else 0
+            flags = []
+            if speed < 1 - tolerance:
+                flags.append("SLOWER")
+            if memory > 1 + tolerance:
+                flags.append("MORE MEMORY")
+            regressions += bool(flags)
+            lines.append(f"{stage:<10} {point['items']:>9} {point['items_per_second']:>10.1f} "
+                         f"{base['items_per_second']:>10.1f} {speed:>6.2f} {_mib(point['peak_rss_mb'])} "
+                         f"{_mib(base['peak_rss_mb'])} {memory:>6.2f}  {' '.join(flags)}")
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark of steps 01-03 on synthetic corpora.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="generate the corpora (once per scale) and time the stages")
+    run.add_argument("--work-dir", type=Path, default=DEFAULT_WORK_DIR,
+                     help="corpora, per-run outputs and logs (default: ./bench)")
+    run.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    run.add_argument("--abstracts", nargs="+", type=int, default=DEFAULT_ABSTRACTS,
+                     help="abstract counts for the aggregate and filter stages")
+    run.add_argument("--documents", nargs="+", type=int, default=DEFAULT_DOCUMENTS,
+                     help="XML/PDF counts for the text and LLM stages")
+    run.add_argument("--token-delay", type=float, default=DEFAULT_TOKEN_DELAY,
+                     help="seconds per generated token of the LLM stub")
+    run.add_argument("--repeat", type=int, default=1, help="runs per stage and scale (the median is reported)")
+    run.add_argument("--label", default="", help="tag of these rows in the results file, e.g. a commit")
+    run.add_argument("--results", type=Path, help="results CSV to append to (default: <work-dir>/results.csv)")
+    generate = sub.add_parser("generate", help="only write a synthetic corpus")
+    generate.add_argument("folder", type=Path)
+    generate.add_argument("--abstracts", type=int, default=0)
+    generate.add_argument("--documents", type=int, default=0)
+    generate.add_argument("--no-pdf", action="store_true", help="XML files only")
+    show = sub.add_parser("curves", help="scaling curves of a results file")
+    show.add_argument("results", type=Path)
+    show.add_argument("--label")
+    check = sub.add_parser("compare", help="compare a results file with a baseline")
+    check.add_argument("results", type=Path)
+    check.add_argument("--baseline", type=Path, required=True)
+    check.add_argument("--label", help="only the rows with this label (both files)")
+    check.add_argument("--tolerance", type=float, default=0.2, help="relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmark(args.work_dir, args.stages, args.abstracts, args.documents, args.token_delay, args.repeat,
+                      args.label, args.results)
+    elif args.command == "generate":
+        if args.abstracts:
+            items = generate_abstracts(args.folder / "abstracts", args.abstracts)
+            print(f"{args.abstracts} papers, {items} export rows in {args.folder / 'abstracts'}")
+        if args.documents:
+            generate_documents(args.folder / "documents", args.documents, pdf=not args.no_pdf)
+            print(f"{args.documents} documents in {args.folder / 'documents'}")
+    elif args.command == "curves":
+        print(format_curves(read_results(args.results, args.label)))
+    else:
+        lines, regressions = compare(read_results(args.results, args.label), read_results(args.baseline, args.label),
+                                     args.tolerance)
+        print("\n".join(lines))
+        print(f"{regressions} regression(s) beyond {args.tolerance:.0%}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Small-model-first extraction with confidence-based escalation.
+
+Every paper first goes through a cheap tier (a smaller model on a reduced
+context). Its answer is scored for confidence from three signals:
+
+* self-consistency: a second, sampled answer agrees with the greedy one;
+* completeness: every field has an acceptable value (``pipeline.prompts``);
+* evidence: the extractive fields (dataset, method type, disease, ...) can be
+  found in the paper text.
+
+Papers below ``CASCADE_THRESHOLD`` are escalated to the next tier (the
+regular model on the regular context); the last tier's answer is final. The
+run summary gives the escalation rate and the time saved against running
+the last tier for every paper. ``evaluate`` runs both on the annotated
+papers and reports the escalation rate, the measured throughput gain and the
+quality delta against step 04:
+
+    python -m pipeline.cascade evaluate \
+        --annotations step_04_human_annotated_data/pubMed/task4_human_annotated_data.csv \
+        --metadata step_02_semantic_filtering/pubMed/dataset/semantic_filtering_final_data/final_semantically_filtered_dataset.csv \
+        --docs xml_outputs --limit 30
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+from pipeline.context_selection import TASK_FIELDS, field_recall, select_context
+from pipeline.llm_client import MODEL, LLMMetrics, ask_json
+from pipeline.prompts import FIELD_CHOICES, build_messages, field_problem, is_empty, normalize_choice
+
+log = logging.getLogger(__name__)
+
+SMALL_MODEL = os.environ.get("CASCADE_SMALL_MODEL", "llama3.2:1b")
+
+# Cheapest first; ``samples`` > 1 adds sampled answers for the self-consistency check
+DEFAULT_TIERS = [
+    {"name": "small", "model": SMALL_MODEL, "top_k": 2, "token_budget": 1500, "samples": 2},
+    {"name": "full", "model": MODEL, "top_k": 4, "token_budget": 3000, "samples": 1},
+]
+
+CASCADE_THRESHOLD = 0.8
+CONFIDENCE_WEIGHTS = {"consistency": 0.4, "completeness": 0.4, "evidence": 0.2}
+SAMPLE_OPTIONS = {"temperature": 0.7, "seed": 7}
+
+# Fields whose answer should be found (mostly) verbatim in the paper
+EVIDENCE_FIELDS = {"ai_method_type", "type_of_underlying_data", "dataset_name", "disease_name",
+                   "performance_results"}
+# Share of an answer's content words that must agree / occur in the paper
+MIN_AGREEMENT = 0.5
+MIN_EVIDENCE = 0.6
+
+
+def cascade_tiers(top_k=4, token_budget=3000, small_model=SMALL_MODEL):
+    """``DEFAULT_TIERS`` with the last tier on a script's own context settings."""
+    return [dict(DEFAULT_TIERS[0], model=small_model),
+            dict(DEFAULT_TIERS[-1], top_k=top_k, token_budget=token_budget)]
+
+
+def value_text(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return "" if is_empty(value) else str(value)
+
+
+def values_agree(field, a, b):
+    """Closed fields must match exactly, free-text fields share most of their content words."""
+    if is_empty(a) or is_empty(b):
+        return is_empty(a) and is_empty(b)
+    if field in FIELD_CHOICES:
+        return normalize_choice(field, a) == normalize_choice(field, b)
+    a, b = value_text(a), value_text(b)
+    overlap = [field_recall(a, b), field_recall(b, a)]
+    return all(o is None or o >= MIN_AGREEMENT for o in overlap)
+
+
+def answer_confidence(answers, fields, source_text):
+    """Confidence of the first of ``answers`` (the greedy one), with its three signals.
+
+    Args:
+        answers (list): Parsed replies for the same prompt; the first one is used,
+            the others are samples for the self-consistency check.
+        fields (list): Requested fields.
+        source_text (str): Paper text the answer must be supported by.
+
+    Returns:
+        dict: ``consistency``, ``completeness``, ``evidence`` and ``confidence`` (0-1).
+    """
+    answer = answers[0] if answers else None
+    if not answer:
+        return {"consistency": 0.0, "completeness": 0.0, "evidence": 0.0, "confidence": 0.0}
+    measured = normalize_choice("was_performance_measured", answer.get("was_performance_measured"))
+
+    complete = sum(field_problem(f, normalize_choice(f, answer.get(f)), measured) is None for f in fields)
+    completeness = complete / len(fields)
+
+    samples = [a for a in answers[1:] if a]
+    if samples:
+        agreeing = sum(values_agree(f, answer.get(f), sample.get(f)) for sample in samples for f in fields)
+        consistency = agreeing / (len(samples) * len(fields))
+    else:
+        # No usable sample: nothing to compare with, so no evidence of consistency
+        consistency = 0.0 if len(answers) > 1 else 1.0
+
+    checked = supported = 0
+    for field in fields:
+        if field in EVIDENCE_FIELDS and not is_empty(answer.get(field)):
+            recall = field_recall(value_text(answer.get(field)), source_text)
+            if recall is not None:
+                checked += 1
+                supported += recall >= MIN_EVIDENCE
+    evidence = supported / checked if checked else 1.0
+
+    signals = {"consistency": consistency, "completeness": completeness, "evidence": evidence}
+    signals["confidence"] = sum(CONFIDENCE_WEIGHTS[k] * v for k, v in signals.items())
+    return signals
+
+
+class Cascade:
+    """Tiered extraction of ``fields``; safe to share between pipeline threads.
+
+    Args:
+        metrics (LLMMetrics): Records every call (all tiers).
+        fields (list): Fields to extract (e.g. ``TASK_FIELDS["additional"]``).
+        tiers (list): Tier dicts, cheapest first (default ``DEFAULT_TIERS``).
+        threshold (float): Confidence below which a paper is escalated.
+    """
+
+    def __init__(self, metrics, fields, tiers=None, threshold=CASCADE_THRESHOLD):
+        self.metrics = metrics
+        self.fields = list(fields)
+        self.tiers = tiers or DEFAULT_TIERS
+        self.threshold = threshold
+        self.papers = []
+        self._lock = threading.Lock()
+
+    def _ask(self, paper_id, text, fields, tier):
+        context = text
+        if tier["top_k"]:
+            context, _ = select_context(text, fields=fields, top_k=tier["top_k"],
+                                        token_budget=tier["token_budget"], num_ctx=self.metrics.num_ctx)
+        messages = build_messages(context, fields)
+        answers = [ask_json(self.metrics, paper_id, messages, model=tier["model"])]
+        if answers[0]:
+            for _ in range(tier["samples"] - 1):
+                answers.append(ask_json(self.metrics, paper_id, messages, model=tier["model"],
+                                        options=SAMPLE_OPTIONS))
+        return answers
+
+    def extract(self, paper_id, text, fields=None):
+        """Answer of the cheapest confident tier (or the last tier) and how it was reached.
+
+        Returns:
+            tuple: (answer dict, info dict with ``tier``, ``confidence`` and ``seconds`` per tier).
+        """
+        fields = fields or self.fields
+        info = {"paper_id": paper_id, "tier": None, "confidence": None, "seconds": {}}
+        best = {}
+        for i, tier in enumerate(self.tiers):
+            start = time.perf_counter()
+            answers = self._ask(paper_id, text, fields, tier)
+            last = i == len(self.tiers) - 1
+            score = answer_confidence(answers, fields, text) if not last else None
+            info["seconds"][tier["name"]] = time.perf_counter() - start
+            info["tier"] = tier["name"]
+            if answers[0]:
+                best = answers[0]
+            if last:
+                break
+            info["confidence"] = score["confidence"]
+            if score["confidence"] >= self.threshold:
+                break
+            log.info("%s: %s answer confidence %.2f (consistency %.2f, completeness %.2f, evidence %.2f), "
+                     "escalating", paper_id, tier["name"], score["confidence"], score["consistency"],
+                     score["completeness"], score["evidence"])
+        with self._lock:
+            self.papers.append(info)
+        return best, info
+
+    def summary(self):
+        return summarize_cascade(self.papers, [tier["name"] for tier in self.tiers])
+
+
+def summarize_cascade(papers, tier_names, baseline_seconds=None):
+    """Escalation rate and time per tier; throughput gain against the last tier alone.
+
+    ``baseline_seconds`` is the measured time of running the last tier for all
+    papers; without it, the gain is estimated from the escalated papers.
+    """
+    if not papers:
+        return "Cascade: no papers"
+    top = tier_names[-1]
+    finished = {name: sum(p["tier"] == name for p in papers) for name in tier_names}
+    escalated = len(papers) - finished[tier_names[0]]
+    spent = sum(sum(p["seconds"].values()) for p in papers)
+    lines = [f"Cascade: {len(papers)} papers, {escalated} escalated ({escalated / len(papers):.0%}); "
+             + ", ".join(f"{finished[name]} finished on {name}" for name in tier_names)]
+    for name in tier_names:
+        times = [p["seconds"][name] for p in papers if name in p["seconds"]]
+        if times:
+            lines.append(f"  {name:<8}{len(times):>5} papers  {sum(times) / len(times):7.2f} s/paper")
+    top_times = [p["seconds"][top] for p in papers if top in p["seconds"]]
+    if baseline_seconds is None and top_times:
+        baseline_seconds = sum(top_times) / len(top_times) * len(papers)
+        label = "estimated from the escalated papers"
+    else:
+        label = "measured"
+    if baseline_seconds and spent:
+        lines.append(f"  {spent:.1f} s in total vs {baseline_seconds:.1f} s for {top} on every paper "
+                     f"({label}): {baseline_seconds / spent:.2f}x throughput")
+    return "\n".join(lines)
+
+
+def field_score(field, reference, answer):
+    """Agreement of one answer with the annotated value: exact for closed fields, word-overlap F1 otherwise."""
+    if is_empty(reference):
+        return None
+    if is_empty(answer):
+        return 0.0
+    if field in FIELD_CHOICES:
+        return float(normalize_choice(field, str(reference).strip()) == normalize_choice(field, answer))
+    answer, reference = value_text(answer), value_text(reference)
+    precision, recall = field_recall(answer, reference), field_recall(reference, answer)
+    if not precision or not recall:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+def quality(results, annotations, fields):
+    """Mean ``field_score`` per field over the papers; ``results`` maps annotation row -> answer."""
+    scores = {}
+    for index, answer in results.items():
+        for field in fields:
+            if field not in annotations.columns:
+                continue
+            score = field_score(field, annotations.at[index, field], answer.get(field))
+            if score is not None:
+                scores.setdefault(field, []).append(score)
+    return {field: sum(values) / len(values) for field, values in scores.items()}
+
+
+def main():
+    from pipeline.annotations import load_annotations
+    from pipeline.assets import open_registry
+    from pipeline.documents import load_document_text
+    from pipeline.logs import setup_logging
+
+    parser = argparse.ArgumentParser(description="Evaluate the small-model-first extraction cascade.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    evaluate = sub.add_parser("evaluate", help="cascade vs the last tier alone on the annotated papers")
+    evaluate.add_argument("--annotations", required=True, help="step 04 annotated CSV")
+    evaluate.add_argument("--metadata", help="step 02 output used to map titles to PMCID/DOI")
+    evaluate.add_argument("--docs", required=True, help="folder with the XML/PDF files")
+    evaluate.add_argument("--task", choices=sorted(TASK_FIELDS), default="additional")
+    evaluate.add_argument("--small-model", default=SMALL_MODEL)
+    evaluate.add_argument("--threshold", type=float, default=CASCADE_THRESHOLD)
+    evaluate.add_argument("--limit", type=int, help="evaluate at most this many papers")
+    args = parser.parse_args()
+    setup_logging()
+
+    annotations = load_annotations(args.annotations, args.metadata)
+    registry = open_registry(args.docs)
+    documents = {}
+    for index, row in annotations.iterrows():
+        record = registry.lookup(pmcid=row.get("pmcid"), pmid=row.get("pmid"), doi=row.get("doi"))
+        text = load_document_text(record["path"]) if record else None
+        if text:
+            documents[index] = text
+        if args.limit and len(documents) >= args.limit:
+            break
+    print(f"Loaded {len(documents)} annotated papers.")
+
+    fields = TASK_FIELDS[args.task]
+    tiers = cascade_tiers(small_model=args.small_model)
+    cascade = Cascade(LLMMetrics(), fields, tiers, args.threshold)
+    baseline = Cascade(LLMMetrics(), fields, tiers[-1:])
+    cascade_results, baseline_results = {}, {}
+    for index, text in documents.items():
+        cascade_results[index], _ = cascade.extract(index, text)
+        baseline_results[index], _ = baseline.extract(index, text)
+
+    baseline_seconds = sum(sum(p["seconds"].values()) for p in baseline.papers)
+    print(summarize_cascade(cascade.papers, [tier["name"] for tier in tiers], baseline_seconds))
+    cascade_quality = quality(cascade_results, annotations, fields)
+    baseline_quality = quality(baseline_results, annotations, fields)
+    print(f"\n{'field':<34}{tiers[-1]['name'] + ' only':>12}{'cascade':>10}{'delta':>8}")
+    for field in fields:
+        if field in baseline_quality:
+            delta = cascade_quality[field] - baseline_quality[field]
+            print(f"{field:<34}{baseline_quality[field]:>12.2f}{cascade_quality[field]:>10.2f}{delta:>+8.2f}")
+    if baseline_quality:
+        before = sum(baseline_quality.values()) / len(baseline_quality)
+        after = sum(cascade_quality[f] for f in baseline_quality) / len(baseline_quality)
+        print(f"{'mean':<34}{before:>12.2f}{after:>10.2f}{after - before:>+8.2f}")
+
+
+if __name__ == "__main__":
+    main()
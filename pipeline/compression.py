@@ -0,0 +1,344 @@
+"""Prompt compression: boilerplate removal before the step 03 prompts.
+
+The extracted paper text still carries blocks that never answer a requested
+field: author lists and affiliations above the abstract, acknowledgements,
+funding, competing-interest and author-contribution statements, license
+blurbs, and the bioRxiv/medRxiv banner repeated on every PDF page. ``compress``
+removes them and collapses OCR whitespace and line-break hyphenation before
+context selection, so the token budget goes to the Methods and Results.
+
+Each step can be switched off in ``COMPRESSION_CONFIG``. ``PromptCompressor``
+records the original and compressed token count per paper; the table is
+written next to the run's output (``<output>.compression.csv``). Check what
+would be removed from a folder of downloaded papers, or print the removed
+lines of one paper:
+
+    python -m pipeline.compression report path/to/merged_pdfs
+    python -m pipeline.compression show path/to/merged_pdfs/10.1101_2020.01.01.123456.pdf
+"""
+import argparse
+import csv
+import os
+import re
+import threading
+from pathlib import Path
+
+from pipeline.context_selection import estimate_tokens
+
+COMPRESSION_CONFIG = {
+    "whitespace": True,       # collapse runs of spaces, join hyphenated line breaks
+    "page_furniture": True,   # lines repeated on many pages, page numbers
+    "license": True,          # preprint banners, copyright and license statements
+    "front_matter": True,     # author, affiliation and correspondence lines above the abstract
+    "sections": True,         # acknowledgements, funding, competing interests, author contributions
+}
+# JATS text has no author or affiliation lines (they are left out when the XML is read)
+XML_COMPRESSION_CONFIG = {"front_matter": False}
+
+# Headings of sections that never answer a step 03 field
+BOILERPLATE_HEADINGS = [
+    r"acknowledge?ments?", r"funding(?: information| sources?| statement)?", r"financial support",
+    r"sources? of funding", r"competing (?:financial )?interests?", r"conflicts? of interests?",
+    r"declarations? of (?:competing )?interests?", r"disclosures?", r"author contributions?",
+    r"authors'? contributions?", r"credit authorship contribution statement", r"role of the funding source",
+]
+_HEADING = re.compile(r"^(?:\d+(?:\.\d+)*\.?\s+)?(?:%s)(?:\s*[:.]|\s*$)" % "|".join(BOILERPLATE_HEADINGS),
+                      re.IGNORECASE)
+# Longest line still taken for a section heading
+HEADING_MAX_WORDS = 6
+# Longest boilerplate section removed after its heading
+SECTION_MAX_CHARS = 1500
+
+# Preprint banners and license statements, matched per line
+LICENSE_PATTERNS = [
+    r"\b(?:bio|med)rxiv preprint\b", r"this version posted\b", r"copyright holder for this preprint",
+    r"was not certified by peer review", r"granted (?:bio|med)rxiv a license", r"display the preprint in perpetuity",
+    r"made available under a\s+cc[- ]", r"all rights reserved\. no reuse allowed",
+    r"should not be used to guide clinical practice", r"distributed under the terms of the creative commons",
+    r"creative commons attribution", r"^\s*(?:©|\(c\)|copyright)\s*(?:19|20)\d\d",
+]
+_LICENSE = re.compile("|".join(LICENSE_PATTERNS), re.IGNORECASE)
+# Longer lines are paragraphs that merely cite a license; they are kept
+LICENSE_MAX_CHARS = 400
+
+# Author, affiliation and correspondence lines above the abstract
+_AFFILIATION = re.compile(
+    r"\b(?:universit\w*|institut\w*|department|dept\.|hospital|college|school of|faculty|laborator\w*|"
+    r"cent(?:er|re) for|academy|ministry of|inc\.|ltd\.?)\b|@|orcid|corresponding author|correspondence|"
+    r"contributed equally|equal contribution|present address",
+    re.IGNORECASE)
+# "Jane Doe1,2, John Smith3*" style author lists
+_AUTHOR_LIST = re.compile(r"^(?:[A-Z][\w'.-]+\s+){1,3}[A-Z][\w'-]+[\d*†‡,\s]*(?:,|\band\b)")
+_ABSTRACT_HEADING = re.compile(r"^\s*(?:abstract|summary)\s*:?\s*$", re.IGNORECASE)
+# The abstract heading is looked for in this many leading lines; without one
+# nothing counts as front matter
+ABSTRACT_SEARCH_LINES = 100
+
+# A line seen on this many pages is a running header or footer
+MIN_REPEATS = 3
+REPEATED_MAX_CHARS = 200
+# Page break in PDF text (pdftotext's form feed, kept on a line of its own)
+PAGE_BREAK = "\f"
+_PAGE_NUMBER = re.compile(r"^\s*(?:page\s+)?\d{1,3}(?:\s*(?:/|of)\s*\d{1,3})?\s*$", re.IGNORECASE)
+# Table cells and other number-only lines ("0.94", "87.2%", "(0.91-0.97)") are never furniture
+_NUMERIC = re.compile(r"^[\s\d.,:;%±+\-–()\[\]/]*$")
+
+COMPRESSION_COLUMNS = ["paper_id", "original_tokens", "compressed_tokens", "whitespace", "page_furniture",
+                       "license", "front_matter", "sections"]
+
+
+def _normalize_line(line):
+    """Repeated-line key: digits (page numbers, dates) do not count."""
+    return re.sub(r"\d+", "#", " ".join(line.split()).lower())
+
+
+def collapse_whitespace(text):
+    """Join words hyphenated across line breaks and collapse OCR spacing, keeping paragraph breaks."""
+    text = text.replace("­", "").replace("\r\n", "\n").replace(PAGE_BREAK, f"\n{PAGE_BREAK}\n")
+    text = re.sub(r"([a-z])-\n[ \t]*([a-z])", r"\1\2", text)
+    text = re.sub(r"[ \t ]+", " ", text)
+    text = re.sub(r" ?\n ?", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def drop_page_furniture(lines):
+    """Drop running headers/footers and page numbers of PDF text.
+
+    A short line is a running header or footer when it occurs on at least
+    ``MIN_REPEATS`` pages (counted once per page, pages separated by
+    ``PAGE_BREAK`` lines); a bare page number is dropped only as the first or
+    last line of a page. Number-only lines are kept, since those are table
+    cells. Text without page breaks (e.g. from XML) is left as it is.
+    """
+    pages = [[]]
+    for i, line in enumerate(lines):
+        if line == PAGE_BREAK:
+            pages.append([])
+        else:
+            pages[-1].append(i)
+    if len(pages) < 2:
+        return list(lines), []
+
+    def candidate(line):
+        stripped = line.strip()
+        return stripped and len(line) <= REPEATED_MAX_CHARS and not _NUMERIC.match(stripped)
+
+    counts, edges = {}, set()
+    for page in pages:
+        for key in {_normalize_line(lines[i]) for i in page if candidate(lines[i])}:
+            counts[key] = counts.get(key, 0) + 1
+        filled = [i for i in page if lines[i].strip()]
+        edges.update(filled[:1] + filled[-1:])
+    kept, removed = [], []
+    for i, line in enumerate(lines):
+        repeated = candidate(line) and counts[_normalize_line(line)] >= MIN_REPEATS
+        page_number = i in edges and _PAGE_NUMBER.match(line)
+        (removed if repeated or page_number else kept).append(line)
+    return kept, removed
+
+
+def drop_license(lines):
+    kept, removed = [], []
+    for line in lines:
+        (removed if len(line) <= LICENSE_MAX_CHARS and _LICENSE.search(line) else kept).append(line)
+    return kept, removed
+
+
+def is_front_matter_line(line):
+    stripped = line.strip()
+    if not stripped:
+        return False
+    return bool(_AFFILIATION.search(stripped) or _AUTHOR_LIST.match(stripped)
+                or re.match(r"^[\d*†‡§¶]+\s*[A-Z]", stripped))
+
+
+def drop_front_matter(lines):
+    """Drop author/affiliation lines between the title and the abstract heading.
+
+    The first line (title) is always kept. Without an abstract heading nothing
+    is dropped: the lines could as well be body paragraphs that mention a
+    hospital or a city.
+    """
+    end = next((i for i, line in enumerate(lines[:ABSTRACT_SEARCH_LINES]) if _ABSTRACT_HEADING.match(line)), None)
+    if end is None:
+        return lines, []
+    first = next((i for i, line in enumerate(lines) if line.strip()), 0)
+    kept, removed = [], []
+    for i, line in enumerate(lines):
+        (removed if first < i < end and is_front_matter_line(line) else kept).append(line)
+    return kept, removed
+
+
+def _is_heading(line):
+    """Short title-like line (any section heading, not only boilerplate ones)."""
+    words = line.split()
+    return 0 < len(words) <= HEADING_MAX_WORDS and line[0].isupper() and not line.endswith((".", ",", ";", ":"))
+
+
+def drop_sections(lines):
+    """Drop sections headed by a ``BOILERPLATE_HEADINGS`` heading.
+
+    A section ends at the first blank line after its text, at the next
+    heading, or after ``SECTION_MAX_CHARS`` characters (PDF text often has no
+    blank lines at all).
+    """
+    kept, removed = [], []
+    in_section, has_body, section_chars = False, False, 0
+    for line in lines:
+        if line == PAGE_BREAK:
+            kept.append(line)
+            continue
+        stripped = line.strip()
+        match = _HEADING.match(stripped)
+        if match:
+            in_section, section_chars = True, 0
+            # "Funding: This work was supported by ..." has its text on the heading line
+            has_body = bool(stripped[match.end():].strip())
+            removed.append(line)
+            continue
+        if in_section:
+            if (has_body and not stripped) or _is_heading(stripped) or section_chars > SECTION_MAX_CHARS:
+                in_section = False
+            else:
+                has_body = has_body or bool(stripped)
+                section_chars += len(line)
+                removed.append(line)
+                continue
+        kept.append(line)
+    return kept, removed
+
+
+# Steps that drop whole lines, in the order they run
+LINE_STEPS = [("page_furniture", drop_page_furniture), ("license", drop_license),
+              ("front_matter", drop_front_matter), ("sections", drop_sections)]
+
+
+def compress(text, config=None):
+    """Remove boilerplate from ``text``.
+
+    Returns:
+        tuple: (compressed text, dict of removed tokens per step plus
+        ``original_tokens`` and ``compressed_tokens``).
+    """
+    config = {**COMPRESSION_CONFIG, **(config or {})}
+    stats = {"original_tokens": estimate_tokens(text or "")}
+    if not text:
+        stats.update({step: 0 for step in COMPRESSION_CONFIG}, compressed_tokens=0)
+        return text, stats
+
+    if config["whitespace"]:
+        text = collapse_whitespace(text)
+    stats["whitespace"] = stats["original_tokens"] - estimate_tokens(text)
+
+    lines = text.split("\n")
+    for step, drop in LINE_STEPS:
+        removed = []
+        if config[step]:
+            lines, removed = drop(lines)
+        stats[step] = sum(estimate_tokens(line) for line in removed)
+    lines = [line for line in lines if line != PAGE_BREAK]
+    text = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+    stats["compressed_tokens"] = estimate_tokens(text)
+    return text, stats
+
+
+class PromptCompressor:
+    """``compress`` with the token counts kept per paper; safe to share between pipeline threads."""
+
+    def __init__(self, config=None):
+        self.config = config
+        self.papers = []
+        self._lock = threading.Lock()
+
+    def compress(self, paper_id, text):
+        text, stats = compress(text, self.config)
+        with self._lock:
+            self.papers.append({"paper_id": paper_id, **stats})
+        return text
+
+    def write_csv(self, path):
+        """Append the per-paper rows to ``path`` (header written when the file is new)."""
+        with self._lock:
+            rows = list(self.papers)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=COMPRESSION_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def summary(self, metrics=None):
+        with self._lock:
+            rows = list(self.papers)
+        return summarize_compression(rows, metrics.paper_rows() if metrics else None)
+
+
+def summarize_compression(rows, metric_rows=None):
+    """Tokens removed per step; with the run's LLM metrics, the prompt-eval time they stand for.
+
+    The time is the removed tokens at the measured prompt-eval rate, i.e. what
+    sending the whole paper would have cost. With context selection the prompt
+    is capped by the token budget, and the removed tokens free budget for
+    relevant paragraphs instead.
+    """
+    if not rows:
+        return "Compression: no papers"
+    original = sum(int(r["original_tokens"]) for r in rows)
+    compressed = sum(int(r["compressed_tokens"]) for r in rows)
+    removed = original - compressed
+    lines = [f"Compression: {len(rows)} papers, ~{original} -> ~{compressed} tokens "
+             f"({removed / original if original else 0:.0%} removed, mean {removed / len(rows):.0f}/paper)"]
+    lines.append("  " + ", ".join(f"{step} {sum(int(r[step]) for r in rows)}" for step in COMPRESSION_CONFIG))
+    if metric_rows:
+        prompt_tokens = sum(int(r["prompt_tokens"]) for r in metric_rows)
+        prompt_seconds = sum(float(r["prompt_eval_seconds"]) for r in metric_rows)
+        if prompt_tokens and prompt_seconds:
+            rate = prompt_tokens / prompt_seconds
+            lines.append(f"  ~{removed / rate:.1f} s of prompt eval at the measured {rate:.0f} tok/s "
+                         f"({removed / rate / len(rows):.2f} s/paper when the whole text is sent)")
+    return "\n".join(lines)
+
+
+def _removed_lines(text, config=None):
+    """What each step removes, for inspection."""
+    config = {**COMPRESSION_CONFIG, **(config or {})}
+    lines = (collapse_whitespace(text) if config["whitespace"] else text).split("\n")
+    removed = {}
+    for step, drop in LINE_STEPS:
+        if config[step]:
+            lines, removed[step] = drop(lines)
+    return removed
+
+
+def main():
+    from pipeline.documents import load_document_text
+
+    parser = argparse.ArgumentParser(description="Check the boilerplate removed before the step 03 prompts.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser("report", help="token counts before and after compression over a folder")
+    report.add_argument("doc_dir")
+    report.add_argument("--limit", type=int)
+    report.add_argument("--output", help="write the per-paper table here")
+    show = sub.add_parser("show", help="print what is removed from one paper")
+    show.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        for step, removed in _removed_lines(load_document_text(args.path)).items():
+            print(f"== {step} ({len(removed)} lines)")
+            for line in removed:
+                print(f"  {line[:160]}")
+        return
+
+    compressor = PromptCompressor()
+    paths = sorted(p for p in Path(args.doc_dir).iterdir() if p.suffix.lower() in (".xml", ".pdf"))
+    for path in paths[:args.limit]:
+        compressor.compress(path.name, load_document_text(path))
+    print(compressor.summary())
+    if args.output:
+        compressor.write_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Retrieval-guided context selection for the step 03 LLM prompts.
+
+Most requested fields live in a few Methods/Results paragraphs, so instead of
+sending the whole paper we rank its paragraphs against a short query per field
+with the step 02 MiniLM encoder and keep the best ones within a token budget.
+
+Recall check against the human annotations (pick the smallest k that keeps
+the annotated answers in the prompt)::
+
+    python -m pipeline.context_selection \
+        --annotations step_04_human_annotated_data/pubMed/task4_human_annotated_data.csv \
+        --metadata step_02_semantic_filtering/pubMed/dataset/semantic_filtering_final_data/final_semantically_filtered_dataset.csv \
+        --docs xml_outputs --k 2 4 6 8 --budget 3000
+"""
+import argparse
+import re
+
+import numpy as np
+import pandas as pd
+
+from pipeline.embeddings import encode
+from pipeline.logs import setup_logging
+from pipeline.prompts import build_messages
+
+# Short retrieval queries per extraction field
+FIELD_QUERIES = {
+    "research_aim": ["The aim of this study is to", "In this paper we propose a method to"],
+    "research_problem": ["The problem addressed in this work is", "Existing approaches are limited because"],
+    "ai_objective": ["We use deep learning to predict, classify or detect"],
+    "ai_methodology": ["Our approach uses a neural network model trained on the data"],
+    "ai_method_details": ["The model architecture consists of convolutional layers, LSTM or transformer encoder",
+                          "The network was trained with an optimizer, learning rate, epochs and batch size"],
+    "ai_method_type": ["We used a convolutional neural network, random forest, transformer or LSTM model"],
+    "type_of_underlying_data": ["The input data consisted of images, sequences, clinical records or time series"],
+    "dataset_name": ["The dataset was obtained from a public database or repository",
+                     "Data were collected from patients, samples or surveillance records"],
+    "disease_name": ["The disease studied is an infectious or viral disease such as COVID-19, influenza or HIV"],
+    "virology_subdomain": ["The virus infects the respiratory tract, the liver, the nervous system or the immune system"],
+    "was_performance_measured": ["The model was evaluated and its performance compared to baselines"],
+    "performance_results": ["The model achieved an accuracy, AUC, F1-score, sensitivity and specificity of",
+                            "Table shows the performance results of the models"],
+    "performance_measurement_details": ["Performance was evaluated using cross-validation on a held-out test set"],
+}
+
+# Fields requested by each step 03 prompt
+TASK_FIELDS = {
+    "additional": ["research_aim", "research_problem", "ai_objective", "ai_methodology",
+                   "ai_method_details", "ai_method_type", "type_of_underlying_data",
+                   "dataset_name", "disease_name", "virology_subdomain"],
+    "performance": ["was_performance_measured", "performance_results",
+                    "performance_measurement_details"],
+}
+
+# Tokens left free in the context window for the JSON reply
+REPLY_TOKENS = 512
+# Chat-template tokens around each message (role header, end of turn)
+MESSAGE_TOKENS = 8
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "was", "were", "using",
+    "used", "based", "which", "their", "its", "into", "not", "specified", "null", "none",
+}
+
+
+def estimate_tokens(text):
+    """Rough LLaMA token count (about four characters per token)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def context_budget(fields, num_ctx, token_budget=None, reply_tokens=REPLY_TOKENS):
+    """Context tokens that fit a ``num_ctx`` window next to the prompt for ``fields`` and the reply.
+
+    The prompt overhead is measured on ``build_messages`` without paper text;
+    ``token_budget`` caps the result.
+    """
+    overhead = sum(estimate_tokens(m["content"]) + MESSAGE_TOKENS for m in build_messages("", fields))
+    budget = max(0, num_ctx - overhead - reply_tokens)
+    return min(budget, token_budget) if token_budget else budget
+
+
+def split_paragraphs(text, max_words=180):
+    """Split text into paragraphs, windowing long blocks into sentence groups.
+
+    XML full texts arrive as a single line, so blocks longer than ``max_words``
+    are cut into consecutive sentence windows of roughly that size.
+    """
+    paragraphs = []
+    for block in re.split(r"\n\s*\n", text or ""):
+        block = " ".join(block.split())
+        if not block:
+            continue
+        if len(block.split()) <= max_words:
+            paragraphs.append(block)
+            continue
+        window, window_words = [], 0
+        for sentence in _SENTENCE_SPLIT.split(block):
+            words = len(sentence.split())
+            if window and window_words + words > max_words:
+                paragraphs.append(" ".join(window))
+                window, window_words = [], 0
+            window.append(sentence)
+            window_words += words
+        if window:
+            paragraphs.append(" ".join(window))
+    return paragraphs
+
+
+def rank_paragraphs(paragraphs, fields):
+    """Return a (fields x paragraphs) matrix of the best query similarity per field."""
+    paragraph_embeddings = encode(paragraphs)
+    scores = np.zeros((len(fields), len(paragraphs)), dtype=np.float32)
+    for i, field in enumerate(fields):
+        query_embeddings = encode(FIELD_QUERIES[field])
+        scores[i] = (paragraph_embeddings @ query_embeddings.T).max(axis=1)
+    return scores
+
+
+def select_context(text, task="additional", fields=None, top_k=4, token_budget=3000, lead_paragraphs=1,
+                   num_ctx=None):
+    """Build a compact context from the paragraphs most relevant to the requested fields.
+
+    Args:
+        text (str): Full (reference-stripped) paper text.
+        task (str): Key of ``TASK_FIELDS`` used when ``fields`` is not given.
+        fields (list): Explicit list of field names to retrieve for.
+        top_k (int): Paragraphs kept per field.
+        token_budget (int): Maximum estimated tokens of the returned context.
+        lead_paragraphs (int): Leading paragraphs (title/abstract) always kept.
+        num_ctx (int): Context window of the LLM call; the budget is lowered so
+            the prompt and the reply fit it (see ``context_budget``).
+
+    Returns:
+        tuple: (context text, stats dict with full/context token counts).
+    """
+    fields = fields or TASK_FIELDS[task]
+    if num_ctx:
+        token_budget = context_budget(fields, num_ctx, token_budget)
+    full_tokens = estimate_tokens(text)
+    paragraphs = split_paragraphs(text)
+    stats = {"paragraphs": len(paragraphs), "selected": len(paragraphs),
+             "full_tokens": full_tokens, "context_tokens": full_tokens}
+    if full_tokens <= token_budget or len(paragraphs) <= lead_paragraphs + 1:
+        return text, stats
+
+    scores = rank_paragraphs(paragraphs, fields)
+    rankings = np.argsort(-scores, axis=1)[:, :top_k]
+
+    # Leading paragraphs first, then round-robin over fields by rank
+    candidates = list(range(min(lead_paragraphs, len(paragraphs))))
+    for rank in range(rankings.shape[1]):
+        candidates.extend(int(i) for i in rankings[:, rank])
+
+    chosen, used = set(), 0
+    for index in candidates:
+        if index in chosen:
+            continue
+        cost = estimate_tokens(paragraphs[index])
+        if used + cost > token_budget:
+            continue
+        chosen.add(index)
+        used += cost
+
+    context = "\n\n".join(paragraphs[i] for i in sorted(chosen))
+    stats.update(selected=len(chosen), context_tokens=estimate_tokens(context))
+    return context, stats
+
+
+def _content_words(text):
+    return {w for w in _WORD.findall(str(text).lower()) if len(w) > 2 and w not in _STOPWORDS}
+
+
+def field_recall(reference, context):
+    """Share of the annotated answer's content words that occur in the context (None if no answer)."""
+    if reference is None or (isinstance(reference, float) and np.isnan(reference)):
+        return None
+    words = _content_words(reference)
+    if not words:
+        return None
+    return len(words & _content_words(context)) / len(words)
+
+
+def recall_report(documents, annotations, ks, token_budget=3000, fields=None):
+    """Measure how much of each annotated answer survives context selection at every k.
+
+    Args:
+        documents (dict): Annotation row index -> full paper text.
+        annotations (pd.DataFrame): Canonical-column annotations (see pipeline.annotations).
+        ks (list): Values of top_k to try.
+        token_budget (int): Token budget passed to ``select_context``.
+        fields (list): Fields to check; defaults to all retrievable fields present.
+
+    Returns:
+        pd.DataFrame: One row per (k, field) with mean recall relative to the full text
+        and the mean prompt size.
+    """
+    fields = fields or [f for f in FIELD_QUERIES if f in annotations.columns]
+    rows = []
+    for k in ks:
+        for index, text in documents.items():
+            context, stats = select_context(text, fields=fields, top_k=k, token_budget=token_budget)
+            for field in fields:
+                reference = annotations.at[index, field]
+                full = field_recall(reference, text)
+                if not full:
+                    continue
+                rows.append({
+                    "k": k,
+                    "field": field,
+                    "full_text_recall": full,
+                    "context_recall": field_recall(reference, context),
+                    "full_tokens": stats["full_tokens"],
+                    "context_tokens": stats["context_tokens"],
+                })
+    detail = pd.DataFrame(rows)
+    if detail.empty:
+        return detail
+    report = detail.groupby(["k", "field"]).mean().reset_index()
+    report["relative_recall"] = report["context_recall"] / report["full_text_recall"]
+    report["token_reduction"] = report["full_tokens"] / report["context_tokens"]
+    return report
+
+
+def main():
+    from pipeline.annotations import load_annotations
+    from pipeline.assets import open_registry
+    from pipeline.documents import find_document, load_document_text
+
+    parser = argparse.ArgumentParser(description="Recall check for retrieval-guided context selection.")
+    parser.add_argument("--annotations", required=True, help="step_04 task4_human_annotated_data.csv")
+    parser.add_argument("--metadata", help="step 02 output used to map titles to PMCID/DOI")
+    parser.add_argument("--docs", required=True, help="folder with the downloaded XML/PDF files")
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 4, 6, 8])
+    parser.add_argument("--budget", type=int, default=3000)
+    parser.add_argument("--min-recall", type=float, default=0.95,
+                        help="relative recall the chosen k must keep (default 0.95)")
+    parser.add_argument("--output", help="optional CSV for the per-field report")
+    args = parser.parse_args()
+    setup_logging()
+
+    annotations = load_annotations(args.annotations, args.metadata)
+    registry = open_registry(args.docs)
+    documents = {}
+    for index, row in annotations.iterrows():
+        path = find_document(registry, pmcid=row.get("pmcid"), doi=row.get("doi"), pmid=row.get("pmid"))
+        if path is None:
+            continue
+        text = load_document_text(path)
+        if text:
+            documents[index] = text
+    print(f"Loaded {len(documents)} of {len(annotations)} annotated papers.")
+
+    report = recall_report(documents, annotations, args.k, args.budget)
+    if report.empty:
+        print("No annotated fields could be checked.")
+        return
+    print(report.to_string(index=False))
+    if args.output:
+        report.to_csv(args.output, index=False)
+
+    summary = report.groupby("k").agg(relative_recall=("relative_recall", "mean"),
+                                      token_reduction=("token_reduction", "mean"))
+    print(summary.to_string())
+    good = summary[summary["relative_recall"] >= args.min_recall]
+    if good.empty:
+        print(f"No k reaches {args.min_recall:.0%} relative recall; send the full text or raise the budget.")
+    else:
+        k = good.index.min()
+        print(f"Smallest k keeping {args.min_recall:.0%} recall: k={k} "
+              f"({good.at[k, 'token_reduction']:.1f}x fewer prompt tokens)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Full-text loading shared by the step 03 scripts.
+
+``extract_full_text`` reads PMC XML files (PubMed flow, see ``pipeline.jats``) and
+``extract_text_from_pdf`` reads preprint PDFs (bioRxiv/medRxiv flow, see
+``pipeline.pdf_text``).
+"""
+import logging
+import re
+from pathlib import Path
+
+from pipeline.assets import open_registry
+from pipeline.jats import cache_path, document_to_text, parse_cached, parse_many
+from pipeline.pdf_text import extract_text_from_pdf
+from pipeline.tracing import traced
+
+log = logging.getLogger(__name__)
+
+
+@traced("xml.extract_full_text")
+def extract_full_text(xml_file, cache_dir=None):
+    """Extracts the title, abstract, body sections and tables of a PMC XML paper (references excluded)."""
+    try:
+        return document_to_text(parse_cached(xml_file, cache_dir))
+    except Exception as e:
+        log.warning("Error parsing XML %s: %s", xml_file, e)
+        return None
+
+
+@traced("xml.extract_full_texts")
+def extract_full_texts(xml_files, cache_dir=None, workers=None):
+    """Extract many XML papers in a process pool; returns path (str) -> text."""
+    docs = parse_many(xml_files, cache_dir=cache_dir, workers=workers)
+    return {path: document_to_text(doc) for path, doc in docs.items()}
+
+
+def strip_references(text):
+    match = re.split(r'\bReferences\b|\bREFERENCES\b|\bBibliography\b', text, maxsplit=1)
+    return match[0].strip() if match else text.strip()
+
+
+def find_document(registry, pmcid=None, doi=None, pmid=None):
+    """Locate the downloaded XML or PDF of a paper through the asset registry, or None.
+
+    ``registry`` is an ``AssetRegistry`` or a document folder (scanned into its registry).
+    """
+    if not hasattr(registry, "lookup"):
+        registry = open_registry(registry)
+    record = registry.lookup(pmcid=pmcid, pmid=pmid, doi=doi)
+    return Path(record["path"]) if record else None
+
+
+def registered_xml_text(registry, record, cache_dir=None):
+    """Full text of a registered XML paper; the parse cache location is kept in the registry."""
+    text = extract_full_text(record["path"], cache_dir)
+    if text is not None and cache_dir and record.get("text_cache") is None:
+        cache_file = cache_path(record["path"], cache_dir)
+        registry.set_text_cache(record["path"], cache_file)
+        record["text_cache"] = str(cache_file)
+    return text
+
+
+def registered_pdf_text(registry, record):
+    """Raw text of a registered PDF, extracted once and then read from the registry's text cache."""
+    text = registry.cached_text(record)
+    if text is None:
+        text = extract_text_from_pdf(record["path"])
+        if text:
+            registry.store_text(record, text)
+    return text
+
+
+def load_document_text(path):
+    """Return the reference-stripped full text of an XML or PDF document."""
+    path = Path(path)
+    if path.suffix.lower() == ".xml":
+        return extract_full_text(path) or ""
+    return strip_references(extract_text_from_pdf(path))
@@ -0,0 +1,32 @@
+"""Lazily loaded sentence encoder shared by the step 03 helpers.
+
+This is the same ``all-MiniLM-L6-v2`` model the step 02 semantic filter uses,
+loaded once per process so that several helpers can reuse it.
+"""
+import numpy as np
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+
+_model = None
+
+
+def get_model():
+    """Return the shared SentenceTransformer instance, loading it on first use."""
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def encode(texts, batch_size=64):
+    """Encode a list of texts into L2-normalised embeddings (numpy array)."""
+    if not texts:
+        return np.zeros((0, 384), dtype=np.float32)
+    return get_model().encode(
+        list(texts),
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
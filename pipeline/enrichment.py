@@ -0,0 +1,167 @@
+"""Batched PubMed enrichment (first author's affiliation and publication types).
+
+Step 03 used to create a ``PubMedFetcher`` and fetch one article per paper
+inside the LLM loop. ``fetch_article_details`` instead pulls every PMID up
+front with batched EFetch calls and keeps the parsed details in a local JSON
+store, which the step 01 abstract fetcher also fills while it downloads
+records. PMIDs already in the store never hit NCBI again.
+"""
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import requests
+
+from pipeline.tracing import count, traced
+
+log = logging.getLogger(__name__)
+
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+# NCBI allows 3 requests/s without an API key and 10 with one
+BATCH_SIZE = 200
+
+# Default store of the step 01 abstract fetcher and the step 03 script; the
+# pipeline config (data_dir "data/pubmed") uses the same file
+DEFAULT_STORE = str(Path(__file__).resolve().parents[1] / "data" / "pubmed" / "pubmed_details.json")
+
+NOT_FOUND = {"primary_author_affiliation": "No article found", "publication_types": "Not available"}
+# PMIDs whose EFetch batch failed; never stored, so they are fetched again on the next call
+FETCH_FAILED = {"primary_author_affiliation": "PubMed fetch failed", "publication_types": "PubMed fetch failed"}
+
+
+def normalize_pmid(pmid):
+    """PMIDs come as int, float (pandas) or str; return the canonical string or None."""
+    if pmid is None:
+        return None
+    try:
+        if isinstance(pmid, float):
+            if pmid != pmid:
+                return None
+            pmid = int(pmid)
+        pmid = str(pmid).strip()
+        return pmid if pmid.isdigit() else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_article(article):
+    """Details of one ``<PubmedArticle>`` element, in the format the step 03 output uses."""
+    primary_author_affiliation = "No authors found"
+    author = article.find(".//AuthorList/Author")
+    if author is not None:
+        affiliation = author.find(".//AffiliationInfo/Affiliation")
+        if affiliation is None:
+            affiliation = author.find(".//Affiliation")
+        if affiliation is not None and affiliation.text:
+            primary_author_affiliation = affiliation.text.strip()
+    publication_types = [p.text for p in article.findall(".//PublicationType") if p.text]
+    return {
+        "primary_author_affiliation": primary_author_affiliation,
+        "publication_types": ", ".join(publication_types) if publication_types else "Publication type not available",
+    }
+
+
+def parse_pubmed_xml(xml_content):
+    """Parse an EFetch (or metapub ``article.xml``) payload into PMID -> details."""
+    if isinstance(xml_content, bytes):
+        xml_content = xml_content.decode("utf-8")
+    root = ET.fromstring(xml_content)
+    articles = [root] if root.tag == "PubmedArticle" else root.iter("PubmedArticle")
+    details = {}
+    for article in articles:
+        pmid = article.findtext(".//MedlineCitation/PMID")
+        if pmid:
+            details[pmid.strip()] = parse_article(article)
+    return details
+
+
+def load_store(path):
+    """Read the local PMID -> details store (empty if it does not exist yet)."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_store(path, store):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(store, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+@traced("ncbi.efetch_batch")
+def efetch_batch(pmids, api_key=None, max_retry=3, timeout=60):
+    """One EFetch round trip for up to ``BATCH_SIZE`` PMIDs (None if every attempt failed)."""
+    data = {"db": "pubmed", "id": ",".join(pmids), "retmode": "xml"}
+    if api_key:
+        data["api_key"] = api_key
+    for attempt in range(max_retry):
+        try:
+            response = requests.post(EFETCH_URL, data=data, timeout=timeout)
+            response.raise_for_status()
+            return parse_pubmed_xml(response.content)
+        except (requests.exceptions.RequestException, ET.ParseError) as e:
+            log.warning("EFetch batch failed (attempt %d/%d): %s", attempt + 1, max_retry, e)
+            count("ncbi.retries")
+            time.sleep(2 ** attempt)
+    return None
+
+
+def _fetch_batches(pmids, store, api_key, batch_size):
+    """EFetch ``pmids`` into ``store``; returns the PMIDs whose batch failed every attempt."""
+    delay = 0.11 if api_key else 0.34
+    failed = []
+    for start in range(0, len(pmids), batch_size):
+        batch = pmids[start:start + batch_size]
+        fetched = efetch_batch(batch, api_key=api_key)
+        if fetched is None:
+            failed.extend(batch)
+        else:
+            # Remember PMIDs NCBI has no record for, so they are not asked for again
+            store.update({pmid: fetched.get(pmid, NOT_FOUND) for pmid in batch})
+        time.sleep(delay)
+    return failed
+
+
+@traced("ncbi.fetch_article_details")
+def fetch_article_details(pmids, store_path=None, api_key=None, batch_size=BATCH_SIZE, retry_rounds=1,
+                          retry_delay=30):
+    """Affiliation and publication types for all ``pmids``, fetched in batches.
+
+    Args:
+        pmids (iterable): PMIDs (int, float or str; invalid values are skipped).
+        store_path (str): Local JSON store to read first and extend with new records.
+        api_key (str): Optional NCBI API key (defaults to the NCBI_API_KEY variable).
+        retry_rounds (int): Further rounds for the batches that failed, ``retry_delay`` seconds apart.
+
+    Returns:
+        dict: PMID (str) -> {"primary_author_affiliation", "publication_types"};
+        ``FETCH_FAILED`` for PMIDs that could not be fetched, ``NOT_FOUND`` for
+        PMIDs NCBI has no record for.
+    """
+    api_key = api_key or os.environ.get("NCBI_API_KEY")
+    store = load_store(store_path)
+    wanted = {p for p in map(normalize_pmid, pmids) if p}
+    missing = sorted(wanted - store.keys())
+    if missing:
+        log.info("Fetching PubMed details for %d PMIDs (%d already stored)", len(missing), len(wanted) - len(missing))
+    failed = _fetch_batches(missing, store, api_key, batch_size)
+    for _ in range(retry_rounds):
+        if not failed:
+            break
+        log.info("Retrying %d PMIDs whose EFetch batch failed", len(failed))
+        time.sleep(retry_delay)
+        failed = _fetch_batches(failed, store, api_key, batch_size)
+    if failed:
+        log.warning("No PubMed details for %d PMIDs after %d retry rounds; they are fetched again on the next run",
+                    len(failed), retry_rounds)
+    if store_path and missing:
+        save_store(store_path, store)
+    details = {pmid: store.get(pmid, NOT_FOUND) for pmid in wanted}
+    details.update((pmid, FETCH_FAILED) for pmid in failed)
+    return details
@@ -0,0 +1,347 @@
+"""Extraction quality of a step 03 output against the step 04 human annotations.
+
+Both CSVs are read under the canonical column names of
+``pipeline.annotations``. Records are then aligned by PMCID/DOI when both
+files have them, otherwise by exact title and finally by the most similar
+title. Every field gets a score in [0, 1] for each aligned paper:
+
+* closed fields (``Yes``/``No``, the seven subdomains): exact match;
+* list fields (AI method type, disease, underlying data, dataset): F1 over
+  the listed items, where an item counts as found when a listed item on the
+  other side shares most of its character trigrams (diseases are compared
+  by their canonical name, so "SARS-CoV-2" matches "COVID-19");
+* performance results: F1 over the (metric, value) pairs;
+* free-text fields: F1 over content words, as in ``pipeline.cascade``.
+
+A paper passes a field when its score reaches ``PASS_SCORE``. Papers
+without an annotated value are skipped for that field. The n-gram overlaps
+of all papers are computed at once with numpy, without a Python loop per
+pair, so scoring a whole output takes well under a second. Compare two
+runs (e.g. before and after a step 03 speed-up) with ``--baseline``:
+
+    python -m pipeline.evaluation --source pubmed
+    python -m pipeline.evaluation --output out/Extracted_fields.csv \
+        --annotations step_04_human_annotated_data/pubMed/task4_human_annotated_data.csv \
+        --baseline step_03_text_extraction_llm/pubMed/dataset/task3_llm_extraction_output.csv
+"""
+import argparse
+import ast
+import functools
+import json
+import re
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from pipeline.annotations import LLM_FIELDS, load_annotations, normalize_title
+from pipeline.prompts import FIELD_CHOICES, is_empty, normalize_choice
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+# Source -> (step 03 output, step 04 annotations) shipped with the repository
+SOURCE_FILES = {
+    "pubmed": ("step_03_text_extraction_llm/pubMed/dataset/task3_llm_extraction_output.csv",
+               "step_04_human_annotated_data/pubMed/task4_human_annotated_data.csv"),
+    "biorxiv": ("step_03_text_extraction_llm/bioRxiv/dataset/task3_llm_extraction_output.csv",
+                "step_04_human_annotated_data/bioRxiv/task4_human_annotated_data.csv"),
+    "medrxiv": ("step_03_text_extraction_llm/medRxiv/dataset/task3_llm_extraction_ground_truth.csv",
+                "step_04_human_annotated_data/medRxiv/task4_human_annotated_data.csv"),
+}
+
+LIST_FIELDS = {"ai_method_type", "disease_name", "type_of_underlying_data", "dataset_name"}
+METRIC_FIELDS = {"performance_results"}
+
+PASS_SCORE = 0.5
+# Character-trigram Dice similarity for two titles (or two list items) to be the same
+TITLE_MATCH = 0.85
+ITEM_MATCH = 0.6
+
+_WORD = re.compile(r"[a-z0-9]+")
+_ITEM_SPLIT = re.compile(r"\s*(?:[;,\n]|\band\b)\s*")
+_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "was", "were", "using",
+    "used", "based", "which", "their", "its", "into", "not", "specified", "null", "none",
+    "study", "paper", "research", "primary", "aim",
+}
+
+
+def field_kind(field):
+    if field in FIELD_CHOICES:
+        return "choice"
+    if field in LIST_FIELDS:
+        return "list"
+    if field in METRIC_FIELDS:
+        return "metrics"
+    return "text"
+
+
+def value_text(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return "" if is_empty(value) else str(value)
+
+
+def words(text):
+    """Content words of a text (lower case, stopwords and one-letter tokens dropped)."""
+    return {w for w in _WORD.findall(text.lower()) if len(w) > 1 and w not in _STOPWORDS}
+
+
+def trigrams(text):
+    text = f" {normalize_title(text)} "
+    return {text[i:i + 3] for i in range(len(text) - 2)} if len(text) > 3 else set()
+
+
+def list_items(field, value):
+    """Normalised items of a list-valued cell ("['CNN', 'LSTM']", "CNN, LSTM", ...)."""
+    if is_empty(value):
+        return []
+    return list(_cell_items(field, value if isinstance(value, str) else json.dumps(value)))
+
+
+# Cells repeat a lot across papers (e.g. "['COVID-19']"); each distinct one is parsed once
+@functools.lru_cache(maxsize=None)
+def _cell_items(field, value):
+    try:
+        value = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        value = _ITEM_SPLIT.split(value.strip("[]{}() "))
+    if isinstance(value, dict):
+        value = list(value.values())
+    if not isinstance(value, (list, tuple, set)):
+        value = [value]
+    items = []
+    for item in value:
+        text = normalize_title(str(item))
+        if field == "disease_name":
+            from pipeline.field_classifier import disease_mentions
+
+            canonical = disease_mentions(str(item))
+            if canonical:
+                items.extend(normalize_title(name) for name in canonical)
+                continue
+        if text and not is_empty(text):
+            items.append(text)
+    return tuple(dict.fromkeys(items))
+
+
+def metric_items(value):
+    """``"<metric>=<value>"`` items of a Performance Results cell (values rounded to the match tolerance)."""
+    if is_empty(value):
+        return []
+    return list(_cell_metrics(value if isinstance(value, str) else json.dumps(value)))
+
+
+@functools.lru_cache(maxsize=None)
+def _cell_metrics(value):
+    from pipeline.metric_miner import annotated_metrics
+
+    return tuple(f"{metric}={round(number, 2):g}" for metric, number in annotated_metrics(value).items())
+
+
+def overlaps(left, right, features):
+    """Feature overlap of every pair ``(left[i], right[i])`` in one pass.
+
+    Each text becomes a set of hashed features; (pair, feature) keys of both
+    sides are intersected with numpy.
+
+    Returns:
+        tuple: (shared features, left feature count, right feature count), arrays of ``len(left)``.
+    """
+    n = len(left)
+
+    def keys(texts):
+        rows, hashes = [], []
+        for i, text in enumerate(texts):
+            grams = features(text)
+            rows.extend([i] * len(grams))
+            hashes.extend(zlib.crc32(g.encode("utf-8")) for g in grams)
+        rows = np.asarray(rows, dtype=np.int64)
+        unique = np.unique((rows << 32) | np.asarray(hashes, dtype=np.int64))
+        return unique, np.bincount(unique >> 32, minlength=n)
+
+    left_keys, left_counts = keys(left)
+    right_keys, right_counts = keys(right)
+    shared = np.intersect1d(left_keys, right_keys, assume_unique=True)
+    return np.bincount(shared >> 32, minlength=n), left_counts, right_counts
+
+
+def dice(left, right, features):
+    shared, left_counts, right_counts = overlaps(left, right, features)
+    total = left_counts + right_counts
+    return np.divide(2 * shared, total, out=np.zeros(len(left)), where=total > 0)
+
+
+def set_f1(gold_items, predicted_items, exact=False):
+    """F1 of every pair of item lists; items match by trigram similarity (or exactly with ``exact``)."""
+    n = len(gold_items)
+    pairs = pd.DataFrame([(row, g, p) for row, (gold, predicted) in enumerate(zip(gold_items, predicted_items))
+                          for g in range(len(gold)) for p in range(len(predicted))],
+                         columns=["row", "gold", "predicted"])
+    gold_sizes = np.array([len(items) for items in gold_items])
+    predicted_sizes = np.array([len(items) for items in predicted_items])
+    if pairs.empty:
+        return np.zeros(n)
+    left = [gold_items[r][g] for r, g in zip(pairs["row"], pairs["gold"])]
+    right = [predicted_items[r][p] for r, p in zip(pairs["row"], pairs["predicted"])]
+    if exact:
+        pairs["match"] = [a == b for a, b in zip(left, right)]
+    else:
+        # The same item pairs come back in many papers; each distinct one is compared once
+        codes, unique = pd.factorize(pd.Series(list(zip(left, right))))
+        similarity = dice([a for a, _ in unique], [b for _, b in unique], trigrams)
+        pairs["match"] = similarity[codes] >= ITEM_MATCH
+    found = pairs.groupby(["row", "gold"])["match"].any().groupby(level=0).sum()
+    used = pairs.groupby(["row", "predicted"])["match"].any().groupby(level=0).sum()
+    recall = np.divide(found.reindex(range(n), fill_value=0).to_numpy(), gold_sizes,
+                       out=np.zeros(n), where=gold_sizes > 0)
+    precision = np.divide(used.reindex(range(n), fill_value=0).to_numpy(), predicted_sizes,
+                          out=np.zeros(n), where=predicted_sizes > 0)
+    total = precision + recall
+    return np.divide(2 * precision * recall, total, out=np.zeros(n), where=total > 0)
+
+
+def score_field(field, gold, predicted):
+    """Scores of ``predicted`` against ``gold`` (aligned Series); NaN where there is no annotated value."""
+    gold, predicted = list(gold), list(predicted)
+    annotated = np.array([not is_empty(v) for v in gold])
+    answered = np.array([not is_empty(v) for v in predicted])
+    kind = field_kind(field)
+    if kind == "choice":
+        scores = np.array([normalize_choice(field, str(g).strip()) == normalize_choice(field, str(p).strip())
+                           for g, p in zip(gold, predicted)], dtype=float)
+    elif kind == "list":
+        scores = set_f1([list_items(field, v) for v in gold], [list_items(field, v) for v in predicted])
+    elif kind == "metrics":
+        scores = set_f1([metric_items(v) for v in gold], [metric_items(v) for v in predicted], exact=True)
+    else:
+        scores = dice([value_text(v) for v in gold], [value_text(v) for v in predicted], words)
+    return np.where(annotated, np.where(answered, scores, 0.0), np.nan)
+
+
+def align(annotations, outputs):
+    """Pairs of (annotation row, output row) for the same paper.
+
+    Papers are matched by PMCID or DOI, then by exact normalised title, then
+    by the most similar remaining title (trigram Dice of at least ``TITLE_MATCH``).
+
+    Returns:
+        pd.DataFrame: ``annotation``, ``output`` (index labels) and ``matched_by``.
+    """
+    pairs = []
+    free_annotations, free_outputs = set(annotations.index), set(outputs.index)
+
+    def take(by, candidates):
+        for a, o in candidates:
+            if a in free_annotations and o in free_outputs:
+                free_annotations.discard(a)
+                free_outputs.discard(o)
+                pairs.append((a, o, by))
+
+    for column in ("pmcid", "doi"):
+        if column in annotations.columns and column in outputs.columns:
+            keys = outputs[column].dropna().astype(str).str.strip().str.lower()
+            lookup = dict(zip(keys, keys.index))
+            gold = annotations[column].dropna().astype(str).str.strip().str.lower()
+            take(column, [(a, lookup[key]) for a, key in gold.items() if key in lookup])
+    lookup = dict(zip(outputs["title_key"], outputs.index))
+    take("title", [(a, lookup.get(key)) for a, key in annotations["title_key"].items() if key])
+
+    rest_a = [a for a in annotations.index if a in free_annotations and annotations.at[a, "title_key"]]
+    rest_o = [o for o in outputs.index if o in free_outputs and outputs.at[o, "title_key"]]
+    if rest_a and rest_o:
+        cross = pd.MultiIndex.from_product([rest_a, rest_o])
+        similarity = dice([annotations.at[a, "title_key"] for a, _ in cross],
+                          [outputs.at[o, "title_key"] for _, o in cross], trigrams)
+        order = np.argsort(-similarity, kind="stable")
+        take("fuzzy title", [cross[i] for i in order if similarity[i] >= TITLE_MATCH])
+    return pd.DataFrame(pairs, columns=["annotation", "output", "matched_by"])
+
+
+def evaluate(annotations, outputs, fields=None):
+    """Per-field quality of ``outputs`` against ``annotations`` (both from ``load_annotations``).
+
+    Returns:
+        tuple: (report DataFrame indexed by field with ``kind``, ``papers``,
+        ``answered``, ``mean_score`` and ``accuracy``; the alignment DataFrame
+        with one score column per field).
+    """
+    pairs = align(annotations, outputs)
+    fields = [f for f in (fields or LLM_FIELDS) if f in annotations.columns and f in outputs.columns]
+    rows = []
+    for field in fields:
+        gold = annotations.loc[pairs["annotation"], field]
+        predicted = outputs.loc[pairs["output"], field]
+        scores = score_field(field, gold, predicted)
+        pairs[field] = scores
+        scored = ~np.isnan(scores)
+        answered = np.array([not is_empty(v) for v in predicted])
+        rows.append({"field": field, "kind": field_kind(field), "papers": int(scored.sum()),
+                     "answered": int((answered & scored).sum()),
+                     "mean_score": float(np.nanmean(scores)) if scored.any() else np.nan,
+                     "accuracy": float((scores[scored] >= PASS_SCORE).mean()) if scored.any() else np.nan})
+    return pd.DataFrame(rows).set_index("field"), pairs
+
+
+def format_report(report, pairs, annotations, outputs, baseline=None):
+    counts = pairs["matched_by"].value_counts()
+    lines = [f"{len(pairs)} of {len(annotations)} annotated papers aligned with {len(outputs)} output rows ("
+             + ", ".join(f"{n} by {by}" for by, n in counts.items()) + ")",
+             f"{'field':<34}{'kind':>8}{'papers':>8}{'answered':>10}{'score':>8}{'accuracy':>10}"
+             + (f"{'baseline':>10}{'delta':>8}" if baseline is not None else "")]
+    for field, row in report.iterrows():
+        line = (f"{field:<34}{row['kind']:>8}{row['papers']:>8}{row['answered']:>10}"
+                f"{row['mean_score']:>8.2f}{row['accuracy']:>10.0%}")
+        if baseline is not None and field in baseline.index:
+            before = baseline.at[field, "accuracy"]
+            line += f"{before:>10.0%}{(row['accuracy'] - before) * 100:>+7.0f}%"
+        lines.append(line)
+    if len(report):
+        line = f"{'mean':<34}{'':>26}{report['mean_score'].mean():>8.2f}{report['accuracy'].mean():>10.0%}"
+        if baseline is not None:
+            before = baseline["accuracy"].reindex(report.index).mean()
+            line += f"{before:>10.0%}{(report['accuracy'].mean() - before) * 100:>+7.0f}%"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a step 03 output against the step 04 human annotations.")
+    parser.add_argument("--source", choices=sorted(SOURCE_FILES),
+                        help="use the repository's step 03 output and step 04 annotations of this source")
+    parser.add_argument("--output", help="step 03 output CSV (default: that of --source)")
+    parser.add_argument("--annotations", help="step 04 annotated CSV (default: that of --source)")
+    parser.add_argument("--metadata", help="step 02 output used to fill in PMCID/DOI by title")
+    parser.add_argument("--baseline", help="another step 03 output to compare with (e.g. before a change)")
+    parser.add_argument("--fields", nargs="+", choices=LLM_FIELDS, help="score only these fields")
+    parser.add_argument("--details", help="write the per-paper scores to this CSV")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    if not args.source and not (args.output and args.annotations):
+        parser.error("give --source or both --output and --annotations")
+    default_output, default_annotations = SOURCE_FILES.get(args.source, (None, None))
+
+    start = time.perf_counter()
+    annotations = load_annotations(args.annotations or REPO_ROOT / default_annotations, args.metadata)
+    outputs = load_annotations(args.output or REPO_ROOT / default_output)
+    report, pairs = evaluate(annotations, outputs, args.fields)
+    baseline = evaluate(annotations, load_annotations(args.baseline), args.fields)[0] if args.baseline else None
+    seconds = time.perf_counter() - start
+
+    if args.details:
+        details = pairs.assign(title=annotations.loc[pairs["annotation"], "title"].to_numpy())
+        details.to_csv(args.details, index=False)
+    if args.json:
+        result = {"papers": len(pairs), "seconds": round(seconds, 3),
+                  "fields": json.loads(report.to_json(orient="index"))}
+        if baseline is not None:
+            result["baseline"] = json.loads(baseline.to_json(orient="index"))
+        print(json.dumps(result, indent=2))
+    else:
+        print(format_report(report, pairs, annotations, outputs, baseline))
+        print(f"Scored in {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
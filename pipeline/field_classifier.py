@@ -0,0 +1,434 @@
+"""Fast labels for the closed step 03 fields without a full-text LLM call.
+
+``virology_subdomain`` is one of seven fixed labels and ``disease_name`` is
+nearly always one of a short list of viral and infectious diseases
+(``DISEASE_ALIASES``), so both can be labelled from the title and abstract in
+a few milliseconds:
+
+* Subdomain: nearest centroid over the step 02 MiniLM embeddings. Each label's
+  centroid is the mean of its human-annotated papers (step 04) plus a short
+  description of the label, so labels without examples still get one.
+* Disease name: diseases mentioned in the title/abstract (by name or common
+  alias, title mentions counted three times); the closest disease by
+  embedding is used only as a low-confidence guess.
+
+A prediction is confident when the subdomain margin (best minus second-best
+similarity) or the disease mention count passes a threshold calibrated on the
+annotations for a target accuracy. The step 03 scripts take confident labels
+as they are and ask the LLM only for the rest.
+
+    python -m pipeline.field_classifier train --output field_classifier.npz \
+        --annotations step_04_human_annotated_data/*/task4_human_annotated_data.csv \
+        --metadata step_02_semantic_filtering/{pubMed,bioRxiv,medRxiv}/dataset/semantic_filtering_final_data/final_semantically_filtered_dataset.csv
+    python -m pipeline.field_classifier evaluate --model field_classifier.npz --annotations ... --metadata ... \
+        --llm-output step_03_text_extraction_llm/pubMed/dataset/task3_llm_extraction_output.csv
+"""
+import argparse
+import ast
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from pipeline.embeddings import encode
+from pipeline.logs import setup_logging
+from pipeline.prompts import VIROLOGY_SUBDOMAINS
+
+log = logging.getLogger(__name__)
+
+CLASSIFIER_FIELDS = ["virology_subdomain", "disease_name"]
+
+SUBDOMAIN_DESCRIPTIONS = {
+    "Respiratory Virology": "Respiratory viruses such as influenza, RSV, SARS-CoV-2 and COVID-19 pneumonia.",
+    "Neurovirology": "Viruses affecting the nervous system such as rabies, Zika, HSV and viral encephalitis.",
+    "Hepatic Virology": "Liver viruses such as hepatitis B, hepatitis C and viral hepatitis.",
+    "Viral Immunology": "How viruses interact with the immune system, antibodies, T cells and vaccine response.",
+    "Emerging & Re-emerging Viruses": ("Emerging or re-emerging viruses and outbreaks such as COVID-19, "
+                                       "Monkeypox, Nipah, dengue and Zika."),
+    "Zoonotic Virology": "Viruses that jump from animals to humans such as Ebola, Nipah, avian influenza and bats.",
+    "General Virology": "Virology in general, viral genomes, virus discovery and infectious diseases.",
+}
+
+# Hand-curated viral and other infectious diseases with the spellings seen in
+# the annotations (canonical name -> aliases). It is not read from the step 02
+# target sentences; a disease added there needs an entry here as well.
+DISEASE_ALIASES = {
+    "COVID-19": ["COVID-19", "COVID19", "COVID", "SARS-CoV-2", "2019-nCoV", "coronavirus disease 2019",
+                 "severe acute respiratory syndrome coronavirus 2", "novel coronavirus"],
+    "SARS": ["SARS-CoV-1", "SARS-CoV", "SARS", "severe acute respiratory syndrome"],
+    "MERS": ["MERS-CoV", "MERS", "Middle East Respiratory Syndrome"],
+    "Influenza": ["influenza", "flu", "H1N1", "H3N2", "H5N1", "H7N9", "avian influenza"],
+    "Respiratory Syncytial Virus": ["respiratory syncytial virus", "RSV"],
+    "HIV": ["HIV", "AIDS", "human immunodeficiency virus"],
+    "Hepatitis A": ["hepatitis A", "HAV"],
+    "Hepatitis B": ["hepatitis B", "HBV"],
+    "Hepatitis C": ["hepatitis C", "HCV"],
+    "Hepatitis E": ["hepatitis E", "HEV"],
+    "Hepatitis": ["hepatitis", "viral hepatitis"],
+    "Dengue": ["dengue", "DENV"],
+    "Zika": ["Zika", "ZIKV"],
+    "Chikungunya": ["chikungunya", "CHIKV"],
+    "West Nile Virus": ["West Nile", "WNV"],
+    "Yellow Fever": ["yellow fever"],
+    "Ebola": ["Ebola", "EBOV", "Ebola virus disease"],
+    "Marburg": ["Marburg"],
+    "Lassa": ["Lassa"],
+    "Nipah": ["Nipah"],
+    "Hantavirus": ["hantavirus"],
+    "Monkeypox": ["monkeypox", "mpox"],
+    "Smallpox": ["smallpox", "variola"],
+    "Measles": ["measles"],
+    "Rubella": ["rubella", "German measles"],
+    "Mumps": ["mumps"],
+    "Rabies": ["rabies"],
+    "Human Papillomavirus": ["human papillomavirus", "HPV"],
+    "Herpes Simplex": ["herpes simplex", "HSV"],
+    "Varicella": ["varicella", "chickenpox", "herpes zoster", "shingles", "VZV"],
+    "Cytomegalovirus": ["cytomegalovirus", "CMV"],
+    "Norovirus": ["norovirus"],
+    "Rotavirus": ["rotavirus"],
+    "Enterovirus": ["enterovirus", "EV-D68", "EV71"],
+    "Poliomyelitis": ["poliomyelitis", "poliovirus", "polio"],
+    "Tuberculosis": ["tuberculosis"],
+    "Malaria": ["malaria", "Plasmodium"],
+    "Babesiosis": ["babesiosis", "Babesia"],
+    "Lyme Disease": ["Lyme disease", "Lyme"],
+    "Cholera": ["cholera", "Vibrio cholerae"],
+}
+
+DEFAULT_MIN_MARGIN = 0.05
+DEFAULT_MIN_MENTIONS = 2
+TARGET_ACCURACY = 0.9
+TITLE_WEIGHT = 3
+
+# Longest aliases first, so "SARS-CoV-2" is consumed before "SARS" can match it;
+# short acronyms are case-sensitive ("AIDS" but not "aids")
+_ALIAS_PATTERNS = [
+    (re.compile(r"(?<![A-Za-z0-9])" + re.escape(alias) + r"(?![A-Za-z0-9])",
+                0 if alias.isupper() and len(alias) <= 4 else re.IGNORECASE), canonical)
+    for alias, canonical in sorted(((a, c) for c, aliases in DISEASE_ALIASES.items() for a in aliases),
+                                   key=lambda pair: -len(pair[0]))
+]
+
+
+def canonical_subdomain(label):
+    """One of the seven subdomains for an annotated label, or None for anything else."""
+    if not isinstance(label, str):
+        return None
+    key = label.strip().lower()
+    for subdomain in VIROLOGY_SUBDOMAINS:
+        if subdomain.lower() == key:
+            return subdomain
+    return None
+
+
+def disease_mentions(title, abstract=""):
+    """Canonical disease -> weighted mention count in the title and abstract."""
+    counts = {}
+    for text, weight in ((title, TITLE_WEIGHT), (abstract, 1)):
+        if not isinstance(text, str):
+            continue
+        for pattern, canonical in _ALIAS_PATTERNS:
+            text, hits = pattern.subn(" ", text)
+            if hits:
+                counts[canonical] = counts.get(canonical, 0) + hits * weight
+    return counts
+
+
+def parse_disease_list(value):
+    """Canonical diseases of an annotated or extracted "Disease Name" value (e.g. "['COVID-19']")."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return set()
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+    names = value if isinstance(value, (list, tuple, set)) else [value]
+    return {canonical for name in names for canonical in disease_mentions(str(name))}
+
+
+def paper_text(row):
+    """(title, abstract) of an input row, whatever the source's column names are."""
+    from pipeline.annotations import column_map
+
+    columns = column_map(row.keys())
+    title = row.get(columns["title"]) if "title" in columns else ""
+    abstract = row.get(columns["abstract"]) if "abstract" in columns else ""
+    return (title if isinstance(title, str) else ""), (abstract if isinstance(abstract, str) else "")
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class FieldClassifier:
+    """Nearest-centroid subdomain and mention-based disease labels with confidence thresholds.
+
+    Args:
+        labels (list): Subdomain of each centroid row.
+        sums (np.ndarray): Per-label sum of the example embeddings plus the description embedding.
+        counts (np.ndarray): Number of annotated examples per label.
+        min_margin (float): Subdomain margin needed for a confident label.
+        min_mentions (int): Weighted disease mentions needed for a confident label.
+    """
+
+    def __init__(self, labels, sums, counts, min_margin=DEFAULT_MIN_MARGIN, min_mentions=DEFAULT_MIN_MENTIONS):
+        self.labels = list(labels)
+        self.sums = np.asarray(sums, dtype=np.float32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.centroids = _normalize(self.sums)
+        self.min_margin = float(min_margin)
+        self.min_mentions = int(min_mentions)
+        self._disease_names = list(DISEASE_ALIASES)
+        self._disease_embeddings = None
+        self.stats = {"papers": 0, **{f"{field}_confident": 0 for field in CLASSIFIER_FIELDS}}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def train(cls, embeddings, subdomains):
+        """Centroids from annotated papers (``subdomains`` already canonical, None skipped)."""
+        labels = list(SUBDOMAIN_DESCRIPTIONS)
+        sums = encode(list(SUBDOMAIN_DESCRIPTIONS.values())).astype(np.float32)
+        counts = np.zeros(len(labels), dtype=np.int64)
+        for embedding, subdomain in zip(embeddings, subdomains):
+            if subdomain in labels:
+                sums[labels.index(subdomain)] += embedding
+                counts[labels.index(subdomain)] += 1
+        return cls(labels, sums, counts)
+
+    def save(self, path):
+        np.savez(path, labels=np.array(self.labels), sums=self.sums, counts=self.counts,
+                 min_margin=self.min_margin, min_mentions=self.min_mentions)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls([str(label) for label in data["labels"]], data["sums"], data["counts"],
+                   float(data["min_margin"]), int(data["min_mentions"]))
+
+    def subdomain_scores(self, embeddings):
+        """(best label index, margin) per row of ``embeddings``."""
+        similarities = np.atleast_2d(embeddings) @ self.centroids.T
+        ranked = np.sort(similarities, axis=1)
+        return similarities.argmax(axis=1), ranked[:, -1] - ranked[:, -2]
+
+    def predict_disease(self, title, abstract="", embedding=None):
+        """(list of diseases, weighted mentions of the top one); mentions are 0 for an embedding guess."""
+        mentions = disease_mentions(title, abstract)
+        if mentions:
+            top = max(mentions.values())
+            diseases = sorted((d for d, n in mentions.items() if n * 2 >= top), key=lambda d: -mentions[d])
+            return diseases, top
+        if embedding is None:
+            return [], 0
+        if self._disease_embeddings is None:
+            self._disease_embeddings = encode([", ".join(DISEASE_ALIASES[name]) for name in self._disease_names])
+        return [self._disease_names[int((self._disease_embeddings @ embedding).argmax())]], 0
+
+    def classify(self, title, abstract="", embedding=None):
+        """Labels of one paper: field -> {"value", "score", "confident"}."""
+        if embedding is None:
+            embedding = encode([f"{title}. {abstract}".strip(". ")])[0]
+        index, margin = self.subdomain_scores(embedding)
+        diseases, mentions = self.predict_disease(title, abstract, embedding)
+        return {
+            "virology_subdomain": {"value": self.labels[int(index[0])], "score": float(margin[0]),
+                                   "confident": bool(margin[0] >= self.min_margin)},
+            "disease_name": {"value": diseases, "score": mentions,
+                             "confident": bool(diseases) and mentions >= self.min_mentions},
+        }
+
+    def confident_fields(self, title, abstract=""):
+        """Field -> value for the fields that need no LLM call for this paper."""
+        if not (title or abstract):
+            return {}
+        labels = self.classify(title, abstract)
+        confident = {field: label["value"] for field, label in labels.items() if label["confident"]}
+        with self._lock:
+            self.stats["papers"] += 1
+            for field in confident:
+                self.stats[f"{field}_confident"] += 1
+        return confident
+
+    def summary(self):
+        papers = self.stats["papers"]
+        if not papers:
+            return "Field classifier: no papers classified"
+        parts = [f"{field} {self.stats[f'{field}_confident']}/{papers}" for field in CLASSIFIER_FIELDS]
+        return "Field classifier labelled without the LLM: " + ", ".join(parts)
+
+
+def load_classifier(path):
+    """The classifier saved at ``path``, or None when no path is given."""
+    if not path:
+        return None
+    classifier = FieldClassifier.load(path)
+    log.info("Loaded field classifier %s (subdomain margin >= %.3f, disease mentions >= %d)",
+             path, classifier.min_margin, classifier.min_mentions)
+    return classifier
+
+
+def load_training_data(annotation_paths, metadata_paths=None):
+    """Annotated papers of all sources with title, abstract, subdomain and disease columns."""
+    from pipeline.annotations import load_annotations
+
+    metadata_paths = list(metadata_paths or [])
+    frames = []
+    for i, path in enumerate(annotation_paths):
+        metadata = metadata_paths[i] if i < len(metadata_paths) else None
+        df = load_annotations(path, metadata, fill_columns=("pmid", "pmcid", "doi", "abstract"))
+        for column in ("title", "abstract", "virology_subdomain", "disease_name"):
+            if column not in df.columns:
+                df[column] = None
+        df["source"] = path
+        frames.append(df[["source", "title", "title_key", "abstract", "virology_subdomain", "disease_name"]])
+    data = pd.concat(frames, ignore_index=True)
+    data["title"] = data["title"].where(data["title"].map(lambda v: isinstance(v, str)), "")
+    data["abstract"] = data["abstract"].where(data["abstract"].map(lambda v: isinstance(v, str)), "")
+    return data[data["title"].str.strip() != ""].reset_index(drop=True)
+
+
+def embed_papers(data):
+    return encode([f"{t}. {a}".strip(". ") for t, a in zip(data["title"], data["abstract"])])
+
+
+def _calibrate(scores, correct, candidates, target):
+    """Lowest threshold whose confident predictions reach ``target`` accuracy (None if none does)."""
+    for threshold in candidates:
+        chosen = scores >= threshold
+        if chosen.any() and correct[chosen].mean() >= target:
+            return threshold
+    return None
+
+
+def leave_one_out_subdomains(classifier, embeddings, subdomains):
+    """Predicted label index and margin of every annotated paper, without its own vote."""
+    predicted = np.full(len(subdomains), -1)
+    margins = np.zeros(len(subdomains))
+    for i, (embedding, subdomain) in enumerate(zip(embeddings, subdomains)):
+        sums = classifier.sums.copy()
+        if subdomain in classifier.labels:
+            sums[classifier.labels.index(subdomain)] -= embedding
+        similarities = _normalize(sums) @ embedding
+        ranked = np.sort(similarities)
+        predicted[i], margins[i] = similarities.argmax(), ranked[-1] - ranked[-2]
+    return predicted, margins
+
+
+def evaluate(classifier, data, embeddings, llm_outputs=None, target=TARGET_ACCURACY, calibrate=False):
+    """Accuracy of both fields against the annotations (leave-one-out for the subdomain).
+
+    Args:
+        classifier (FieldClassifier): Trained classifier.
+        data (pd.DataFrame): Output of ``load_training_data``.
+        embeddings (np.ndarray): ``embed_papers(data)``.
+        llm_outputs (pd.DataFrame): Optional step 03 outputs (canonical columns with
+            ``title_key``) to compare the LLM's answers on the same papers.
+        target (float): Accuracy the confident predictions must reach when calibrating.
+        calibrate (bool): Set the classifier's thresholds from this data.
+
+    Returns:
+        str: Printable report.
+    """
+    lines = []
+    llm = llm_outputs.drop_duplicates("title_key").set_index("title_key") if llm_outputs is not None else None
+
+    gold = data["virology_subdomain"].map(canonical_subdomain)
+    labelled = gold.notna().to_numpy()
+    predicted, margins = leave_one_out_subdomains(classifier, embeddings[labelled], list(gold[labelled]))
+    correct = np.array([classifier.labels[p] == g for p, g in zip(predicted, gold[labelled])])
+    if calibrate and len(correct):
+        threshold = _calibrate(margins, correct, np.unique(margins), target)
+        classifier.min_margin = float(threshold if threshold is not None else np.inf)
+    lines.append(f"Subdomain: {int(labelled.sum())} annotated papers "
+                 f"({int(data['virology_subdomain'].notna().sum() - labelled.sum())} with labels outside the seven skipped)")
+    if len(correct):
+        confident = margins >= classifier.min_margin
+        lines.append(f"  classifier accuracy (leave-one-out): {correct.mean():.0%}")
+        lines.append(f"  confident (margin >= {classifier.min_margin:.3f}): {confident.mean():.0%} of papers, "
+                     + (f"{correct[confident].mean():.0%} accurate" if confident.any() else "none")
+                     + f"; {1 - confident.mean():.0%} go to the LLM")
+    if llm is not None and "virology_subdomain" in llm.columns:
+        answers = data.loc[labelled, "title_key"].map(llm["virology_subdomain"]).map(canonical_subdomain)
+        answered = answers.notna()
+        if answered.any():
+            llm_correct = (answers[answered] == gold[labelled][answered]).mean()
+            mine = correct[answered.to_numpy()].mean()
+            lines.append(f"  LLM accuracy on the {int(answered.sum())} papers it labelled: {llm_correct:.0%} "
+                         f"(classifier {mine:.0%} on the same papers)")
+
+    gold_diseases = data["disease_name"].map(parse_disease_list)
+    has_gold = gold_diseases.map(bool).to_numpy()
+    results = [classifier.predict_disease(t, a, e) for t, a, e in
+               zip(data.loc[has_gold, "title"], data.loc[has_gold, "abstract"], embeddings[has_gold])]
+    hits = np.array([bool(diseases) and diseases[0] in g for (diseases, _), g in zip(results, gold_diseases[has_gold])])
+    mentions = np.array([n for _, n in results])
+    if calibrate and len(hits):
+        threshold = _calibrate(mentions, hits, [1, 2, 3, 4, 6, 8], target)
+        classifier.min_mentions = int(threshold if threshold is not None else 10 ** 6)
+    lines.append(f"Disease name: {int(has_gold.sum())} annotated papers with a known disease")
+    if len(hits):
+        confident = mentions >= classifier.min_mentions
+        lines.append(f"  classifier top disease correct: {hits.mean():.0%}")
+        lines.append(f"  confident (mentions >= {classifier.min_mentions}): {confident.mean():.0%} of papers, "
+                     + (f"{hits[confident].mean():.0%} accurate" if confident.any() else "none")
+                     + f"; {1 - confident.mean():.0%} go to the LLM")
+    if llm is not None and "disease_name" in llm.columns:
+        answers = data.loc[has_gold, "title_key"].map(llm["disease_name"]).map(parse_disease_list)
+        answered = answers.map(bool).to_numpy()
+        if answered.any():
+            llm_hits = np.array([bool(a & g) for a, g in zip(answers[answered], gold_diseases[has_gold][answered])])
+            lines.append(f"  LLM answer contains an annotated disease on {llm_hits.mean():.0%} of the "
+                         f"{int(answered.sum())} papers it answered (classifier {hits[answered].mean():.0%})")
+
+    sample = data.head(50)
+    start = time.perf_counter()
+    for title, abstract in zip(sample["title"], sample["abstract"]):
+        classifier.classify(title, abstract)
+    if len(sample):
+        lines.append(f"Classification: {(time.perf_counter() - start) / len(sample) * 1000:.1f} ms/paper "
+                     f"(encoder already loaded)")
+    return "\n".join(lines)
+
+
+def main():
+    from pipeline.annotations import load_annotations
+
+    parser = argparse.ArgumentParser(description="Embedding classifier for the subdomain and disease fields.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("train", "build centroids and calibrate thresholds from the annotations"),
+                            ("evaluate", "report accuracy of a saved classifier")):
+        command = sub.add_parser(name, help=help_text)
+        command.add_argument("--annotations", nargs="+", required=True, help="step 04 annotated CSVs")
+        command.add_argument("--metadata", nargs="+", help="step 02 outputs with abstracts, in the same order")
+        command.add_argument("--llm-output", nargs="+", help="step 03 outputs to compare the LLM's answers")
+        command.add_argument("--target", type=float, default=TARGET_ACCURACY,
+                             help="accuracy of confident predictions when calibrating (default 0.9)")
+    sub.choices["train"].add_argument("--output", required=True, help="file for the classifier (.npz)")
+    sub.choices["evaluate"].add_argument("--model", required=True)
+    args = parser.parse_args()
+    setup_logging()
+
+    data = load_training_data(args.annotations, args.metadata)
+    print(f"{len(data)} annotated papers, {int((data['abstract'] != '').sum())} with an abstract")
+    embeddings = embed_papers(data)
+    llm_outputs = None
+    if args.llm_output:
+        llm_outputs = pd.concat([load_annotations(path) for path in args.llm_output], ignore_index=True)
+
+    if args.command == "train":
+        classifier = FieldClassifier.train(embeddings, list(data["virology_subdomain"].map(canonical_subdomain)))
+        print(evaluate(classifier, data, embeddings, llm_outputs, args.target, calibrate=True))
+        classifier.save(args.output)
+        print(f"Saved field classifier to {args.output}")
+    else:
+        print(evaluate(FieldClassifier.load(args.model), data, embeddings, llm_outputs, args.target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""Ollama chat calls with per-paper token and latency accounting.
+
+Every ollama chat response carries ``prompt_eval_count``, ``eval_count`` and
+the prompt-eval, generation and model-load durations (in nanoseconds).
+``LLMMetrics.chat`` keeps these for each call together with the wall-clock
+time, and the scripts add the retry count and how the reply was parsed. The
+per-paper table is appended to ``<output>.llm_metrics.csv`` and summarised at
+the end of a run (latency percentiles, tokens/s, prompt-eval vs generation
+share, truncated and slowest papers). An existing table can be summarised
+again with:
+
+    python -m pipeline.llm_client report path/to/Extracted_fields.llm_metrics.csv
+
+Replies are streamed. ``JsonStreamTracker`` follows the JSON nesting depth of
+the streamed text and generation is stopped as soon as the top-level object
+closes (the model otherwise keeps explaining its answer), or when a single
+field grows past ``FIELD_CHAR_CAP`` characters, in which case the object is
+closed at that point. A stopped stream never gets ollama's final chunk, so the
+token counts and durations of such a call are estimated on the client and the
+call is counted in ``estimated_calls``. With ``LLM_EARLY_STOP=0`` the full
+reply is consumed and the tokens generated after the object closed are
+counted instead, which is what early stop saves per paper.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import ollama
+
+from pipeline.prompts import MAX_FIELD_CHARS
+from pipeline.tracing import span
+
+log = logging.getLogger(__name__)
+
+MODEL = "llama3.2:3b"
+# Context window sent with every call (unless the caller's options set num_ctx);
+# prompts at or above it have been cut by the server
+NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", 4096))
+
+# Stop streaming once the top-level JSON object is closed
+EARLY_STOP = os.environ.get("LLM_EARLY_STOP", "1") != "0"
+# Longest value (characters) a single top-level field may stream before it is cut
+FIELD_CHAR_CAP = int(os.environ.get("LLM_FIELD_CHAR_CAP", MAX_FIELD_CHARS))
+
+# Parse outcomes recorded by the scripts
+PARSE_OK = "ok"
+PARSE_RECOVERED = "recovered"
+PARSE_NO_JSON = "no_json"
+PARSE_INVALID_JSON = "invalid_json"
+PARSE_ERROR = "error"
+
+PAPER_COLUMNS = [
+    "paper_id", "calls", "retries", "errors", "wall_seconds", "load_seconds", "prompt_eval_seconds",
+    "eval_seconds", "prompt_tokens", "eval_tokens", "num_ctx", "truncated", "parse_outcome",
+    "stopped_early", "capped_fields", "tokens_after_json", "estimated_calls",
+]
+
+_NS = 1e9
+
+
+def _field(response, name):
+    """Read a count or duration from a dict-style or object-style ollama response."""
+    try:
+        value = response[name]
+    except (KeyError, TypeError, AttributeError):
+        value = getattr(response, name, None)
+    return value or 0
+
+
+class JsonStreamTracker:
+    """Incremental JSON depth tracker over streamed text.
+
+    ``feed`` returns True once the first top-level object has closed or one of
+    its fields has streamed more than ``max_field_chars`` characters; ``text()``
+    is then the reply up to that point, with the open string and brackets
+    closed after a cap.
+    """
+
+    _CLOSERS = {"{": "}", "[": "]"}
+
+    def __init__(self, max_field_chars=None):
+        self.max_field_chars = max_field_chars
+        self.parts = []
+        self.length = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.key_chars = None
+        self.key = None
+        self.value_start = None
+        self.done = False
+        self.capped_field = None
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+        for i, c in enumerate(chunk):
+            pos = self.length + i
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.key_chars is not None:
+                        self.key, self.key_chars = "".join(self.key_chars), None
+                if self.key_chars is not None and self.in_string:
+                    self.key_chars.append(c)
+            elif not self.stack:
+                # Text before the object (e.g. "Here is the JSON:") is kept but not tracked
+                if c == "{":
+                    self.stack.append(c)
+            elif c == '"':
+                self.in_string = True
+                # A string at depth 1 outside a value is a key
+                if len(self.stack) == 1 and self.value_start is None:
+                    self.key_chars = []
+            elif c in self._CLOSERS:
+                self.stack.append(c)
+            elif c in "}]":
+                self.stack.pop()
+                if not self.stack:
+                    return self._stop(chunk, i + 1)
+            elif len(self.stack) == 1 and c == ":":
+                self.value_start = pos + 1
+            elif len(self.stack) == 1 and c == ",":
+                self.value_start = None
+            if (self.max_field_chars and self.value_start is not None
+                    and pos - self.value_start >= self.max_field_chars):
+                self.capped_field = self.key
+                return self._stop(chunk, i)
+        self.parts.append(chunk)
+        self.length += len(chunk)
+        return False
+
+    def _stop(self, chunk, cut):
+        self.parts.append(chunk[:cut])
+        self.length += cut
+        self.done = True
+        return True
+
+    def text(self):
+        """Streamed text up to the end of the object, closed properly if a field was capped."""
+        text = "".join(self.parts)
+        if self.capped_field is None:
+            return text
+        if self.in_string:
+            # Do not leave a dangling escape before the closing quote
+            text = (text[:-1] if self.escape else text) + '"'
+        text = text.rstrip().rstrip(",:").rstrip()
+        return text + "".join(self._CLOSERS[c] for c in reversed(self.stack))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of ``values`` (0 <= q <= 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-q * len(ordered) // 100))
+    return ordered[int(rank) - 1]
+
+
+class LLMMetrics:
+    """Collects per-call figures and aggregates them per paper; safe to share between threads."""
+
+    def __init__(self, num_ctx=NUM_CTX, stream=True, early_stop=EARLY_STOP, max_field_chars=FIELD_CHAR_CAP,
+                 client=None):
+        self.num_ctx = num_ctx
+        self.stream = stream
+        self.early_stop = early_stop
+        self.max_field_chars = max_field_chars
+        # Anything with ollama's ``chat`` signature, e.g. ``ollama.Client(host=...)``
+        self.client = client or ollama
+        self.calls = []
+        self.outcomes = {}
+        self._lock = threading.Lock()
+
+    def chat(self, paper_id, messages, model=MODEL, options=None, **kwargs):
+        """``ollama.chat`` that records the call under ``paper_id``; errors are recorded and re-raised.
+
+        Returns a response with ``response["message"]["content"]`` like ``ollama.chat``.
+        """
+        options = dict(options or {})
+        num_ctx = options.get("num_ctx", self.num_ctx)
+        if num_ctx:
+            options["num_ctx"] = num_ctx
+        call = {"paper_id": paper_id, "model": model, "num_ctx": num_ctx, "error": ""}
+        start = time.perf_counter()
+        with span("llm.chat", paper_id=paper_id, model=model) as timing:
+            try:
+                if self.stream:
+                    response = self._chat_stream(call, messages, model, options, start, **kwargs)
+                else:
+                    response = self.client.chat(model=model, messages=messages, options=options, **kwargs)
+                    call.update(self.response_figures(response, num_ctx))
+            except Exception as e:
+                call.update(wall_seconds=time.perf_counter() - start, error=str(e))
+                self._add(call)
+                raise
+            timing.set(prompt_tokens=call.get("prompt_tokens"), eval_tokens=call.get("eval_tokens"))
+        call["wall_seconds"] = time.perf_counter() - start
+        self._add(call)
+        return response
+
+    def _chat_stream(self, call, messages, model, options, start, **kwargs):
+        tracker = JsonStreamTracker(self.max_field_chars if self.early_stop else None)
+        pieces, final, tokens, after_json, first_token = [], None, 0, 0, None
+        chunks = self.client.chat(model=model, messages=messages, options=options, stream=True, **kwargs)
+        try:
+            for chunk in chunks:
+                content = chunk["message"]["content"]
+                if content:
+                    # Ollama streams one token per chunk
+                    tokens += 1
+                    first_token = first_token or time.perf_counter()
+                    pieces.append(content)
+                    if tracker.done:
+                        after_json += 1
+                    elif tracker.feed(content) and self.early_stop:
+                        break
+                if _field(chunk, "done"):
+                    final = chunk
+                    break
+        finally:
+            # Closing the stream drops the connection, which makes the server stop generating
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+        call["estimated"] = final is None
+        if final is not None:
+            call.update(self.response_figures(final, call["num_ctx"]))
+        else:
+            # Stopped (or cut off) before the final chunk with the server's counts: estimate them
+            prompt_chars = sum(len(m.get("content", "")) for m in messages)
+            prompt_tokens = prompt_chars // 4
+            now = time.perf_counter()
+            call.update({
+                "prompt_tokens": prompt_tokens,
+                "eval_tokens": tokens,
+                "load_seconds": 0.0,
+                "prompt_eval_seconds": (first_token or now) - start,
+                "eval_seconds": now - (first_token or now),
+                "total_seconds": now - start,
+                "truncated": bool(call["num_ctx"]) and prompt_tokens >= call["num_ctx"],
+                "done_reason": ("field_cap" if tracker.capped_field is not None
+                                else "json_closed" if tracker.done else "incomplete"),
+            })
+        cut = self.early_stop and tracker.done
+        call["stopped_early"] = int(cut and final is None)
+        call["capped_fields"] = int(tracker.capped_field is not None)
+        call["tokens_after_json"] = after_json
+        content = tracker.text() if cut else "".join(pieces)
+        return {"model": model, "message": {"role": "assistant", "content": content}, "done": True,
+                "done_reason": call["done_reason"]}
+
+    @staticmethod
+    def response_figures(response, num_ctx=NUM_CTX):
+        """Token counts and durations (seconds) of one response."""
+        prompt_tokens = _field(response, "prompt_eval_count")
+        return {
+            "prompt_tokens": prompt_tokens,
+            "eval_tokens": _field(response, "eval_count"),
+            "load_seconds": _field(response, "load_duration") / _NS,
+            "prompt_eval_seconds": _field(response, "prompt_eval_duration") / _NS,
+            "eval_seconds": _field(response, "eval_duration") / _NS,
+            "total_seconds": _field(response, "total_duration") / _NS,
+            "truncated": bool(num_ctx) and prompt_tokens >= num_ctx,
+            "done_reason": _field(response, "done_reason") or "",
+        }
+
+    def _add(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def record_outcome(self, paper_id, outcome):
+        """How the reply for ``paper_id`` was parsed; the last outcome recorded wins."""
+        with self._lock:
+            self.outcomes[paper_id] = outcome
+
+    def paper_rows(self):
+        """One row per paper (``PAPER_COLUMNS``), in the order the papers were first called."""
+        with self._lock:
+            calls = list(self.calls)
+            outcomes = dict(self.outcomes)
+        papers = {}
+        for call in calls:
+            row = papers.setdefault(call["paper_id"], {
+                "paper_id": call["paper_id"], "calls": 0, "retries": 0, "errors": 0, "wall_seconds": 0.0,
+                "load_seconds": 0.0, "prompt_eval_seconds": 0.0, "eval_seconds": 0.0, "prompt_tokens": 0,
+                "eval_tokens": 0, "num_ctx": call["num_ctx"], "truncated": False, "parse_outcome": "",
+                "stopped_early": 0, "capped_fields": 0, "tokens_after_json": 0, "estimated_calls": 0,
+            })
+            row["calls"] += 1
+            row["errors"] += bool(call["error"])
+            for key in ("wall_seconds", "load_seconds", "prompt_eval_seconds", "eval_seconds",
+                        "prompt_tokens", "eval_tokens", "stopped_early", "capped_fields", "tokens_after_json"):
+                row[key] += call.get(key, 0)
+            row["estimated_calls"] += int(call.get("estimated", False))
+            row["truncated"] = row["truncated"] or call.get("truncated", False)
+        for paper_id, row in papers.items():
+            row["retries"] = row["calls"] - 1
+            row["parse_outcome"] = outcomes.get(paper_id, "")
+        return list(papers.values())
+
+    def write_csv(self, path):
+        """Append the per-paper rows to ``path`` (header written when the file is new)."""
+        rows = self.paper_rows()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=PAPER_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            for row in rows:
+                writer.writerow({k: round(v, 3) if isinstance(v, float) else v for k, v in row.items()})
+        return path
+
+    def summary(self):
+        return summarize(self.paper_rows())
+
+
+def ask_json(metrics, paper_id, messages, model=MODEL, options=None, **kwargs):
+    """One chat call whose reply is parsed as a JSON object; None (outcome recorded) when that fails."""
+    try:
+        response = metrics.chat(paper_id, messages, model=model, options=options or {"temperature": 0}, **kwargs)
+    except Exception as e:
+        log.warning("Error interacting with LLaMA for %s: %s", paper_id, e)
+        metrics.record_outcome(paper_id, PARSE_ERROR)
+        return None
+    match = re.search(r"\{.*\}", response["message"]["content"], re.DOTALL)
+    if not match:
+        metrics.record_outcome(paper_id, PARSE_NO_JSON)
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        metrics.record_outcome(paper_id, PARSE_INVALID_JSON)
+        return None
+    metrics.record_outcome(paper_id, PARSE_OK)
+    return data if isinstance(data, dict) else None
+
+
+def metrics_path(output_csv, kind="llm_metrics"):
+    """Default metrics table next to an output CSV or store file."""
+    return f"{os.path.splitext(output_csv)[0]}.{kind}.csv"
+
+
+def summarize(rows, slowest=5):
+    """Text report over per-paper rows: latency percentiles, throughput, time split and outliers."""
+    if not rows:
+        return "LLM metrics: no calls recorded."
+    wall = [float(r["wall_seconds"]) for r in rows]
+    prompt_tokens = [int(r["prompt_tokens"]) for r in rows]
+    eval_tokens = [int(r["eval_tokens"]) for r in rows]
+    load = sum(float(r["load_seconds"]) for r in rows)
+    prompt_eval = sum(float(r["prompt_eval_seconds"]) for r in rows)
+    generation = sum(float(r["eval_seconds"]) for r in rows)
+    # Server-side durations can exceed the client wall clock by rounding; never divide by less
+    total = max(sum(wall), load + prompt_eval + generation) or 1.0
+    other = max(0.0, total - load - prompt_eval - generation)
+    calls = sum(int(r["calls"]) for r in rows)
+    truncated = [r["paper_id"] for r in rows if str(r["truncated"]) in ("True", "1", "true")]
+    outcomes = {}
+    for r in rows:
+        outcomes[r["parse_outcome"] or "unknown"] = outcomes.get(r["parse_outcome"] or "unknown", 0) + 1
+
+    lines = [
+        f"LLM metrics: {len(rows)} papers, {calls} calls ({calls - len(rows)} retries, "
+        f"{sum(int(r['errors']) for r in rows)} errors)",
+        f"  latency per paper  p50 {percentile(wall, 50):.1f}s  p95 {percentile(wall, 95):.1f}s  "
+        f"max {max(wall):.1f}s  total {total / 60:.1f} min",
+        f"  prompt tokens      p50 {percentile(prompt_tokens, 50)}  p95 {percentile(prompt_tokens, 95)}  "
+        f"max {max(prompt_tokens)}",
+        f"  generated tokens   p50 {percentile(eval_tokens, 50)}  p95 {percentile(eval_tokens, 95)}  "
+        f"max {max(eval_tokens)}",
+        f"  throughput         prompt eval {sum(prompt_tokens) / prompt_eval if prompt_eval else 0:.1f} tok/s, "
+        f"generation {sum(eval_tokens) / generation if generation else 0:.1f} tok/s",
+        f"  time share         prompt eval {prompt_eval / total:.0%}, generation {generation / total:.0%}, "
+        f"model load {load / total:.0%}, other {other / total:.0%}",
+        "  parse outcomes     " + ", ".join(f"{k} {v}" for k, v in sorted(outcomes.items())),
+        f"  truncated prompts  {len(truncated)}" + (f" ({', '.join(map(str, truncated[:10]))})" if truncated else ""),
+    ]
+    stopped = sum(int(r.get("stopped_early") or 0) for r in rows)
+    capped = sum(int(r.get("capped_fields") or 0) for r in rows)
+    after_json = [int(r.get("tokens_after_json") or 0) for r in rows]
+    estimated = sum(int(r.get("estimated_calls") or 0) for r in rows)
+    lines.append(f"  early stop         {stopped} calls stopped at JSON close or field cap ({capped} capped fields); "
+                 f"tokens generated after the JSON closed: mean {sum(after_json) / len(rows):.1f}/paper, "
+                 f"total {sum(after_json)}")
+    if estimated:
+        lines.append(f"  estimated figures  {estimated} calls ended before the server's counts; their tokens, "
+                     "durations and truncation are client-side estimates")
+    worst = sorted(rows, key=lambda r: float(r["wall_seconds"]), reverse=True)[:slowest]
+    lines.append("  slowest papers     " + ", ".join(
+        f"{r['paper_id']} {float(r['wall_seconds']):.1f}s/{r['prompt_tokens']} tok" for r in worst))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a step 03 LLM metrics table.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser("report")
+    report.add_argument("metrics_csv", nargs="+")
+    report.add_argument("--slowest", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for path in args.metrics_csv:
+        with open(path, newline="", encoding="utf-8") as f:
+            rows.extend(csv.DictReader(f))
+    print(summarize(rows, args.slowest))
+
+
+if __name__ == "__main__":
+    main()
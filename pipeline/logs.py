@@ -0,0 +1,110 @@
+"""Run logs of the step 03 scripts: levels, per-paper records, rotation, asynchronous writes.
+
+``setup_logging`` sends the records of a run to two handlers that run on a
+background thread (``QueueHandler``/``QueueListener``), so a paper's stage
+only pays for putting a record on a queue:
+
+* the console, human-readable, at ``--log-level`` (INFO by default);
+* a JSON-lines file next to the output (``<output>.log``, one file per
+  shard or ``--queue`` worker), rotated at ``LOG_MAX_BYTES`` with
+  ``LOG_BACKUPS`` old files kept.
+  Each line has ``ts``, ``level``, ``logger`` and ``message`` plus the
+  structured fields of the record (``paper_id``, ``status``, ...).
+
+Every finished paper is one ``log_paper`` record. The full extracted JSON
+and the raw LLM replies are DEBUG records, which are dropped before they are
+formatted unless ``--log-level DEBUG`` is given.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+LOG_MAX_BYTES = 20 * 2**20
+LOG_BACKUPS = 5
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+CONSOLE_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+# Attributes every LogRecord has; anything else was passed in ``extra``
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record with the ``extra`` fields at the top level."""
+
+    def format(self, record):
+        line = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                "message": record.getMessage()}
+        line.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRS)
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+def log_path(output_csv, shard=None, worker=None):
+    """Default log file next to an output CSV, one file per shard (like the run store) or queue worker."""
+    stem = os.path.splitext(output_csv)[0]
+    if worker:
+        return f"{stem}.{worker}.log"
+    return f"{stem}.log" if shard is None else f"{stem}.shard{shard[0]}of{shard[1]}.log"
+
+
+def add_logging_arguments(parser):
+    """``--log-file`` and ``--log-level`` options shared by the step 03 scripts."""
+    parser.add_argument("--log-file", help="JSON-lines run log (default: the output CSV path with .log)")
+    parser.add_argument("--log-level", choices=LEVELS, default=os.environ.get("PIPELINE_LOG_LEVEL", "INFO"),
+                        help="console and file level; DEBUG adds the raw LLM replies and full results")
+    return parser
+
+
+def setup_logging(log_file=None, level="INFO", max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Configure the root logger for this run; returns the ``pipeline`` logger.
+
+    The handlers are flushed and stopped at exit.
+    """
+    global _listener
+    if _listener is not None:
+        return logging.getLogger("pipeline")
+    level = getattr(logging, str(level).upper())
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT, "%H:%M:%S"))
+    handlers = [console]
+    if log_file:
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups,
+                                                            encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return logging.getLogger("pipeline")
+
+
+def stop_logging():
+    """Write out the queued records and stop the background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log_paper(logger, paper_id, status, started=None, **fields):
+    """One INFO record per finished paper; ``fields`` are kept as structured fields in the file."""
+    if started is not None:
+        fields["seconds"] = round(time.perf_counter() - started, 3)
+    summary = ", ".join(f"{key}={value}" for key, value in fields.items())
+    logger.info("paper %s %s%s", paper_id, status, f" ({summary})" if summary else "",
+                extra={"event": "paper", "paper_id": paper_id, "status": status, **fields})
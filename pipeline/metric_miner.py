@@ -0,0 +1,365 @@
+"""Deterministic miner for the reported performance metrics of a paper.
+
+The performance prompts ask the LLM to find accuracy/AUC/F1 values in the
+paper text, but in PMC XML most of them sit in ``<table-wrap>`` elements that
+``pipeline.jats`` keeps as cell rows. The miner reads those tables (metric
+names in the header row or the first column) and "metric = value" phrases in
+the abstract and body ("an AUC of 0.94", "94.2% accuracy") into
+``{"metric", "value", "raw", "source", "context"}`` records, and reduces them to
+one representative value per metric (the abstract's value, else the best
+table value, else the first value in the body).
+
+When the miner is confident (a metric in the abstract or a table, or at least
+``MIN_TEXT_METRICS`` metrics in the body) the performance scripts fill "Was
+Performance Measured" and "Performance Results" from it and ask the LLM only
+for the measurement details. Agreement with the human annotations (and the
+LLM's answers) on the same papers:
+
+    python -m pipeline.metric_miner evaluate \
+        --annotations step_04_human_annotated_data/medRxiv/task4_human_annotated_data.csv \
+        --metadata step_02_semantic_filtering/medRxiv/dataset/semantic_filtering_final_data/final_semantically_filtered_dataset.csv \
+        --llm-output step_03_text_extraction_llm/medRxiv/dataset/task3_llm_extraction_ground_truth.csv
+    python -m pipeline.metric_miner mine path/to/PMC1234567.xml
+"""
+import argparse
+import json
+import re
+
+import pandas as pd
+
+# Canonical metric -> spellings seen in papers and annotations
+METRIC_ALIASES = {
+    "Accuracy": ["accuracy", "acc", "classification accuracy", "overall accuracy", "balanced accuracy"],
+    "AUC": ["AUC", "AUROC", "ROC-AUC", "AUC-ROC", "ROC AUC", "area under the curve",
+            "area under the ROC curve", "area under the receiver operating characteristic curve", "C-statistic"],
+    "F1-score": ["F1", "F1-score", "F1 score", "F-score", "F-measure", "F1-measure"],
+    "Precision": ["precision", "PPV", "positive predictive value"],
+    "Sensitivity": ["sensitivity", "recall", "TPR", "true positive rate"],
+    "Specificity": ["specificity", "TNR", "true negative rate"],
+    "NPV": ["NPV", "negative predictive value"],
+    "MCC": ["MCC", "Matthews correlation coefficient"],
+    "Kappa": ["kappa", "Cohen's kappa"],
+    "Dice Similarity": ["Dice", "Dice similarity", "Dice coefficient", "DSC"],
+    "Jaccard Index": ["Jaccard", "Jaccard index", "IoU", "intersection over union"],
+    "Correlation Coefficient": ["correlation coefficient", "Pearson correlation", "Pearson's r"],
+    "R2": ["R2", "R²", "R^2", "R-squared", "coefficient of determination"],
+    "RMSE": ["RMSE", "root mean square error", "root mean squared error"],
+    "MAE": ["MAE", "mean absolute error"],
+    "MAPE": ["MAPE", "mean absolute percentage error"],
+}
+
+# Lower is better; every other metric is a rate or score where higher is better
+ERROR_METRICS = {"RMSE", "MAE", "MAPE"}
+# Metrics that are not bounded by 1 (or 100%)
+UNBOUNDED_METRICS = {"RMSE", "MAE", "MAPE"}
+
+MIN_TEXT_METRICS = 2
+# Characters after a metric name searched for its value
+VALUE_WINDOW = 40
+
+_ALIAS_LOOKUP = {alias.lower(): metric for metric, aliases in METRIC_ALIASES.items() for alias in aliases}
+_METRIC = re.compile(
+    r"(?<![A-Za-z0-9])(" + "|".join(re.escape(a) for a in sorted(_ALIAS_LOOKUP, key=len, reverse=True))
+    + r")(?![A-Za-z0-9])", re.IGNORECASE)
+_NUMBER = re.compile(r"(?<![\d.])(\d{1,3}(?:\.\d+)?|\.\d+)(?![\d.]*\d)\s*(%)?")
+_VALUE_BEFORE = re.compile(r"(?<![\d.])(\d{1,3}(?:\.\d+)?|\.\d+)\s*(%)?\s+(?:[A-Za-z]+\s+){0,2}$")
+_LIST_GAP = re.compile(r"\s*(?:,|/|and|or|, and)\s*$")
+# Numbers that are not the metric's value ("95% CI", "5-fold", "n = 120")
+_NOT_A_VALUE = re.compile(r"\s*(?:%?\s*(?:CI|confidence)|-?\s*fold|\s*(?:patients|samples|images|cases|epochs))",
+                          re.IGNORECASE)
+
+
+def metric_name(text):
+    """Canonical metric named in a short text (e.g. a table header cell), or None."""
+    match = _METRIC.search(text or "")
+    return _ALIAS_LOOKUP[match.group(1).lower()] if match else None
+
+
+def parse_value(metric, number, percent=""):
+    """Metric value as a fraction (percentages of bounded metrics / 100), or None if implausible."""
+    value = float(number)
+    if metric in UNBOUNDED_METRICS:
+        return value
+    if percent:
+        return value / 100 if value <= 100 else None
+    if value <= 1:
+        return value
+    # "94.2" without a % sign is a percentage; a bare integer is more likely a count
+    if "." in number and value <= 100:
+        return value / 100
+    return None
+
+
+def _record(metric, number, percent, source, context):
+    value = parse_value(metric, number, percent)
+    if value is None:
+        return None
+    return {"metric": metric, "value": value, "raw": number + (percent or ""), "source": source,
+            "context": context}
+
+
+def _value_after(window):
+    """First plausible value in ``window`` before the sentence ends, as a regex match or None."""
+    number = _NUMBER.search(window)
+    if not number or re.search(r"[.;]\s", window[:number.start()]):
+        return None
+    if _NOT_A_VALUE.match(window, number.end(2) if number.group(2) else number.end(1)):
+        return None
+    return number
+
+
+def mine_text(text, source="text"):
+    """Records of the "metric ... value" and "value metric" phrases in ``text``.
+
+    Lists such as "sensitivity and specificity were 0.91 and 0.88" give each
+    metric its value in order.
+    """
+    records = []
+    if not isinstance(text, str):
+        return records
+    matches = list(_METRIC.finditer(text))
+    # Group metrics named one after the other ("sensitivity, specificity and AUC")
+    groups = []
+    for match in matches:
+        if groups and _LIST_GAP.match(text[groups[-1][-1].end():match.start()]):
+            groups[-1].append(match)
+        else:
+            groups.append([match])
+
+    for g, group in enumerate(groups):
+        end = groups[g + 1][0].start() if g + 1 < len(groups) else len(text)
+        last = group[-1]
+        window = text[last.end():min(end, last.end() + VALUE_WINDOW * len(group))]
+        context = text[max(0, group[0].start() - 60):last.end() + VALUE_WINDOW].replace("\n", " ").strip()
+        metrics = [_ALIAS_LOOKUP[m.group(1).lower()] for m in group]
+        if len(group) > 1:
+            numbers = [n for n in _NUMBER.finditer(window)
+                       if not _NOT_A_VALUE.match(window, n.end(2) if n.group(2) else n.end(1))]
+            if len(numbers) >= len(group) and not re.search(r"[.;]\s", window[:numbers[len(group) - 1].start()]):
+                for metric, number in zip(metrics, numbers):
+                    record = _record(metric, number.group(1), number.group(2), source, context)
+                    if record:
+                        records.append(record)
+            continue
+
+        record = None
+        number = _value_after(window)
+        if number:
+            record = _record(metrics[0], number.group(1), number.group(2), source, context)
+        if record is None:
+            start = groups[g - 1][-1].end() if g else 0
+            before = _VALUE_BEFORE.search(text[max(start, last.start() - 25):last.start()])
+            if before:
+                record = _record(metrics[0], before.group(1), before.group(2), source, context)
+        if record:
+            records.append(record)
+    return records
+
+
+def mine_table(table):
+    """Records of a parsed JATS table (see ``pipeline.jats``), metrics in the header row or first column."""
+    rows = table.get("rows") or []
+    label = " ".join(p for p in (table.get("label"), table.get("caption")) if p)
+    records = []
+    if len(rows) < 2:
+        return records
+
+    header = rows[0]
+    columns = {i: metric_name(cell) for i, cell in enumerate(header) if len(cell) <= 40}
+    columns = {i: metric for i, metric in columns.items() if metric}
+    if columns:
+        for row in rows[1:]:
+            for i, metric in columns.items():
+                if i < len(row):
+                    number = _NUMBER.search(row[i])
+                    if number:
+                        record = _record(metric, number.group(1), number.group(2), "table",
+                                         f"{label} | {row[0]}".strip(" |"))
+                        if record:
+                            records.append(record)
+        return records
+
+    # Transposed: one metric per row, one model/setting per column
+    for row in rows:
+        metric = metric_name(row[0]) if row and len(row[0]) <= 40 else None
+        if not metric:
+            continue
+        for i, cell in enumerate(row[1:], 1):
+            number = _NUMBER.search(cell)
+            if number:
+                setting = header[i] if i < len(header) else ""
+                record = _record(metric, number.group(1), number.group(2), "table",
+                                 f"{label} | {setting}".strip(" |"))
+                if record:
+                    records.append(record)
+    return records
+
+
+def mine_document(doc):
+    """Records of a parsed JATS document: abstract, tables and body sections."""
+    records = []
+    for paragraph in doc.get("abstract", []):
+        records.extend(mine_text(paragraph, "abstract"))
+    for table in doc.get("tables", []):
+        records.extend(mine_table(table))
+    for section in doc.get("sections", []):
+        for paragraph in section["paragraphs"]:
+            records.extend(mine_text(paragraph, "text"))
+    return records
+
+
+def summarize_records(records):
+    """The representative record per metric and whether the miner can stand in for the LLM.
+
+    Returns:
+        tuple: (``{metric: record}`` in first-seen order, confident flag).
+    """
+    by_metric = {}
+    for record in records:
+        by_metric.setdefault(record["metric"], []).append(record)
+    chosen = {}
+    for metric, found in by_metric.items():
+        abstract = [r for r in found if r["source"] == "abstract"]
+        table = [r for r in found if r["source"] == "table"]
+        if abstract:
+            chosen[metric] = abstract[0]
+        elif table:
+            best = min if metric in ERROR_METRICS else max
+            chosen[metric] = best(table, key=lambda r: r["value"])
+        else:
+            chosen[metric] = found[0]
+    sources = {r["source"] for r in records}
+    confident = bool(sources & {"abstract", "table"}) or len(by_metric) >= MIN_TEXT_METRICS
+    return chosen, confident
+
+
+def mine_paper(doc=None, text=None, abstract=None):
+    """Mine a parsed JATS ``doc``, or plain ``text`` (e.g. from a PDF) plus its ``abstract``.
+
+    Returns:
+        dict: ``records``, ``results`` (metric -> value as written in the paper),
+        ``values`` (metric -> value as a fraction) and ``confident``.
+    """
+    if doc is not None:
+        records = mine_document(doc)
+    else:
+        records = mine_text(abstract, "abstract") + mine_text(text, "text")
+    chosen, confident = summarize_records(records)
+    return {"records": records, "results": {m: r["raw"] for m, r in chosen.items()},
+            "values": {m: r["value"] for m, r in chosen.items()}, "confident": confident}
+
+
+def annotated_metrics(value):
+    """Metric -> value of an annotated or extracted "Performance Results" cell."""
+    if value is None or (isinstance(value, float) and value != value):
+        return {}
+    text = value if isinstance(value, str) else json.dumps(value)
+    found = {}
+    for record in mine_text(text.replace("_", " "), "annotation"):
+        found.setdefault(record["metric"], record["value"])
+    return found
+
+
+def values_match(a, b, tolerance=0.005):
+    return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+
+def agreement(annotations, mined, llm_outputs=None):
+    """Compare mined (and optionally LLM) performance fields with the annotations.
+
+    Args:
+        annotations (pd.DataFrame): Canonical-column annotations (see pipeline.annotations).
+        mined (dict): Annotation row index -> ``mine_paper`` result.
+        llm_outputs (pd.DataFrame): Optional step 03 output with canonical columns and ``title_key``.
+
+    Returns:
+        str: Printable report.
+    """
+    llm = llm_outputs.drop_duplicates("title_key").set_index("title_key") if llm_outputs is not None else None
+    measured = annotations.get("was_performance_measured", pd.Series(dtype=object)).astype(str).str.strip().str.lower()
+    confident = [i for i, m in mined.items() if m["confident"]]
+    lines = [f"Performance metrics: {len(mined)} papers mined, {len(confident)} confident "
+             f"({len(mined) - len(confident)} left to the LLM)"]
+    if confident:
+        yes = sum(measured.get(i) == "yes" for i in confident)
+        lines.append(f"  'Was Performance Measured' = Yes agrees with the annotation on {yes}/{len(confident)}")
+
+    def compare(label, answers):
+        annotated = found = correct = extra = 0
+        for index, predicted in answers.items():
+            gold = annotated_metrics(annotations.at[index, "performance_results"])
+            if not gold:
+                continue
+            annotated += len(gold)
+            common = set(gold) & set(predicted)
+            found += len(common)
+            correct += sum(values_match(gold[m], predicted[m]) for m in common)
+            extra += len(set(predicted) - set(gold))
+        if annotated:
+            lines.append(f"  {label}: {found}/{annotated} annotated metrics found ({found / annotated:.0%}), "
+                         f"{correct}/{found or 1} with the annotated value, {extra} metrics not in the annotation")
+
+    if "performance_results" in annotations.columns:
+        compare("miner (confident papers)", {i: mined[i]["values"] for i in confident})
+        if llm is not None and "performance_results" in llm.columns:
+            answers = {}
+            for i in confident:
+                key = annotations.at[i, "title_key"]
+                if key in llm.index:
+                    answers[i] = annotated_metrics(llm.at[key, "performance_results"])
+            compare("LLM (same papers)", answers)
+    return "\n".join(lines)
+
+
+def main():
+    from pipeline.annotations import load_annotations
+
+    parser = argparse.ArgumentParser(description="Mine reported performance metrics from tables and text.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mine_parser = sub.add_parser("mine", help="print the metric records of one XML or PDF file")
+    mine_parser.add_argument("path")
+    evaluate_parser = sub.add_parser("evaluate", help="agreement with the human annotations")
+    evaluate_parser.add_argument("--annotations", required=True, help="step 04 annotated CSV")
+    evaluate_parser.add_argument("--metadata", help="step 02 output with abstracts and PMCID/DOI")
+    evaluate_parser.add_argument("--docs", help="folder with the XML/PDF files (default: abstracts only)")
+    evaluate_parser.add_argument("--xml-cache", help="JATS parse cache folder")
+    evaluate_parser.add_argument("--llm-output", help="step 03 performance output to compare")
+    args = parser.parse_args()
+
+    if args.command == "mine":
+        if args.path.lower().endswith(".xml"):
+            from pipeline.jats import parse_cached
+            result = mine_paper(parse_cached(args.path))
+        else:
+            from pipeline.documents import load_document_text
+            result = mine_paper(text=load_document_text(args.path))
+        for record in result["records"]:
+            print(f"{record['source']:<9}{record['metric']:<24}{record['raw']:<10}{record['context'][:80]}")
+        print(json.dumps(result["results"]), "(confident)" if result["confident"] else "(not confident)")
+        return
+
+    annotations = load_annotations(args.annotations, args.metadata,
+                                   fill_columns=("pmid", "pmcid", "doi", "abstract"))
+    registry = None
+    if args.docs:
+        from pipeline.assets import open_registry
+        registry = open_registry(args.docs)
+    mined = {}
+    for index, row in annotations.iterrows():
+        record = registry.lookup(pmcid=row.get("pmcid"), pmid=row.get("pmid"), doi=row.get("doi")) \
+            if registry else None
+        if record and record["kind"] == "xml":
+            from pipeline.jats import parse_cached
+            mined[index] = mine_paper(parse_cached(record["path"], args.xml_cache))
+        elif record:
+            from pipeline.documents import registered_pdf_text, strip_references
+            mined[index] = mine_paper(text=strip_references(registered_pdf_text(registry, record) or ""),
+                                      abstract=row.get("abstract"))
+        elif isinstance(row.get("abstract"), str):
+            mined[index] = mine_paper(abstract=row.get("abstract"))
+    llm_outputs = load_annotations(args.llm_output) if args.llm_output else None
+    print(agreement(annotations, mined, llm_outputs))
+
+
+if __name__ == "__main__":
+    main()
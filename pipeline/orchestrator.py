@@ -0,0 +1,506 @@
+"""DAG runner for steps 01-03 with content-hash caching.
+
+Each source (PubMed, bioRxiv, medRxiv) is declared as a chain of nodes: a
+script, the files and folders it reads, the files it writes and the
+parameters it is run with. Paths and parameters come from a JSON config
+(``pipeline_config.json`` next to this package by default) instead of the
+paths hard-coded in the scripts.
+
+A node is skipped when its inputs (by content hash), its script and its
+parameters are unchanged since its last successful run and its outputs still
+exist. Since inputs are compared by content, a rerun upstream that produces
+the same file does not trigger anything downstream, and changing one
+threshold only recomputes the nodes that depend on it. Nodes whose inputs are
+ready run in parallel (so the three sources proceed independently), limited
+per resource (one LLM job and one NCBI client at a time by default).
+
+    python -m pipeline.orchestrator graph
+    python -m pipeline.orchestrator run --dry-run
+    python -m pipeline.orchestrator run --sources pubmed --jobs 2
+    python -m pipeline.orchestrator run --force pubmed/02_filter
+    python -m pipeline.orchestrator status
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from pipeline.assets import file_sha256
+from pipeline.tracing import PROFILE_ENV, PROFILERS, TRACE_DIR_ENV
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+DEFAULT_CONFIG = REPO_ROOT / "pipeline_config.json"
+STATE_NAME = "state.json"
+
+# Concurrent nodes per resource; nodes without a resource only count against --jobs
+DEFAULT_RESOURCES = {"llm": 1, "ncbi": 1}
+DEFAULT_JOBS = 3
+
+STEP01 = REPO_ROOT / "step_01_metadata_collection"
+STEP02 = REPO_ROOT / "step_02_semantic_filtering"
+STEP03 = REPO_ROOT / "step_03_text_extraction_llm"
+SCRIPTS = {
+    "pubmed": {
+        "aggregate": STEP01 / "pubmed/scripts/aggregate_collected_records.py",
+        "abstracts": STEP01 / "pubmed/scripts/extract_abstracts_from_pmid.py",
+        "fulltext": STEP01 / "pubmed/scripts/fetch_fulltext_from_doi_pmcid.py",
+        "filter": STEP02 / "pubMed/scripts/semantic_filtering_pipeline.py",
+        "additional": STEP03 / "pubMed/scripts/textextraction_additionalfields_pubmed.py",
+        "performance": STEP03 / "pubMed/scripts/textextraction_perfomancemetrics_pubmed.py",
+    },
+    "biorxiv": {
+        "fetch": STEP01 / "bioRxiv/scripts/biorxiv_metadata_fetcher.R",
+        "aggregate": STEP01 / "bioRxiv/scripts/aggregate_and_deduplicate_doi.R",
+        "filter": STEP02 / "bioRxiv/scripts/semantic_filtering_model_biorxiv.py",
+        "additional": STEP03 / "bioRxiv/scripts/textextraction_additionalfields_biorxiv.py",
+        "performance": STEP03 / "bioRxiv/scripts/textextraction_perfomancemetrics_biorxiv.py",
+    },
+    "medrxiv": {
+        "fetch": STEP01 / "medRxiv/scripts/medrxiv_metadata_fetcher.R",
+        "aggregate": STEP01 / "medRxiv/scripts/aggregate_and_deduplicate_doi.R",
+        "filter": STEP02 / "medRxiv/scripts/semantic_filtering_model_medrxiv.py",
+        "additional": STEP03 / "medRxiv/scripts/textextraction_additionalfields_medrxiv.py",
+        "performance": STEP03 / "medRxiv/scripts/textextraction_perfomancemetrics_medrxiv.py",
+    },
+}
+# Step 02 thresholds used by the scripts
+DEFAULT_THRESHOLDS = {"threshold_general": 0.39, "threshold_dl": 0.42}
+
+
+class Node:
+    """One script run in the DAG.
+
+    Args:
+        name (str): ``<source>/<node>``, e.g. ``pubmed/02_filter``.
+        command (list): Argument list; ``script`` is run by ``program``.
+        inputs (list): Files/folders read (outputs of other nodes or external data).
+        outputs (list): Files/folders written; consumers depend on the node through them.
+        params (dict): Parameters passed on the command line (for reporting changes).
+        resource (str): Shared resource the node occupies (``llm``, ``ncbi``).
+        clean (list): Files removed before a fresh run (default: the file outputs),
+            so append-style scripts do not resume from stale results.
+        incremental (bool): Keep ``clean`` when only the inputs changed (the
+            step 03 stores skip papers already done and process the new ones).
+    """
+
+    def __init__(self, name, program, script, args, inputs=(), outputs=(), params=None, resource=None,
+                 clean=None, incremental=False):
+        self.name = name
+        self.script = Path(script)
+        self.command = [str(program), str(script)] + [str(a) for a in args]
+        self.inputs = [Path(p) for p in inputs]
+        self.outputs = [Path(p) for p in outputs]
+        self.params = params or {}
+        self.resource = resource
+        self.clean = [Path(p) for p in clean] if clean is not None else [p for p in self.outputs if p.suffix]
+        self.incremental = incremental
+
+    @property
+    def source(self):
+        return self.name.split("/", 1)[0]
+
+
+def _flag(name):
+    return "--" + name.replace("_", "-")
+
+
+def source_nodes(source, settings, base_dir, python=sys.executable, rscript="Rscript", records=None, delta=False):
+    """The nodes of one source from its config section (paths relative to ``base_dir``).
+
+    ``records`` is the shared record store (pipeline/record_store.py) the step 02
+    and step 03 scripts also write to. With ``delta``, the step 01 downloads and
+    step 02 embeddings keep their earlier results and only process new or
+    changed records (step 03 always does, through its per-paper stores).
+    """
+    def path(value):
+        return (base_dir / value).resolve() if value else None
+
+    scripts = SCRIPTS[source]
+    data = path(settings.get("data_dir", f"data/{source}"))
+    nodes = []
+
+    # Step 01, unless the metadata CSV is given (e.g. collected by hand)
+    metadata_csv = path(settings.get("metadata_csv"))
+    xml_dir = path(settings.get("xml_dir")) or data / "xml_outputs"
+    details = path(settings.get("pubmed_store")) or data / "pubmed_details.json"
+    delta_args = ["--delta"] if delta else []
+    if source == "pubmed" and not metadata_csv:
+        exports = path(settings.get("export_dir")) or data / "exports"
+        aggregated, abstracts, metadata_csv = data / "01_aggregated.csv", data / "01_with_abstracts.csv", data / "01_fulltext.csv"
+        nodes += [
+            Node(f"{source}/01_aggregate", python, scripts["aggregate"], [exports, "--output", aggregated],
+                 inputs=[exports], outputs=[aggregated]),
+            Node(f"{source}/01_abstracts", python, scripts["abstracts"],
+                 ["--input", aggregated, "--output", abstracts, "--details-store", details] + delta_args,
+                 inputs=[aggregated], outputs=[abstracts, details], resource="ncbi",
+                 clean=[abstracts, data / "01_with_abstracts_progress.log"], incremental=delta),
+            Node(f"{source}/01_fulltext", python, scripts["fulltext"],
+                 ["--input", abstracts, "--output", metadata_csv, "--xml-dir", xml_dir] + delta_args,
+                 inputs=[abstracts], outputs=[metadata_csv, xml_dir], resource="ncbi", incremental=delta),
+        ]
+    elif source != "pubmed" and not metadata_csv:
+        queries, metadata_csv = data / "01_queries", data / "01_aggregated.csv"
+        # A later to_date than the cached metadata downloads only the new preprints
+        to_date = settings.get("to_date")
+        nodes += [
+            Node(f"{source}/01_fetch", rscript, scripts["fetch"], [queries] + ([to_date] if to_date else []),
+                 outputs=[queries], params={"to_date": to_date} if to_date else {}),
+            Node(f"{source}/01_aggregate", rscript, scripts["aggregate"], [queries, metadata_csv],
+                 inputs=[queries], outputs=[metadata_csv]),
+        ]
+
+    # Step 02: both embedding stages, then the rows relevant in both
+    params = {**DEFAULT_THRESHOLDS, **settings.get("step02", {})}
+    stage1, stage2, filtered = data / "02_stage1.csv", data / "02_stage2.csv", data / "02_filtered.csv"
+    args = ["--input", metadata_csv, "--output-general", stage1, "--dl-input", stage1, "--output", stage2,
+            "--final-output", filtered]
+    for name, value in params.items():
+        args += [_flag(name), path(value) if name.startswith("ground_truth") else value]
+    if records:
+        args += ["--records", records] + delta_args
+    nodes.append(Node(f"{source}/02_filter", python, scripts["filter"], args,
+                      inputs=[metadata_csv] + [path(v) for k, v in params.items() if k.startswith("ground_truth")],
+                      outputs=[stage1, stage2, filtered], params=params))
+
+    # Step 03: the two LLM extractions read the same filtered list
+    step03 = settings.get("step03", {})
+    if source == "pubmed":
+        documents = ["--xml-dir", xml_dir, "--xml-cache", data / "xml_cache"]
+        inputs = [filtered, xml_dir]
+    else:
+        pdf_dir = path(settings.get("pdf_dir")) or data / "pdfs"
+        documents, inputs = ["--pdf-dir", pdf_dir], [filtered, pdf_dir]
+    for task in ("additional", "performance"):
+        output = data / f"03_{task}.csv"
+        args = ["--input", filtered, "--output"] + [output] + documents
+        if records:
+            args += ["--records", records]
+        task_inputs = list(inputs)
+        params = {}
+        if task == "additional":
+            if source == "pubmed":
+                args += ["--pubmed-store", details]
+                task_inputs.append(details)
+            if step03.get("classifier"):
+                params["classifier"] = step03["classifier"]
+                args += ["--classifier", path(step03["classifier"])]
+                task_inputs.append(path(step03["classifier"]))
+            if step03.get("cascade"):
+                params["cascade"] = True
+                args.append("--cascade")
+        nodes.append(Node(f"{source}/03_{task}", python, scripts[task], args, inputs=task_inputs,
+                          outputs=[output], params=params, resource="llm",
+                          clean=[output, output.with_suffix(".jsonl")], incremental=True))
+    return nodes
+
+
+def load_config(config_path):
+    with open(config_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_dag(config, base_dir, sources=None):
+    """All nodes of the enabled (or the given) sources, in declaration order."""
+    nodes = []
+    for source, settings in config.get("sources", {}).items():
+        if source not in SCRIPTS:
+            raise ValueError(f"Unknown source '{source}' in config, expected one of {sorted(SCRIPTS)}")
+        if (sources and source not in sources) or (not sources and not settings.get("enabled", True)):
+            continue
+        records = (base_dir / config["records"]).resolve() if config.get("records") else None
+        nodes += source_nodes(source, settings, base_dir, config.get("python", sys.executable),
+                              config.get("rscript", "Rscript"), records, config.get("delta", False))
+    return nodes
+
+
+def dependencies(nodes):
+    """Node name -> names of the nodes producing one of its inputs."""
+    producers = {output: node.name for node in nodes for output in node.outputs}
+    return {node.name: sorted({producers[p] for p in node.inputs if p in producers} - {node.name})
+            for node in nodes}
+
+
+class State:
+    """Per-node record of the last successful run plus a (size, mtime) -> SHA-256 cache of the files read."""
+
+    def __init__(self, state_dir):
+        self.dir = Path(state_dir)
+        self.path = self.dir / STATE_NAME
+        self.data = {"files": {}, "nodes": {}}
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                self.data = json.load(f)
+        self._lock = threading.Lock()
+
+    def save(self):
+        with self._lock:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def file_hash(self, path):
+        stat = path.stat()
+        key = str(path)
+        with self._lock:
+            cached = self.data["files"].get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = file_sha256(path)
+        with self._lock:
+            self.data["files"][key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def path_hash(self, path):
+        """Content hash of a file or folder (hidden files such as registries and caches excluded); None if missing."""
+        if path.is_file():
+            return self.file_hash(path)
+        if not path.is_dir():
+            return None
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if not name.startswith("."):
+                    file_path = Path(root) / name
+                    digest.update(f"{file_path.relative_to(path).as_posix()}:{self.file_hash(file_path)}\n".encode())
+        return digest.hexdigest()
+
+    def node(self, name):
+        with self._lock:
+            return self.data["nodes"].get(name, {})
+
+    def update_node(self, name, **values):
+        with self._lock:
+            self.data["nodes"].setdefault(name, {}).update(values)
+
+
+def fingerprint(node, state):
+    """What a node's result depends on: script and input content hashes, and the command line."""
+    inputs = {str(p): state.path_hash(p) for p in node.inputs}
+    return {"code": state.file_hash(node.script), "inputs": inputs, "command": node.command, "params": node.params}
+
+
+def fingerprint_key(fp):
+    return hashlib.sha256(json.dumps(fp, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stale_reason(node, fp, previous, force=False):
+    """Why ``node`` has to run (None when it is up to date)."""
+    if force:
+        return "forced"
+    missing = [str(p) for p, digest in fp["inputs"].items() if digest is None]
+    if missing:
+        return "missing input " + ", ".join(missing)
+    if not previous.get("key"):
+        return "never run"
+    if previous["key"] == fingerprint_key(fp):
+        absent = [str(p) for p in node.outputs if not p.exists()]
+        return "missing output " + ", ".join(absent) if absent else None
+    if previous.get("code") != fp["code"]:
+        return "script changed"
+    changed = sorted(k for k in set(fp["params"]) | set(previous.get("params", {}))
+                     if fp["params"].get(k) != previous.get("params", {}).get(k))
+    if changed:
+        return "params changed: " + ", ".join(
+            f"{k} {previous.get('params', {}).get(k)} -> {fp['params'].get(k)}" for k in changed)
+    inputs = [p for p, digest in fp["inputs"].items() if previous.get("inputs", {}).get(p) != digest]
+    if inputs:
+        return "input changed: " + ", ".join(Path(p).name for p in inputs)
+    return "command changed"
+
+
+def _prepare_outputs(node, fp, previous):
+    """Remove stale outputs before a fresh run; keep them to resume the same run or extend an incremental one."""
+    key = fingerprint_key(fp)
+    resuming = previous.get("attempt") == key
+    only_inputs = (previous.get("key") and previous.get("code") == fp["code"]
+                   and previous.get("command") == fp["command"])
+    if resuming or (node.incremental and only_inputs):
+        return
+    for path in node.clean:
+        if path.is_file():
+            path.unlink()
+    for path in node.outputs:
+        (path if not path.suffix else path.parent).mkdir(parents=True, exist_ok=True)
+
+
+def run_node(node, fp, state):
+    """Run one node, output to ``<state>/logs/<source>_<node>.log``; returns (ok, seconds)."""
+    previous = state.node(node.name)
+    _prepare_outputs(node, fp, previous)
+    state.update_node(node.name, attempt=fingerprint_key(fp))
+    state.save()
+    log_path = state.dir / "logs" / (node.name.replace("/", "_") + ".log")
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        log.write(" ".join(node.command) + "\n\n")
+        log.flush()
+        result = subprocess.run(node.command, cwd=REPO_ROOT, stdout=log, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    absent = [str(p) for p in node.outputs if not p.exists()]
+    ok = result.returncode == 0 and not absent
+    if ok:
+        # Outputs are hashed now so the next run compares consumers against exactly this content
+        for path in node.outputs:
+            state.path_hash(path)
+        state.update_node(node.name, key=fingerprint_key(fp), code=fp["code"], inputs=fp["inputs"],
+                          command=fp["command"], params=fp["params"], seconds=round(seconds, 1),
+                          finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    else:
+        reason = f"exit code {result.returncode}" if result.returncode else "missing output " + ", ".join(absent)
+        print(f"{node.name} failed ({reason}); last lines of {log_path}:")
+        with open(log_path, encoding="utf-8", errors="replace") as log:
+            for line in log.readlines()[-10:]:
+                print(f"    {line.rstrip()}")
+    state.save()
+    return ok, seconds
+
+
+def run_dag(nodes, state, jobs=DEFAULT_JOBS, resources=None, force=(), dry_run=False):
+    """Run the stale nodes, each once its producers are done, in parallel up to ``jobs`` and the resource limits.
+
+    Returns:
+        dict: node name -> {"status": ran/skipped/failed/blocked/would run, "reason", "seconds"}.
+    """
+    resources = {**DEFAULT_RESOURCES, **(resources or {})}
+    deps = dependencies(nodes)
+    by_name = {node.name: node for node in nodes}
+    results = {}
+    pending = [node.name for node in nodes]
+    in_use = {}
+    running = {}
+
+    def forced(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in force)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            progressed = False
+            for name in list(pending):
+                node = by_name[name]
+                statuses = [results.get(d, {}).get("status") for d in deps[name]]
+                if any(s in ("failed", "blocked") for s in statuses):
+                    results[name] = {"status": "blocked", "reason": "upstream failed", "seconds": 0.0}
+                    pending.remove(name)
+                    progressed = True
+                    continue
+                if dry_run and "would run" in statuses:
+                    results[name] = {"status": "would run", "reason": "after upstream changes", "seconds": 0.0}
+                    pending.remove(name)
+                    progressed = True
+                    continue
+                if any(s not in ("ran", "skipped") for s in statuses):
+                    continue
+                if len(running) >= jobs or (node.resource and
+                                            in_use.get(node.resource, 0) >= resources.get(node.resource, 1)):
+                    continue
+                pending.remove(name)
+                progressed = True
+                fp = fingerprint(node, state)
+                reason = stale_reason(node, fp, state.node(name), forced(name))
+                if reason is None:
+                    results[name] = {"status": "skipped", "reason": "up to date", "seconds": 0.0}
+                elif reason.startswith("missing input"):
+                    print(f"{name}: {reason}")
+                    results[name] = {"status": "failed", "reason": reason, "seconds": 0.0}
+                elif dry_run:
+                    results[name] = {"status": "would run", "reason": reason, "seconds": 0.0}
+                else:
+                    print(f"{name}: running ({reason})")
+                    results[name] = {"status": "running", "reason": reason, "seconds": 0.0}
+                    if node.resource:
+                        in_use[node.resource] = in_use.get(node.resource, 0) + 1
+                    running[pool.submit(run_node, node, fp, state)] = name
+            if not running:
+                if pending and not progressed:
+                    raise RuntimeError(f"Dependency cycle among {pending}")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                node = by_name[name]
+                if node.resource:
+                    in_use[node.resource] -= 1
+                ok, seconds = future.result()
+                results[name].update(status="ran" if ok else "failed", seconds=seconds)
+                print(f"{name}: {'done' if ok else 'failed'} in {seconds:.1f}s")
+    return results
+
+
+def format_results(results):
+    lines = [f"{'node':<28}{'status':<11}{'seconds':>9}  reason"]
+    for name, result in results.items():
+        lines.append(f"{name:<28}{result['status']:<11}{result['seconds']:>9.1f}  {result['reason']}")
+    counts = {}
+    for result in results.values():
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    lines.append(", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run steps 01-03 as a content-hash-cached DAG.")
+    parser.add_argument("--config", default=str(DEFAULT_CONFIG))
+    parser.add_argument("--state-dir", help="default: state_dir from the config, else .pipeline_state next to it")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the stale nodes")
+    run.add_argument("--sources", nargs="+", choices=sorted(SCRIPTS), help="only these sources")
+    run.add_argument("--nodes", nargs="+", help="only these nodes (glob patterns, e.g. 'pubmed/03_*')")
+    run.add_argument("--force", nargs="+", default=[], help="rerun these nodes (glob patterns) even if up to date")
+    run.add_argument("--jobs", type=int, help=f"nodes run at the same time (default {DEFAULT_JOBS})")
+    run.add_argument("--dry-run", action="store_true", help="only show what would run and why")
+    run.add_argument("--trace-dir", help="span timings of every script go here (see pipeline/tracing.py)")
+    run.add_argument("--profile", choices=PROFILERS, help="also profile every script into the trace folder")
+    sub.add_parser("graph", help="list the nodes with their inputs and outputs")
+    sub.add_parser("status", help="last successful run of every node")
+    args = parser.parse_args()
+
+    config_path = Path(args.config).resolve()
+    config = load_config(config_path)
+    base_dir = config_path.parent
+    state = State(args.state_dir or base_dir / config.get("state_dir", ".pipeline_state"))
+    nodes = build_dag(config, base_dir, getattr(args, "sources", None))
+
+    if args.command == "graph":
+        deps = dependencies(nodes)
+        for node in nodes:
+            print(f"{node.name}  <- {', '.join(deps[node.name]) or 'external inputs'}")
+            for path in node.inputs:
+                print(f"    in   {path}")
+            for path in node.outputs:
+                print(f"    out  {path}")
+            if node.params:
+                print(f"    params {json.dumps(node.params)}")
+    elif args.command == "status":
+        for node in nodes:
+            record = state.node(node.name)
+            last = f"{record['finished_at']} ({record['seconds']}s)" if record.get("key") else "never run"
+            print(f"{node.name:<28}{last}")
+    else:
+        if args.nodes:
+            nodes = [n for n in nodes if any(fnmatch.fnmatch(n.name, p) for p in args.nodes)]
+        # The scripts pick the trace settings up from the environment they inherit
+        if args.trace_dir:
+            os.environ[TRACE_DIR_ENV] = str(Path(args.trace_dir).resolve())
+        if args.profile:
+            os.environ[PROFILE_ENV] = args.profile
+        results = run_dag(nodes, state, args.jobs or config.get("jobs", DEFAULT_JOBS),
+                          config.get("resources"), args.force, args.dry_run)
+        print(format_results(results))
+        if any(r["status"] == "failed" for r in results.values()):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""Pack files: many downloaded documents in one compressed, append-only file.
+
+A folder of tens of thousands of ``PMC*.xml`` or preprint PDFs is slow to
+list, uses an inode per paper and is read back one small file at a time. A
+pack keeps the documents of a folder in two files:
+
+* ``documents.pack``: the documents one after the other, each a zstd frame
+  (or the raw bytes when compression does not pay, as for most PDFs);
+* ``documents.pack.idx``: one tab-separated line per document with its
+  name, offset, stored length, size, codec, modification time and SHA-256.
+
+Documents are only ever appended, by one writer at a time: the bytes go to
+the pack before the index line, so a crash leaves at most unreferenced bytes
+at its end, and a document added again under the same name replaces the
+earlier copy. ``compact`` drops the stale bytes by writing the current copies
+to a new pack file (``documents.pack.1``, ``.2``, ...) with an index whose
+header line names it; replacing the index is the single step that switches
+to the new file, so a crash leaves either the old or the new pack in use.
+Reads go through a read-only memory map of the pack and the in-memory index,
+so opening a document is a dictionary lookup and a slice, without a file
+open per paper, and every document is checked against its SHA-256.
+
+Inside a pack a document is addressed as ``<pack>#<name>``, e.g.
+``xml_outputs/documents.pack#PMC123.xml``. The asset registry indexes the
+packs of a document folder under these paths next to the loose files, and
+``open_document``, ``document_stat`` and ``local_file`` accept both, which is
+how ``extract_full_text`` and the PDF extraction read packed documents
+without changes to the step 03 scripts.
+
+    python -m pipeline.packs convert xml_outputs --remove
+    python -m pipeline.packs list xml_outputs/documents.pack
+    python -m pipeline.packs cat xml_outputs/documents.pack#PMC123.xml > PMC123.xml
+    python -m pipeline.packs verify xml_outputs/documents.pack
+    python -m pipeline.packs compact xml_outputs/documents.pack
+
+Packs need the ``zstandard`` package (``pip install zstandard``).
+"""
+import argparse
+import hashlib
+import io
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+# Default pack of a document folder
+PACK_NAME = "documents.pack"
+ZSTD_LEVEL = 10
+# Documents that do not shrink below this share of their size are stored raw
+MIN_SAVING = 0.95
+
+Entry = namedtuple("Entry", "name offset length size codec mtime sha256")
+
+# First line of an index written by ``compact``: the pack file it refers to and its generation
+_HEADER = "#data"
+_MEMBER = re.compile(r"^(.*\.pack)#([^#]+)$")
+_packs = {}
+_packs_lock = threading.Lock()
+_local = threading.local()
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Pack files need the zstandard package: pip install zstandard") from None
+    return zstandard
+
+
+def split_member(path):
+    """``(pack path, name)`` of a ``<pack>#<name>`` path, or None for a plain file path."""
+    match = _MEMBER.match(str(path))
+    return (match.group(1), match.group(2)) if match else None
+
+
+def member_path(pack_path, name):
+    return f"{pack_path}#{name}"
+
+
+def document_name(path):
+    """File name of a document, inside a pack or not (``PMC123.xml``)."""
+    member = split_member(path)
+    return member[1] if member else Path(path).name
+
+
+class Pack:
+    """One pack file and its index; safe to share between threads.
+
+    Args:
+        path (str): Pack file (``.pack``); it and its index are created on the first append.
+        level (int): zstd compression level of appended documents.
+    """
+
+    def __init__(self, path, level=ZSTD_LEVEL):
+        self.path = str(path)
+        self.index_path = self.path + INDEX_SUFFIX
+        # File holding the documents; another one after ``compact``, as named by the index header
+        self.data_path = self.path
+        self.generation = 0
+        self.level = level
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._index_id = None
+        self._index_read = 0
+        self._data = None
+        self._map = None
+        self._mapped = 0
+        self._writer = None
+        self._index_writer = None
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def refresh(self):
+        """Read index lines appended since the last call (e.g. by another process).
+
+        An index replaced by ``compact`` is read again from the start, together
+        with the pack file it names.
+        """
+        with self._lock:
+            try:
+                with open(self.index_path, "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    if (stat.st_dev, stat.st_ino) != self._index_id:
+                        self._reset()
+                        self._index_id = (stat.st_dev, stat.st_ino)
+                    f.seek(self._index_read)
+                    chunk = f.read()
+            except FileNotFoundError:
+                return
+            # A line still being written is picked up by the next refresh
+            complete = chunk[:chunk.rfind(b"\n") + 1]
+            self._index_read += len(complete)
+            lines = complete.decode("utf-8").splitlines()
+            if lines and lines[0].startswith(_HEADER + "\t"):
+                _, data_name, generation = lines.pop(0).split("\t")
+                self.data_path = os.path.join(os.path.dirname(self.index_path), data_name)
+                self.generation = int(generation)
+            pack_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+            for line in lines:
+                try:
+                    name, offset, length, size, codec, mtime, sha256 = line.split("\t")
+                    entry = Entry(name, int(offset), int(length), int(size), codec, float(mtime), sha256)
+                except ValueError:
+                    continue
+                # Bytes that never reached the pack before a crash
+                if entry.offset + entry.length <= pack_size:
+                    self.entries[entry.name] = entry
+
+    def _reset(self):
+        """Forget the index read so far and the open pack file (the index was replaced)."""
+        self._close_files()
+        self.entries = {}
+        self._index_read = 0
+        self.data_path = self.path
+        self.generation = 0
+
+    def _close_files(self):
+        for f in (self._map, self._data, self._writer, self._index_writer):
+            if f is not None:
+                f.close()
+        self._map = self._data = self._writer = self._index_writer = None
+        self._mapped = 0
+
+    def _view(self, end):
+        """Memory map covering the pack up to ``end``; remapped when the pack has grown."""
+        if self._map is None or end > self._mapped:
+            if self._map is not None:
+                self._map.close()
+            if self._data is None:
+                self._data = open(self.data_path, "rb")
+            size = os.fstat(self._data.fileno()).st_size
+            self._map = mmap.mmap(self._data.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            self._mapped = size
+        return self._map
+
+    def entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            self.refresh()
+            entry = self.entries.get(name)
+        if entry is None:
+            raise FileNotFoundError(f"{name} is not in {self.path}")
+        return entry
+
+    def read(self, name):
+        """Bytes of document ``name``; raises ``OSError`` when they do not match the index."""
+        entry = self.entry(name)
+        with self._lock:
+            stored = self._view(entry.offset + entry.length)[entry.offset:entry.offset + entry.length]
+        if entry.codec == "raw":
+            data = stored
+        else:
+            # Decompressors are not thread-safe; one per thread
+            decompressor = getattr(_local, "decompressor", None)
+            if decompressor is None:
+                decompressor = _local.decompressor = _zstd().ZstdDecompressor()
+            try:
+                data = decompressor.decompress(stored)
+            except _zstd().ZstdError as e:
+                raise OSError(f"{name} in {self.path} cannot be decompressed: {e}") from None
+        if hashlib.sha256(data).hexdigest() != entry.sha256:
+            raise OSError(f"{name} in {self.path} does not match its SHA-256")
+        return data
+
+    def append(self, name, data, mtime=None):
+        """Add (or replace) document ``name``; returns its ``Entry``."""
+        if "\t" in name or "\n" in name or "#" in name:
+            raise ValueError(f"Unsupported document name {name!r}")
+        compressed = _zstd().ZstdCompressor(level=self.level, write_content_size=True).compress(data)
+        codec, stored = ("zstd", compressed) if len(compressed) < MIN_SAVING * len(data) else ("raw", data)
+        sha256 = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self._writer is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._writer = open(self.data_path, "ab")
+                self._index_writer = open(self.index_path, "ab+")
+                # An index line cut off by a crash is skipped, not merged with the next one
+                if self._index_writer.seek(0, os.SEEK_END):
+                    self._index_writer.seek(-1, os.SEEK_END)
+                    if self._index_writer.read(1) != b"\n":
+                        self._index_writer.write(b"\n")
+            offset = self._writer.seek(0, os.SEEK_END)
+            self._writer.write(stored)
+            self._writer.flush()
+            entry = Entry(name, offset, len(stored), len(data), codec, mtime or time.time(), sha256)
+            line = "\t".join(str(field) for field in entry) + "\n"
+            self._index_writer.write(line.encode("utf-8"))
+            self._index_writer.flush()
+            self.entries[name] = entry
+        return entry
+
+    def sync(self):
+        """fsync the pack and its index (once at the end of a batch of appends)."""
+        with self._lock:
+            for f in (self._writer, self._index_writer):
+                if f is not None:
+                    os.fsync(f.fileno())
+
+    def stats(self):
+        entries = list(self.entries.values())
+        return {"documents": len(entries), "size": sum(e.size for e in entries),
+                "stored": sum(e.length for e in entries),
+                "pack_bytes": os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0}
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._close_files()
+
+
+def get_pack(path):
+    """Shared ``Pack`` for ``path``, opened once per process."""
+    key = os.path.abspath(path)
+    with _packs_lock:
+        if key not in _packs:
+            _packs[key] = Pack(key)
+        return _packs[key]
+
+
+def read_document(path):
+    """Bytes of a document file or of a ``<pack>#<name>`` document."""
+    member = split_member(path)
+    if member:
+        return get_pack(member[0]).read(member[1])
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def open_document(path):
+    """Binary file object of a document file or of a ``<pack>#<name>`` document."""
+    member = split_member(path)
+    if member:
+        return io.BytesIO(get_pack(member[0]).read(member[1]))
+    return open(path, "rb")
+
+
+def document_stat(path):
+    """``(size, mtime)`` of a document file or of a ``<pack>#<name>`` document."""
+    member = split_member(path)
+    if member:
+        entry = get_pack(member[0]).entry(member[1])
+        return entry.size, entry.mtime
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+@contextmanager
+def local_file(path):
+    """A real file with the document's bytes, for tools that need a path (Poppler, Tesseract).
+
+    Plain files are used as they are; a packed document is written to a
+    temporary file that is removed afterwards.
+    """
+    member = split_member(path)
+    if not member:
+        yield str(path)
+        return
+    fd, tmp_path = tempfile.mkstemp(suffix=Path(member[1]).suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(get_pack(member[0]).read(member[1]))
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def pack_documents(folder):
+    """``(path, size, mtime, sha256)`` of every document in the packs directly inside ``folder``."""
+    # A pack is known by its index; after ``compact`` its documents live in another file
+    for entry in sorted(os.scandir(folder), key=lambda e: e.name):
+        if entry.name.endswith(PACK_SUFFIX + INDEX_SUFFIX) and entry.is_file():
+            pack_path = entry.path[:-len(INDEX_SUFFIX)]
+            pack = get_pack(pack_path)
+            pack.refresh()
+            for doc in list(pack.entries.values()):
+                yield member_path(pack_path, doc.name), doc.size, doc.mtime, doc.sha256
+
+
+def folder_documents(folder, suffix):
+    """Sorted paths of the ``suffix`` documents in ``folder``, as plain files or ``<pack>#<name>`` documents.
+
+    A document that is both a plain file and packed (``convert`` without
+    ``remove``) is listed once, as the plain file.
+    """
+    suffix = suffix.lower()
+    paths = {entry.name: entry.path for entry in os.scandir(folder)
+             if entry.is_file() and entry.name.lower().endswith(suffix)}
+    for path, *_ in pack_documents(folder):
+        name = document_name(path)
+        if name.lower().endswith(suffix):
+            paths.setdefault(name, path)
+    return sorted(paths.values())
+
+
+def convert(folder, pack_path=None, remove=False, level=ZSTD_LEVEL):
+    """Move the loose XML/PDF files of ``folder`` into a pack.
+
+    Files already in the pack with the same content are skipped, and the
+    modification time of each file is kept. With ``remove``, a file is
+    deleted only after its packed copy has been read back and checked.
+
+    Returns:
+        dict: ``files``, ``skipped``, ``removed``, ``bytes`` and ``stored`` (bytes in the pack).
+    """
+    # Imported here since the registry reads packs through this module
+    from pipeline.assets import DOCUMENT_SUFFIXES
+
+    pack_path = pack_path or os.path.join(folder, PACK_NAME)
+    pack = Pack(pack_path, level)
+    counts = {"files": 0, "skipped": 0, "removed": 0, "bytes": 0, "stored": 0}
+    files = sorted(entry.path for entry in os.scandir(folder)
+                   if entry.is_file() and os.path.splitext(entry.name)[1].lower() in DOCUMENT_SUFFIXES)
+    packed = []
+    try:
+        for path in files:
+            name = os.path.basename(path)
+            with open(path, "rb") as f:
+                data = f.read()
+            existing = pack.entries.get(name)
+            if existing and existing.sha256 == hashlib.sha256(data).hexdigest():
+                counts["skipped"] += 1
+            else:
+                entry = pack.append(name, data, os.stat(path).st_mtime)
+                counts["files"] += 1
+                counts["bytes"] += entry.size
+                counts["stored"] += entry.length
+            packed.append(path)
+        pack.sync()
+        if remove:
+            for path in packed:
+                name = os.path.basename(path)
+                if hashlib.sha256(pack.read(name)).hexdigest() == pack.entries[name].sha256:
+                    os.remove(path)
+                    counts["removed"] += 1
+                else:
+                    print(f"Packed copy of {path} does not match; file kept")
+    finally:
+        pack.close()
+    return counts
+
+
+def verify(pack_path):
+    """Names of the documents whose bytes do not match their SHA-256 (empty when the pack is sound)."""
+    with Pack(pack_path) as pack:
+        bad = []
+        for name, entry in pack.entries.items():
+            try:
+                if hashlib.sha256(pack.read(name)).hexdigest() != entry.sha256:
+                    bad.append(name)
+            except Exception:
+                bad.append(name)
+        return bad
+
+
+def compact(pack_path, level=ZSTD_LEVEL):
+    """Rewrite a pack with only the current copy of each document; returns the bytes saved.
+
+    No other process may append to the pack meanwhile. Readers pick up the
+    new pack file on their next ``refresh``.
+    """
+    tmp_path = pack_path + ".compact"
+    with Pack(pack_path) as old:
+        before = old.stats()["pack_bytes"] + os.path.getsize(old.index_path)
+        generation = old.generation + 1
+        data_path = f"{pack_path}.{generation}"
+        # Leftovers of a compaction that crashed before it switched over
+        for path in (data_path, tmp_path + INDEX_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(tmp_path + INDEX_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(f"{_HEADER}\t{os.path.basename(data_path)}\t{generation}\n")
+        open(data_path, "wb").close()
+        with Pack(tmp_path, level) as new:
+            for entry in sorted(old.entries.values(), key=lambda e: e.offset):
+                new.append(entry.name, old.read(entry.name), entry.mtime)
+        old_data = old.data_path
+    # The switch: until this replace the old index and pack are in use, after it the new ones
+    os.replace(tmp_path + INDEX_SUFFIX, pack_path + INDEX_SUFFIX)
+    if os.path.exists(old_data):
+        os.remove(old_data)
+    with _packs_lock:
+        stale = _packs.pop(os.path.abspath(pack_path), None)
+    if stale is not None:
+        stale.close()
+    return before - os.path.getsize(data_path) - os.path.getsize(pack_path + INDEX_SUFFIX)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    convert_parser = sub.add_parser("convert", help="pack the loose XML/PDF files of a folder")
+    convert_parser.add_argument("folder")
+    convert_parser.add_argument("--pack", help=f"pack file (default: <folder>/{PACK_NAME})")
+    convert_parser.add_argument("--remove", action="store_true", help="delete each file once its packed copy is checked")
+    convert_parser.add_argument("--level", type=int, default=ZSTD_LEVEL, help="zstd compression level")
+    list_parser = sub.add_parser("list", help="documents in a pack")
+    list_parser.add_argument("pack")
+    cat_parser = sub.add_parser("cat", help="write a packed document (<pack>#<name>) to stdout")
+    cat_parser.add_argument("document")
+    verify_parser = sub.add_parser("verify", help="check every document against its SHA-256")
+    verify_parser.add_argument("pack")
+    compact_parser = sub.add_parser("compact", help="drop replaced copies of documents")
+    compact_parser.add_argument("pack")
+    compact_parser.add_argument("--level", type=int, default=ZSTD_LEVEL)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        start = time.perf_counter()
+        counts = convert(args.folder, args.pack, args.remove, args.level)
+        ratio = counts["stored"] / counts["bytes"] if counts["bytes"] else 0
+        print(f"Packed {counts['files']} files ({counts['bytes'] / 2**20:.1f} MB -> {counts['stored'] / 2**20:.1f} MB, "
+              f"{ratio:.0%}), {counts['skipped']} already packed, {counts['removed']} removed "
+              f"({time.perf_counter() - start:.1f}s)")
+    elif args.command == "list":
+        with Pack(args.pack) as pack:
+            for entry in sorted(pack.entries.values(), key=lambda e: e.name):
+                print(f"{entry.name}\t{entry.size}\t{entry.length}\t{entry.codec}")
+            stats = pack.stats()
+        print(f"{stats['documents']} documents, {stats['size'] / 2**20:.1f} MB in {stats['pack_bytes'] / 2**20:.1f} MB "
+              f"({stats['pack_bytes'] - stats['stored']} bytes of replaced copies)", file=sys.stderr)
+    elif args.command == "cat":
+        sys.stdout.buffer.write(read_document(args.document))
+    elif args.command == "verify":
+        bad = verify(args.pack)
+        print(f"{len(bad)} damaged documents" + (": " + ", ".join(bad) if bad else ""))
+        sys.exit(1 if bad else 0)
+    else:
+        print(f"Saved {compact(args.pack, args.level) / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Field-level instructions of the step 03 extraction prompts.
+
+The step 03 scripts ask for all fields of a task in one prompt. The same
+instructions are kept here per field, so a prompt can be built for any subset
+of fields (e.g. to re-ask only the fields that came back empty), and so the
+answers can be checked against what each field allows.
+"""
+import json
+import re
+
+SYSTEM_PROMPT = ("You are an AI research assistant with expertise in Virology and Artificial Intelligence. "
+                 "Extract only the required structured information and return valid JSON.")
+
+VIROLOGY_SUBDOMAINS = [
+    "Respiratory Virology", "Neurovirology", "Hepatic Virology", "Viral Immunology",
+    "Emerging & Re-emerging Viruses", "Zoonotic Virology", "General Virology",
+]
+
+FIELD_INSTRUCTIONS = {
+    "research_aim": "Extract the primary goal or aim of the research.",
+    "research_problem": "Identify the specific research problem addressed in the paper.",
+    "ai_objective": "What AI is being used for in the research.",
+    "ai_methodology": "Provide a brief description of the AI-based approach used.",
+    "ai_method_details": ("Extract details about how AI is used, including specific techniques, "
+                          "architectures, or models."),
+    "ai_method_type": "The AI method used. If more than one method present, return as a list.",
+    "type_of_underlying_data": "The raw input used for experiment and analysis in the research paper.",
+    "dataset_name": "Extract the name of the dataset used in the research.",
+    "disease_name": ("Identify and extract the infectious or viral disease examined in the paper. "
+                     "If multiple diseases are studied, return a list of disease names."),
+    "virology_subdomain": ("Determine the specific subdomain of virology studied in the paper, based on the focus "
+                           "of the study. Return exactly one of: "
+                           + ", ".join(f'"{s}"' for s in VIROLOGY_SUBDOMAINS) + ".\n"
+                           '   - Respiratory viruses (e.g., Influenza, RSV, SARS-CoV-2): "Respiratory Virology".\n'
+                           '   - Viruses affecting the nervous system (e.g., Rabies, Zika, HSV): "Neurovirology".\n'
+                           '   - Liver viruses (e.g., Hepatitis B, Hepatitis C): "Hepatic Virology".\n'
+                           '   - How viruses interact with the immune system: "Viral Immunology".\n'
+                           '   - Emerging or re-emerging viruses (e.g., COVID-19, Monkeypox, Nipah): '
+                           '"Emerging & Re-emerging Viruses".\n'
+                           '   - Viruses that jump from animals to humans (e.g., Ebola, Nipah): "Zoonotic Virology".\n'
+                           '   - If the paper does not specify a clear virology subdomain, return "General Virology".'),
+    "was_performance_measured": ('Answer "Yes" ONLY IF the paper explicitly mentions performance evaluation, '
+                                 'reports specific metrics, or references a performance comparison. Otherwise, answer "No".'),
+    "performance_results": ("Extract all reported performance metrics and their values as they appear in the paper, "
+                            'as a JSON object of metric name to single value. If evaluation is mentioned but no '
+                            'values are provided, return "Mentioned but not provided".'),
+    "performance_measurement_details": ("Describe how the performance was measured, including the methods, datasets, "
+                                        'and evaluation criteria used. If not mentioned, return "Not specified".'),
+}
+
+# Allowed answers for the closed fields
+FIELD_CHOICES = {
+    "was_performance_measured": ["Yes", "No"],
+    "virology_subdomain": VIROLOGY_SUBDOMAINS,
+}
+
+# Only required when the paper reports an evaluation
+PERFORMANCE_DEPENDENT = {"performance_results", "performance_measurement_details"}
+
+# Answers that mean the model gave none
+EMPTY_VALUES = {"", "null", "none", "nan", "n/a", "na", "[]", "{}", "[none]", "['']", "unknown"}
+
+MAX_FIELD_CHARS = 2000
+
+_FIELD_KEY = re.compile(r'"(%s)"\s*:' % "|".join(FIELD_INSTRUCTIONS))
+
+
+def build_messages(text, fields):
+    """Chat messages asking for ``fields`` only, answered from ``text``."""
+    lines = [f'{i}. "{field}": {FIELD_INSTRUCTIONS[field]}' for i, field in enumerate(fields, 1)]
+    user = (
+        "Analyze the provided research paper text and extract the following information strictly from the "
+        "content without any assumptions:\n\n"
+        f"{text}\n\n"
+        "IMPORTANT: Your response must be strictly a JSON object with exactly these keys:\n"
+        + "\n".join(lines)
+        + "\n\nStrict Constraints:\n"
+        "- The response must be strictly based on explicit mentions in the paper. Do not infer or assume missing details.\n"
+        "- Always return valid JSON output and do not include any additional text or explanations."
+    )
+    return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user}]
+
+
+def is_empty(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return True
+    if isinstance(value, (list, dict)):
+        return not value
+    return str(value).strip().lower() in EMPTY_VALUES
+
+
+def field_problem(field, value, performance_measured=None):
+    """Why ``value`` is not an acceptable answer for ``field`` ("missing", "invalid", "too_long"), or None.
+
+    ``performance_measured`` is the paper's "was_performance_measured" answer; the
+    performance fields may be empty when it is "No".
+    """
+    if field in PERFORMANCE_DEPENDENT and str(performance_measured).strip().lower() == "no":
+        return None
+    if is_empty(value):
+        return "missing"
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    choices = FIELD_CHOICES.get(field)
+    if choices and text.strip().lower() not in {c.lower() for c in choices}:
+        return "invalid"
+    if len(text) > MAX_FIELD_CHARS:
+        return "too_long"
+    # Other fields of the JSON answer leaked into this one (broken output parsing)
+    if isinstance(value, str) and _FIELD_KEY.search(value):
+        return "invalid"
+    return None
+
+
+def normalize_choice(field, value):
+    """Canonical spelling of a closed-field answer (e.g. "yes" -> "Yes")."""
+    for choice in FIELD_CHOICES.get(field, []):
+        if isinstance(value, str) and value.strip().lower() == choice.lower():
+            return choice
+    return value
@@ -0,0 +1,509 @@
+"""SQLite record store shared by steps 02-04, indexed on PMID, PMCID and DOI.
+
+One row per paper, whatever file it first came from. Papers are matched by
+PMCID, PMID, DOI and finally normalised title, so a record keeps its identity
+across the step 01 exports, step 02 outputs, step 03 stores and step 04
+annotations even when rows are reordered or filtered. It holds:
+
+- ``papers``: identifiers, title, abstract and the input row (step 01 CSV);
+- ``texts``: document text per paper (e.g. the reference-stripped full text);
+- ``scores``: the step 02 similarity and label per stage (``general``, ``dl``);
+- ``extractions``: the latest step 03 row per task (``additional``, ``performance``);
+- ``annotations``: step 04 rows and ground-truth labels per annotation set.
+
+The scripts write to it with ``--records`` (the CSV outputs are unchanged), and
+joins such as "papers relevant in both stages without a successful extraction"
+are indexed queries:
+
+    python -m pipeline.record_store --db records.sqlite import step01.csv --source pubmed
+    python -m pipeline.record_store --db records.sqlite import-annotations annotated.csv --name human --metadata step02.csv
+    python -m pipeline.record_store --db records.sqlite pending --task additional --source pubmed --output todo.csv
+    python -m pipeline.record_store --db records.sqlite export extractions --task additional --output additional.csv
+    python -m pipeline.record_store --db records.sqlite summary
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from pipeline.annotations import column_map, load_annotations, normalize_title, read_csv_any
+from pipeline.assets import doi_key
+from pipeline.enrichment import normalize_pmid
+from pipeline.logs import setup_logging
+from pipeline.run_store import read_records
+
+log = logging.getLogger(__name__)
+
+# Step 02 stages in the order they are applied
+STAGES = ("general", "dl")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    id INTEGER PRIMARY KEY,
+    source TEXT,
+    pmid TEXT,
+    pmcid TEXT,
+    doi TEXT,
+    doi_key TEXT,
+    title TEXT,
+    title_key TEXT,
+    abstract TEXT,
+    data TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS papers_pmid ON papers (pmid);
+CREATE INDEX IF NOT EXISTS papers_pmcid ON papers (pmcid);
+CREATE INDEX IF NOT EXISTS papers_doi_key ON papers (doi_key);
+CREATE INDEX IF NOT EXISTS papers_title_key ON papers (title_key);
+CREATE INDEX IF NOT EXISTS papers_source ON papers (source);
+CREATE TABLE IF NOT EXISTS texts (
+    paper_id INTEGER NOT NULL REFERENCES papers (id),
+    kind TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    text TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (paper_id, kind)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    paper_id INTEGER NOT NULL REFERENCES papers (id),
+    stage TEXT NOT NULL,
+    score REAL,
+    label INTEGER,
+    threshold REAL,
+    fingerprint TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (paper_id, stage)
+);
+CREATE INDEX IF NOT EXISTS scores_stage_label ON scores (stage, label);
+CREATE TABLE IF NOT EXISTS extractions (
+    paper_id INTEGER NOT NULL REFERENCES papers (id),
+    task TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    fingerprint TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (paper_id, task)
+);
+CREATE INDEX IF NOT EXISTS extractions_task_ok ON extractions (task, ok);
+CREATE TABLE IF NOT EXISTS annotations (
+    paper_id INTEGER NOT NULL REFERENCES papers (id),
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (paper_id, name)
+);
+"""
+# Columns added after the first version of the schema
+ADDED_COLUMNS = {"scores": ["fingerprint TEXT"], "extractions": ["fingerprint TEXT"]}
+
+
+def content_fingerprint(*parts):
+    """SHA-256 of everything a result depends on (e.g. the model, the target sentences and the abstract)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, ensure_ascii=False, default=str).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _clean(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    value = str(value).strip()
+    return value if value and value.lower() not in ("nan", "none", "null") else None
+
+
+def normalize_pmcid(pmcid):
+    pmcid = _clean(pmcid)
+    if not pmcid:
+        return None
+    pmcid = pmcid.upper()
+    return f"PMC{pmcid}" if pmcid.isdigit() else pmcid
+
+
+def _json(row):
+    return json.dumps({key: None if isinstance(value, float) and value != value else value
+                       for key, value in row.items()}, ensure_ascii=False, default=str)
+
+
+def row_identity(row, columns):
+    """Normalised identifiers, title and abstract of ``row`` (``columns`` from ``annotations.column_map``)."""
+    def get(field):
+        return row.get(columns[field]) if field in columns else None
+
+    doi = _clean(get("doi"))
+    title = _clean(get("title"))
+    return {"pmcid": normalize_pmcid(get("pmcid")), "pmid": normalize_pmid(get("pmid")), "doi": doi,
+            "doi_key": doi_key(doi), "title": title, "title_key": normalize_title(title) or None,
+            "abstract": _clean(get("abstract"))}
+
+
+def run_store_id_column(paper_id):
+    """Step 03 stores key papers by PMCID (PubMed) or DOI (preprints)."""
+    return "PMCID" if str(paper_id).upper().startswith("PMC") else "doi"
+
+
+class RecordStore:
+    """SQLite-backed system of record for papers and their per-stage results; safe to share between threads."""
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=60)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            # Several sources may write at the same time (see pipeline/orchestrator.py)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {row["name"] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                for column in columns:
+                    if column.split()[0] not in existing:
+                        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def close(self):
+        self._conn.close()
+
+    def _find(self, identity):
+        for column in ("pmcid", "pmid", "doi_key", "title_key"):
+            if identity[column]:
+                row = self._conn.execute(f"SELECT id FROM papers WHERE {column} = ? LIMIT 1",
+                                         (identity[column],)).fetchone()
+                if row:
+                    return row["id"]
+        return None
+
+    def match(self, df, create=False, source=None, with_data=False):
+        """Paper id of every row of ``df`` (None for unknown papers unless ``create``).
+
+        Args:
+            df (pd.DataFrame): Rows with any of the PMID/PMCID/DOI/title columns (any known header).
+            create (bool): Add papers that are not in the store yet.
+            source (str): Source recorded for new papers (``pubmed``, ``biorxiv``, ``medrxiv``).
+            with_data (bool): Store the row itself as the paper's input record.
+
+        Returns:
+            list: Paper ids aligned with the rows of ``df``.
+        """
+        columns = column_map(df.columns)
+        ids = []
+        now = time.time()
+        with self._lock, self._conn:
+            for row in df.to_dict("records"):
+                identity = row_identity(row, columns)
+                paper_id = self._find(identity)
+                data = _json(row) if with_data else None
+                if paper_id is not None and create:
+                    # Identifiers learned from this file fill the gaps of the existing record
+                    self._conn.execute(
+                        "UPDATE papers SET pmid = COALESCE(pmid, ?), pmcid = COALESCE(pmcid, ?), "
+                        "doi = COALESCE(doi, ?), doi_key = COALESCE(doi_key, ?), title = COALESCE(title, ?), "
+                        "title_key = COALESCE(title_key, ?), abstract = COALESCE(?, abstract), "
+                        "source = COALESCE(source, ?), data = COALESCE(?, data), updated_at = ? WHERE id = ?",
+                        (identity["pmid"], identity["pmcid"], identity["doi"], identity["doi_key"],
+                         identity["title"], identity["title_key"], identity["abstract"], source, data, now,
+                         paper_id))
+                elif create and any(identity[c] for c in ("pmcid", "pmid", "doi_key", "title_key")):
+                    paper_id = self._conn.execute(
+                        "INSERT INTO papers (source, pmid, pmcid, doi, doi_key, title, title_key, abstract, data, "
+                        "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (source, identity["pmid"], identity["pmcid"], identity["doi"], identity["doi_key"],
+                         identity["title"], identity["title_key"], identity["abstract"], data, now)).lastrowid
+                ids.append(paper_id)
+        return ids
+
+    def upsert_papers(self, df, source=None, with_data=True):
+        """Add or update the papers of ``df`` (e.g. a step 01 CSV); returns their ids in row order."""
+        return self.match(df, create=True, source=source, with_data=with_data)
+
+    def put_text(self, paper_id, kind, text):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO texts (paper_id, kind, sha256, text, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (paper_id, kind, hashlib.sha256(text.encode("utf-8")).hexdigest(), text, time.time()))
+
+    def without_text(self, kind):
+        """Papers (id and identifiers) that have no text of ``kind`` yet."""
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(
+                "SELECT id, pmcid, pmid, doi FROM papers p WHERE NOT EXISTS "
+                "(SELECT 1 FROM texts t WHERE t.paper_id = p.id AND t.kind = ?)", (kind,))]
+
+    def get_text(self, paper_id, kind):
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM texts WHERE paper_id = ? AND kind = ?",
+                                     (paper_id, kind)).fetchone()
+        return row["text"] if row else None
+
+    def put_scores(self, paper_ids, stage, labels, scores=None, threshold=None, fingerprints=None):
+        """Step 02 label (and similarity) of each paper for ``stage``.
+
+        ``fingerprints`` (see ``content_fingerprint``) identify the text and
+        targets each score was computed from, for ``cached_scores``.
+        """
+        scores = list(scores) if scores is not None else [None] * len(paper_ids)
+        fingerprints = list(fingerprints) if fingerprints is not None else [None] * len(paper_ids)
+        now = time.time()
+        rows = [(paper_id, stage, None if score is None else float(score), int(label), threshold, fingerprint, now)
+                for paper_id, label, score, fingerprint in zip(paper_ids, labels, scores, fingerprints)
+                if paper_id is not None]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scores (paper_id, stage, score, label, threshold, fingerprint, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def cached_scores(self, paper_ids, stage, fingerprints):
+        """Stored ``stage`` similarity of each paper whose fingerprint is unchanged, None for the others."""
+        with self._lock:
+            stored = {row["paper_id"]: (row["fingerprint"], row["score"]) for row in self._conn.execute(
+                "SELECT paper_id, fingerprint, score FROM scores WHERE stage = ? AND fingerprint IS NOT NULL",
+                (stage,))}
+        cached = []
+        for paper_id, fingerprint in zip(paper_ids, fingerprints):
+            previous = stored.get(paper_id)
+            cached.append(previous[1] if previous and previous[0] == fingerprint else None)
+        log.info("%s: %d/%d similarities unchanged since the last run",
+                 stage, sum(score is not None for score in cached), len(cached))
+        return cached
+
+    def put_extractions(self, paper_ids, task, rows, ok=None, fingerprints=None):
+        """Latest step 03 output row of each paper for ``task`` (``fingerprints``: SHA-256 of the documents)."""
+        ok = list(ok) if ok is not None else [True] * len(paper_ids)
+        fingerprints = list(fingerprints) if fingerprints is not None else [None] * len(paper_ids)
+        now = time.time()
+        values = [(paper_id, task, int(bool(success)), _json(row), fingerprint, now)
+                  for paper_id, row, success, fingerprint in zip(paper_ids, rows, ok, fingerprints)
+                  if paper_id is not None]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO extractions (paper_id, task, ok, data, fingerprint, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", values)
+        return len(values)
+
+    def import_run_store(self, store_path, task, source=None):
+        """Latest records of a step 03 JSONL store (see ``pipeline.run_store``) as extractions of ``task``."""
+        latest = {}
+        for record in read_records(store_path):
+            latest[record["id"]] = record
+        records = sorted(latest.values(), key=lambda r: (r.get("seq") is None, r.get("seq")))
+        if not records:
+            return 0
+        # The store id is the PMCID or DOI; the row itself may only carry the title
+        keyed = pd.DataFrame([{**r["row"], run_store_id_column(r["id"]): r["id"]} for r in records])
+        paper_ids = self.upsert_papers(keyed, source, with_data=False)
+        return self.put_extractions(paper_ids, task, [r["row"] for r in records], [r.get("ok", True) for r in records],
+                                    [r.get("fp") for r in records])
+
+    def put_annotations(self, df, name, source=None):
+        """Rows of an annotated CSV (or ground-truth labels) under the annotation set ``name``."""
+        paper_ids = self.upsert_papers(df, source, with_data=False)
+        now = time.time()
+        rows = [(paper_id, name, _json(row), now) for paper_id, row in zip(paper_ids, df.to_dict("records"))
+                if paper_id is not None]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO annotations (paper_id, name, data, updated_at) VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def pending(self, task, source=None, stages=STAGES):
+        """Papers labelled relevant in every one of ``stages`` without a successful ``task`` extraction."""
+        placeholders = ", ".join("?" for _ in stages)
+        query = ("SELECT p.* FROM papers p "
+                 "WHERE (SELECT COUNT(*) FROM scores s WHERE s.paper_id = p.id AND s.label = 1 "
+                 f"AND s.stage IN ({placeholders})) = ? "
+                 "AND NOT EXISTS (SELECT 1 FROM extractions e WHERE e.paper_id = p.id AND e.task = ? AND e.ok = 1)")
+        params = list(stages) + [len(stages), task]
+        if source:
+            query += " AND p.source = ?"
+            params.append(source)
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(query + " ORDER BY p.id", params)]
+
+    def papers_frame(self, papers):
+        """Input rows of ``papers`` (as stored from the step 01 CSV) with their identifiers filled in."""
+        rows = []
+        for paper in papers:
+            row = json.loads(paper["data"]) if paper.get("data") else {}
+            columns = column_map(row)
+            for field, header in (("pmid", "PMID"), ("pmcid", "PMCID"), ("doi", "DOI"), ("title", "Title"),
+                                  ("abstract", "Abstract")):
+                if paper.get(field) and not _clean(row.get(columns.get(field, header))):
+                    row[columns.get(field, header)] = paper[field]
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def table(self, kind, task=None, name=None, source=None):
+        """Rows of ``papers``, ``scores`` (one column per stage), ``extractions`` or ``annotations`` as a DataFrame."""
+        filters, params = [], []
+        if source:
+            filters.append("p.source = ?")
+            params.append(source)
+        if kind == "papers":
+            with self._lock:
+                papers = [dict(r) for r in self._conn.execute(
+                    "SELECT * FROM papers p" + (" WHERE " + " AND ".join(filters) if filters else "") +
+                    " ORDER BY p.id", params)]
+            return self.papers_frame(papers)
+        if kind == "scores":
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT p.id, p.source, p.pmid, p.pmcid, p.doi, p.title, s.stage, s.score, s.label "
+                    "FROM scores s JOIN papers p ON p.id = s.paper_id" +
+                    (" WHERE " + " AND ".join(filters) if filters else "") + " ORDER BY p.id", params).fetchall()
+            df = pd.DataFrame([dict(r) for r in rows])
+            if df.empty:
+                return df
+            wide = df.pivot(index="id", columns="stage", values=["score", "label"])
+            wide.columns = [f"{stage}_{value}" for value, stage in wide.columns]
+            papers = df.drop_duplicates("id").set_index("id")[["source", "pmid", "pmcid", "doi", "title"]]
+            return papers.join(wide).reset_index()
+        table, key, value = {"extractions": ("extractions", "task", task),
+                             "annotations": ("annotations", "name", name)}[kind]
+        if value:
+            filters.append(f"t.{key} = ?")
+            params.append(value)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT t.data FROM {table} t JOIN papers p ON p.id = t.paper_id" +
+                (" WHERE " + " AND ".join(filters) if filters else "") + " ORDER BY p.id", params).fetchall()
+        return pd.DataFrame([json.loads(r["data"]) for r in rows])
+
+    def summary(self):
+        with self._lock:
+            papers = self._conn.execute("SELECT source, COUNT(*) FROM papers GROUP BY source").fetchall()
+            scores = self._conn.execute(
+                "SELECT stage, COUNT(*), SUM(label) FROM scores GROUP BY stage").fetchall()
+            extractions = self._conn.execute(
+                "SELECT task, COUNT(*), SUM(ok) FROM extractions GROUP BY task").fetchall()
+            annotations = self._conn.execute("SELECT name, COUNT(*) FROM annotations GROUP BY name").fetchall()
+            texts = self._conn.execute("SELECT kind, COUNT(*) FROM texts GROUP BY kind").fetchall()
+        lines = [f"Record store {self.db_path}"]
+        lines += [f"  papers      {r[0] or '-':<14}{r[1]:>8}" for r in papers]
+        lines += [f"  texts       {r[0]:<14}{r[1]:>8}" for r in texts]
+        lines += [f"  scores      {r[0]:<14}{r[1]:>8}  ({r[2] or 0} relevant)" for r in scores]
+        lines += [f"  extractions {r[0]:<14}{r[1]:>8}  ({r[2] or 0} ok)" for r in extractions]
+        lines += [f"  annotations {r[0]:<14}{r[1]:>8}" for r in annotations]
+        return "\n".join(lines)
+
+
+def align_labels(truth_df, truth_column, predicted, paper_ids=None, records=None):
+    """Pair ground-truth labels with predictions.
+
+    Rows are paired by PMID/PMCID/DOI/title when ``records`` is given and the
+    ground truth has any of those columns, otherwise by position (which needs
+    both files to have the same rows in the same order).
+
+    Args:
+        truth_df (pd.DataFrame): Ground truth with a ``truth_column`` label column.
+        predicted (sequence): Predicted labels.
+        paper_ids (list): Record store ids of the predicted rows.
+
+    Returns:
+        tuple: (truth labels, predicted labels) as lists, or None if they cannot be paired.
+    """
+    predicted = list(predicted)
+    if records is not None and paper_ids is not None and column_map(truth_df.columns).keys() & {
+            "pmid", "pmcid", "doi", "title"}:
+        position = {paper_id: i for i, paper_id in enumerate(paper_ids) if paper_id is not None}
+        truth_ids = records.match(truth_df)
+        pairs = [(label, predicted[position[paper_id]])
+                 for paper_id, label in zip(truth_ids, truth_df[truth_column]) if paper_id in position]
+        log.info("Matched %d/%d ground-truth rows to predictions by identifier", len(pairs), len(truth_df))
+        return [t for t, _ in pairs], [p for _, p in pairs]
+    if len(truth_df) != len(predicted):
+        log.warning("Cannot compare by row order: %d ground-truth rows vs %d predictions", len(truth_df), len(predicted))
+        return None
+    return list(truth_df[truth_column]), predicted
+
+
+def import_texts(records, doc_dir, xml_cache_dir=None, kind="fulltext"):
+    """Store the reference-stripped text of every paper with a document in ``doc_dir`` and no text yet."""
+    from pipeline.assets import open_registry
+    from pipeline.repair import load_paper_text
+
+    registry = open_registry(doc_dir)
+    stored = 0
+    for paper in records.without_text(kind):
+        text = load_paper_text(registry, paper["pmcid"], paper["pmid"], paper["doi"], xml_cache_dir)
+        if text:
+            records.put_text(paper["id"], kind, text)
+            stored += 1
+    registry.close()
+    return stored
+
+
+def _write(df, output):
+    df.to_csv(output, index=False, encoding="utf-8")
+    print(f"Wrote {len(df)} rows to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Papers, step 02 scores, step 03 extractions and step 04 "
+                                                 "annotations in one indexed SQLite store.")
+    parser.add_argument("--db", required=True, help="record store SQLite file")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="add or update the papers of a step 01/02 CSV")
+    imp.add_argument("csv")
+    imp.add_argument("--source", choices=["pubmed", "biorxiv", "medrxiv"])
+    run = sub.add_parser("import-run-store", help="add the latest records of a step 03 JSONL store")
+    run.add_argument("store")
+    run.add_argument("--task", required=True, choices=["additional", "performance"])
+    ann = sub.add_parser("import-annotations", help="add a step 04 annotated CSV or a ground-truth file")
+    ann.add_argument("csv")
+    ann.add_argument("--name", required=True, help="annotation set, e.g. human or ground_truth_general")
+    ann.add_argument("--metadata", help="step 02 CSV used to fill in identifiers by title")
+    txt = sub.add_parser("import-texts", help="store the full text of the papers with a document in a folder")
+    txt.add_argument("--docs", required=True)
+    txt.add_argument("--xml-cache")
+    pend = sub.add_parser("pending", help="papers relevant in both step 02 stages without a successful extraction")
+    pend.add_argument("--task", required=True, choices=["additional", "performance"])
+    pend.add_argument("--source", choices=["pubmed", "biorxiv", "medrxiv"])
+    pend.add_argument("--stages", nargs="+", default=list(STAGES))
+    pend.add_argument("--output", help="write their input rows as a CSV (e.g. the step 03 input)")
+    exp = sub.add_parser("export", help="write one table as a CSV")
+    exp.add_argument("table", choices=["papers", "scores", "extractions", "annotations"])
+    exp.add_argument("--output", required=True)
+    exp.add_argument("--task", help="step 03 task of the extractions")
+    exp.add_argument("--name", help="annotation set")
+    exp.add_argument("--source", choices=["pubmed", "biorxiv", "medrxiv"])
+    sub.add_parser("summary", help="papers, scores, extractions and annotations per kind")
+    args = parser.parse_args()
+    setup_logging()
+
+    records = RecordStore(args.db)
+    if args.command == "import":
+        ids = records.upsert_papers(read_csv_any(args.csv), args.source)
+        print(f"{sum(i is not None for i in ids)}/{len(ids)} rows stored ({len(ids) - len(set(ids) - {None})} "
+              f"duplicates or rows without identifiers)")
+    elif args.command == "import-run-store":
+        print(f"{records.import_run_store(args.store, args.task)} extractions stored")
+    elif args.command == "import-annotations":
+        df = load_annotations(args.csv, args.metadata).drop(columns="title_key")
+        print(f"{records.put_annotations(df, args.name)}/{len(df)} annotated rows stored")
+    elif args.command == "import-texts":
+        print(f"{import_texts(records, args.docs, args.xml_cache)} texts stored")
+    elif args.command == "pending":
+        papers = records.pending(args.task, args.source, args.stages)
+        print(f"{len(papers)} papers still need the {args.task} extraction")
+        if args.output:
+            _write(records.papers_frame(papers), args.output)
+        else:
+            for paper in papers[:20]:
+                print(f"  {paper['pmcid'] or paper['doi'] or paper['pmid']}  {paper['title']}")
+    elif args.command == "export":
+        _write(records.table(args.table, args.task, args.name, args.source), args.output)
+    else:
+        print(records.summary())
+    records.close()
+
+
+if __name__ == "__main__":
+    main()
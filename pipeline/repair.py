@@ -0,0 +1,272 @@
+"""Field-level repair pass over existing step 03 outputs.
+
+Finds fields that came back missing ("null", empty), outside their allowed
+answers (e.g. a subdomain that is not one of the seven) or malformed, and
+re-asks the LLM only for those fields, with a prompt listing just those
+fields and a context reduced to the paragraphs relevant to them. Accepted
+answers are merged back into the output; everything else is left untouched.
+
+Repair a CSV in place (``--ids-from`` maps titles to PMCID/DOI when the
+output has no identifier column), or a run store from ``pipeline.run_store``
+(a JSONL store or a ``--queue`` file):
+
+    python -m pipeline.repair Extracted_fields.csv --docs xml_outputs --ids-from papers.csv
+    python -m pipeline.repair --store Extracted_fields.jsonl --docs xml_outputs
+    python -m pipeline.repair Extracted_fields.csv --docs xml_outputs --ids-from papers.csv --dry-run
+"""
+import argparse
+import logging
+import os
+
+from pipeline.annotations import column_map, load_annotations, read_csv_any
+from pipeline.assets import open_registry
+from pipeline.context_selection import TASK_FIELDS, estimate_tokens, select_context
+from pipeline.documents import registered_pdf_text, registered_xml_text, strip_references
+from pipeline.llm_client import LLMMetrics, ask_json, metrics_path
+from pipeline.logs import setup_logging
+from pipeline.prompts import FIELD_INSTRUCTIONS, build_messages, field_problem, normalize_choice
+from pipeline.run_store import RunStore, merge, read_records
+from pipeline.work_queue import is_queue, update_results
+
+log = logging.getLogger(__name__)
+
+# Repair prompts only need the paragraphs for a few fields
+REPAIR_TOP_K = 2
+REPAIR_TOKEN_BUDGET = 1500
+# Context budget of a full step 03 extraction (CONTEXT_TOKEN_BUDGET in the scripts)
+FULL_TOKEN_BUDGET = 3000
+
+
+def find_problems(row, columns, fields=None):
+    """Fields of ``row`` that need repair, as field -> reason.
+
+    Args:
+        row (dict): One output row keyed by the file's own headers.
+        columns (dict): Canonical field -> header (see ``annotations.column_map``).
+        fields (list): Restrict the check to these fields.
+    """
+    measured = row.get(columns["was_performance_measured"]) if "was_performance_measured" in columns else None
+    problems = {}
+    for field in fields or FIELD_INSTRUCTIONS:
+        if field in columns:
+            reason = field_problem(field, row.get(columns[field]), measured)
+            if reason:
+                problems[field] = reason
+    return problems
+
+
+def load_paper_text(registry, pmcid=None, pmid=None, doi=None, xml_cache_dir=None):
+    """Reference-stripped full text of a paper from the asset registry, or None."""
+    record = registry.lookup(pmcid=pmcid, pmid=pmid, doi=doi)
+    if not record:
+        return None
+    if record["kind"] == "xml":
+        return registered_xml_text(registry, record, xml_cache_dir)
+    return strip_references(registered_pdf_text(registry, record) or "") or None
+
+
+def ask_fields(metrics, paper_id, text, fields, performance_measured=None,
+               top_k=REPAIR_TOP_K, token_budget=REPAIR_TOKEN_BUDGET):
+    """Ask the LLM for ``fields`` only; returns (accepted answers, prompt token estimate)."""
+    context, _ = select_context(text, fields=fields, top_k=top_k, token_budget=token_budget,
+                                num_ctx=metrics.num_ctx)
+    messages = build_messages(context, fields)
+    prompt_tokens = estimate_tokens("".join(m["content"] for m in messages))
+    data = ask_json(metrics, paper_id, messages)
+    if data is None:
+        return {}, prompt_tokens
+
+    answers = {}
+    measured = normalize_choice("was_performance_measured", data.get("was_performance_measured"))
+    measured = measured if "was_performance_measured" in fields else performance_measured
+    for field in fields:
+        value = normalize_choice(field, data.get(field))
+        if field_problem(field, value, measured) is None:
+            answers[field] = value
+    return answers, prompt_tokens
+
+
+def full_prompt_tokens(text, fields):
+    """Estimated prompt size of re-running the whole step 03 extraction for the tasks of ``fields``."""
+    tokens = 0
+    for task, task_fields in TASK_FIELDS.items():
+        if set(fields) & set(task_fields):
+            tokens += min(estimate_tokens(text), FULL_TOKEN_BUDGET)
+            tokens += estimate_tokens(build_messages("", task_fields)[1]["content"])
+    return tokens
+
+
+def repair_rows(rows, paper_ids, columns, registry, fields=None, metrics=None, xml_cache_dir=None,
+                dry_run=False, top_k=REPAIR_TOP_K, token_budget=REPAIR_TOKEN_BUDGET, as_text=False):
+    """Repair ``rows`` in place.
+
+    Args:
+        rows (list): Output rows (dicts keyed by header).
+        paper_ids (list): ``{"pmcid", "pmid", "doi"}`` per row, used to find the paper.
+        columns (dict): Canonical field -> header.
+        as_text (bool): Store list/dict answers as their text form (for CSV cells).
+
+    Returns:
+        tuple: (indices of the changed rows, report dict).
+    """
+    metrics = metrics or LLMMetrics()
+    report = {"papers": len(rows), "papers_with_problems": 0, "problems": {}, "repaired": {},
+              "no_document": 0, "repair_prompt_tokens": 0, "full_prompt_tokens": 0}
+    changed = []
+    for index, (row, ids) in enumerate(zip(rows, paper_ids)):
+        problems = find_problems(row, columns, fields)
+        if not problems:
+            continue
+        report["papers_with_problems"] += 1
+        for field, reason in problems.items():
+            key = f"{field} ({reason})"
+            report["problems"][key] = report["problems"].get(key, 0) + 1
+        if dry_run:
+            continue
+        paper_id = ids.get("pmcid") or ids.get("doi") or ids.get("pmid") or f"row {index}"
+        text = load_paper_text(registry, xml_cache_dir=xml_cache_dir, **ids)
+        if not text:
+            # Preprint outputs keep the abstract; better than nothing for short fields
+            text = row.get("Abstract") if isinstance(row.get("Abstract"), str) else None
+        if not text:
+            report["no_document"] += 1
+            log.warning("No document for %s, cannot repair %s", paper_id, sorted(problems))
+            continue
+
+        measured = row.get(columns["was_performance_measured"]) if "was_performance_measured" in columns else None
+        answers, prompt_tokens = ask_fields(metrics, paper_id, text, list(problems), measured, top_k, token_budget)
+        report["repair_prompt_tokens"] += prompt_tokens
+        report["full_prompt_tokens"] += full_prompt_tokens(text, list(problems))
+        for field, value in answers.items():
+            if as_text and not isinstance(value, str):
+                value = str(value)
+            row[columns[field]] = value
+            report["repaired"][field] = report["repaired"].get(field, 0) + 1
+        if answers:
+            changed.append(index)
+        log.info("%s: repaired %s, still missing %s", paper_id, sorted(answers), sorted(set(problems) - set(answers)))
+    return changed, report
+
+
+def format_repair_report(report):
+    lines = [f"Repair: {report['papers_with_problems']}/{report['papers']} papers had fields to repair"]
+    for key, count in sorted(report["problems"].items()):
+        lines.append(f"  {key:<48}{count:>6}")
+    repaired = sum(report["repaired"].values())
+    lines.append(f"Repaired {repaired}/{sum(report['problems'].values())} fields"
+                 + (f" ({report['no_document']} papers without a document)" if report["no_document"] else ""))
+    if report["full_prompt_tokens"]:
+        share = report["repair_prompt_tokens"] / report["full_prompt_tokens"]
+        lines.append(f"Prompt tokens: ~{report['repair_prompt_tokens']} for the repair vs "
+                     f"~{report['full_prompt_tokens']} for a full re-extraction of the same papers ({share:.0%})")
+    return "\n".join(lines)
+
+
+def _ids(row_ids):
+    ids = {}
+    for key in ("pmcid", "pmid", "doi"):
+        value = row_ids.get(key)
+        if value is not None and not (isinstance(value, float) and value != value) and str(value).strip():
+            ids[key] = str(value).strip()
+    return ids
+
+
+def repair_csv(path, doc_dir, output=None, ids_from=None, fields=None, xml_cache_dir=None, dry_run=False,
+               top_k=REPAIR_TOP_K, token_budget=REPAIR_TOKEN_BUDGET):
+    """Repair a step 03 CSV; written back to ``path`` unless ``output`` is given."""
+    df = read_csv_any(path)
+    columns = column_map(df.columns)
+    # Same rows in the same order, with PMCID/PMID/DOI (looked up by title if needed)
+    ids_df = load_annotations(path, ids_from)
+    paper_ids = [_ids(row) for row in ids_df.to_dict("records")]
+    rows = df.to_dict("records")
+    registry = None if dry_run else open_registry(doc_dir)
+    metrics = LLMMetrics()
+    changed, report = repair_rows(rows, paper_ids, columns, registry, fields, metrics, xml_cache_dir,
+                                  dry_run, top_k, token_budget, as_text=True)
+    print(format_repair_report(report))
+    if dry_run:
+        return report
+    output = output or path
+    if changed:
+        df = df.astype(object)
+        for index in changed:
+            for column, value in rows[index].items():
+                df.at[df.index[index], column] = value
+        tmp_path = f"{output}.tmp"
+        df.to_csv(tmp_path, index=False, encoding="utf-8")
+        os.replace(tmp_path, output)
+        print(f"Merged {len(changed)} repaired papers into {output}")
+    print(metrics.summary())
+    metrics.write_csv(metrics_path(output, "repair.llm_metrics"))
+    registry.close()
+    return report
+
+
+def repair_store(store_path, doc_dir, output_csv=None, fields=None, xml_cache_dir=None, dry_run=False,
+                 top_k=REPAIR_TOP_K, token_budget=REPAIR_TOKEN_BUDGET):
+    """Repair the latest records of a run store, store the fixed ones and rebuild the CSV.
+
+    Fixed records are appended to a JSONL store; in a work queue the stored
+    results are overwritten.
+    """
+    latest = {}
+    for record in read_records(store_path):
+        latest[record["id"]] = record
+    records = sorted(latest.values(), key=lambda r: (r.get("seq") is None, r.get("seq")))
+    rows = [record["row"] for record in records]
+    header = list(rows[0]) if rows else []
+    columns = column_map(header)
+    paper_ids = [{"pmcid": r["id"]} if str(r["id"]).upper().startswith("PMC") else {"doi": r["id"]}
+                 for r in records]
+    registry = None if dry_run else open_registry(doc_dir)
+    metrics = LLMMetrics()
+    changed, report = repair_rows(rows, paper_ids, columns, registry, fields, metrics, xml_cache_dir,
+                                  dry_run, top_k, token_budget)
+    print(format_repair_report(report))
+    if dry_run:
+        return report
+    results = [(records[index]["id"], rows[index],
+                records[index].get("ok", True) or not find_problems(rows[index], columns, fields))
+               for index in changed]
+    if is_queue(store_path):
+        update_results(store_path, results)
+    else:
+        store = RunStore(store_path)
+        for index, (paper_id, row, ok) in zip(changed, results):
+            store.append(paper_id, records[index].get("seq"), row, ok=ok)
+        store.close()
+    merge([store_path], output_csv or f"{os.path.splitext(store_path)[0]}.csv", header)
+    print(metrics.summary())
+    metrics.write_csv(metrics_path(store_path, "repair.llm_metrics"))
+    registry.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-ask the LLM only for missing or invalid step 03 fields.")
+    parser.add_argument("output_csv", nargs="?", help="step 03 CSV to repair in place")
+    parser.add_argument("--store", help="repair a per-paper JSONL run store instead of a CSV")
+    parser.add_argument("--docs", required=True, help="folder with the downloaded XML/PDF files")
+    parser.add_argument("--xml-cache", help="JATS parse cache folder used by the step 03 scripts")
+    parser.add_argument("--ids-from", help="CSV with Title and PMCID/PMID/doi columns (e.g. the step 03 input)")
+    parser.add_argument("--output", help="write the repaired CSV here instead of in place")
+    parser.add_argument("--fields", nargs="+", choices=sorted(FIELD_INSTRUCTIONS), help="only check these fields")
+    parser.add_argument("--top-k", type=int, default=REPAIR_TOP_K)
+    parser.add_argument("--budget", type=int, default=REPAIR_TOKEN_BUDGET)
+    parser.add_argument("--dry-run", action="store_true", help="only report the fields that need repair")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.store:
+        repair_store(args.store, args.docs, args.output, args.fields, args.xml_cache, args.dry_run,
+                     args.top_k, args.budget)
+    elif args.output_csv:
+        repair_csv(args.output_csv, args.docs, args.output, args.ids_from, args.fields, args.xml_cache,
+                   args.dry_run, args.top_k, args.budget)
+    else:
+        parser.error("give an output CSV or --store")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Crash-safe per-paper output for the step 03 extraction runs.
+
+Every finished paper is appended to a JSONL store and fsynced before the next
+one is written, so a crash loses at most the paper in flight. A rerun with the
+same store skips the papers already completed (failed papers are retried, and
+so are papers whose document changed since they were extracted).
+``--shard i/N`` splits one input file deterministically across machines (by a
+hash of the paper id) and ``merge`` turns one or more stores into the final CSV
+in input order:
+
+    python -m pipeline.run_store merge "Extracted_LLaMA_Output.shard*of4.jsonl" --output Extracted_LLaMA_Output.csv
+
+With ``--queue`` the papers are not split up front: workers claim them from a
+shared SQLite queue, which also holds their results (see pipeline/work_queue.py).
+A queue file can be given wherever a store is read, e.g. to ``merge``.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import pandas as pd
+
+from pipeline.logs import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+def parse_shard(value):
+    """Parse ``"i/N"`` (1-based, e.g. ``"2/4"``) into ``(i, N)``; None means no sharding."""
+    if not value:
+        return None
+    try:
+        index, count = (int(part) for part in str(value).split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{value}', expected i/N such as 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{value}', i must be between 1 and N")
+    return index, count
+
+
+def in_shard(paper_id, shard):
+    """True if ``paper_id`` belongs to ``shard``; stable across machines and Python runs."""
+    if shard is None:
+        return True
+    index, count = shard
+    digest = hashlib.md5(str(paper_id).strip().lower().encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+
+def shard_store_path(output_csv, shard=None):
+    """Default store next to the output CSV, one file per shard."""
+    stem = os.path.splitext(output_csv)[0]
+    if shard is None:
+        return f"{stem}.jsonl"
+    return f"{stem}.shard{shard[0]}of{shard[1]}.jsonl"
+
+
+def read_records(path):
+    """Records of a store (or of a work queue); a line cut short by a crash is ignored."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    # Imported here since the work queue builds on this module
+    from pipeline.work_queue import is_queue, queue_records
+
+    if is_queue(path):
+        return queue_records(path)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+class RunStore:
+    """Append-only JSONL store of per-paper results.
+
+    Each line is ``{"id", "seq", "ok", "row"}``: the paper id (PMCID or DOI), its
+    position in the input file, whether extraction succeeded and the output row,
+    plus ``"fp"``, the SHA-256 of the document it was extracted from, when known.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # Terminate a line cut short by a crash so the next record starts cleanly
+        partial = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                partial = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if partial:
+            self._file.write("\n")
+
+    def completed(self, fingerprints=None):
+        """Ids of the papers that already have a successful record.
+
+        With ``fingerprints`` (paper id -> current document SHA-256, see
+        ``document_fingerprints``), papers extracted from a different version of
+        their document are not counted, so they are extracted again.
+        """
+        latest = {}
+        for record in read_records(self.path):
+            latest[record["id"]] = record
+        done = {paper_id for paper_id, record in latest.items() if record.get("ok", True)}
+        if fingerprints:
+            changed = {paper_id for paper_id in done
+                       if latest[paper_id].get("fp") and fingerprints.get(paper_id) not in (None, latest[paper_id]["fp"])}
+            if changed:
+                log.info("%d completed papers have a changed document and will be extracted again", len(changed))
+            done -= changed
+        return done
+
+    def claim(self, df, id_column, fingerprints=None):
+        """All rows of ``df``, as a ``RowFeed``; a run with its own store does not share its papers."""
+        return RowFeed(df.iterrows())
+
+    def append(self, paper_id, seq, row, ok=True, fingerprint=None):
+        record = {"id": paper_id, "seq": seq, "ok": ok, "row": row}
+        if fingerprint:
+            record["fp"] = fingerprint
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class RowFeed:
+    """``(index, row)`` pairs for ``run_pipeline`` that remembers the index of every row it handed out.
+
+    ``index[seq]`` is the DataFrame index of the row with pipeline sequence
+    number ``seq``, also when the rows are claimed from a queue in any order.
+    Pass ``dropped`` as ``run_pipeline(on_drop=...)`` so that a row a stage
+    dropped is handed to ``on_drop`` (by index).
+    """
+
+    def __init__(self, pairs, on_drop=None):
+        self.index = []
+        self._pairs = pairs
+        self._on_drop = on_drop
+
+    def dropped(self, seq):
+        if self._on_drop is not None:
+            self._on_drop(self.index[seq])
+
+    def __iter__(self):
+        for index, row in self._pairs:
+            self.index.append(index)
+            yield index, row
+
+
+def open_store(output_csv, store_path=None, shard=None, work_queue=None):
+    """The per-paper store of a run: a JSONL ``RunStore``, or with ``work_queue`` the shared ``WorkQueue``.
+
+    Args:
+        work_queue (dict): ``WorkQueue`` arguments (see ``work_queue.queue_settings``).
+    """
+    if work_queue:
+        from pipeline.work_queue import WorkQueue
+
+        if shard is not None:
+            raise ValueError("--shard and --queue cannot be combined; the workers of a queue share its papers")
+        return WorkQueue(**work_queue)
+    return RunStore(store_path or shard_store_path(output_csv, shard))
+
+
+def merge(paths, output_csv, columns=None):
+    """Write the latest record of every paper in ``paths`` to ``output_csv`` in input order.
+
+    Args:
+        paths (list): Store files (glob patterns are expanded).
+        output_csv (str): Final CSV.
+        columns (list): Optional column order (missing values are left empty).
+
+    Returns:
+        int: Number of papers written.
+    """
+    latest = {}
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            for record in read_records(path):
+                latest[record["id"]] = record
+    records = sorted(latest.values(), key=lambda r: (r.get("seq") is None, r.get("seq")))
+    output_df = pd.DataFrame([r["row"] for r in records], columns=columns)
+    output_df.to_csv(output_csv, index=False, encoding="utf-8")
+    failed = sum(not r.get("ok", True) for r in records)
+    log.info("Merged %d papers (%d failed) into %s", len(records), failed, output_csv)
+    return len(records)
+
+
+def document_fingerprints(df, id_column, registry, kind=None):
+    """Paper id -> SHA-256 of its document in the asset registry (``pipeline.assets``), for ``completed``."""
+    fingerprints = {}
+    for row in df.to_dict("records"):
+        record = registry.lookup(doi=row.get("doi"), pmcid=row.get("PMCID"), pmid=row.get("PMID"), kind=kind)
+        if record:
+            fingerprints[str(row[id_column]).strip()] = record["sha256"]
+    return fingerprints
+
+
+def pending_rows(df, id_column, done, shard=None, limit=None):
+    """Rows of ``df`` in ``shard`` whose id is not in ``done`` (at most ``limit``), index kept."""
+    ids = df[id_column].astype(str).str.strip()
+    in_scope = ids.map(lambda paper_id: in_shard(paper_id, shard))
+    pending = in_scope & ~ids.isin(done)
+    todo = df[pending]
+    if limit is not None:
+        todo = todo.head(limit)
+    log.info("%d papers to process (%d in shard, %d already completed)", len(todo), int(in_scope.sum()),
+             int(in_scope.sum() - pending.sum()))
+    return todo
+
+
+def finish_run(store, output_csv, shard=None, columns=None, records_path=None, task=None):
+    """Close the store and write the CSV, or say how to merge when only one shard was run.
+
+    With ``records_path``, the latest record of every paper is also stored as a
+    ``task`` extraction in the shared record store (see pipeline/record_store.py).
+    Workers of a queue leave the CSV to the worker that finishes the last paper.
+    """
+    remaining = store.remaining() if hasattr(store, "remaining") else 0
+    store.close()
+    if records_path:
+        # Imported here since the record store reads these JSONL stores
+        from pipeline.record_store import RecordStore
+
+        records = RecordStore(records_path)
+        log.info("%d %s extractions recorded in %s", records.import_run_store(store.path, task), task, records_path)
+        records.close()
+    if remaining:
+        log.info("%d papers of %s are pending or in progress on other workers; the last one writes %s, or run:\n"
+                 "python -m pipeline.run_store merge %s --output %s", remaining, store.path, output_csv,
+                 store.path, output_csv)
+    elif shard is None:
+        merge([store.path], output_csv, columns)
+    else:
+        log.info("Shard %d/%d stored in %s; once all shards are done run:\n"
+                 "python -m pipeline.run_store merge %s --output %s", shard[0], shard[1], store.path,
+                 shard_store_path(output_csv, ("*", shard[1])), output_csv)
+
+
+def add_run_arguments(parser):
+    """``--store``, ``--shard``, ``--limit``, ``--records``, ``--registry-db`` and the ``--queue`` options of the step 03 scripts."""
+    # Imported here since the work queue builds on this module
+    from pipeline.work_queue import add_queue_arguments
+
+    parser.add_argument("--store", help="per-paper JSONL store (default: the output CSV path with .jsonl, "
+                                        "one file per shard)")
+    parser.add_argument("--shard", type=parse_shard, help="process only shard i of N (1-based), e.g. 2/4")
+    parser.add_argument("--limit", type=int, help="process at most this many pending papers")
+    parser.add_argument("--records", help="also record the results in this SQLite record store "
+                                          "(see pipeline/record_store.py)")
+    parser.add_argument("--registry-db", help="asset registry SQLite file (default: inside the document folder, "
+                                              "which must then be writable)")
+    return add_queue_arguments(parser)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge step 03 per-paper stores into the final CSV.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    merge_parser = sub.add_parser("merge", help="combine one or more stores (e.g. all shards) into a CSV")
+    merge_parser.add_argument("stores", nargs="+")
+    merge_parser.add_argument("--output", required=True)
+    merge_parser.add_argument("--columns", nargs="+", help="column order of the CSV")
+    status_parser = sub.add_parser("status", help="completed and failed papers per store")
+    status_parser.add_argument("stores", nargs="+")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.command == "merge":
+        merge(args.stores, args.output, args.columns)
+    else:
+        for pattern in args.stores:
+            for path in sorted(glob.glob(pattern)) or [pattern]:
+                latest = {r["id"]: r.get("ok", True) for r in read_records(path)}
+                print(f"{path}: {sum(latest.values())} completed, {len(latest) - sum(latest.values())} failed")
+
+
+if __name__ == "__main__":
+    main()
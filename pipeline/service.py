@@ -0,0 +1,460 @@
+"""Local HTTP service that screens and extracts single papers with warm models.
+
+The step 02 and step 03 scripts load the sentence encoder (and reconnect to
+ollama) on every run, which costs seconds before the first paper. The service
+loads the encoder, the target sentences of the semantic filter and the LLM
+client once and then answers per paper:
+
+* ``POST /filter`` with ``{"id", "title", "abstract"}`` (or ``{"papers": [...]}``)
+  returns the stage-1 (infectious disease) and stage-2 (deep learning) maximum
+  similarities and labels, computed like ``calculate_relevance`` in step 02:
+  the text is split into sentences and the best cosine similarity to the
+  target sentences is compared with the thresholds.
+* ``POST /extract`` with ``{"id", "text" | "xml_path" | "pdf_path", "task"}``
+  returns the step 03 fields of ``task`` (``additional``, ``performance`` or
+  both when omitted), using the same compression, context selection and
+  prompts as the scripts.
+* ``GET /metrics`` (Prometheus text) and ``GET /stats`` (JSON) give request
+  counts, rejections and latency percentiles per endpoint, and the batch sizes
+  of the encoder; ``GET /health`` answers once the models are loaded.
+
+Sentences of concurrent ``/filter`` requests are encoded together: the
+``MicroBatcher`` thread takes the first waiting request, collects whatever
+else arrives within ``--max-wait-ms`` (up to ``--max-batch`` sentences) and
+runs one ``encode`` call for all of them. Both queues are bounded: when
+``--max-queue`` filter requests or ``--max-pending-llm`` extractions are
+already waiting, new ones get ``503`` with ``Retry-After`` instead of piling
+up behind the model.
+
+    python -m pipeline.service serve --source pubmed --port 8765
+    curl -s localhost:8765/filter -d '{"title": "...", "abstract": "..."}'
+"""
+import argparse
+import ast
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from pipeline import embeddings
+from pipeline.compression import XML_COMPRESSION_CONFIG, compress as compress_text
+from pipeline.context_selection import TASK_FIELDS, select_context
+from pipeline.documents import extract_full_text, extract_text_from_pdf, strip_references
+from pipeline.llm_client import MODEL, LLMMetrics, ask_json, percentile
+from pipeline.logs import LEVELS, setup_logging
+from pipeline.orchestrator import DEFAULT_THRESHOLDS, SCRIPTS, load_config
+from pipeline.prompts import build_messages, normalize_choice
+
+# Same settings as the step 03 scripts
+CONTEXT_TOP_K = 4
+CONTEXT_TOKEN_BUDGET = 3000
+LLM_ATTEMPTS = 3
+# How long ollama keeps the model loaded after a request
+KEEP_ALIVE = "30m"
+
+# Target sentence lists and their threshold parameter in the step 02 scripts
+STAGES = {"stage1": ("target_sentences_general", "threshold_general"),
+          "stage2": ("deep_learning_embedding2", "threshold_dl")}
+
+# Latencies kept per endpoint for the percentiles
+LATENCY_WINDOW = 4096
+
+log = logging.getLogger("pipeline.service")
+
+
+class Overloaded(Exception):
+    """The queue in front of the encoder or the LLM is full."""
+
+
+def load_targets(source):
+    """Target sentence lists of a source's step 02 script, read without running the script."""
+    tree = ast.parse(SCRIPTS[source]["filter"].read_text(encoding="utf-8"))
+    names = {name for name, _ in STAGES.values()}
+    targets = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and getattr(node.targets[0], "id", None) in names:
+            targets[node.targets[0].id] = ast.literal_eval(node.value)
+    missing = names - set(targets)
+    if missing:
+        raise ValueError(f"{SCRIPTS[source]['filter']} has no {', '.join(sorted(missing))}")
+    return targets
+
+
+def load_thresholds(source, config_path=None):
+    """Thresholds of a source from the pipeline config, else the step 02 defaults."""
+    settings = load_config(config_path)["sources"].get(source, {}) if config_path else {}
+    return {**DEFAULT_THRESHOLDS, **settings.get("step02", {})}
+
+
+class MicroBatcher:
+    """Encodes the texts of concurrent requests in shared ``encode`` calls.
+
+    Args:
+        encode (callable): ``encode(texts) -> array`` with one row per text.
+        max_batch (int): Texts per ``encode`` call (a larger single request is still encoded whole).
+        max_wait (float): Seconds to wait for more requests after the first one arrives.
+        max_queue (int): Requests that may wait; ``submit`` raises ``Overloaded`` beyond that.
+    """
+
+    def __init__(self, encode, max_batch=64, max_wait=0.005, max_queue=256):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = {"batches": 0, "texts": 0, "requests": 0, "max_batch": 0}
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def submit(self, texts):
+        """Future of the embeddings of ``texts``."""
+        future = Future()
+        try:
+            self._queue.put_nowait((list(texts), future))
+        except queue.Full:
+            raise Overloaded("encoder queue is full") from None
+        return future
+
+    def _collect(self, first):
+        batch, size = [first], len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back for the main loop
+                self._queue.put(None)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            texts = [text for item, _ in batch for text in item]
+            try:
+                vectors = self.encode(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["requests"] += len(batch)
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(texts))
+            start = 0
+            for item, future in batch:
+                future.set_result(vectors[start:start + len(item)])
+                start += len(item)
+
+
+class EndpointMetrics:
+    """Request counts and recent latencies per endpoint; safe to share between threads."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            entry = self.endpoints.setdefault(endpoint, {
+                "requests": 0, "errors": 0, "rejected": 0, "seconds": 0.0,
+                "latencies": collections.deque(maxlen=self.window)})
+            entry["requests"] += 1
+            entry["seconds"] += seconds
+            entry["rejected"] += status == 503
+            entry["errors"] += status >= 400 and status != 503
+            entry["latencies"].append(seconds)
+
+    def summary(self):
+        """Per endpoint: counts, mean and p50/p95/p99 latency in milliseconds."""
+        with self._lock:
+            entries = {name: dict(entry, latencies=list(entry["latencies"])) for name, entry in self.endpoints.items()}
+        result = {}
+        for name, entry in sorted(entries.items()):
+            latencies = entry.pop("latencies")
+            result[name] = {**entry, "seconds": round(entry["seconds"], 3), "mean_ms": round(1000 * entry["seconds"] / max(entry["requests"], 1), 2),
+                            **{f"p{q}_ms": round(1000 * percentile(latencies, q), 2) for q in (50, 95, 99)}}
+        return result
+
+
+class ScreeningService:
+    """The warm models behind the HTTP endpoints.
+
+    Args:
+        source (str): Source whose step 02 target sentences are used.
+        thresholds (dict): ``threshold_general`` and ``threshold_dl``.
+        llm_slots (int): Extractions sent to the LLM at the same time.
+        max_pending_llm (int): Extractions that may wait for a slot before ``Overloaded``.
+        llm_host (str): Ollama address (default: ``OLLAMA_HOST`` or ollama's default).
+    """
+
+    def __init__(self, source="pubmed", thresholds=None, max_batch=64, max_wait=0.005, max_queue=256,
+                 llm_slots=1, max_pending_llm=4, llm_host=None, model=MODEL, compress=True, timeout=60.0):
+        import nltk
+        import ollama
+
+        self.source = source
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+        self.model = model
+        self.timeout = timeout
+        self.targets = load_targets(source)
+        self._sent_tokenize = nltk.sent_tokenize
+        self._llm = ollama.Client(host=llm_host or os.environ.get("OLLAMA_HOST"))
+        self._llm_slots = threading.Semaphore(llm_slots)
+        self._llm_pending = threading.BoundedSemaphore(llm_slots + max_pending_llm)
+        self.compress = compress
+        self.batcher = MicroBatcher(embeddings.encode, max_batch, max_wait, max_queue)
+        self.metrics = EndpointMetrics()
+        self.target_embeddings = {}
+
+    def start(self):
+        """Load the encoder and embed the target sentences before the first request."""
+        start = time.perf_counter()
+        embeddings.get_model()
+        for stage, (name, _) in STAGES.items():
+            self.target_embeddings[stage] = embeddings.encode(self.targets[name])
+        self.batcher.start()
+        log.info("Encoder and %s target sentences ready in %.1fs",
+                 " + ".join(str(len(self.targets[name])) for name, _ in STAGES.values()),
+                 time.perf_counter() - start)
+        return self
+
+    def warm_llm(self):
+        """Have ollama load the model now rather than on the first extraction."""
+        try:
+            self._llm.chat(model=self.model, messages=[], keep_alive=KEEP_ALIVE)
+        except Exception as e:
+            log.warning("Could not load %s: %s", self.model, e)
+
+    def stop(self):
+        self.batcher.stop()
+
+    def filter(self, papers):
+        """Stage-1/stage-2 similarities and labels of each paper (``id``, ``title``, ``abstract``)."""
+        if not all(isinstance(paper, dict) for paper in papers):
+            raise ValueError("papers must be JSON objects")
+        sentences = [self._sent_tokenize(f"{paper.get('title') or ''} {paper.get('abstract') or ''}")
+                     for paper in papers]
+        if not all(sentences):
+            raise ValueError("every paper needs a title or an abstract")
+        futures = [self.batcher.submit(paper_sentences) for paper_sentences in sentences]
+        results = []
+        for paper, future in zip(papers, futures):
+            vectors = future.result(self.timeout)
+            result = {"id": paper.get("id")}
+            for stage, (_, threshold) in STAGES.items():
+                # Embeddings are normalised, so the dot product is the cosine similarity
+                similarity = float(np.max(vectors @ self.target_embeddings[stage].T))
+                result[stage] = {"similarity": round(similarity, 4),
+                                 "relevant": int(similarity >= self.thresholds[threshold])}
+            result["relevant"] = int(result["stage1"]["relevant"] and result["stage2"]["relevant"])
+            results.append(result)
+        return results
+
+    def paper_text(self, request):
+        """Reference-stripped text of an ``/extract`` request."""
+        if request.get("text"):
+            return strip_references(request["text"])
+        if request.get("xml_path"):
+            return extract_full_text(request["xml_path"])
+        if request.get("pdf_path"):
+            return strip_references(extract_text_from_pdf(request["pdf_path"]) or "")
+        raise ValueError("give text, xml_path or pdf_path")
+
+    def extract(self, request):
+        """Step 03 fields of one paper, with the LLM figures of the calls made for it."""
+        tasks = request.get("task") or list(TASK_FIELDS)
+        tasks = [tasks] if isinstance(tasks, str) else tasks
+        unknown = set(tasks) - set(TASK_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown task: {', '.join(sorted(unknown))}")
+        if not self._llm_pending.acquire(blocking=False):
+            raise Overloaded("too many extractions waiting for the LLM")
+        try:
+            paper_id = str(request.get("id") or "paper")
+            text = self.paper_text(request)
+            if not text:
+                raise ValueError(f"no text for {paper_id}")
+            # Plain ``compress`` and per-request metrics, so a long-running service keeps nothing per paper
+            if self.compress:
+                from_xml = not request.get("text") and request.get("xml_path")
+                text, _ = compress_text(text, XML_COMPRESSION_CONFIG if from_xml else None)
+            metrics = LLMMetrics(client=self._llm)
+            fields, failed = {}, []
+            for task in tasks:
+                context, _ = select_context(text, task, top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                                            num_ctx=metrics.num_ctx)
+                messages = build_messages(context, TASK_FIELDS[task])
+                with self._llm_slots:
+                    for _ in range(LLM_ATTEMPTS):
+                        data = ask_json(metrics, f"{paper_id}:{task}", messages, model=self.model,
+                                        keep_alive=KEEP_ALIVE)
+                        if data is not None:
+                            break
+                if data is None:
+                    failed.append(task)
+                    continue
+                fields.update((field, normalize_choice(field, data.get(field))) for field in TASK_FIELDS[task])
+            llm = {key: round(sum(row[key] for row in metrics.paper_rows()), 3)
+                   for key in ("calls", "wall_seconds", "prompt_tokens", "eval_tokens")}
+            return {"id": request.get("id"), "fields": fields, "failed_tasks": failed, "llm": llm}
+        finally:
+            self._llm_pending.release()
+
+    def stats(self):
+        return {"source": self.source, "thresholds": self.thresholds, "endpoints": self.metrics.summary(),
+                "encoder": {**self.batcher.stats, "pending": self.batcher.pending()}}
+
+    def prometheus(self):
+        """Endpoint and encoder figures in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = ["# HELP pipeline_service_requests_total Requests per endpoint.",
+                 "# TYPE pipeline_service_requests_total counter"]
+        lines += [f'pipeline_service_requests_total{{endpoint="{name}",result="{result}"}} {entry[result]}'
+                  for name, entry in stats["endpoints"].items() for result in ("requests", "errors", "rejected")]
+        lines += ["# HELP pipeline_service_latency_seconds Latency percentiles of the recent requests.",
+                  "# TYPE pipeline_service_latency_seconds gauge"]
+        lines += [f'pipeline_service_latency_seconds{{endpoint="{name}",quantile="{q / 100:g}"}} {entry[f"p{q}_ms"] / 1000:.6g}'
+                  for name, entry in stats["endpoints"].items() for q in (50, 95, 99)]
+        encoder = stats["encoder"]
+        lines += ["# HELP pipeline_service_encoder_total Encoder batches, texts and requests.",
+                  "# TYPE pipeline_service_encoder_total counter"]
+        lines += [f'pipeline_service_encoder_total{{kind="{kind}"}} {encoder[kind]}'
+                  for kind in ("batches", "texts", "requests")]
+        lines += ["# HELP pipeline_service_encoder_pending Filter requests waiting for the encoder.",
+                  "# TYPE pipeline_service_encoder_pending gauge",
+                  f"pipeline_service_encoder_pending {encoder['pending']}"]
+        return "\n".join(lines) + "\n"
+
+
+def make_server(service, host="127.0.0.1", port=8765):
+    """``ThreadingHTTPServer`` for ``service``; one thread per connection."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            log.debug("%s %s", self.address_string(), format % args)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {"status": "ok", "source": service.source})
+            elif self.path == "/stats":
+                self._send(200, service.stats())
+            elif self.path == "/metrics":
+                self._send(200, service.prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+            else:
+                self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            routes = {"/filter": self._filter, "/extract": service.extract}
+            if self.path not in routes:
+                self._send(404, {"error": f"unknown path {self.path}"})
+                return
+            start = time.perf_counter()
+            status = 200
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                body = routes[self.path](request)
+            except Overloaded as e:
+                status, body = 503, {"error": str(e)}
+            except (ValueError, TypeError) as e:
+                status, body = 400, {"error": str(e)}
+            except FutureTimeout:
+                status, body = 504, {"error": "timed out waiting for the encoder"}
+            except Exception as e:
+                log.exception("%s failed", self.path)
+                status, body = 500, {"error": str(e)}
+            self._send(status, body)
+            service.metrics.record(self.path, time.perf_counter() - start, status)
+
+        @staticmethod
+        def _filter(request):
+            if "papers" in request:
+                return {"results": service.filter(request["papers"])}
+            return service.filter([request])[0]
+
+        def _send(self, status, body, content_type="application/json"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if status == 503:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="load the models and answer /filter and /extract")
+    serve.add_argument("--source", choices=sorted(SCRIPTS), default="pubmed",
+                       help="step 02 script whose target sentences are used")
+    serve.add_argument("--config", help="pipeline config with the step 02 thresholds (default: the step 02 defaults)")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--max-batch", type=int, default=64, help="sentences per encoder call")
+    serve.add_argument("--max-wait-ms", type=float, default=5.0,
+                       help="how long the first request of a batch waits for others")
+    serve.add_argument("--max-queue", type=int, default=256, help="filter requests waiting before 503")
+    serve.add_argument("--llm-slots", type=int, default=1, help="concurrent LLM extractions")
+    serve.add_argument("--max-pending-llm", type=int, default=4, help="extractions waiting before 503")
+    serve.add_argument("--model", default=MODEL)
+    serve.add_argument("--no-compress", action="store_true", help="send the uncompressed paper text")
+    serve.add_argument("--no-warm-llm", action="store_true", help="do not load the LLM at start-up")
+    serve.add_argument("--log-level", choices=LEVELS, default=os.environ.get("PIPELINE_LOG_LEVEL", "INFO"))
+    args = parser.parse_args()
+
+    setup_logging(level=args.log_level)
+    service = ScreeningService(args.source, load_thresholds(args.source, args.config), args.max_batch,
+                               args.max_wait_ms / 1000, args.max_queue, args.llm_slots, args.max_pending_llm,
+                               model=args.model, compress=not args.no_compress).start()
+    if not args.no_warm_llm:
+        service.warm_llm()
+    httpd = make_server(service, args.host, args.port)
+    log.info("Serving %s screening on http://%s:%d", args.source, *httpd.server_address[:2])
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Staged producer/consumer pipeline with bounded queues.
+
+Each stage runs in its own worker threads and hands items to the next stage
+through a bounded queue, so while paper N is in LLM inference, papers
+N+1..N+k are already being parsed and their prompts built. The queue sizes
+bound how far ahead the preparation stages can run.
+
+Per-stage busy time, utilisation and input-queue depth are recorded so the
+bottleneck stage on a given machine is visible in ``format_report``.
+"""
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+# Keys the step 03 items (input rows and the dicts the stages pass on) carry their paper id under
+ID_KEYS = ("paper_id", "pmcid", "PMCID", "doi", "DOI")
+
+
+class Stage:
+    """One pipeline stage: ``func(item) -> item`` run by ``workers`` threads.
+
+    Returning None from ``func`` drops the item (e.g. a paper without a PDF).
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=4):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.depth_samples = []
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        samples = self.depth_samples or [0]
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "errors": self.errors,
+            "busy_seconds": self.busy_seconds,
+            "utilisation": self.busy_seconds / (wall * self.workers) if wall > 0 else 0.0,
+            "mean_queue_depth": sum(samples) / len(samples),
+            "max_queue_depth": max(samples),
+            "queue_size": self.queue_size,
+        }
+
+
+def item_id(item):
+    """Paper id of a stage item, for log messages; None when it carries none."""
+    if isinstance(item, tuple) and item:
+        # ``(index, row)`` pairs
+        item = item[-1]
+    for key in ID_KEYS:
+        try:
+            value = item[key]
+        except (KeyError, IndexError, TypeError):
+            continue
+        if value is not None and str(value).strip():
+            return str(value).strip()
+    return None
+
+
+def _run_stage(stage, inbox, outbox, remaining, on_drop=None):
+    while True:
+        entry = inbox.get()
+        if entry is _DONE:
+            # Last worker of this stage closes the next queue
+            with stage._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                stage.finished = time.perf_counter()
+                outbox.put(_DONE)
+            else:
+                inbox.put(_DONE)
+            return
+        seq, item = entry
+        start = time.perf_counter()
+        try:
+            result = stage.func(item)
+        except Exception:
+            log.exception("Error in stage '%s' for %s", stage.name, item_id(item) or f"item {seq}")
+            result = None
+            with stage._lock:
+                stage.errors += 1
+        with stage._lock:
+            stage.busy_seconds += time.perf_counter() - start
+            stage.items += 1
+        if result is not None:
+            outbox.put((seq, result))
+        elif on_drop is not None:
+            on_drop(seq)
+
+
+def run_pipeline(items, stages, sample_interval=0.5, on_drop=None):
+    """Push ``items`` through ``stages`` and yield ``(index, result)`` as results complete.
+
+    Args:
+        items (iterable): Inputs of the first stage.
+        stages (list): ``Stage`` objects, in order.
+        sample_interval (float): Seconds between queue-depth samples.
+        on_drop (callable): Called with the input index of an item a stage dropped.
+
+    Yields:
+        tuple: (input index, output of the last stage); with one worker per stage
+        results arrive in input order.
+
+    Raises:
+        Exception: Whatever iterating ``items`` raised, once the items read
+        before it have gone through the stages.
+    """
+    queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+    results = queue.Queue()
+    outboxes = queues[1:] + [results]
+    threads = []
+    start = time.perf_counter()
+    for stage, inbox, outbox in zip(stages, queues, outboxes):
+        stage.started = start
+        remaining = [stage.workers]
+        for _ in range(stage.workers):
+            thread = threading.Thread(target=_run_stage, args=(stage, inbox, outbox, remaining, on_drop),
+                                      name=f"stage-{stage.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    stop_sampling = threading.Event()
+
+    def sample():
+        while not stop_sampling.wait(sample_interval):
+            for stage, inbox in zip(stages, queues):
+                stage.depth_samples.append(inbox.qsize())
+
+    sampler = threading.Thread(target=sample, name="stage-sampler", daemon=True)
+    sampler.start()
+
+    # Error raised by ``items`` (e.g. a work queue whose database is locked)
+    failure = []
+
+    def feed():
+        try:
+            for seq, item in enumerate(items):
+                queues[0].put((seq, item))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            queues[0].put(_DONE)
+
+    feeder = threading.Thread(target=feed, name="stage-feeder", daemon=True)
+    feeder.start()
+
+    try:
+        while True:
+            entry = results.get()
+            if entry is _DONE:
+                break
+            yield entry
+        if failure:
+            raise failure[0]
+    finally:
+        stop_sampling.set()
+
+
+def format_report(stages):
+    """Text table of per-stage utilisation and queue depth; the busiest stage is the bottleneck."""
+    rows = [stage.stats() for stage in stages]
+    lines = [f"{'stage':<12}{'workers':>8}{'items':>7}{'errors':>7}{'busy s':>9}"
+             f"{'util':>7}{'queue avg/max/size':>20}"]
+    for r in rows:
+        lines.append(f"{r['stage']:<12}{r['workers']:>8}{r['items']:>7}{r['errors']:>7}"
+                     f"{r['busy_seconds']:>9.1f}{r['utilisation']:>7.0%}"
+                     f"{r['mean_queue_depth']:>10.1f}/{r['max_queue_depth']}/{r['queue_size']}")
+    if rows:
+        bottleneck = max(rows, key=lambda r: r["utilisation"])
+        lines.append(f"Bottleneck: {bottleneck['stage']} ({bottleneck['utilisation']:.0%} busy)")
+    return "\n".join(lines)
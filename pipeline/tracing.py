@@ -0,0 +1,345 @@
+"""Timing spans, counters and opt-in profiling for the pipeline scripts.
+
+The hot functions of steps 01-03 (NCBI round trips, NLTK tokenization and
+``model.encode`` in step 02, XML parsing, PDF text layer and OCR, LLM calls)
+are wrapped in named spans. Every span adds to a per-process total (calls,
+seconds, min/max, errors), which costs two ``perf_counter`` calls and is
+always on. With a trace folder (``--trace-dir`` on the scripts, or the
+``PIPELINE_TRACE_DIR`` variable, which the orchestrator and worker processes
+inherit) each script also writes, per process:
+
+    <script>.<worker>.trace.jsonl   one line per span (name, start, seconds,
+                                    parent, thread, attributes) and the totals
+                                    at exit
+    <script>.<worker>.prom          the totals as a Prometheus textfile (for the
+                                    node_exporter textfile collector), labelled
+                                    with ``script`` and ``worker``
+
+``<worker>`` is the ``--queue`` worker id, the ``--shard`` (``shard2of4``) or
+else the process id, so parallel runs of one script do not write to the same
+files.
+
+Spans inside per-row loops are recorded with ``event=False``: they count in
+the totals but do not write a JSONL line each.
+
+``--profile cprofile`` (or ``PIPELINE_PROFILE``) also writes
+``<script>.<worker>.prof`` (open with ``snakeviz`` or ``pstats``); cProfile only sees
+the main thread. ``--profile sample`` samples the stacks of every thread
+(e.g. the step 03 prepare/infer stages) every few milliseconds and writes
+``<script>.<worker>.collapsed``, the folded-stack format of ``flamegraph.pl`` and
+speedscope.
+
+    python -m pipeline.tracing summary .trace/textextraction_perfomancemetrics_pubmed.*.trace.jsonl
+"""
+import argparse
+import atexit
+import cProfile
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+TRACE_DIR_ENV = "PIPELINE_TRACE_DIR"
+PROFILE_ENV = "PIPELINE_PROFILE"
+PROFILERS = ("cprofile", "sample")
+# Seconds between stack samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+_lock = threading.Lock()
+_local = threading.local()
+_totals = {}        # span name -> {"calls", "seconds", "min", "max", "errors"}
+_counters = Counter()
+_state = {"script": None, "worker": None, "trace_dir": None, "events": None, "profiler": None, "sampler": None,
+          "started": time.time()}
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(name, start, seconds, error, parent, event, attrs):
+    with _lock:
+        total = _totals.get(name)
+        if total is None:
+            total = _totals[name] = {"calls": 0, "seconds": 0.0, "min": seconds, "max": seconds, "errors": 0}
+        total["calls"] += 1
+        total["seconds"] += seconds
+        total["min"] = min(total["min"], seconds)
+        total["max"] = max(total["max"], seconds)
+        total["errors"] += error
+        if event and _state["events"] is not None:
+            line = {"span": name, "start": round(start, 6), "seconds": round(seconds, 6), "parent": parent,
+                    "thread": threading.current_thread().name, "pid": os.getpid()}
+            if error:
+                line["error"] = True
+            line.update(attrs)
+            _state["events"].write(json.dumps(line, default=str) + "\n")
+
+
+class span:
+    """Time a block under ``name``; extra keyword arguments go into its JSONL line.
+
+        with span("step02.encode", event=False):
+            embeddings = model.encode(sentences)
+
+    ``set(**attrs)`` adds attributes known only inside the block (e.g. a token count).
+    """
+
+    def __init__(self, name, event=True, **attrs):
+        self.name = name
+        self.event = event
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _stack().pop()
+        _record(self.name, self.wall, seconds, exc_type is not None, self.parent, self.event, self.attrs)
+        return False
+
+
+def traced(name=None, event=True):
+    """Decorator form of ``span``; the name defaults to ``<module>.<function>``."""
+    def decorate(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, event=event):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    """Add ``value`` to the counter ``name`` (e.g. retries, cache hits)."""
+    with _lock:
+        _counters[name] += value
+
+
+def totals():
+    """Copy of the span totals and counters of this process."""
+    with _lock:
+        return {name: dict(total) for name, total in _totals.items()}, dict(_counters)
+
+
+class StackSampler:
+    """Samples the Python stack of every thread at a fixed interval into folded-stack counts."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(frames))] += 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, samples in self.samples.most_common():
+                f.write(f"{stack} {samples}\n")
+
+
+def add_trace_arguments(parser):
+    """``--trace-dir`` and ``--profile`` (defaults from ``PIPELINE_TRACE_DIR`` / ``PIPELINE_PROFILE``)."""
+    parser.add_argument("--trace-dir", default=os.environ.get(TRACE_DIR_ENV),
+                        help=f"write span timings (JSONL) and a Prometheus textfile here (env {TRACE_DIR_ENV})")
+    parser.add_argument("--profile", choices=PROFILERS, default=os.environ.get(PROFILE_ENV) or None,
+                        help=f"also profile the run into the trace folder (env {PROFILE_ENV})")
+
+
+def worker_name(args=None):
+    """This process's part of a run: the ``--queue`` worker id, the ``--shard`` or the process id."""
+    if getattr(args, "queue", None) and getattr(args, "worker_id", None):
+        name = args.worker_id
+    elif getattr(args, "shard", None):
+        name = f"shard{args.shard[0]}of{args.shard[1]}"
+    else:
+        name = str(os.getpid())
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+def start_tracing(args=None, trace_dir=None, profile=None, script=None, worker=None):
+    """Start writing spans (and profiling) for this process; the files are completed at exit.
+
+    Takes the parsed ``--trace-dir``/``--profile`` options (and ``--shard``,
+    ``--queue``/``--worker-id`` for the file names) or the same values as
+    keywords. Without a trace folder only the in-memory totals are kept.
+    """
+    trace_dir = getattr(args, "trace_dir", None) or trace_dir or os.environ.get(TRACE_DIR_ENV)
+    profile = getattr(args, "profile", None) or profile or os.environ.get(PROFILE_ENV) or None
+    if not trace_dir or _state["trace_dir"]:
+        if profile and not trace_dir:
+            print("--profile needs a trace folder (--trace-dir); not profiling.")
+        return
+    if profile and profile not in PROFILERS:
+        print(f"Unknown profiler {profile!r} (use one of {', '.join(PROFILERS)}); not profiling.")
+        profile = None
+    trace_dir = Path(trace_dir)
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    _state["script"] = script or Path(sys.argv[0]).stem or "python"
+    _state["worker"] = worker or worker_name(args)
+    _state["trace_dir"] = trace_dir
+    # Line buffered so that the spans of a killed run are kept
+    _state["events"] = open(trace_dir / f"{_state['script']}.{_state['worker']}.trace.jsonl", "a",
+                            encoding="utf-8", buffering=1)
+    if profile == "cprofile":
+        _state["profiler"] = cProfile.Profile()
+        _state["profiler"].enable()
+    elif profile == "sample":
+        _state["sampler"] = StackSampler().start()
+    atexit.register(finish_tracing)
+
+
+def prometheus_text(script, span_totals, counters, run_seconds, worker=None):
+    """Span totals and counters in the Prometheus text exposition format."""
+    label = f'script="{script}"' + (f',worker="{worker}"' if worker else "")
+    lines = []
+    metrics = [("pipeline_span_seconds_total", "counter", "Seconds spent in each span.", "seconds"),
+               ("pipeline_span_calls_total", "counter", "Calls of each span.", "calls"),
+               ("pipeline_span_errors_total", "counter", "Spans that ended with an exception.", "errors"),
+               ("pipeline_span_max_seconds", "gauge", "Longest single call of each span.", "max")]
+    for metric, kind, help_text, key in metrics:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{{label},span="{name}"}} {total[key]:.6g}' for name, total in sorted(span_totals.items())]
+    if counters:
+        lines += ["# HELP pipeline_events_total Counters of the run (retries, cache hits, ...).",
+                  "# TYPE pipeline_events_total counter"]
+        lines += [f'pipeline_events_total{{{label},name="{name}"}} {value:g}' for name, value in sorted(counters.items())]
+    lines += ["# HELP pipeline_run_seconds Wall time of the run.", "# TYPE pipeline_run_seconds gauge",
+              f"pipeline_run_seconds{{{label}}} {run_seconds:.3f}",
+              "# HELP pipeline_run_finished_timestamp_seconds End of the run.",
+              "# TYPE pipeline_run_finished_timestamp_seconds gauge",
+              f"pipeline_run_finished_timestamp_seconds{{{label}}} {time.time():.0f}"]
+    return "\n".join(lines) + "\n"
+
+
+def finish_tracing():
+    """Write the totals, the Prometheus textfile and the profile (also registered with atexit)."""
+    if _state["events"] is None:
+        return
+    trace_dir, script, worker = _state["trace_dir"], _state["script"], _state["worker"]
+    stem = f"{script}.{worker}"
+    span_totals, counters = totals()
+    run_seconds = time.time() - _state["started"]
+    if _state["profiler"]:
+        _state["profiler"].disable()
+        _state["profiler"].dump_stats(trace_dir / f"{stem}.prof")
+    if _state["sampler"]:
+        _state["sampler"].stop()
+        _state["sampler"].write(trace_dir / f"{stem}.collapsed")
+    events = _state["events"]
+    events.write(json.dumps({"totals": span_totals, "counters": counters, "run_seconds": round(run_seconds, 3),
+                             "pid": os.getpid(), "worker": worker, "finished": time.time()}) + "\n")
+    events.close()
+    _state["events"] = None
+    # Textfile collectors read whole files only, so replace it atomically
+    prom = trace_dir / f"{stem}.prom"
+    with open(prom.with_suffix(".prom.tmp"), "w", encoding="utf-8") as f:
+        f.write(prometheus_text(script, span_totals, counters, run_seconds, worker))
+    os.replace(prom.with_suffix(".prom.tmp"), prom)
+    print(format_totals(span_totals, counters))
+    print(f"Trace written to {trace_dir}")
+
+
+def format_totals(span_totals, counters=None):
+    """Spans sorted by total time, with calls, mean and max."""
+    lines = [f"{'span':<34} {'calls':>8} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'errors':>6}"]
+    for name, total in sorted(span_totals.items(), key=lambda item: -item[1]["seconds"]):
+        mean = total["seconds"] / total["calls"] * 1000 if total["calls"] else 0
+        lines.append(f"{name:<34} {total['calls']:>8} {total['seconds']:>9.2f} {mean:>9.1f} "
+                     f"{total['max'] * 1000:>9.1f} {total['errors']:>6}")
+    for name, value in sorted((counters or {}).items()):
+        lines.append(f"{name:<34} {value:>8g}")
+    return "\n".join(lines)
+
+
+def summarize_trace(path):
+    """Totals of the last finished run in a JSONL trace, or recomputed from its span lines."""
+    last, spans = None, {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "totals" in record:
+                last, spans = record, {}
+                continue
+            total = spans.setdefault(record["span"], {"calls": 0, "seconds": 0.0, "min": record["seconds"],
+                                                      "max": 0.0, "errors": 0})
+            total["calls"] += 1
+            total["seconds"] += record["seconds"]
+            total["min"] = min(total["min"], record["seconds"])
+            total["max"] = max(total["max"], record["seconds"])
+            total["errors"] += bool(record.get("error"))
+    # Span lines after the last totals belong to a run that did not finish
+    if spans or last is None:
+        print("Run did not finish; totals from its span lines (per-row spans are not included)")
+        return spans, {}
+    return last["totals"], last["counters"]
+
+
+def combine_totals(runs):
+    """Span totals and counters of several traces (e.g. the workers of one run) added up."""
+    span_totals, counters = {}, Counter()
+    for spans, run_counters in runs:
+        for name, total in spans.items():
+            combined = span_totals.setdefault(name, {"calls": 0, "seconds": 0.0, "min": total["min"],
+                                                     "max": 0.0, "errors": 0})
+            for key in ("calls", "seconds", "errors"):
+                combined[key] += total[key]
+            combined["min"] = min(combined["min"], total["min"])
+            combined["max"] = max(combined["max"], total["max"])
+        counters.update(run_counters)
+    return span_totals, dict(counters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Span timings written by the pipeline scripts.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary = sub.add_parser("summary", help="time per span of .trace.jsonl files (added up over several)")
+    summary.add_argument("traces", nargs="+")
+    args = parser.parse_args()
+    print(format_totals(*combine_totals(summarize_trace(path) for path in args.traces)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""Shared SQLite work queue for running step 03 on several machines at once.
+
+With ``--queue path/to/queue.sqlite`` a step 03 script becomes a worker: it
+adds the pending papers of its input to the queue (papers already there are
+left alone) and then claims papers one at a time instead of taking a fixed
+``--shard``. Any number of workers, on one machine or on several machines
+sharing the file, can work on the same queue, and a worker can join or leave
+at any time.
+
+A claimed paper is leased to its worker for ``--lease-seconds``, and the
+worker renews the leases of its papers while it is running. When a worker
+dies, its leases run out and the papers are claimed again by the next worker
+that asks, up to ``MAX_ATTEMPTS`` claims per paper. Results are written to
+the queue itself, which is the shared store of the run: the first result for a
+paper wins, ``python -m pipeline.run_store merge queue.sqlite --output out.csv``
+turns it into the CSV (the last worker to finish does this too), and
+``--records`` imports it into the record store like a JSONL store.
+
+    python textextraction_additionalfields_pubmed.py --input ... --output out.csv --queue /shared/additional.sqlite
+    python -m pipeline.work_queue status /shared/additional.sqlite --watch 60
+    python -m pipeline.work_queue retry /shared/additional.sqlite
+
+SQLite's rollback journal is used, not WAL, because WAL does not work when the
+processes are on different hosts. The file must be on a filesystem with
+working POSIX locks (e.g. NFS with lockd); every operation is one short
+transaction, so a few dozen workers do not contend.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from pipeline.run_store import RowFeed
+
+log = logging.getLogger(__name__)
+
+LEASE_SECONDS = float(os.environ.get("PIPELINE_LEASE_SECONDS", 600))
+MAX_ATTEMPTS = 3
+# How often a worker with nothing to claim checks whether another worker's lease ran out
+POLL_SECONDS = 15
+# Papers a worker holds at once: one in inference and one being prepared. The
+# stages would otherwise claim as far ahead as their queues allow, while other
+# workers sit idle.
+CLAIM_AHEAD = 2
+
+# pending -> leased -> done | failed; an expired lease is claimed again
+STATES = ("pending", "leased", "done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    paper_id TEXT PRIMARY KEY,
+    seq INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    fp TEXT,
+    ok INTEGER,
+    row TEXT,
+    error TEXT,
+    enqueued_at REAL NOT NULL,
+    claimed_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_state_seq ON tasks (state, seq);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    lease_seconds REAL,
+    started_at REAL,
+    last_seen REAL,
+    stopped_at REAL,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    busy_seconds REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def is_queue(path):
+    """True if ``path`` is a queue (an SQLite file) rather than a JSONL store."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == b"SQLite format 3\x00"
+    except OSError:
+        return False
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def queue_records(path):
+    """Results of a queue as ``RunStore`` records (``id``, ``seq``, ``ok``, ``row``, ``fp``), in input order."""
+    conn = _connect(path)
+    try:
+        rows = conn.execute("SELECT paper_id, seq, ok, row, fp FROM tasks WHERE row IS NOT NULL ORDER BY seq").fetchall()
+    finally:
+        conn.close()
+    records = []
+    for row in rows:
+        record = {"id": row["paper_id"], "seq": row["seq"], "ok": bool(row["ok"]), "row": json.loads(row["row"])}
+        if row["fp"]:
+            record["fp"] = row["fp"]
+        records.append(record)
+    return records
+
+
+def update_results(path, results):
+    """Overwrite the stored result of finished papers, e.g. after ``pipeline.repair``.
+
+    Args:
+        results (list): ``(paper_id, row, ok)`` tuples; a paper that becomes ok is marked done.
+
+    Returns:
+        int: Papers updated.
+    """
+    conn = _connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        updated = 0
+        for paper_id, row, ok in results:
+            updated += conn.execute(
+                "UPDATE tasks SET row = ?, ok = ?, state = CASE WHEN ? THEN 'done' ELSE state END, error = NULL "
+                "WHERE paper_id = ? AND row IS NOT NULL",
+                (json.dumps(row, ensure_ascii=False, default=str), int(ok), int(ok), paper_id)).rowcount
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return updated
+
+
+class WorkQueue:
+    """One worker's connection to a shared queue; used by the step 03 scripts in place of a ``RunStore``.
+
+    Args:
+        path (str): Queue file, created on first use.
+        worker (str): Name of this worker in ``status`` (default: host name and process id).
+        lease_seconds (float): How long a claimed paper stays with this worker without a renewal.
+        max_attempts (int): Claims of a paper before it is given up as failed.
+        claim_ahead (int): Papers this worker holds without a result at any time.
+    """
+
+    def __init__(self, path, worker=None, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 poll_seconds=POLL_SECONDS, claim_ahead=CLAIM_AHEAD):
+        self.path = str(path)
+        self.worker = worker or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.claim_ahead = claim_ahead
+        self._held = 0
+        self._slots = threading.Condition()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = _connect(self.path)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        now = time.time()
+        with self._transaction():
+            self._conn.execute(
+                "INSERT INTO workers (worker, host, pid, lease_seconds, started_at, last_seen) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (worker) DO UPDATE SET pid = excluded.pid, lease_seconds = excluded.lease_seconds, "
+                "started_at = excluded.started_at, last_seen = excluded.last_seen, stopped_at = NULL",
+                (self.worker, socket.gethostname(), os.getpid(), lease_seconds, now, now))
+
+    def _transaction(self):
+        return _Transaction(self._conn, self._lock)
+
+    def completed(self, fingerprints=None):
+        """Ids of the papers with a successful result; papers whose document changed are not counted."""
+        with self._lock:
+            rows = self._conn.execute("SELECT paper_id, fp FROM tasks WHERE state = 'done'").fetchall()
+        fingerprints = fingerprints or {}
+        return {row["paper_id"] for row in rows
+                if not row["fp"] or fingerprints.get(row["paper_id"]) in (None, row["fp"])}
+
+    def enqueue(self, df, id_column, fingerprints=None):
+        """Add the rows of ``df`` to the queue; finished papers whose document changed are queued again.
+
+        Returns:
+            int: Papers added or queued again.
+        """
+        fingerprints = fingerprints or {}
+        now = time.time()
+        rows = [(str(paper_id).strip(), int(index), fingerprints.get(str(paper_id).strip()), now)
+                for index, paper_id in df[id_column].items()]
+        with self._transaction():
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT INTO tasks (paper_id, seq, fp, enqueued_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (paper_id) DO UPDATE SET state = 'pending', attempts = 0, worker = NULL, "
+                "fp = excluded.fp, enqueued_at = excluded.enqueued_at "
+                "WHERE tasks.state = 'done' AND tasks.fp IS NOT NULL AND excluded.fp IS NOT NULL "
+                "AND tasks.fp != excluded.fp", rows)
+            return self._conn.total_changes - before
+
+    def claim(self, df, id_column, fingerprints=None):
+        """Rows of ``df`` claimed from the queue one at a time, as a ``RowFeed`` for ``run_pipeline``.
+
+        The rows are queued first. The feed ends once no paper of ``df`` is
+        pending and no other worker holds one (their leases may still run out).
+        """
+        added = self.enqueue(df, id_column, fingerprints)
+        ids = df[id_column].astype(str).str.strip()
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS mine (paper_id TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM temp.mine")
+            self._conn.executemany("INSERT OR IGNORE INTO temp.mine VALUES (?)", ((paper_id,) for paper_id in ids))
+        log.info("Worker %s: %d papers added to %s", self.worker, added, self.path)
+        self._start_heartbeat()
+        index_of = dict(zip(ids, df.index))
+        id_of = dict(zip(df.index, ids))
+        return RowFeed(self._claims(df, index_of), lambda index: self.release(id_of[index]))
+
+    def _claims(self, df, index_of):
+        while True:
+            with self._slots:
+                self._slots.wait_for(lambda: self._held < self.claim_ahead)
+            paper_id = self._claim_next()
+            if paper_id is not None:
+                with self._slots:
+                    self._held += 1
+                index = index_of[paper_id]
+                yield index, df.loc[index]
+                continue
+            with self._lock:
+                held = self._conn.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE state = 'leased' AND worker != ? "
+                    "AND paper_id IN (SELECT paper_id FROM temp.mine)", (self.worker,)).fetchone()[0]
+            if not held:
+                return
+            # Another worker may still die; wait for its leases to be renewed or to run out
+            if self._stop.wait(self.poll_seconds):
+                return
+
+    def _claim_next(self):
+        now = time.time()
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE tasks SET state = 'failed', ok = 0, worker = NULL, lease_until = NULL, finished_at = ?, "
+                "error = 'lease expired ' || attempts || ' times' "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+            task = self._conn.execute(
+                "SELECT paper_id, worker, attempts FROM tasks WHERE paper_id IN (SELECT paper_id FROM temp.mine) "
+                "AND (state = 'pending' OR (state = 'leased' AND lease_until < ?)) ORDER BY seq LIMIT 1",
+                (now,)).fetchone()
+            if task is None:
+                return None
+            self._conn.execute(
+                "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "claimed_at = ? WHERE paper_id = ?", (self.worker, now + self.lease_seconds, now, task["paper_id"]))
+            self._conn.execute("UPDATE workers SET claimed = claimed + 1, last_seen = ? WHERE worker = ?",
+                               (now, self.worker))
+        if task["worker"]:
+            log.warning("Lease of %s held by %s expired; claim %d/%d", task["paper_id"], task["worker"],
+                        task["attempts"] + 1, self.max_attempts)
+        return task["paper_id"]
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew, name="queue-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            now = time.time()
+            try:
+                with self._transaction():
+                    self._conn.execute("UPDATE tasks SET lease_until = ? WHERE worker = ? AND state = 'leased'",
+                                       (now + self.lease_seconds, self.worker))
+                    self._conn.execute("UPDATE workers SET last_seen = ? WHERE worker = ?", (now, self.worker))
+            except sqlite3.OperationalError as e:
+                # A busy or briefly unreachable file; the next renewal is well within the lease
+                log.warning("Could not renew the leases of %s: %s", self.worker, e)
+
+    def append(self, paper_id, seq, row, ok=True, fingerprint=None):
+        """Store the result of a claimed paper (same signature as ``RunStore.append``)."""
+        now = time.time()
+        row = json.dumps(row, ensure_ascii=False, default=str)
+        with self._transaction():
+            claimed_at = self._conn.execute("SELECT claimed_at FROM tasks WHERE paper_id = ?",
+                                            (paper_id,)).fetchone()
+            before = self._conn.total_changes
+            self._conn.execute(
+                "INSERT INTO tasks (paper_id, seq, state, worker, ok, row, fp, enqueued_at, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (paper_id) DO UPDATE SET state = excluded.state, worker = excluded.worker, "
+                "ok = excluded.ok, row = excluded.row, fp = COALESCE(excluded.fp, tasks.fp), lease_until = NULL, "
+                "error = NULL, finished_at = excluded.finished_at WHERE tasks.state != 'done'",
+                (paper_id, seq, "done" if ok else "failed", self.worker, int(ok), row, fingerprint, now, now))
+            stored = self._conn.total_changes > before
+            busy = now - claimed_at["claimed_at"] if claimed_at and claimed_at["claimed_at"] else 0.0
+            self._conn.execute(
+                f"UPDATE workers SET {'done' if ok else 'failed'} = {'done' if ok else 'failed'} + 1, "
+                "busy_seconds = busy_seconds + ?, last_seen = ? WHERE worker = ?", (busy, now, self.worker))
+        self._release_slot()
+        if not stored:
+            log.info("%s was already finished by another worker; result of %s not kept", paper_id, self.worker)
+
+    def release(self, paper_id, error="dropped without a result"):
+        """Give up a claimed paper that produced no result (e.g. its document is missing)."""
+        now = time.time()
+        with self._transaction():
+            self._conn.execute(
+                "UPDATE tasks SET state = 'failed', ok = 0, worker = NULL, lease_until = NULL, error = ?, "
+                "finished_at = ? WHERE paper_id = ? AND worker = ? AND state = 'leased'",
+                (error, now, paper_id, self.worker))
+            self._conn.execute("UPDATE workers SET failed = failed + 1, last_seen = ? WHERE worker = ?",
+                               (now, self.worker))
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._slots:
+            self._held = max(self._held - 1, 0)
+            self._slots.notify_all()
+
+    def remaining(self):
+        """Papers still pending or leased, by any worker."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('pending', 'leased')").fetchone()[0]
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._transaction():
+            self._conn.execute("UPDATE workers SET stopped_at = ?, last_seen = ? WHERE worker = ?",
+                               (time.time(), time.time(), self.worker))
+        self._conn.close()
+
+
+class _Transaction:
+    """``BEGIN IMMEDIATE`` ... ``COMMIT`` under the connection lock, so a claim is never taken twice."""
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+def queue_status(path, window=3600):
+    """Progress of a queue and figures per worker.
+
+    Args:
+        path (str): Queue file.
+        window (float): Seconds of recent results the throughput and ETA are based on.
+    """
+    conn = _connect(path)
+    now = time.time()
+    try:
+        states = dict.fromkeys(STATES, 0)
+        states.update(conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state").fetchall())
+        recent = conn.execute("SELECT COUNT(*) FROM tasks WHERE state IN ('done', 'failed') AND finished_at >= ?",
+                              (now - window,)).fetchone()[0]
+        first = conn.execute("SELECT MIN(claimed_at) FROM tasks").fetchone()[0]
+        held = dict(conn.execute("SELECT worker, COUNT(*) FROM tasks WHERE state = 'leased' GROUP BY worker").fetchall())
+        workers = [dict(row) for row in conn.execute("SELECT * FROM workers ORDER BY started_at")]
+    finally:
+        conn.close()
+
+    for worker in workers:
+        end = worker["stopped_at"] or now
+        hours = max(end - worker["started_at"], 1.0) / 3600
+        finished = worker["done"] + worker["failed"]
+        worker["leased"] = held.get(worker["worker"], 0)
+        worker["papers_per_hour"] = finished / hours
+        worker["seconds_per_paper"] = worker["busy_seconds"] / finished if finished else None
+        if worker["stopped_at"]:
+            worker["status"] = "stopped"
+        elif now - worker["last_seen"] > worker["lease_seconds"]:
+            worker["status"] = "lost"
+        else:
+            worker["status"] = "running"
+
+    # Throughput of the last ``window`` seconds, or of the whole run while it is shorter than that
+    elapsed = min(window, now - first) if first else 0
+    rate = recent / (elapsed / 3600) if elapsed > 0 else 0.0
+    left = states["pending"] + states["leased"]
+    total = sum(states.values())
+    return {"path": str(path), "states": states, "total": total, "papers_per_hour": rate,
+            "eta_hours": left / rate if rate else None, "workers": workers}
+
+
+def format_status(status):
+    states, total = status["states"], status["total"]
+    finished = states["done"] + states["failed"]
+    lines = [f"{status['path']}: {finished}/{total} finished ({finished / total if total else 0:.0%}), "
+             f"{states['done']} done, {states['failed']} failed, {states['leased']} in progress, "
+             f"{states['pending']} pending"]
+    eta = f", ETA {status['eta_hours']:.1f} h" if status["eta_hours"] is not None else ""
+    lines.append(f"Throughput {status['papers_per_hour']:.1f} papers/h{eta}")
+    lines.append(f"{'worker':<28}{'status':>9}{'done':>7}{'failed':>7}{'leased':>7}{'papers/h':>10}"
+                 f"{'s/paper':>9}{'last seen':>11}")
+    now = time.time()
+    for worker in status["workers"]:
+        per_paper = f"{worker['seconds_per_paper']:.0f}" if worker["seconds_per_paper"] is not None else "-"
+        lines.append(f"{worker['worker']:<28}{worker['status']:>9}{worker['done']:>7}{worker['failed']:>7}"
+                     f"{worker['leased']:>7}{worker['papers_per_hour']:>10.1f}{per_paper:>9}"
+                     f"{now - worker['last_seen']:>10.0f}s")
+    return "\n".join(lines)
+
+
+def retry(path, expired=False):
+    """Queue the failed papers again (and with ``expired``, take back leases that ran out); returns the count."""
+    conn = _connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        changed = conn.execute("UPDATE tasks SET state = 'pending', attempts = 0, worker = NULL, "
+                               "lease_until = NULL, error = NULL WHERE state = 'failed'").rowcount
+        if expired:
+            changed += conn.execute("UPDATE tasks SET state = 'pending', worker = NULL, lease_until = NULL "
+                                    "WHERE state = 'leased' AND lease_until < ?", (time.time(),)).rowcount
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return changed
+
+
+def add_queue_arguments(parser):
+    """``--queue``, ``--worker-id`` and ``--lease-seconds`` options of the step 03 scripts."""
+    parser.add_argument("--queue", help="claim papers from this shared SQLite queue (see pipeline/work_queue.py) "
+                                        "instead of processing a fixed shard")
+    parser.add_argument("--worker-id", default=os.environ.get("PIPELINE_WORKER_ID") or default_worker_id(),
+                        help="name of this worker in the queue status (default: host name and process id)")
+    parser.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS,
+                        help="how long a claimed paper stays with a worker that stopped renewing it")
+    return parser
+
+
+def queue_settings(args):
+    """``WorkQueue`` arguments from the parsed options, or None without ``--queue``."""
+    if not args.queue:
+        return None
+    return {"path": args.queue, "worker": args.worker_id, "lease_seconds": args.lease_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    status_parser = sub.add_parser("status", help="progress, throughput and ETA, and figures per worker")
+    status_parser.add_argument("queue")
+    status_parser.add_argument("--window", type=float, default=3600,
+                               help="seconds of recent results the throughput is based on")
+    status_parser.add_argument("--watch", type=float, help="print the status again every this many seconds")
+    status_parser.add_argument("--json", action="store_true", help="print the status as JSON")
+    retry_parser = sub.add_parser("retry", help="queue the failed papers again")
+    retry_parser.add_argument("queue")
+    retry_parser.add_argument("--expired", action="store_true", help="also take back leases that ran out")
+    args = parser.parse_args()
+
+    if args.command == "retry":
+        print(f"{retry(args.queue, args.expired)} papers queued again in {args.queue}")
+        return
+    while True:
+        status = queue_status(args.queue, args.window)
+        print(json.dumps(status, indent=2) if args.json else format_status(status), flush=True)
+        if not args.watch or status["states"]["pending"] + status["states"]["leased"] == 0:
+            break
+        time.sleep(args.watch)
+        print()
+
+
+if __name__ == "__main__":
+    main()
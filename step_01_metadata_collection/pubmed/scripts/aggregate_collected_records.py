@@ -1,18 +1,25 @@
+import argparse
 import os
 import pandas as pd
 
+parser = argparse.ArgumentParser(description="Aggregate the PubMed export CSVs of a folder, deduplicated by PMID.")
+parser.add_argument("input_directory", nargs="?", help="folder with the PubMed export CSVs (prompted if omitted)")
+parser.add_argument("--output", help="aggregated CSV (default: aggregated_deduplicated_collection.csv in the folder)")
+args = parser.parse_args()
+
 # Prompt the user for the directory containing CSV files
-input_directory = input("Enter the path to the directory containing CSV files: ")
+input_directory = args.input_directory or input("Enter the path to the directory containing CSV files: ")
 
 # Define the output file name in the same directory
-output_file = os.path.join(input_directory, "aggregated_deduplicated_collection.csv")
+output_file = args.output or os.path.join(input_directory, "aggregated_deduplicated_collection.csv")
 
 # Initialize an empty dictionary to hold unique records by PMID
 unique_records = {}
 
 # Traverse the directory and process each CSV file
 for filename in os.listdir(input_directory):
-    if filename.endswith(".csv"):
+    # Never aggregate a previous output back into itself
+    if filename.endswith(".csv") and os.path.abspath(os.path.join(input_directory, filename)) != os.path.abspath(output_file):
         file_path = os.path.join(input_directory, filename)
         
         # Load the CSV file into a DataFrame
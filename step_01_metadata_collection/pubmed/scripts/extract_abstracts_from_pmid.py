@@ -1,12 +1,34 @@
+import argparse
 import pandas as pd
 from metapub import PubMedFetcher
 import time
 import os
+import sys
+from pathlib import Path
+
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.enrichment import DEFAULT_STORE, load_store, parse_pubmed_xml, save_store
+from pipeline.tracing import add_trace_arguments, start_tracing, traced
+
+parser = argparse.ArgumentParser(description="Add the PubMed abstract of every PMID to a step 01 CSV.")
+parser.add_argument("--input", help="CSV with a PMID column (prompted if omitted)")
+parser.add_argument("--output", help="default: <input>_with_abstracts.csv")
+parser.add_argument("--details-store", default=DEFAULT_STORE,
+                    help="PubMed details store, shared with step 03 (default: data/pubmed/pubmed_details.json)")
+parser.add_argument("--delta", action="store_true",
+                    help="keep the abstracts already in the output and fetch only new PMIDs (and earlier failures)")
+add_trace_arguments(parser)
+args = parser.parse_args()
+start_tracing(args)
 
 # Prompt the user to enter the path to the CSV file
-input_file = input("Enter the path to the CSV file: ")
-output_file = input_file.replace(".csv", "_with_abstracts.csv")
-log_file = input_file.replace(".csv", "_progress.log")
+input_file = args.input or input("Enter the path to the CSV file: ")
+output_file = args.output or input_file.replace(".csv", "_with_abstracts.csv")
+log_file = (output_file if args.output else input_file).replace(".csv", "_progress.log")
+# Affiliation and publication types of every fetched record, reused by step 03
+details_store_file = args.details_store
+details_store = load_store(details_store_file)
 
 # Load the CSV file into a DataFrame
 df = pd.read_csv(input_file)
@@ -15,9 +37,21 @@ df.columns = df.columns.str.strip()  # Ensure no extra whitespace in headers
 # Initialize the PubMedFetcher
 fetch = PubMedFetcher()
 
+# Placeholders written when a fetch fails; such records are fetched again in delta mode
+FETCH_FAILURES = ("Abstract not found", "Error fetching abstract")
+
+# Delta mode: the previous output already holds the abstracts of most PMIDs
+known_abstracts = {}
+if args.delta and os.path.exists(output_file):
+    previous = pd.read_csv(output_file)
+    known_abstracts = {pmid: abstract for pmid, abstract in zip(previous['PMID'], previous['Abstract'])
+                       if isinstance(abstract, str) and abstract not in FETCH_FAILURES}
+    print(f"{int(df['PMID'].isin(known_abstracts).sum())} of {len(df)} PMIDs already have an abstract.")
+todo = df[~df['PMID'].isin(known_abstracts)] if args.delta else df
+
 # Check the log file for the last processed PMID and set the start index accordingly
 start_index = 0
-if os.path.exists(log_file):
+if os.path.exists(log_file) and not args.delta:
     with open(log_file, "r") as log:
         last_pmid = log.read().strip()
         if last_pmid:
@@ -29,9 +63,12 @@ if os.path.exists(log_file):
                 print("Last PMID from log not found in the dataset. Starting from the beginning.")
 
 # Define a function to fetch the abstract given a PMID
+@traced("ncbi.fetch_abstract")
 def fetch_abstract(pmid):
     try:
         article = fetch.article_by_pmid(str(pmid))
+        if article and article.xml:
+            details_store.update(parse_pubmed_xml(article.xml))
         return article.abstract if article else "Abstract not found"
     except Exception as e:
         print(f"Error fetching abstract for PMID {pmid}: {e}")
@@ -39,8 +76,8 @@ def fetch_abstract(pmid):
 
 # Process records in batches of 10
 batch_size = 10
-for i in range(start_index, len(df), batch_size):
-    batch = df.iloc[i:i+batch_size].copy()  # Use .copy() to avoid SettingWithCopyWarning
+for i in range(start_index, len(todo), batch_size):
+    batch = todo.iloc[i:i+batch_size].copy()  # Use .copy() to avoid SettingWithCopyWarning
     
     # Fetch abstracts for each PMID in the current batch and add them as a new column
     batch.loc[:, 'Abstract'] = batch['PMID'].apply(fetch_abstract)
@@ -49,16 +86,26 @@ for i in range(start_index, len(df), batch_size):
     header = not os.path.exists(output_file) if i == 0 else False
     batch.to_csv(output_file, mode='a', index=False, header=header)
     
+    save_store(details_store_file, details_store)
+
     # Update the log file with the last PMID in this batch
     last_pmid = batch['PMID'].iloc[-1]
     with open(log_file, "w") as log:
         log.write(str(last_pmid))
 
     # Log progress to the console
-    print(f"Processed and saved up to record {min(i+batch_size, len(df))} of {len(df)}.")
+    print(f"Processed and saved up to record {min(i+batch_size, len(todo))} of {len(todo)}.")
 
     # Pause to avoid exceeding 10 requests per second
     #time.sleep(0.1 * batch_size)  # 0.1 seconds per request, 10 requests per batch
 
+# Delta mode appended the new abstracts; rewrite the output in input order, one row per PMID
+if args.delta and os.path.exists(output_file):
+    fetched = pd.read_csv(output_file).drop_duplicates('PMID', keep='last').set_index('PMID')['Abstract']
+    df['Abstract'] = df['PMID'].map(fetched)
+    df.to_csv(output_file + ".tmp", index=False)
+    os.replace(output_file + ".tmp", output_file)
+
 print(f"Data with abstracts saved to {output_file}")
 print(f"Progress logged in {log_file}")
+print(f"PubMed details for step 03 saved to {details_store_file}")
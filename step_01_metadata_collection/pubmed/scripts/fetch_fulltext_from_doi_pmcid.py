@@ -1,17 +1,39 @@
+import argparse
 import requests
 import pandas as pd
 import os
+import sys
 import time
+from pathlib import Path
+
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.packs import PACK_NAME, Pack
+from pipeline.tracing import add_trace_arguments, count, span, start_tracing, traced
+
+parser = argparse.ArgumentParser(description="Look up PMCIDs by DOI and download the PMC full-text XML.")
+parser.add_argument("--input", help="CSV with DOI, PMCID and Abstract columns (prompted if omitted)")
+parser.add_argument("--output", help="default: <input>_complete_fulltext.csv")
+parser.add_argument("--xml-dir", help="default: xml_outputs next to the input")
+parser.add_argument("--delta", action="store_true",
+                    help="reuse the PMCIDs of the previous output and skip XML files already downloaded")
+parser.add_argument("--pack", action="store_true",
+                    help=f"append the XML files to <xml-dir>/{PACK_NAME} instead of one file per article")
+add_trace_arguments(parser)
+args = parser.parse_args()
+start_tracing(args)
 
 #Prompt for input file
-input_file = input("Enter the path to the CSV file: ")
-output_csv = input_file.replace(".csv", "_complete_fulltext.csv")
+input_file = args.input or input("Enter the path to the CSV file: ")
+output_csv = args.output or input_file.replace(".csv", "_complete_fulltext.csv")
 
 # Create output folder for storing full-text
 input_directory = os.path.dirname(input_file)
-output_folder = os.path.join(input_directory, "xml_outputs")
+output_folder = args.xml_dir or os.path.join(input_directory, "xml_outputs")
 os.makedirs(output_folder, exist_ok=True)
+pack = Pack(os.path.join(output_folder, PACK_NAME)) if args.pack else None
 
+@traced("ncbi.convert_doi_to_pmcid")
 def convert_doi_to_pmcid(doi):
     """
     Convert a DOI to a PMCID using the NCBI ID Converter API.
@@ -40,6 +62,7 @@ def convert_doi_to_pmcid(doi):
         print(f"Error communicating with the ID converter API for DOI '{doi}': {e}")
         return None
 
+@traced("ncbi.fetch_pmcid_xmls")
 def fetch_pmcid_xmls(df, pmcid_column, max_retry=5, timeout=10):
     """
     Fetch and store full-text articles in XML format using PMCIDs.
@@ -56,30 +79,43 @@ def fetch_pmcid_xmls(df, pmcid_column, max_retry=5, timeout=10):
     successful_pmcids = []
 
     for pmcid in df[pmcid_column]:
+        # Delta mode: the article was downloaded by an earlier run
+        if args.delta and (os.path.exists(os.path.join(output_folder, f"{pmcid}.xml"))
+                           or (pack is not None and f"{pmcid}.xml" in pack)):
+            successful_pmcids.append(pmcid)
+            continue
         retry = 0
         while retry < max_retry:
             try:
                 url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pmc&id={pmcid}"
-                response = requests.get(url, timeout=timeout)
+                with span("ncbi.efetch_pmc", pmcid=pmcid):
+                    response = requests.get(url, timeout=timeout)
 
                 if response.status_code == 200:
-                    output_path = os.path.join(output_folder, f"{pmcid}.xml")
-                    with open(output_path, "wb") as file:
-                        file.write(response.content)
+                    if pack is not None:
+                        pack.append(f"{pmcid}.xml", response.content)
+                    else:
+                        output_path = os.path.join(output_folder, f"{pmcid}.xml")
+                        with open(output_path, "wb") as file:
+                            file.write(response.content)
                     print(f"Successfully saved {pmcid}.xml")
                     successful_pmcids.append(pmcid)
                     break
                 else:
                     print(f"Failed to fetch PMCID {pmcid}: HTTP {response.status_code}")
+                    count("ncbi.retries")
                     retry += 1
                     time.sleep(2)
             except requests.exceptions.RequestException as e:
                 print(f"Error fetching PMCID {pmcid}: {e}")
+                count("ncbi.retries")
                 retry += 1
                 time.sleep(2)
         else:
             print(f"Failed to fetch PMCID {pmcid} after {max_retry} retries.")
 
+    if pack is not None:
+        pack.close()
     print(f"Successfully fetched {len(successful_pmcids)} XML files.")
     return df[df[pmcid_column].isin(successful_pmcids)]
 
@@ -105,16 +141,20 @@ def preprocess_data(input_csv, doi_column, pmcid_column):
         df = df[df[doi_column].notna() & (df[doi_column].str.strip() != "")]
         print(f"Dropped {initial_count - len(df)} rows with missing or empty '{doi_column}'.")
 
-        # Step 2: Populate PMCIDs for rows with valid DOIs
+        # Step 2: Populate PMCIDs for rows with valid DOIs (in delta mode, from the previous output first)
+        known_pmcids = {}
+        if args.delta and os.path.exists(output_csv):
+            previous = pd.read_csv(output_csv)
+            known_pmcids = dict(zip(previous[doi_column].str.lower(), previous[pmcid_column]))
         for index, row in df.iterrows():
             if pd.isna(row[pmcid_column]) or row[pmcid_column].strip() == "":
-                pmcid = convert_doi_to_pmcid(row[doi_column])
+                pmcid = known_pmcids.get(row[doi_column].lower()) or convert_doi_to_pmcid(row[doi_column])
                 df.at[index, pmcid_column] = pmcid
 
         # Step 3: Drop rows with missing or empty PMCIDs
         initial_count = len(df)
         df = df[df[pmcid_column].notna() & (df[pmcid_column].str.strip() != "")&
-                (df['Abstract'] != "") & df['Abstract'].notna()]]
+                (df['Abstract'] != "") & df['Abstract'].notna()]
         print(f"Dropped {initial_count - len(df)} rows with missing or empty '{pmcid_column}'.")
 
         # Step 4: Fetch XML files for PMCIDs
@@ -1,18 +1,33 @@
-from google.colab import drive
-drive.mount('/content/drive')
+try:
+    from google.colab import drive
+    drive.mount('/content/drive')
+except ImportError:
+    # Outside Colab the paths are given on the command line
+    drive = None
 
 # Import necessary libraries
+import argparse
+import os
+import sys
+from pathlib import Path
 import nltk
 from sentence_transformers import SentenceTransformer, util
 import pandas as pd
 import numpy as np
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.logs import setup_logging
+from pipeline.tracing import add_trace_arguments, span, start_tracing, traced
+
 # Download necessary NLTK package
 nltk.download('punkt_tab')
 
 #Initialize the sentenceTransformer model to generate sentence embeddings
-model = SentenceTransformer("all-MiniLM-L6-v2")
+MODEL_NAME = "all-MiniLM-L6-v2"
+with span("step02.load_model"):
+    model = SentenceTransformer(MODEL_NAME)
 
 # Function to read CSV data and combine 'Title' and 'Abstract' columns into one text field
 def preprocess_dataframe(csv_path):
@@ -21,24 +36,31 @@ def preprocess_dataframe(csv_path):
     return df
 
 # Function to calculate relevance of text based on similarity to predefined target sentences
-def calculate_relevance(df, target_sentences, column_name, similarity_threshold):
+# (known_similarities: similarity per row from an earlier run, None where it must be computed)
+@traced("step02.calculate_relevance")
+def calculate_relevance(df, target_sentences, column_name, similarity_threshold, known_similarities=None):
     # Encode target sentences into embeddings
     target_embeddings = model.encode(target_sentences, convert_to_tensor=True)
 
     relevance_scores = []
+    similarity_scores = []
     count = 0
 
     # Iterate through each row in the dataframe
-    for idx, row in df.iterrows():
-        combined_text = row['Combined_Text']
-        max_similarity = 0
-        sentences = nltk.sent_tokenize(combined_text)
+    for position, (idx, row) in enumerate(df.iterrows()):
+        max_similarity = known_similarities[position] if known_similarities else None
+        if max_similarity is None:
+            combined_text = row['Combined_Text']
+            with span("step02.sent_tokenize", event=False):
+                sentences = nltk.sent_tokenize(combined_text)
 
-        # Encode and calculate similarities
-        sentence_embeddings = model.encode(sentences, convert_to_tensor=True)
-        # Compute cosine similarity between text and target sentences
-        similarities = util.pytorch_cos_sim(sentence_embeddings, target_embeddings)
-        max_similarity = similarities.max().item()
+            # Encode and calculate similarities
+            with span("step02.encode", event=False):
+                sentence_embeddings = model.encode(sentences, convert_to_tensor=True)
+            # Compute cosine similarity between text and target sentences
+            similarities = util.pytorch_cos_sim(sentence_embeddings, target_embeddings)
+            max_similarity = similarities.max().item()
+        similarity_scores.append(max_similarity)
 
         # Mark as relevant if similarity is above the threshold
         if max_similarity >= similarity_threshold:
@@ -49,18 +71,27 @@ def calculate_relevance(df, target_sentences, column_name, similarity_threshold)
     
     # Add the relevance results to the dataframe
     df[column_name] = relevance_scores
+    df[f"{column_name}_similarity"] = similarity_scores
 
     print(f"{column_name}: {count} relevant rows identified (from {len(df)} filtered rows).")
     return df
 
 # Function to evaluate predictions using ground truth labels
-def evaluate_predictions(df, ground_truth_path, prediction_column):
+def evaluate_predictions(df, ground_truth_path, prediction_column, records=None, paper_ids=None):
     # Load ground truth labels
-    ground_truth = pd.read_csv(ground_truth_path, encoding="ISO-8859-1")['Is_Relevant'].to_numpy()
-    print(len(ground_truth))
+    ground_truth_df = pd.read_csv(ground_truth_path, encoding="ISO-8859-1")
+    print(len(ground_truth_df))
 
-    # Extract predicted labels from the dataframe
-    predicted = df[prediction_column].to_numpy()
+    if records is not None:
+        # Pair labels by PMID/PMCID/DOI/title instead of row position
+        aligned = align_labels(ground_truth_df, 'Is_Relevant', df[prediction_column], paper_ids, records)
+        if aligned is None:
+            return
+        ground_truth, predicted = (np.array(labels) for labels in aligned)
+    else:
+        ground_truth = ground_truth_df['Is_Relevant'].to_numpy()
+        # Extract predicted labels from the dataframe
+        predicted = df[prediction_column].to_numpy()
 
     # Compute accuracy
     correct_predictions = np.sum(ground_truth == predicted)
@@ -119,20 +150,8 @@ target_sentences_general = [
     "parainfectious", "Hantavirus Pulmonary Syndrome", "Monkeypox"
 ]
 
-# Load and process the medical dataset
-df = preprocess_dataframe(MEDICAL_CSV)
-
-# Perform first-level filtering based on infectious diseases
-df = calculate_relevance(df, target_sentences_general, 'Is_infectious', SIMILARITY_THRESHOLD_GENERAL)
-
-# Save the filtered data to a new CSV file
-df.to_csv(UPDATED_MEDICAL_CSV, index=False)
-
-# Evaluate the performance of the first filtering step
-evaluate_predictions(df, GROUND_TRUTH_GENERAL, 'Is_infectious')
-
 #Define all the paramaters for second layer of embedding
-SIMILARITY_THRESHOLD_DL = 0.40
+SIMILARITY_THRESHOLD_DL = 0.42
 UPDATED_MEDICAL_DL_CSV = '/content/drive/MyDrive/paper_review/OutputOfEmbedding1.csv'
 DL_OUTPUT_CSV = '/content/drive/MyDrive/paper_review/OutputOfEmbedding2.csv'
 GROUND_TRUTH_DL = '/content/drive/MyDrive/paper_review/GroundTruthForembedding2.csv'
@@ -174,14 +193,80 @@ deep_learning_embedding2 = [
     "Image processing and neural networks are integral to computer vision.",
 ]
 
+parser = argparse.ArgumentParser(description="Two-stage semantic filtering of the PubMed records "
+                                             "(infectious disease, then deep learning).")
+parser.add_argument("--input", default=MEDICAL_CSV, help="step 01 CSV with Title and Abstract columns")
+parser.add_argument("--output-general", default=UPDATED_MEDICAL_CSV, help="input rows with the first-stage label")
+parser.add_argument("--dl-input", default=UPDATED_MEDICAL_DL_CSV, help="rows for the second stage")
+parser.add_argument("--output", default=DL_OUTPUT_CSV, help="second-stage rows with the second-stage label")
+parser.add_argument("--final-output", help="rows relevant in both stages (the step 03 input)")
+parser.add_argument("--threshold-general", type=float, default=SIMILARITY_THRESHOLD_GENERAL)
+parser.add_argument("--threshold-dl", type=float, default=SIMILARITY_THRESHOLD_DL)
+parser.add_argument("--ground-truth-general", default=GROUND_TRUTH_GENERAL)
+parser.add_argument("--ground-truth-dl", default=GROUND_TRUTH_DL)
+parser.add_argument("--records", help="SQLite record store (pipeline/record_store.py) for the papers and their scores")
+parser.add_argument("--delta", action="store_true",
+                    help="only embed records that are new or whose text changed since the last run (needs --records)")
+add_trace_arguments(parser)
+args = parser.parse_args()
+setup_logging()
+start_tracing(args)
+if args.delta and not args.records:
+    parser.error("--delta needs --records")
+
+# Papers and stage labels are also kept in the record store, keyed by PMID/PMCID/DOI
+records = None
+if args.records:
+    from pipeline.record_store import RecordStore, align_labels, content_fingerprint
+    records = RecordStore(args.records)
+
+# Load and process the medical dataset
+df = preprocess_dataframe(args.input)
+paper_ids = records.upsert_papers(df.drop(columns='Combined_Text'), 'pubmed') if records else None
+
+# A similarity depends on the text, the model and the target sentences, not on the threshold
+fingerprints = [content_fingerprint(MODEL_NAME, target_sentences_general, text)
+                for text in df['Combined_Text']] if records else None
+known = records.cached_scores(paper_ids, 'general', fingerprints) if args.delta else None
+
+# Perform first-level filtering based on infectious diseases
+df = calculate_relevance(df, target_sentences_general, 'Is_infectious', args.threshold_general, known)
+
+# Save the filtered data to a new CSV file
+df.to_csv(args.output_general, index=False)
+if records:
+    records.put_scores(paper_ids, 'general', df['Is_infectious'], df['Is_infectious_similarity'], args.threshold_general,
+                       fingerprints)
+
+# Evaluate the performance of the first filtering step
+if os.path.exists(args.ground_truth_general):
+    evaluate_predictions(df, args.ground_truth_general, 'Is_infectious', records, paper_ids)
+
 # Load and process the dataset after the first embedding step
-df = preprocess_dataframe(UPDATED_MEDICAL_DL_CSV)
+df = preprocess_dataframe(args.dl_input)
+paper_ids = records.upsert_papers(df, 'pubmed', with_data=False) if records else None
+first_stage = df['Is_infectious'].copy() if 'Is_infectious' in df.columns else None
+
+fingerprints = [content_fingerprint(MODEL_NAME, deep_learning_embedding2, text)
+                for text in df['Combined_Text']] if records else None
+known = records.cached_scores(paper_ids, 'dl', fingerprints) if args.delta else None
 
 # Perform second-level filtering based on deep learning topics
-df = calculate_relevance(df, deep_learning_embedding2, 'Is_Relevant', 0.42)
+df = calculate_relevance(df, deep_learning_embedding2, 'Is_Relevant', args.threshold_dl, known)
 
 # Save the deep learning relevance results
-df.to_csv('DL_OUTPUT_CSV', index=False)
+df.to_csv(args.output, index=False)
+if records:
+    records.put_scores(paper_ids, 'dl', df['Is_Relevant'], df['Is_Relevant_similarity'], args.threshold_dl, fingerprints)
+
+# Rows relevant in both stages
+if args.final_output:
+    relevant = df['Is_Relevant'] == 1
+    if first_stage is not None:
+        relevant &= first_stage == 1
+    df[relevant].to_csv(args.final_output, index=False)
+    print(f"{int(relevant.sum())} rows relevant in both stages saved to {args.final_output}")
 
 # Evaluate the performance of the second filtering step
-evaluate_predictions(df, GROUND_TRUTH_DL, 'Is_Relevant')
+if os.path.exists(args.ground_truth_dl):
+    evaluate_predictions(df, args.ground_truth_dl, 'Is_Relevant', records, paper_ids)
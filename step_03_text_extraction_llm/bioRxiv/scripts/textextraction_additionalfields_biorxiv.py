@@ -1,154 +1,156 @@
-import os
+import argparse
 import re
 import json
 import time
 import pandas as pd
 from pathlib import Path
-from pdf2image import convert_from_path
-import pytesseract
-import ollama
 
 import sys
 import logging
 
-# Set up logging to file
-logging.basicConfig(
-    filename="output_otheritems.txt",
-    filemode='w',  # overwrite each run; use 'a' to append
-    format='%(message)s',
-    level=logging.INFO,
-    encoding='utf-8'  # ensures Unicode characters are supported
-)
-
-# Redirect print() to also write to the file
-class Logger(object):
-    def __init__(self):
-        self.terminal = sys.stdout
-        self.log = open("output_otheritems.txt", "w", encoding='utf-8')
-
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
-
-    def flush(self):
-        self.terminal.flush()
-        self.log.flush()
-
-sys.stdout = Logger()
-
-# Optional: Set Tesseract path if not in system PATH
-# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-
-def extract_text_from_pdf(pdf_path):
-    try:
-        from pdf2image.exceptions import PDFInfoNotInstalledError
-
-        # Use your exact Poppler path
-        poppler_path = r"C:\Users\thaku\Downloads\Release-24.08.0-0\poppler-24.08.0\Library\bin"
-
-        # Convert PDF to images
-        pages = convert_from_path(
-            pdf_path,
-            dpi=300,
-            poppler_path=poppler_path
-        )
-        
-        # OCR each page
-        text = ""
-        for page in pages:
-            text += pytesseract.image_to_string(page) + "\n"
-        return text.strip()
-
-    except PDFInfoNotInstalledError:
-        print("ERROR: Poppler not found or 'pdfinfo.exe' missing.")
-        return ""
-    except Exception as e:
-        print(f"ERROR reading {pdf_path}: {e}")
-        return ""
-
-
-def strip_references(text):
-    match = re.split(r'\bReferences\b|\bREFERENCES\b|\bBibliography\b', text, maxsplit=1)
-    return match[0].strip() if match else text.strip()
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.assets import open_registry
+from pipeline.cascade import Cascade, cascade_tiers
+from pipeline.documents import registered_pdf_text, strip_references
+from pipeline.pdf_text import ocr_summary
+from pipeline.context_selection import TASK_FIELDS, select_context
+from pipeline.compression import PromptCompressor
+from pipeline.field_classifier import load_classifier, paper_text
+from pipeline.prompts import build_messages
+from pipeline.staged import Stage, format_report, run_pipeline
+from pipeline.run_store import add_run_arguments, document_fingerprints, finish_run, open_store, pending_rows
+from pipeline.work_queue import queue_settings
+from pipeline.logs import add_logging_arguments, log_path, log_paper, setup_logging
+from pipeline.tracing import add_trace_arguments, start_tracing, traced
+from pipeline.llm_client import LLMMetrics, PARSE_ERROR, PARSE_INVALID_JSON, PARSE_NO_JSON, PARSE_OK, metrics_path
+
+# Retrieval-guided context: top-k paragraphs per field within a token budget,
+# lowered to what fits the LLM context window (OLLAMA_NUM_CTX) next to the prompt.
+# Set CONTEXT_TOP_K = None to send the whole paper.
+CONTEXT_TOP_K = 4
+CONTEXT_TOKEN_BUDGET = 3000
+
+# Author lists, funding/competing-interest statements, license banners and
+# repeated page headers are removed before context selection.
+COMPRESS_PROMPTS = True
+
+# PDFs are read and their prompts built while earlier papers are in
+# inference; PREFETCH_PAPERS bounds how far ahead each stage may run.
+PREP_WORKERS = 2
+PREFETCH_PAPERS = 4
+
+# Console and rotating JSON-lines run log, set up in __main__ (see pipeline/logs.py)
+log = logging.getLogger("step03")
+
+# Pages are read from the PDF text layer; only pages that fail the quality
+# check in pipeline/pdf_text.py are OCRed.
+
+# Token counts, durations and parse outcome of every LLM call, per paper
+LLM_METRICS = LLMMetrics()
+# Original vs compressed token count of every paper's text
+COMPRESSOR = PromptCompressor()
 
 # Function to interact with LLaMA 3.2 3B
-def chat_with_llama(full_text):
-    user_prompt = {
-        "role": "user",
-        "content": (
-            "Analyze the provided research paper text and extract the following information strictly from the content without any assumptions:"
-            f"{full_text}\n\n"
-            "IMPORTANT: Your response must be strictly in the JSON format, extract the following information strictly from the paper text provided without any assumptions:"
-            "1. \"research_aim\": Extract the primary goal or aim of the research.\n"
-            "2. \"research_problem\": Identify the specific research problem addressed in the paper.\n"
-            "3. \"ai_objective\": What AI is being used for in the research.\n"
-            "4. \"ai_methodology\": Provide a brief description of the AI-based approach used.\n"
-            "5. \"ai_method_details\": Extract details about how AI is used, including specific techniques, architectures, or models.\n"
-            "6. \"ai_method_type\": The AI method used. If more than one method present, return as a list.\n"
-            "7. \"type_of_underlying_data\": The raw input used for experiment and analysis in the research paper.\n"
-            "8. \"dataset_name\": Extract the name of the dataset used in the research.\n\n"
-            
-            "9. \"disease_name\": Identify and extract the infectious or viral disease examined in the paper. If multiple diseases are discussed, list them all.\n"
-            "   - If multiple diseases are studied, return a list of disease names.\n"
-
-            "10. \"virology_subdomain\": Determine the **specific subdomain of virology** studied in the paper. \n"
-            "   - Identify the virology subdomain based on the focus of the study (e.g., respiratory viruses, neurotropic viruses, hepatic viruses, zoonotic viruses, etc.).\n"
-            "   - If the paper discusses respiratory viruses (e.g., Influenza, RSV, SARS-CoV-2), return \"Respiratory Virology\".\n"
-            "   - If the study focuses on viruses affecting the nervous system (e.g., Rabies, Zika, HSV), return \"Neurovirology\".\n"
-            "   - If the research is related to liver viruses (e.g., Hepatitis B, Hepatitis C), return \"Hepatic Virology\".\n"
-            "   - If the study examines how viruses interact with the immune system, return \"Viral Immunology\".\n"
-            "   - If the research involves emerging or re-emerging viruses (e.g., COVID-19, Monkeypox, Nipah), return \"Emerging & Re-emerging Viruses\".\n"
-            "   - If the focus is on viruses that jump from animals to humans (e.g., Ebola, Nipah), return \"Zoonotic Virology\".\n"
-            "   - If the paper does not specify a clear virology subdomain, return \"General Virology\".\n\n"
-            
-            "Strict Constraints:\n"
-            "- The response must be strictly based on explicit mentions in the paper. Do not infer or assume missing details.\n"
-            "- Always return valid JSON output and do not include any additional text or explanations.\n\n"
-            "- Failure to follow these rules will result in an invalid response."
-        )
-    }
-
-    system_prompt = {
-        "role": "system",
-        "content": "You are an AI research assistant with expertise in Virology and Artificial Intelligence. Extract only the required structured information and return valid JSON."
-    }   
+@traced("llm.chat_with_llama")
+def chat_with_llama(full_text, paper_id=None, fields=None):
+    # Only the fields the field classifier could not label confidently are asked for
+    messages = build_messages(full_text, fields or TASK_FIELDS["additional"])
     for attempt in range(3):
         try:
-            response = ollama.chat(
-                model="llama3.2:3b",
-                messages=[system_prompt, user_prompt],
+            response = LLM_METRICS.chat(
+                paper_id,
+                messages=messages,
                 options={"temperature": 0}
             )
             content = response["message"]["content"]
             match = re.search(r"\{.*\}", content, re.DOTALL)
             if match:
-                return json.loads(match.group(0))
+                data = json.loads(match.group(0))
+                LLM_METRICS.record_outcome(paper_id, PARSE_OK)
+                return data
+            LLM_METRICS.record_outcome(paper_id, PARSE_NO_JSON)
         except Exception as e:
-            print(f"LLaMA attempt {attempt+1} failed: {e}")
+            LLM_METRICS.record_outcome(paper_id, PARSE_INVALID_JSON if isinstance(e, json.JSONDecodeError) else PARSE_ERROR)
+            log.warning("LLaMA attempt %d failed for %s: %s", attempt + 1, paper_id, e)
             time.sleep(1)
     return {}
 
-def process_doi_csv(input_csv, pdf_dir, output_csv):
+def process_doi_csv(input_csv, pdf_dir, output_csv, registry_db=None, store_path=None, shard=None, limit=None,
+                    classifier_path=None, cascade=False, records_path=None, work_queue=None):
+    """Extract the fields of every paper in ``input_csv`` from its PDF.
+
+    Each finished paper is appended to a JSONL store (``store_path``) right away;
+    a rerun skips the papers already in it. ``shard=(i, N)`` processes only
+    shard i of N, and ``limit`` caps the number of papers in this run. With
+    ``work_queue`` (see pipeline/work_queue.py) the papers are instead claimed
+    from a queue shared with other workers, which also stores the results.
+    ``records_path`` also records the results in the shared record store
+    (see pipeline/record_store.py).
+
+    With ``classifier_path`` (see pipeline/field_classifier.py), the subdomain and
+    disease name are labelled from the title and abstract, and the LLM is asked
+    only for the fields the classifier is not confident about.
+
+    With ``cascade`` (see pipeline/cascade.py), each paper is first answered by a
+    smaller model and escalated to the regular one only when that answer is not
+    confident.
+    """
     df = pd.read_csv(input_csv)
-    results = []
-
-    for idx, row in df.iterrows():
+    # Finished papers are appended here one by one; completed ones are skipped on a rerun
+    store = open_store(output_csv, store_path, shard, work_queue)
+    # PDFs are looked up by DOI in the asset registry (only new or changed files are indexed)
+    registry = open_registry(pdf_dir, registry_db)
+    # Papers whose PDF changed since they were extracted are done again
+    fingerprints = document_fingerprints(df, "doi", registry, "pdf")
+    df = pending_rows(df, "doi", store.completed(fingerprints), shard, limit)
+    failed_dois = []
+    # Subdomain/disease labels from the abstract; the LLM only gets the remaining fields
+    classifier = load_classifier(classifier_path)
+    # Small model first; each tier selects its own context from the full text
+    cascade = Cascade(LLM_METRICS, TASK_FIELDS["additional"],
+                      cascade_tiers(CONTEXT_TOP_K, CONTEXT_TOKEN_BUDGET)) if cascade else None
+
+    def prepare(item):
+        idx, row = item
         doi = row.get("doi", "").strip()
         if not doi:
-            print(f"Row {idx} has no DOI, skipping.")
-            continue
-
-        doi_id = doi.replace("/", "_")
-        matching_pdf = next(Path(pdf_dir).glob(f"*{doi_id}.pdf"), None)
-
-        if not matching_pdf:
-            print(f"No PDF found for DOI: {doi}")
-            continue
-
-        print(f"Processing:{doi}({matching_pdf.name})")
-        raw_text = extract_text_from_pdf(matching_pdf)
+            log.warning("Row %s has no DOI, skipping.", idx)
+            return None
+
+        record = registry.lookup(doi=doi, kind="pdf")
+        if not record:
+            log.warning("No PDF found for DOI: %s", doi)
+            return None
+        matching_pdf = Path(record["path"])
+
+        classified = classifier.confident_fields(*paper_text(row)) if classifier else {}
+        fields = [field for field in TASK_FIELDS["additional"] if field not in classified]
+        # Extracted once per PDF; later runs read the registry's text cache
+        raw_text = registered_pdf_text(registry, record)
         clean_text = strip_references(raw_text)
-        llm_data = chat_with_llama(clean_text)
+        if clean_text and COMPRESS_PROMPTS:
+            clean_text = COMPRESSOR.compress(doi, clean_text)
+        if clean_text and CONTEXT_TOP_K and not cascade:
+            clean_text, stats = select_context(clean_text, fields=fields,
+                                               top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                                               num_ctx=LLM_METRICS.num_ctx)
+            log.debug("Context for %s: %d/%d paragraphs, %d/%d tokens", doi, stats["selected"],
+                      stats["paragraphs"], stats["context_tokens"], stats["full_tokens"])
+        return {"row": row, "doi": doi, "pdf": matching_pdf, "text": clean_text, "fields": fields,
+                "classified": classified}
+
+    def infer(paper):
+        row, doi = paper["row"], paper["doi"]
+        log.debug("Processing %s (%s)", doi, paper["pdf"].name)
+        if cascade:
+            llm_data, _ = cascade.extract(doi, paper["text"], paper["fields"])
+        else:
+            llm_data = chat_with_llama(paper["text"], doi, paper["fields"])
+        if not llm_data:
+            failed_dois.append(doi)
+        # The classifier's confident labels are kept even when the LLM gave no usable answer
+        llm_data = {**(llm_data or {}), **paper["classified"]}
 
         result = {
             "Authors": row.get("Authors", ""),
@@ -171,16 +173,55 @@ def process_doi_csv(input_csv, pdf_dir, output_csv):
             "Subdomain": llm_data.get("virology_subdomain", "")
         }
 
-        results.append(result)
-
-    pd.DataFrame(results).to_csv(output_csv, index=False)
-    print(f"\nProcessing complete. Output saved to: {output_csv}")
+        return result
+
+    stages = [
+        Stage("prepare", prepare, workers=PREP_WORKERS, queue_size=PREFETCH_PAPERS),
+        Stage("infer", infer, queue_size=PREFETCH_PAPERS),
+    ]
+    # Claimed from the queue one by one with --queue, else every pending row
+    rows = store.claim(df, "doi", fingerprints)
+    for seq, result in run_pipeline(rows, stages, on_drop=rows.dropped):
+        row_index = rows.index[seq]
+        doi = str(df.at[row_index, "doi"]).strip()
+        store.append(doi, int(row_index), result, ok=doi not in failed_dois, fingerprint=fingerprints.get(doi))
+        log_paper(log, doi, "failed" if doi in failed_dois else "ok")
+    log.info("%s", format_report(stages))
+
+    log.info("%s", ocr_summary())
+    if classifier:
+        log.info("%s", classifier.summary())
+    if cascade:
+        log.info("%s", cascade.summary())
+    log.info("%s", LLM_METRICS.summary())
+    LLM_METRICS.write_csv(metrics_path(store.path))
+    if COMPRESS_PROMPTS:
+        log.info("%s", COMPRESSOR.summary(LLM_METRICS))
+        COMPRESSOR.write_csv(metrics_path(store.path, "compression"))
+    registry.close()
+    finish_run(store, output_csv, shard, records_path=records_path, task="additional")
+    log.info("Processing complete. Output saved to: %s", output_csv)
 
 # === Final Paths ===
 if __name__ == "__main__":
-    input_csv = r"D:\Desktop\biorxiv_new\Final_output_without_false_postives.csv"
-    pdf_dir = r"D:\Desktop\biorxiv_new\pdf\merged_pdfs"
-    output_csv = r"D:\Desktop\biorxiv_new\Extracted_LLaMA_Output.csv"
-
-    process_doi_csv(input_csv, pdf_dir, output_csv)
+    parser = argparse.ArgumentParser(description="Extract additional fields from bioRxiv PDFs with LLaMA.")
+    parser.add_argument("--input", default=r"D:\Desktop\biorxiv_new\Final_output_without_false_postives.csv")
+    parser.add_argument("--pdf-dir", default=r"D:\Desktop\biorxiv_new\pdf\merged_pdfs")
+    parser.add_argument("--output", default=r"D:\Desktop\biorxiv_new\Extracted_LLaMA_Output.csv")
+    parser.add_argument("--classifier", help="field classifier from python -m pipeline.field_classifier train; "
+                                             "confident subdomain/disease labels skip the LLM")
+    parser.add_argument("--cascade", action="store_true",
+                        help="answer with a smaller model first and escalate only low-confidence papers")
+    add_run_arguments(parser)
+    add_trace_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    start_tracing(args)
+    setup_logging(args.log_file or log_path(args.output, args.shard, args.queue and args.worker_id), args.log_level)
+
+    process_doi_csv(args.input, args.pdf_dir, args.output,
+                    store_path=args.store, shard=args.shard, limit=args.limit, classifier_path=args.classifier,
+                    cascade=args.cascade, records_path=args.records,
+                    registry_db=args.registry_db,
+                    work_queue=queue_settings(args))
 
@@ -1,78 +1,62 @@
-import os
+import argparse
 import re
 import json
 import time
 import pandas as pd
 from pathlib import Path
-from pdf2image import convert_from_path
-import pytesseract
-import ollama
 
 import sys
 import logging
 
-# Set up logging to file
-logging.basicConfig(
-    filename="output_otheritems.txt",
-    filemode='w',  # overwrite each run; use 'a' to append
-    format='%(message)s',
-    level=logging.INFO,
-    encoding='utf-8'  # ensures Unicode characters are supported
-)
-
-# Redirect print() to also write to the file
-class Logger(object):
-    def __init__(self):
-        self.terminal = sys.stdout
-        self.log = open("output_otheritems.txt", "w", encoding='utf-8')
-
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
-
-    def flush(self):
-        self.terminal.flush()
-        self.log.flush()
-
-sys.stdout = Logger()
-
-# Optional: Set Tesseract path if not in system PATH
-# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-
-def extract_text_from_pdf(pdf_path):
-    try:
-        from pdf2image.exceptions import PDFInfoNotInstalledError
-
-        # Use your exact Poppler path
-        poppler_path = r"C:\Users\thaku\Downloads\Release-24.08.0-0\poppler-24.08.0\Library\bin"
-
-        # Convert PDF to images
-        pages = convert_from_path(
-            pdf_path,
-            dpi=300,
-            poppler_path=poppler_path
-        )
-        
-        # OCR each page
-        text = ""
-        for page in pages:
-            text += pytesseract.image_to_string(page) + "\n"
-        return text.strip()
-
-    except PDFInfoNotInstalledError:
-        print("ERROR: Poppler not found or 'pdfinfo.exe' missing.")
-        return ""
-    except Exception as e:
-        print(f"ERROR reading {pdf_path}: {e}")
-        return ""
-
-
-def strip_references(text):
-    match = re.split(r'\bReferences\b|\bREFERENCES\b|\bBibliography\b', text, maxsplit=1)
-    return match[0].strip() if match else text.strip()
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.assets import open_registry
+from pipeline.documents import registered_pdf_text, strip_references
+from pipeline.pdf_text import ocr_summary
+from pipeline.context_selection import select_context
+from pipeline.compression import PromptCompressor
+from pipeline.metric_miner import mine_paper
+from pipeline.prompts import build_messages
+from pipeline.staged import Stage, format_report, run_pipeline
+from pipeline.run_store import add_run_arguments, document_fingerprints, finish_run, open_store, pending_rows
+from pipeline.work_queue import queue_settings
+from pipeline.logs import add_logging_arguments, log_path, log_paper, setup_logging
+from pipeline.tracing import add_trace_arguments, start_tracing, traced
+from pipeline.llm_client import LLMMetrics, PARSE_ERROR, PARSE_INVALID_JSON, PARSE_NO_JSON, PARSE_OK, metrics_path
+
+# Metrics found in the tables/text fill "Was Performance Measured" and
+# "Performance Results" directly; the LLM then only describes the evaluation.
+USE_METRIC_MINER = True
+
+# Retrieval-guided context: top-k paragraphs per field within a token budget,
+# lowered to what fits the LLM context window (OLLAMA_NUM_CTX) next to the prompt.
+# Set CONTEXT_TOP_K = None to send the whole paper.
+CONTEXT_TOP_K = 4
+CONTEXT_TOKEN_BUDGET = 3000
+
+# Author lists, funding/competing-interest statements, license banners and
+# repeated page headers are removed before context selection.
+COMPRESS_PROMPTS = True
+
+# PDFs are read and their prompts built while earlier papers are in
+# inference; PREFETCH_PAPERS bounds how far ahead each stage may run.
+PREP_WORKERS = 2
+PREFETCH_PAPERS = 4
+
+# Console and rotating JSON-lines run log, set up in __main__ (see pipeline/logs.py)
+log = logging.getLogger("step03")
+
+# Pages are read from the PDF text layer; only pages that fail the quality
+# check in pipeline/pdf_text.py are OCRed.
+
+# Token counts, durations and parse outcome of every LLM call, per paper
+LLM_METRICS = LLMMetrics()
+# Original vs compressed token count of every paper's text
+COMPRESSOR = PromptCompressor()
 
 # Function to interact with LLaMA 3.2 3B
-def chat_with_llama(full_text):
+@traced("llm.chat_with_llama")
+def chat_with_llama(full_text, paper_id=None, fields=None):
     user_prompt = {
         "role": "user",
         "content": (
@@ -104,60 +88,147 @@ def chat_with_llama(full_text):
         "role": "system",
         "content": "You are an AI assistant specializing in AI research paper analysis. Extract only the required structured information and return valid JSON."
     }
+    if fields:
+        # Only the fields the metric miner left open (the measurement details)
+        messages = build_messages(full_text, fields)
+    else:
+        messages = [system_prompt, user_prompt]
  
     for attempt in range(3):
         try:
-            response = ollama.chat(
-                model="llama3.2:3b",
-                messages=[system_prompt, user_prompt],
+            response = LLM_METRICS.chat(
+                paper_id,
+                messages=messages,
                 options={"temperature": 0}
             )
             content = response["message"]["content"]
             match = re.search(r"\{.*\}", content, re.DOTALL)
             if match:
-                return json.loads(match.group(0))
+                data = json.loads(match.group(0))
+                LLM_METRICS.record_outcome(paper_id, PARSE_OK)
+                return data
+            LLM_METRICS.record_outcome(paper_id, PARSE_NO_JSON)
         except Exception as e:
-            print(f"LLaMA attempt {attempt+1} failed: {e}")
+            LLM_METRICS.record_outcome(paper_id, PARSE_INVALID_JSON if isinstance(e, json.JSONDecodeError) else PARSE_ERROR)
+            log.warning("LLaMA attempt %d failed for %s: %s", attempt + 1, paper_id, e)
             time.sleep(1)
     return {}
 
-def process_doi_csv(input_csv, pdf_dir, output_csv):
+def process_doi_csv(input_csv, pdf_dir, output_csv, registry_db=None, store_path=None, shard=None, limit=None,
+                    records_path=None, work_queue=None):
+    """Extract the fields of every paper in ``input_csv`` from its PDF.
+
+    Each finished paper is appended to a JSONL store (``store_path``) right away;
+    a rerun skips the papers already in it. ``shard=(i, N)`` processes only
+    shard i of N, and ``limit`` caps the number of papers in this run. With
+    ``work_queue`` (see pipeline/work_queue.py) the papers are instead claimed
+    from a queue shared with other workers, which also stores the results.
+    ``records_path`` also records the results in the shared record store
+    (see pipeline/record_store.py).
+    """
     df = pd.read_csv(input_csv)
-    results = []
-
-    for idx, row in df.iterrows():
+    # Finished papers are appended here one by one; completed ones are skipped on a rerun
+    store = open_store(output_csv, store_path, shard, work_queue)
+    # PDFs are looked up by DOI in the asset registry (only new or changed files are indexed)
+    registry = open_registry(pdf_dir, registry_db)
+    # Papers whose PDF changed since they were extracted are done again
+    fingerprints = document_fingerprints(df, "doi", registry, "pdf")
+    df = pending_rows(df, "doi", store.completed(fingerprints), shard, limit)
+    failed_dois = []
+    mined_dois = []
+
+    def prepare(item):
+        idx, row = item
         doi = row.get("doi", "").strip()
         if not doi:
-            print(f"Row {idx} has no DOI, skipping.")
-            continue
-
-        doi_id = doi.replace("/", "_")
-        matching_pdf = next(Path(pdf_dir).glob(f"*{doi_id}.pdf"), None)
+            log.warning("Row %s has no DOI, skipping.", idx)
+            return None
 
-        if not matching_pdf:
-            print(f"No PDF found for DOI: {doi}")
-            continue
+        record = registry.lookup(doi=doi, kind="pdf")
+        if not record:
+            log.warning("No PDF found for DOI: %s", doi)
+            return None
+        matching_pdf = Path(record["path"])
 
-        print(f"Processing:{doi}({matching_pdf.name})")
-        raw_text = extract_text_from_pdf(matching_pdf)
+        # Extracted once per PDF; later runs read the registry's text cache
+        raw_text = registered_pdf_text(registry, record)
         clean_text = strip_references(raw_text)
-        llm_data = chat_with_llama(clean_text)
+        mined = None
+        # The miner reads the full text: compression must not cost it table rows
+        if clean_text and USE_METRIC_MINER:
+            mined = mine_paper(text=clean_text, abstract=row.get("Abstract"))
+            if not mined["confident"]:
+                mined = None
+        if clean_text and COMPRESS_PROMPTS:
+            clean_text = COMPRESSOR.compress(doi, clean_text)
+        fields = ["performance_measurement_details"] if mined else None
+        if clean_text and CONTEXT_TOP_K:
+            clean_text, stats = select_context(clean_text, task="performance", fields=fields,
+                                               top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                                               num_ctx=LLM_METRICS.num_ctx)
+            log.debug("Context for %s: %d/%d paragraphs, %d/%d tokens", doi, stats["selected"],
+                      stats["paragraphs"], stats["context_tokens"], stats["full_tokens"])
+        return {"row": row, "doi": doi, "pdf": matching_pdf, "text": clean_text, "mined": mined, "fields": fields}
+
+    def infer(paper):
+        doi = paper["doi"]
+        log.debug("Processing %s (%s)", doi, paper["pdf"].name)
+        llm_data = chat_with_llama(paper["text"], doi, paper["fields"])
+        if not llm_data:
+            failed_dois.append(doi)
+        if paper["mined"]:
+            mined_dois.append(doi)
+            llm_data = {**llm_data, "was_performance_measured": "Yes",
+                        "performance_results": paper["mined"]["results"]}
 
         result = {
             "Was Performance Measured": llm_data.get("was_performance_measured", "null"),
             "Performance Results": llm_data.get("performance_results", {}),
             "Performance Measurement Details": llm_data.get("performance_measurement_details", "Not specified")
         }
-        print(json.dumps(result, indent=2, ensure_ascii=False)) 
-        results.append(result)
-
-    pd.DataFrame(results).to_csv(output_csv, index=False)
-    print(f"\nProcessing complete. Output saved to: {output_csv}")
+        log.debug("Result for %s: %s", doi, result)
+        return result
+
+    stages = [
+        Stage("prepare", prepare, workers=PREP_WORKERS, queue_size=PREFETCH_PAPERS),
+        Stage("infer", infer, queue_size=PREFETCH_PAPERS),
+    ]
+    # Claimed from the queue one by one with --queue, else every pending row
+    rows = store.claim(df, "doi", fingerprints)
+    for seq, result in run_pipeline(rows, stages, on_drop=rows.dropped):
+        row_index = rows.index[seq]
+        doi = str(df.at[row_index, "doi"]).strip()
+        store.append(doi, int(row_index), result, ok=doi not in failed_dois, fingerprint=fingerprints.get(doi))
+        log_paper(log, doi, "failed" if doi in failed_dois else "ok",
+                  measured=result["Was Performance Measured"], mined=doi in mined_dois)
+    log.info("%s", format_report(stages))
+
+    log.info("%s", ocr_summary())
+    if USE_METRIC_MINER:
+        log.info("Metric miner filled the performance results of %d/%d papers", len(mined_dois), len(df))
+    log.info("%s", LLM_METRICS.summary())
+    LLM_METRICS.write_csv(metrics_path(store.path))
+    if COMPRESS_PROMPTS:
+        log.info("%s", COMPRESSOR.summary(LLM_METRICS))
+        COMPRESSOR.write_csv(metrics_path(store.path, "compression"))
+    registry.close()
+    finish_run(store, output_csv, shard, records_path=records_path, task="performance")
+    log.info("Processing complete. Output saved to: %s", output_csv)
 
 # === Final Paths ===
 if __name__ == "__main__":
-    input_csv = r"D:\Desktop\medrxiv_new\Finaloutput_embedding2_without_falsepositive_medrxiv.csv"
-    pdf_dir = r"D:\Desktop\medrxiv_new\pdf\merged_pdfs"
-    output_csv = r"D:\Desktop\medrxiv_new\Extracted_LLaMA_Output_performanceMertics_1new.csv"
-
-    process_doi_csv(input_csv, pdf_dir, output_csv)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Extract performance metrics from medRxiv PDFs with LLaMA.")
+    parser.add_argument("--input", default=r"D:\Desktop\medrxiv_new\Finaloutput_embedding2_without_falsepositive_medrxiv.csv")
+    parser.add_argument("--pdf-dir", default=r"D:\Desktop\medrxiv_new\pdf\merged_pdfs")
+    parser.add_argument("--output", default=r"D:\Desktop\medrxiv_new\Extracted_LLaMA_Output_performanceMertics_1new.csv")
+    add_run_arguments(parser)
+    add_trace_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    start_tracing(args)
+    setup_logging(args.log_file or log_path(args.output, args.shard, args.queue and args.worker_id), args.log_level)
+
+    process_doi_csv(args.input, args.pdf_dir, args.output,
+                    store_path=args.store, shard=args.shard, limit=args.limit, records_path=args.records,
+                    registry_db=args.registry_db,
+                    work_queue=queue_settings(args))
@@ -1,88 +1,99 @@
-import os
+import argparse
+import logging
 import re
+import sys
 import pandas as pd
-from metapub import PubMedFetcher, PubMedAuthor
-import xml.etree.ElementTree as ET
-import ollama 
+from pathlib import Path
 import json
 import time
 
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.assets import open_registry
+from pipeline.cascade import Cascade, cascade_tiers
+from pipeline.documents import registered_xml_text
+from pipeline.context_selection import TASK_FIELDS, select_context
+from pipeline.compression import XML_COMPRESSION_CONFIG, PromptCompressor
+from pipeline.field_classifier import load_classifier, paper_text
+from pipeline.prompts import build_messages
+from pipeline.staged import Stage, format_report, run_pipeline
+from pipeline.enrichment import DEFAULT_STORE, FETCH_FAILED, NOT_FOUND, fetch_article_details, normalize_pmid
+from pipeline.run_store import add_run_arguments, document_fingerprints, finish_run, open_store, pending_rows
+from pipeline.work_queue import queue_settings
+from pipeline.logs import add_logging_arguments, log_path, log_paper, setup_logging
+from pipeline.tracing import add_trace_arguments, start_tracing, traced
+from pipeline.llm_client import (LLMMetrics, PARSE_ERROR, PARSE_INVALID_JSON, PARSE_NO_JSON, PARSE_OK,
+                                 PARSE_RECOVERED, metrics_path)
+
+# Retrieval-guided context: top-k paragraphs per field within a token budget,
+# lowered to what fits the LLM context window (OLLAMA_NUM_CTX) next to the prompt.
+# Set CONTEXT_TOP_K = None to send the whole paper.
+CONTEXT_TOP_K = 4
+CONTEXT_TOKEN_BUDGET = 3000
+
+# Author lists, funding/competing-interest statements, license banners and
+# repeated page headers are removed before context selection.
+COMPRESS_PROMPTS = True
+
+# Papers are parsed and their prompts built while earlier papers are in
+# inference; PREFETCH_PAPERS bounds how far ahead each stage may run.
+PREP_WORKERS = 2
+PREFETCH_PAPERS = 4
+
+# Token counts, durations and parse outcome of every LLM call, per paper
+LLM_METRICS = LLMMetrics()
+# Original vs compressed token count of every paper's text
+COMPRESSOR = PromptCompressor(XML_COMPRESSION_CONFIG)
+
+# Console and rotating JSON-lines run log, set up in __main__ (see pipeline/logs.py)
+log = logging.getLogger("step03")
+
 # Function to interact with LLaMA 3.2 3B
-def chat_with_llama(full_text):
-    user_prompt = {
-        "role": "user",
-        "content": (
-            "Analyze the provided research paper text and extract the following information strictly from the content without any assumptions:"
-            f"{full_text}\n\n"
-            "IMPORTANT: Your response must be strictly in the JSON format, extract the following information strictly from the paper text provided without any assumptions:"
-            "1. \"research_aim\": Extract the primary goal or aim of the research.\n"
-            "2. \"research_problem\": Identify the specific research problem addressed in the paper.\n"
-            "3. \"ai_objective\": What AI is being used for in the research.\n"
-            "4. \"ai_methodology\": Provide a brief description of the AI-based approach used.\n"
-            "5. \"ai_method_details\": Extract details about how AI is used, including specific techniques, architectures, or models.\n"
-            "6. \"ai_method_type\": The AI method used. If more than one method present, return as a list.\n"
-            "7. \"type_of_underlying_data\": The raw input used for experiment and analysis in the research paper.\n"
-            "8. \"dataset_name\": Extract the name of the dataset used in the research.\n\n"
-            
-            "9. \"disease_name\": Identify and extract the infectious or viral disease examined in the paper. If multiple diseases are discussed, list them all.\n"
-            "   - If multiple diseases are studied, return a list of disease names.\n"
-
-            "10. \"virology_subdomain\": Determine the **specific subdomain of virology** studied in the paper. \n"
-            "   - Identify the virology subdomain based on the focus of the study (e.g., respiratory viruses, neurotropic viruses, hepatic viruses, zoonotic viruses, etc.).\n"
-            "   - If the paper discusses respiratory viruses (e.g., Influenza, RSV, SARS-CoV-2), return \"Respiratory Virology\".\n"
-            "   - If the study focuses on viruses affecting the nervous system (e.g., Rabies, Zika, HSV), return \"Neurovirology\".\n"
-            "   - If the research is related to liver viruses (e.g., Hepatitis B, Hepatitis C), return \"Hepatic Virology\".\n"
-            "   - If the study examines how viruses interact with the immune system, return \"Viral Immunology\".\n"
-            "   - If the research involves emerging or re-emerging viruses (e.g., COVID-19, Monkeypox, Nipah), return \"Emerging & Re-emerging Viruses\".\n"
-            "   - If the focus is on viruses that jump from animals to humans (e.g., Ebola, Nipah), return \"Zoonotic Virology\".\n"
-            "   - If the paper does not specify a clear virology subdomain, return \"General Virology\".\n\n"
-            
-            "Strict Constraints:\n"
-            "- The response must be strictly based on explicit mentions in the paper. Do not infer or assume missing details.\n"
-            "- Always return valid JSON output and do not include any additional text or explanations.\n\n"
-            "- Failure to follow these rules will result in an invalid response."
-        )
-    }
-
-    system_prompt = {
-        "role": "system",
-        "content": "You are an AI research assistant with expertise in Virology and Artificial Intelligence. Extract only the required structured information and return valid JSON."
-    }   
+@traced("llm.chat_with_llama")
+def chat_with_llama(full_text, paper_id=None, fields=None):
+    # Only the fields the field classifier could not label confidently are asked for
+    messages = build_messages(full_text, fields or TASK_FIELDS["additional"])
     retries = 3
     while retries > 0:
         try:
-            response = ollama.chat(
-                model="llama3.2:3b",
-                messages=[system_prompt, user_prompt],
+            response = LLM_METRICS.chat(
+                paper_id,
+                messages=messages,
                 options={"temperature": 0}
             )
             response_text = response["message"]["content"].strip()
-            print(response_text)
+            log.debug("LLaMA reply for %s: %s", paper_id, response_text)
             json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
             if json_match:
-                return json.loads(json_match.group(0))
+                data = json.loads(json_match.group(0))
+                LLM_METRICS.record_outcome(paper_id, PARSE_OK)
+                return data
             else:
-                print("Warning: LLaMA response did not contain valid JSON. Attempting to parse usable data...")
+                log.warning("LLaMA response for %s did not contain valid JSON. Attempting to parse usable data...", paper_id)
                 parsed_data = attempt_to_extract_data(response_text)
                 if parsed_data:
+                    LLM_METRICS.record_outcome(paper_id, PARSE_RECOVERED)
                     return parsed_data
+                LLM_METRICS.record_outcome(paper_id, PARSE_NO_JSON)
                 retries -= 1
                 time.sleep(1)
         except json.JSONDecodeError:
-            print("Error: LLaMA returned invalid JSON. Trying again...")
+            log.warning("LLaMA returned invalid JSON for %s. Trying again...", paper_id)
+            LLM_METRICS.record_outcome(paper_id, PARSE_INVALID_JSON)
             retries -= 1
             time.sleep(1)
         except Exception as e:
-            print(f"Error interacting with LLaMA: {e}. Trying again...")
+            log.warning("Error interacting with LLaMA for %s: %s. Trying again...", paper_id, e)
+            LLM_METRICS.record_outcome(paper_id, PARSE_ERROR)
             retries -= 1
             time.sleep(1)
 
-    print("Failed to get a valid response after several attempts.")
+    log.error("Failed to get a valid response for %s after several attempts.", paper_id)
     return {}
 
 def attempt_to_extract_data(response_text):
     """Attempt to manually parse key-value pairs from malformed JSON or non-JSON output."""
-    fields = ["subdomain", "disease_name", "research_aim", "research_problem", "ai_objective", "ai_methodology",
+    fields = ["virology_subdomain", "subdomain", "disease_name", "research_aim", "research_problem", "ai_objective", "ai_methodology",
                 "ai_method_details", "ai_method_type", "type_of_underlying_data", "dataset_name", ]
     data = {}
     for field in fields:
@@ -98,70 +109,39 @@ def attempt_to_extract_data(response_text):
     return data if data else None
 
 
-def get_article_details(pmid):
-    fetcher = PubMedFetcher()
-    try:
-        # Fetch article metadata using PMID
-        article = fetcher.article_by_pmid(pmid)
-        if not article:
-            return {"primary_author_affiliation": "No article found", "publication_types": "Not available"}
-
-        # Ensure the XML content is a string
-        xml_content = article.xml
-        if isinstance(xml_content, bytes):
-            xml_content = xml_content.decode('utf-8')
-
-        # Parse the XML content
-        root = ET.fromstring(xml_content)
-
-        # Extract primary author's affiliation
-        primary_author_affiliation = "No authors found"
-        primary_author_elem = root.find('.//AuthorList/Author')
-        if primary_author_elem is not None:
-            primary_author = PubMedAuthor(primary_author_elem)
-            if primary_author.affiliations:
-                primary_author_affiliation = primary_author.affiliations[0]
-
-        # Extract evidence source
-        publication_types = []
-        pub_type_elements = root.findall('.//PublicationType')
-        if pub_type_elements:
-            publication_types = [pub_type.text for pub_type in pub_type_elements]
-
-        return {
-            "primary_author_affiliation": primary_author_affiliation,
-            "publication_types": ", ".join(publication_types) if publication_types else "Publication type not available"
-        }
+def process_papers(csv_file_path, xml_folder_path, output_csv, xml_cache_dir=None, pubmed_store=None, registry_db=None,
+                   store_path=None, shard=None, limit=None, classifier_path=None, cascade=False, records_path=None,
+                   work_queue=None):
+    """Reads PMCID from CSV, extracts metadata, processes XML with MetaPub, and saves results.
 
-    except Exception as e:
-        return {"primary_author_affiliation": f"Error: {e}", "publication_types": "Error"}
+    Affiliations and publication types for all PMIDs are fetched in batched
+    EFetch calls (or read from the local ``pubmed_store``) before extraction
+    starts; papers then flow through overlapping stages (XML parsing and
+    context selection, LLM inference, output assembly) connected by bounded
+    queues.
 
-def extract_full_text(xml_file):
-    """Extracts full text content from an XML research paper and truncates it before the 'References' section."""
-    try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
+    Each finished paper is appended to a JSONL store (``store_path``) right away;
+    a rerun skips the papers already in it. ``shard=(i, N)`` processes only
+    shard i of N, and ``limit`` caps the number of papers in this run. With
+    ``work_queue`` (see pipeline/work_queue.py) the papers are instead claimed
+    from a queue shared with other workers, which also stores the results.
+    ``records_path`` also records the results in the shared record store
+    (see pipeline/record_store.py).
 
-        # Extract text from XML structure
-        full_text = " ".join(elem.text.strip() for elem in root.iter() if elem.text)
+    With ``classifier_path`` (see pipeline/field_classifier.py), the subdomain and
+    disease name are labelled from the title and abstract, and the LLM is asked
+    only for the fields the classifier is not confident about.
 
-        # Truncate text at "References" section
-        truncated_text = re.split(r'<title>\s*References\s*</title>|References', full_text, maxsplit=1, flags=re.IGNORECASE)[0]
-        return truncated_text.strip()
-    
-    except Exception as e:
-        print(f"Error parsing XML: {e}")
-        return None
-    
-def process_papers(csv_file_path, xml_folder_path, output_csv):
-    """Reads PMCID from CSV, extracts metadata, processes XML with MetaPub, and saves results."""
+    With ``cascade`` (see pipeline/cascade.py), each paper is first answered by a
+    smaller model and escalated to the regular one only when that answer is not
+    confident.
+    """
     
     # Load CSV data
     df = pd.read_csv(csv_file_path, encoding='utf-8')
-    df = df.head(30)
     # Ensure 'PMCID' column exists
     if 'PMCID' not in df.columns:
-        print("Error: PMCID column not found in CSV file.")
+        log.error("PMCID column not found in CSV file.")
         return
 
     # Define new required columns
@@ -175,32 +155,81 @@ def process_papers(csv_file_path, xml_folder_path, output_csv):
     ]
 
     failed_pmcids = []
-    processed_data = []
 
-    # Process each row
-    for _, row in df.iterrows():
+    # Finished papers are appended here one by one; completed ones are skipped on a rerun
+    store = open_store(output_csv, store_path, shard, work_queue)
+    # XML files are looked up by PMCID/PMID in the asset registry (only new or changed files are indexed)
+    registry = open_registry(xml_folder_path, registry_db)
+    # Papers whose XML changed since they were extracted are done again
+    fingerprints = document_fingerprints(df, "PMCID", registry, "xml")
+    df = pending_rows(df, "PMCID", store.completed(fingerprints), shard, limit)
+
+    # Subdomain/disease labels from the abstract; the LLM only gets the remaining fields
+    classifier = load_classifier(classifier_path)
+
+    # Small model first; each tier selects its own context from the full text
+    cascade = Cascade(LLM_METRICS, TASK_FIELDS["additional"],
+                      cascade_tiers(CONTEXT_TOP_K, CONTEXT_TOKEN_BUDGET)) if cascade else None
+
+    # Bibliographic details for every paper, so the LLM loop never waits on NCBI
+    article_details = fetch_article_details(df["PMID"], store_path=pubmed_store) if "PMID" in df.columns else {}
+
+    def prepare(row):
         pmcid = str(row["PMCID"]).strip()
-        
-        # Find corresponding XML file
-        xml_file_path = os.path.join(xml_folder_path, f"{pmcid}.xml")
 
-        extracted_data = extract_full_text(xml_file_path)
-        
-        print(f"Processing {pmcid}...")
+        # The registry matches on the ids inside the XML, not just the file name
+        record = registry.lookup(pmcid=pmcid, pmid=row.get("PMID"), kind="xml")
+        if not record:
+            log.warning("No XML found for %s", pmcid)
+            return {"row": row, "pmcid": pmcid, "text": None}
+        classified = classifier.confident_fields(*paper_text(row)) if classifier else {}
+        fields = [field for field in TASK_FIELDS["additional"] if field not in classified]
+        extracted_data = registered_xml_text(registry, record, xml_cache_dir)
+        if extracted_data and COMPRESS_PROMPTS:
+            extracted_data = COMPRESSOR.compress(pmcid, extracted_data)
+        if extracted_data and CONTEXT_TOP_K and not cascade:
+            extracted_data, stats = select_context(extracted_data, fields=fields,
+                                                   top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                                                   num_ctx=LLM_METRICS.num_ctx)
+            log.debug("Context for %s: %d/%d paragraphs, %d/%d tokens", pmcid, stats["selected"],
+                      stats["paragraphs"], stats["context_tokens"], stats["full_tokens"])
+        return {"row": row, "pmcid": pmcid, "text": extracted_data, "fields": fields, "classified": classified}
+
+    def infer(paper):
+        pmcid = paper["pmcid"]
+        if not paper["text"]:
+            log.warning("No text for %s, skipping LLM extraction.", pmcid)
+            failed_pmcids.append(pmcid)
+            paper["llm_data"] = {}
+            return paper
+        log.debug("Processing %s", pmcid)
         llm_data = None
+        if cascade:
+            llm_data, _ = cascade.extract(pmcid, paper["text"], paper["fields"])
+            paper["llm_data"] = {**(llm_data or {}), **paper["classified"]}
+            if not llm_data:
+                failed_pmcids.append(pmcid)
+            return paper
         for attempt in range(3):
-            llm_data = chat_with_llama(extracted_data)
+            llm_data = chat_with_llama(paper["text"], pmcid, paper["fields"])
 
-            if isinstance(llm_data, dict): 
+            if llm_data:
                 break
             else:
-                print(f"Warning: Invalid LLaMA response (Attempt {attempt+1}/3) for {pmcid}")
+                log.warning("Invalid LLaMA response (attempt %d/3) for %s", attempt + 1, pmcid)
                 time.sleep(2)  # Wait before retrying
 
-        if not isinstance(llm_data, dict): 
-            print(f"Error: LLaMA failed to return valid JSON after 3 attempts for {pmcid}. Skipping...")
+        if not llm_data:
+            log.error("LLaMA failed to return valid JSON after 3 attempts for %s. Skipping...", pmcid)
             failed_pmcids.append(pmcid)
             llm_data = {} 
+        # The classifier's confident labels are kept even when the LLM gave no usable answer
+        paper["llm_data"] = {**(llm_data or {}), **paper["classified"]}
+        return paper
+
+    def assemble(paper):
+        row = paper["row"]
+        llm_data = paper["llm_data"]
         # Extract metadata
         metadata = {
             "Authors": row.get("Authors", ""),
@@ -211,7 +240,8 @@ def process_papers(csv_file_path, xml_folder_path, output_csv):
 
         if llm_data:
             metadata.update({
-            "Subdomain": llm_data.get("subdomain", "null"),
+            # The prompt asks for "virology_subdomain"; older replies used "subdomain"
+            "Subdomain": llm_data.get("virology_subdomain", llm_data.get("subdomain", "null")),
             "Disease Name": llm_data.get("disease_name", "null"),
             "Research Aim": llm_data.get("research_aim", "null"),
             "Research Problem": llm_data.get("research_problem", "null"),
@@ -225,27 +255,67 @@ def process_papers(csv_file_path, xml_folder_path, output_csv):
             "Dataset Name": llm_data.get("dataset_name", "null")
             })     
 
-        # Extract primary author's affiliation and publication type using MetaPub
-        pmid = row.get("PMID", "")
+        # Primary author's affiliation and publication type from the prefetched PubMed records
+        pmid = normalize_pmid(row.get("PMID"))
         if pmid:
-            article_details = get_article_details(pmid)
-            metadata["Primary affiliation of primary author"] = article_details["primary_author_affiliation"]
-            metadata["Type of Evidence Source"] = article_details["publication_types"]
-
-        # Append to results
-        processed_data.append(metadata)
-        print(processed_data)
-
-    # Save processed data to CSV
-    output_df = pd.DataFrame(processed_data, columns=columns)
-    #print(processed_data)
-    output_df.to_csv(output_csv, index=False, encoding='utf-8')
-    print(f"Processing complete. Results saved to {output_csv}")
-
-# Example usage
-csv_file_path = "D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/final_outputandcode/missed_data.csv"
-xml_folder_path = "D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_outputs"
-output_csv = "D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/final_outputandcode/Extracted_fields.csv"
-
-# Run processing
-process_papers(csv_file_path, xml_folder_path, output_csv)
+            details = article_details.get(pmid, NOT_FOUND)
+            if details is FETCH_FAILED:
+                # NCBI could not be reached; the paper is done again on the next run
+                failed_pmcids.append(pmcid)
+            metadata["Primary affiliation of primary author"] = details["primary_author_affiliation"]
+            metadata["Type of Evidence Source"] = details["publication_types"]
+        return metadata
+
+    stages = [
+        Stage("prepare", prepare, workers=PREP_WORKERS, queue_size=PREFETCH_PAPERS),
+        Stage("infer", infer, queue_size=PREFETCH_PAPERS),
+        Stage("assemble", assemble, queue_size=PREFETCH_PAPERS),
+    ]
+    # Claimed from the queue one by one with --queue, else every pending row
+    rows = store.claim(df, "PMCID", fingerprints)
+    for seq, metadata in run_pipeline((row for _, row in rows), stages, on_drop=rows.dropped):
+        row_index = rows.index[seq]
+        pmcid = str(df.at[row_index, "PMCID"]).strip()
+        store.append(pmcid, int(row_index), {column: metadata.get(column) for column in columns},
+                     ok=pmcid not in failed_pmcids, fingerprint=fingerprints.get(pmcid))
+        log_paper(log, pmcid, "failed" if pmcid in failed_pmcids else "ok")
+        log.debug("Result for %s: %s", pmcid, metadata)
+    log.info("%s", format_report(stages))
+    if classifier:
+        log.info("%s", classifier.summary())
+    if cascade:
+        log.info("%s", cascade.summary())
+    log.info("%s", LLM_METRICS.summary())
+    LLM_METRICS.write_csv(metrics_path(store.path))
+    if COMPRESS_PROMPTS:
+        log.info("%s", COMPRESSOR.summary(LLM_METRICS))
+        COMPRESSOR.write_csv(metrics_path(store.path, "compression"))
+    registry.close()
+
+    # Save processed data to CSV (every paper in the store, in input order)
+    finish_run(store, output_csv, shard, columns, records_path, "additional")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract additional fields from PMC XML papers with LLaMA.")
+    parser.add_argument("--input", default="D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/final_outputandcode/missed_data.csv")
+    parser.add_argument("--xml-dir", default="D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_outputs")
+    parser.add_argument("--xml-cache", default="D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_cache")
+    parser.add_argument("--pubmed-store", default=DEFAULT_STORE,
+                        help="PubMed details store, shared with step 01 (default: data/pubmed/pubmed_details.json)")
+    parser.add_argument("--output", default="D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/final_outputandcode/Extracted_fields.csv")
+    parser.add_argument("--classifier", help="field classifier from python -m pipeline.field_classifier train; "
+                                             "confident subdomain/disease labels skip the LLM")
+    parser.add_argument("--cascade", action="store_true",
+                        help="answer with a smaller model first and escalate only low-confidence papers")
+    add_run_arguments(parser)
+    add_trace_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    start_tracing(args)
+    setup_logging(args.log_file or log_path(args.output, args.shard, args.queue and args.worker_id), args.log_level)
+
+    # Run processing
+    process_papers(args.input, args.xml_dir, args.output, args.xml_cache, args.pubmed_store,
+                   store_path=args.store, shard=args.shard, limit=args.limit, classifier_path=args.classifier, cascade=args.cascade, records_path=args.records,
+                   registry_db=args.registry_db,
+                   work_queue=queue_settings(args))
@@ -1,13 +1,58 @@
-import os
+import argparse
+import logging
 import re
+import sys
 import pandas as pd
 import json
 import time
-import xml.etree.ElementTree as ET
-import ollama
+from pathlib import Path
+
+# Make the shared pipeline helpers importable when run as a plain script
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from pipeline.assets import open_registry
+from pipeline.documents import registered_xml_text
+from pipeline.jats import parse_cached
+from pipeline.context_selection import select_context
+from pipeline.compression import XML_COMPRESSION_CONFIG, PromptCompressor
+from pipeline.metric_miner import mine_paper
+from pipeline.prompts import build_messages
+from pipeline.staged import Stage, format_report, run_pipeline
+from pipeline.run_store import add_run_arguments, document_fingerprints, finish_run, open_store, pending_rows
+from pipeline.work_queue import queue_settings
+from pipeline.logs import add_logging_arguments, log_path, log_paper, setup_logging
+from pipeline.tracing import add_trace_arguments, start_tracing, traced
+from pipeline.llm_client import LLMMetrics, PARSE_ERROR, PARSE_INVALID_JSON, PARSE_NO_JSON, PARSE_OK, metrics_path
+
+# Metrics found in the tables/text fill "Was Performance Measured" and
+# "Performance Results" directly; the LLM then only describes the evaluation.
+USE_METRIC_MINER = True
+
+# Retrieval-guided context: top-k paragraphs per field within a token budget,
+# lowered to what fits the LLM context window (OLLAMA_NUM_CTX) next to the prompt.
+# Set CONTEXT_TOP_K = None to send the whole paper.
+CONTEXT_TOP_K = 4
+CONTEXT_TOKEN_BUDGET = 3000
+
+# Author lists, funding/competing-interest statements, license banners and
+# repeated page headers are removed before context selection.
+COMPRESS_PROMPTS = True
+
+# Papers are parsed and their prompts built while earlier papers are in
+# inference; PREFETCH_PAPERS bounds how far ahead each stage may run.
+PREP_WORKERS = 2
+PREFETCH_PAPERS = 4
+
+# Token counts, durations and parse outcome of every LLM call, per paper
+LLM_METRICS = LLMMetrics()
+# Original vs compressed token count of every paper's text
+COMPRESSOR = PromptCompressor(XML_COMPRESSION_CONFIG)
+
+# Console and rotating JSON-lines run log, set up in __main__ (see pipeline/logs.py)
+log = logging.getLogger("step03")
 
 # Function to interact with LLaMA 3.2 3B
-def chat_with_llama(full_text):
+@traced("llm.chat_with_llama")
+def chat_with_llama(full_text, paper_id=None, fields=None):
     user_prompt = {
         "role": "user",
         "content": (
@@ -39,90 +84,167 @@ def chat_with_llama(full_text):
         "role": "system",
         "content": "You are an AI assistant specializing in AI research paper analysis. Extract only the required structured information and return valid JSON."
     }
+    if fields:
+        # Only the fields the metric miner left open (the measurement details)
+        messages = build_messages(full_text, fields)
+    else:
+        messages = [system_prompt, user_prompt]
 
     try:
-        response = ollama.chat(
-            model="llama3.2:3b",
-            messages=[system_prompt, user_prompt],
+        response = LLM_METRICS.chat(
+            paper_id,
+            messages=messages,
             options={"temperature": 0}
         )
         response_text = response["message"]["content"].strip()
-        print(response_text)
+        log.debug("LLaMA reply for %s: %s", paper_id, response_text)
         json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
         if json_match:
-            return json.loads(json_match.group(0))
+            data = json.loads(json_match.group(0))
+            LLM_METRICS.record_outcome(paper_id, PARSE_OK)
+            return data
         else:
-            print("Warning: LLaMA response did not contain valid JSON.")
+            log.warning("LLaMA response for %s did not contain valid JSON.", paper_id)
+            LLM_METRICS.record_outcome(paper_id, PARSE_NO_JSON)
             return {}
     except json.JSONDecodeError:
-        print("Error: LLaMA returned invalid JSON.")
+        log.warning("LLaMA returned invalid JSON for %s.", paper_id)
+        LLM_METRICS.record_outcome(paper_id, PARSE_INVALID_JSON)
         return {}
     except Exception as e:
-        print(f"Error interacting with LLaMA: {e}")
+        log.warning("Error interacting with LLaMA for %s: %s", paper_id, e)
+        LLM_METRICS.record_outcome(paper_id, PARSE_ERROR)
         return {}
 
-def extract_full_text(xml_file):
-    """Extracts full text content from an XML research paper and truncates it before the 'References' section."""
-    try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-        full_text = " ".join(elem.text.strip() for elem in root.iter() if elem.text)
-        truncated_text = re.split(r'<title>\s*References\s*</title>|References', full_text, maxsplit=1, flags=re.IGNORECASE)[0]
-        return truncated_text.strip()
-    except Exception as e:
-        print(f"Error parsing XML: {e}")
-        return None
+def process_papers(csv_file_path, xml_folder_path, output_csv, xml_cache_dir=None, registry_db=None,
+                   store_path=None, shard=None, limit=None, records_path=None, work_queue=None):
+    """Reads PMCID from CSV, extracts metadata, processes XML, and saves performance evaluation results.
 
-def process_papers(csv_file_path, xml_folder_path, output_csv):
-    """Reads PMCID from CSV, extracts metadata, processes XML, and saves performance evaluation results."""
-    # Read only the first 4 rows of the CSV file
+    XML parsing and context selection for the next papers overlap with LLM
+    inference of the current one (bounded queues between the stages).
+
+    Each finished paper is appended to a JSONL store (``store_path``) right away;
+    a rerun skips the papers already in it. ``shard=(i, N)`` processes only
+    shard i of N, and ``limit`` caps the number of papers in this run. With
+    ``work_queue`` (see pipeline/work_queue.py) the papers are instead claimed
+    from a queue shared with other workers, which also stores the results.
+    ``records_path`` also records the results in the shared record store
+    (see pipeline/record_store.py).
+    """
     df = pd.read_csv(csv_file_path)
-    df = df.tail(13)
     
     if 'PMCID' not in df.columns:
-        print("Error: PMCID column not found in CSV file.")
+        log.error("PMCID column not found in CSV file.")
         return
 
-    processed_data = []
     failed_pmcids = []
-    
-    for _, row in df.iterrows():
+    columns = ["PMCID", "Was Performance Measured", "Performance Results", "Performance Measurement Details"]
+
+    # Finished papers are appended here one by one; completed ones are skipped on a rerun
+    store = open_store(output_csv, store_path, shard, work_queue)
+    # XML files are looked up by PMCID/PMID in the asset registry (only new or changed files are indexed)
+    registry = open_registry(xml_folder_path, registry_db)
+    # Papers whose XML changed since they were extracted are done again
+    fingerprints = document_fingerprints(df, "PMCID", registry, "xml")
+    df = pending_rows(df, "PMCID", store.completed(fingerprints), shard, limit)
+    mined_pmcids = []
+
+    def prepare(row):
         pmcid = str(row["PMCID"]).strip()
-        xml_file_path = os.path.join(xml_folder_path, f"{pmcid}.xml")
-        extracted_data = extract_full_text(xml_file_path)
-        
-        print(f"Processing {pmcid}...")
-        llm_data = None
-        
-        for attempt in range(3):
-            llm_data = chat_with_llama(extracted_data)
-            if isinstance(llm_data, dict): 
-                break
-            print(f"Warning: Invalid LLaMA response (Attempt {attempt+1}/3) for {pmcid}")
-            time.sleep(2)
-
-        if not isinstance(llm_data, dict):
-            print(f"Error: LLaMA failed to return valid JSON after 3 attempts for {pmcid}. Skipping...")
+
+        # The registry matches on the ids inside the XML, not just the file name
+        record = registry.lookup(pmcid=pmcid, pmid=row.get("PMID"), kind="xml")
+        if not record:
+            log.warning("No XML found for %s", pmcid)
+            return {"pmcid": pmcid, "text": None, "mined": None, "fields": None}
+        extracted_data = registered_xml_text(registry, record, xml_cache_dir)
+        if extracted_data and COMPRESS_PROMPTS:
+            extracted_data = COMPRESSOR.compress(pmcid, extracted_data)
+        mined = None
+        if extracted_data and USE_METRIC_MINER:
+            mined = mine_paper(parse_cached(record["path"], xml_cache_dir))
+            if not mined["confident"]:
+                mined = None
+        fields = ["performance_measurement_details"] if mined else None
+        if extracted_data and CONTEXT_TOP_K:
+            extracted_data, stats = select_context(extracted_data, task="performance", fields=fields,
+                                                   top_k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                                                   num_ctx=LLM_METRICS.num_ctx)
+            log.debug("Context for %s: %d/%d paragraphs, %d/%d tokens", pmcid, stats["selected"],
+                      stats["paragraphs"], stats["context_tokens"], stats["full_tokens"])
+        return {"pmcid": pmcid, "text": extracted_data, "mined": mined, "fields": fields}
+
+    def infer(paper):
+        pmcid = paper["pmcid"]
+        if not paper["text"]:
+            log.warning("No text for %s, skipping LLM extraction.", pmcid)
             failed_pmcids.append(pmcid)
             llm_data = {}
-        
-        metadata = {
+        else:
+            log.debug("Processing %s", pmcid)
+            llm_data = None
+            for attempt in range(3):
+                llm_data = chat_with_llama(paper["text"], pmcid, paper["fields"])
+                if llm_data:
+                    break
+                log.warning("Invalid LLaMA response (attempt %d/3) for %s", attempt + 1, pmcid)
+                time.sleep(2)
+
+            if not llm_data:
+                log.error("LLaMA failed to return valid JSON after 3 attempts for %s. Skipping...", pmcid)
+                failed_pmcids.append(pmcid)
+                llm_data = {}
+
+        if paper["mined"]:
+            mined_pmcids.append(pmcid)
+            llm_data = {**llm_data, "was_performance_measured": "Yes",
+                        "performance_results": paper["mined"]["results"]}
+        return {
             "PMCID": pmcid,
             "Was Performance Measured": llm_data.get("was_performance_measured", "null"),
             "Performance Results": llm_data.get("performance_results", {}),
             "Performance Measurement Details": llm_data.get("performance_measurement_details", "Not specified")
         }
-        
-        processed_data.append(metadata)
-        print(processed_data)
-    
-    output_df = pd.DataFrame(processed_data, columns=["PMCID", "Was Performance Measured", "Performance Results", "Performance Measurement Details"])
-    output_df.to_csv(output_csv, index=False)
-    print(f"Processing complete. Results saved to {output_csv}")
 
-# Example usage
-csv_file_path = "D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/dataset/OutputOfEmbedding2WithoutFalsePositive.csv"
-xml_folder_path = "D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_outputs"
-output_csv = "D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/Performance_metrics.csv"
+    stages = [
+        Stage("prepare", prepare, workers=PREP_WORKERS, queue_size=PREFETCH_PAPERS),
+        Stage("infer", infer, queue_size=PREFETCH_PAPERS),
+    ]
+    # Claimed from the queue one by one with --queue, else every pending row
+    rows = store.claim(df, "PMCID", fingerprints)
+    for seq, metadata in run_pipeline((row for _, row in rows), stages, on_drop=rows.dropped):
+        pmcid = metadata["PMCID"]
+        store.append(pmcid, int(rows.index[seq]), metadata, ok=pmcid not in failed_pmcids,
+                     fingerprint=fingerprints.get(pmcid))
+        log_paper(log, pmcid, "failed" if pmcid in failed_pmcids else "ok",
+                  measured=metadata["Was Performance Measured"], mined=pmcid in mined_pmcids)
+        log.debug("Result for %s: %s", pmcid, metadata)
+    log.info("%s", format_report(stages))
+    if USE_METRIC_MINER:
+        log.info("Metric miner filled the performance results of %d/%d papers", len(mined_pmcids), len(df))
+    log.info("%s", LLM_METRICS.summary())
+    LLM_METRICS.write_csv(metrics_path(store.path))
+    if COMPRESS_PROMPTS:
+        log.info("%s", COMPRESSOR.summary(LLM_METRICS))
+        COMPRESSOR.write_csv(metrics_path(store.path, "compression"))
+    registry.close()
+
+    finish_run(store, output_csv, shard, columns, records_path, "performance")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract performance metrics from PMC XML papers with LLaMA.")
+    parser.add_argument("--input", default="D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/dataset/OutputOfEmbedding2WithoutFalsePositive.csv")
+    parser.add_argument("--xml-dir", default="D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_outputs")
+    parser.add_argument("--xml-cache", default="D:/studentassistant/student_assistanttask2/working_dir/virology-ai-papers/xml_cache")
+    parser.add_argument("--output", default="D:/studentassistant/student_assistanttask2/virology-ai-papers/scripts/codes/testLlama/Performance_metrics.csv")
+    add_run_arguments(parser)
+    add_trace_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    start_tracing(args)
+    setup_logging(args.log_file or log_path(args.output, args.shard, args.queue and args.worker_id), args.log_level)
 
-process_papers(csv_file_path, xml_folder_path, output_csv)
+    process_papers(args.input, args.xml_dir, args.output, args.xml_cache,
+                   store_path=args.store, shard=args.shard, limit=args.limit, records_path=args.records,
+                   registry_db=args.registry_db,
+                   work_queue=queue_settings(args))
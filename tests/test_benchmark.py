@@ -0,0 +1,15 @@
+"""Result rows and curves of the throughput benchmark (``pipeline.benchmark``)."""
+import os
+import sys
+
+from pipeline.benchmark import format_curves, measure
+
+
+def test_measure_without_wait4_leaves_rss_empty(tmp_path, monkeypatch):
+    # As on Windows, without psutil installed
+    monkeypatch.delattr(os, "wait4", raising=False)
+    monkeypatch.setitem(sys.modules, "psutil", None)
+    row = measure("text_xml", 3, [sys.executable, "-c", "raise SystemExit(3)"], tmp_path / "run.log")
+    assert row["returncode"] == 3 and row["peak_rss_mb"] == ""
+    ok = dict(row, returncode=0)
+    assert "n/a" in format_curves([ok])
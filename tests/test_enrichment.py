@@ -0,0 +1,33 @@
+"""Batched EFetch with a local store (``pipeline.enrichment``)."""
+import pytest
+
+pytest.importorskip("requests")
+
+from pipeline import enrichment  # noqa: E402
+from pipeline.enrichment import FETCH_FAILED, NOT_FOUND, fetch_article_details, load_store  # noqa: E402
+
+RECORD = {"primary_author_affiliation": "Institute", "publication_types": "Journal Article"}
+
+
+def test_failed_batch_is_retried_and_not_stored_as_missing(tmp_path, monkeypatch):
+    calls = []
+
+    def efetch(batch, api_key=None):
+        calls.append(list(batch))
+        # The first round fails, the retry round finds one of the two PMIDs
+        return None if len(calls) == 1 else {"1": RECORD}
+
+    monkeypatch.setattr(enrichment, "efetch_batch", efetch)
+    monkeypatch.setattr(enrichment.time, "sleep", lambda seconds: None)
+    store = str(tmp_path / "details.json")
+    assert fetch_article_details([1, "2"], store_path=store) == {"1": RECORD, "2": NOT_FOUND}
+    assert calls == [["1", "2"], ["1", "2"]]
+    assert load_store(store) == {"1": RECORD, "2": NOT_FOUND}
+
+
+def test_pmids_that_keep_failing_are_marked_and_fetched_next_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(enrichment, "efetch_batch", lambda batch, api_key=None: None)
+    monkeypatch.setattr(enrichment.time, "sleep", lambda seconds: None)
+    store = str(tmp_path / "details.json")
+    assert fetch_article_details(["1"], store_path=store) == {"1": FETCH_FAILED}
+    assert load_store(store) == {}
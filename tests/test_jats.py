@@ -0,0 +1,39 @@
+"""Section and inline-element handling of the JATS parser (``pipeline.jats``)."""
+import io
+
+from pipeline.jats import parse_jats
+
+ARTICLE = b"""<article>
+<front><article-meta>
+  <title-group><article-title>Title</article-title></title-group>
+  <trans-abstract><sec><title>Resumen</title><p>Otro idioma.</p></sec></trans-abstract>
+</article-meta></front>
+<body>
+  <p>Introduction.</p>
+  <sec><title>Methods</title>
+    <p>We used a CNN.<table-wrap><label>Table 1</label><table><tr><td>AUC</td><td>0.9</td></tr></table></table-wrap> After the table.</p>
+    <p>See<fig><caption>Scans</caption></fig> the figure.</p>
+  </sec>
+  <sec><title>Results</title><p>Accuracy was high.</p></sec>
+</body>
+</article>"""
+
+
+def sections(doc):
+    return [(section["title"], section["paragraphs"]) for section in doc["sections"]]
+
+
+def test_text_after_tables_and_figures_is_kept():
+    doc = parse_jats(io.BytesIO(ARTICLE))
+    assert ("Methods", ["We used a CNN. After the table.", "See the figure."]) in sections(doc)
+    assert doc["tables"][0]["rows"] == [["AUC", "0.9"]]
+    assert doc["figures"][0]["caption"] == "Scans"
+
+
+def test_section_outside_the_body_does_not_swallow_the_body():
+    doc = parse_jats(io.BytesIO(ARTICLE))
+    assert sections(doc) == [
+        ("", ["Introduction."]),
+        ("Methods", ["We used a CNN. After the table.", "See the figure."]),
+        ("Results", ["Accuracy was high."]),
+    ]
@@ -0,0 +1,108 @@
+"""Pack append, refresh and compact (``pipeline.packs``)."""
+import os
+
+import pytest
+
+pytest.importorskip("zstandard")
+
+from pipeline.packs import Pack, compact, folder_documents, pack_documents, verify  # noqa: E402
+
+XML = b"<article>" + b"text " * 400 + b"</article>"
+
+
+@pytest.fixture
+def pack_path(tmp_path):
+    return str(tmp_path / "documents.pack")
+
+
+def test_append_and_read(pack_path):
+    with Pack(pack_path) as pack:
+        pack.append("PMC1.xml", XML)
+        pack.append("paper.pdf", os.urandom(300))
+        assert pack.entries["PMC1.xml"].codec == "zstd"
+        assert pack.entries["paper.pdf"].codec == "raw"
+        assert pack.read("PMC1.xml") == XML
+
+
+def test_refresh_sees_appends_of_another_writer(pack_path):
+    with Pack(pack_path) as writer:
+        writer.append("PMC1.xml", XML)
+        reader = Pack(pack_path)
+        writer.append("PMC2.xml", XML + b"2")
+        assert "PMC2.xml" not in reader
+        reader.refresh()
+        assert reader.read("PMC2.xml") == XML + b"2"
+        reader.close()
+
+
+def test_refresh_skips_bytes_that_never_reached_the_pack(pack_path):
+    with Pack(pack_path) as pack:
+        pack.append("PMC1.xml", XML)
+    with open(pack_path + ".idx", "a", encoding="utf-8") as f:
+        f.write("PMC2.xml\t999999\t10\t10\traw\t0\tabc\n")
+    with Pack(pack_path) as pack:
+        assert list(pack.entries) == ["PMC1.xml"]
+
+
+def test_damaged_document_is_not_returned(pack_path):
+    with Pack(pack_path) as pack:
+        entry = pack.append("paper.pdf", os.urandom(300))
+    with open(pack_path, "r+b") as f:
+        f.seek(entry.offset)
+        f.write(b"\0\0\0\0")
+    with Pack(pack_path) as pack, pytest.raises(OSError):
+        pack.read("paper.pdf")
+    assert verify(pack_path) == ["paper.pdf"]
+
+
+def test_compact_keeps_current_copies(pack_path, tmp_path):
+    with Pack(pack_path) as pack:
+        pack.append("PMC1.xml", XML)
+        pack.append("PMC2.xml", XML + b"2")
+        pack.append("PMC1.xml", XML + b"new")
+    reader = Pack(pack_path)
+    assert compact(pack_path) > 0
+    assert sorted(os.listdir(tmp_path)) == ["documents.pack.1", "documents.pack.idx"]
+    with Pack(pack_path) as pack:
+        assert pack.read("PMC1.xml") == XML + b"new"
+        assert pack.read("PMC2.xml") == XML + b"2"
+        assert pack.stats()["pack_bytes"] == pack.stats()["stored"]
+        # Appends after a compaction go to the new pack file
+        pack.append("PMC3.xml", XML + b"3")
+    # A reader opened before the compaction switches over on refresh
+    reader.refresh()
+    assert reader.read("PMC3.xml") == XML + b"3"
+    reader.close()
+    assert sorted(path for path, *_ in pack_documents(str(tmp_path))) == [
+        f"{pack_path}#PMC1.xml", f"{pack_path}#PMC2.xml", f"{pack_path}#PMC3.xml"]
+
+
+def test_compact_interrupted_before_switch_leaves_old_pack(pack_path, monkeypatch):
+    with Pack(pack_path) as pack:
+        pack.append("PMC1.xml", XML)
+        pack.append("PMC1.xml", XML + b"new")
+
+    def crash(src, dst):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(KeyboardInterrupt):
+        compact(pack_path)
+    monkeypatch.undo()
+    with Pack(pack_path) as pack:
+        assert pack.data_path == pack_path
+        assert pack.read("PMC1.xml") == XML + b"new"
+    # The next compaction cleans up after the interrupted one
+    compact(pack_path)
+    with Pack(pack_path) as pack:
+        assert pack.generation == 1 and pack.read("PMC1.xml") == XML + b"new"
+
+
+def test_folder_documents_lists_loose_and_packed_files(tmp_path):
+    with Pack(str(tmp_path / "documents.pack")) as pack:
+        pack.append("PMC1.xml", XML)
+        pack.append("PMC2.xml", XML)
+    (tmp_path / "PMC2.xml").write_bytes(XML)
+    (tmp_path / "paper.pdf").write_bytes(b"%PDF")
+    assert folder_documents(str(tmp_path), ".xml") == [
+        str(tmp_path / "PMC2.xml"), f"{tmp_path / 'documents.pack'}#PMC1.xml"]
@@ -0,0 +1,27 @@
+"""Ordering and error handling of the staged pipeline (``pipeline.staged``)."""
+import sqlite3
+
+import pytest
+
+from pipeline.staged import Stage, run_pipeline
+
+
+def test_results_arrive_in_input_order():
+    stages = [Stage("double", lambda x: 2 * x), Stage("drop_odd", lambda x: x if x % 4 == 0 else None)]
+    dropped = []
+    results = list(run_pipeline(range(6), stages, on_drop=dropped.append))
+    assert results == [(0, 0), (2, 4), (4, 8)]
+    assert dropped == [1, 3, 5]
+
+
+def test_error_in_the_inputs_reaches_the_caller():
+    def items():
+        yield 1
+        raise sqlite3.OperationalError("database is locked")
+
+    results = []
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        for _, result in run_pipeline(items(), [Stage("double", lambda x: 2 * x)]):
+            results.append(result)
+    # Items read before the error still go through
+    assert results == [2]
@@ -0,0 +1,124 @@
+"""Leases, fail-over and results of the shared work queue (``pipeline.work_queue``)."""
+import sqlite3
+import time
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from pipeline.run_store import read_records  # noqa: E402
+from pipeline.work_queue import WorkQueue, update_results  # noqa: E402
+
+LEASE = 0.2
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "queue.sqlite")
+
+
+@pytest.fixture
+def papers():
+    return pd.DataFrame({"PMCID": ["PMC1", "PMC2"], "Title": ["First", "Second"]})
+
+
+def worker(path, name, **kwargs):
+    return WorkQueue(path, worker=name, lease_seconds=LEASE, poll_seconds=0.05, **kwargs)
+
+
+def task(path, paper_id):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return dict(conn.execute("SELECT * FROM tasks WHERE paper_id = ?", (paper_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def stall(queue):
+    """Stop renewing the leases of ``queue``, as when its worker hangs or dies."""
+    queue._stop.set()
+    queue._heartbeat.join()
+
+
+def test_expired_lease_is_claimed_again(queue_path, papers):
+    first = worker(queue_path, "a")
+    assert next(iter(first.claim(papers, "PMCID")))[1]["PMCID"] == "PMC1"
+    stall(first)
+    time.sleep(LEASE * 1.5)
+
+    second = worker(queue_path, "b")
+    assert next(iter(second.claim(papers, "PMCID")))[1]["PMCID"] == "PMC1"
+    assert task(queue_path, "PMC1")["worker"] == "b"
+    assert task(queue_path, "PMC1")["attempts"] == 2
+    second.close()
+    first.close()
+
+
+def test_leases_are_renewed_while_the_worker_runs(queue_path, papers):
+    first = worker(queue_path, "a")
+    next(iter(first.claim(papers, "PMCID")))
+    time.sleep(LEASE * 2)
+    assert task(queue_path, "PMC1")["lease_until"] > time.time()
+    first.close()
+
+
+def test_paper_fails_after_max_attempts(queue_path, papers):
+    papers = papers.head(1)
+    for name in ("a", "b"):
+        queue = worker(queue_path, name, max_attempts=2)
+        assert next(iter(queue.claim(papers, "PMCID")))[1]["PMCID"] == "PMC1"
+        stall(queue)
+        queue.close()
+        time.sleep(LEASE * 1.5)
+
+    last = worker(queue_path, "c", max_attempts=2)
+    assert list(last.claim(papers, "PMCID")) == []
+    last.close()
+    failed = task(queue_path, "PMC1")
+    assert failed["state"] == "failed" and failed["error"] == "lease expired 2 times"
+
+
+def test_first_result_wins(queue_path, papers):
+    papers = papers.head(1)
+    slow = worker(queue_path, "slow")
+    next(iter(slow.claim(papers, "PMCID")))
+    stall(slow)
+    time.sleep(LEASE * 1.5)
+
+    fast = worker(queue_path, "fast")
+    for seq, (_, row) in enumerate(fast.claim(papers, "PMCID")):
+        fast.append(row["PMCID"], seq, {"PMCID": row["PMCID"], "result": "fast"})
+    fast.close()
+    slow.append("PMC1", 0, {"PMCID": "PMC1", "result": "slow"})
+    slow.close()
+
+    assert [r["row"]["result"] for r in read_records(queue_path)] == ["fast"]
+    assert task(queue_path, "PMC1")["worker"] == "fast"
+
+
+def test_dropped_row_is_released(queue_path, papers):
+    queue = worker(queue_path, "a", claim_ahead=1)
+    feed = queue.claim(papers, "PMCID")
+    rows = iter(feed)
+    next(rows)
+    # A stage dropped the paper (e.g. its document is missing); the slot goes to the next paper
+    feed.dropped(0)
+    assert next(rows)[1]["PMCID"] == "PMC2"
+    queue.append("PMC2", 1, {"PMCID": "PMC2"})
+    queue.close()
+    dropped = task(queue_path, "PMC1")
+    assert dropped["state"] == "failed" and dropped["error"] == "dropped without a result"
+
+
+def test_update_results_overwrites_finished_papers(queue_path, papers):
+    queue = worker(queue_path, "a")
+    for seq, (_, row) in enumerate(queue.claim(papers, "PMCID")):
+        queue.append(row["PMCID"], seq, {"PMCID": row["PMCID"], "field": "null"}, ok=seq == 0)
+    queue.close()
+
+    assert update_results(queue_path, [("PMC2", {"PMCID": "PMC2", "field": "fixed"}, True),
+                                       ("PMC9", {"PMCID": "PMC9"}, True)]) == 1
+    records = {r["id"]: r for r in read_records(queue_path)}
+    assert records["PMC2"]["ok"] and records["PMC2"]["row"]["field"] == "fixed"
+    assert task(queue_path, "PMC2")["state"] == "done"